@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Benchmark della pipeline ingest -> filtro -> scrittura HDF5 -> compressione
+
+Genera payload sintetici in stile /api/states (numero di entità, tasso di
+cambio e mix di valori configurabili), simula una giornata di cicli e
+misura per ogni stadio:
+
+  - tempo totale e latenza per ciclo (p50/p95/max)
+  - throughput (entità/s)
+  - RSS di picco del processo dopo lo stadio
+  - byte prodotti (file HDF5, file compresso)
+
+Senza --start la giornata simulata parte dalla mezzanotte UTC di oggi,
+così i campioni finiscono nel file residente della finestra corrente;
+con un --start passato le misure coprono comunque tutti i file di
+finestra scritti.
+
+Uso:
+  python3 bench_pipeline.py --entities 2000 --cycles 1440 --output run.json
+  python3 bench_pipeline.py --compare base.json run.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_HERE, "..", "rootfs", "usr", "lib"))
+
+import h5py
+import numpy as np
+
+from hdf5_datalogger.compression import compress_file
+from hdf5_datalogger.constants import DEFAULT_INCLUDED_DOMAINS
+from hdf5_datalogger.deadband import DeadbandFilter
+from hdf5_datalogger.domains import build_included_domains, discover_available_domains, group_states_by_domain
+from hdf5_datalogger.filters import filter_states
+from hdf5_datalogger.hdf5_writer import HDF5Writer
+from hdf5_datalogger.rotation import Partitioner, label_window_us, list_data_files
+from hdf5_datalogger.timeutils import epoch_us_to_iso_z, iso_to_epoch_us
+
+STAGES = ("fetch", "filter", "group", "write", "compress")
+
+_ENUMS = ("heat", "cool", "off", "auto", "idle")
+_EXTRA_DOMAINS = ("switch", "automation", "person", "sun")
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss è in KB su Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class SyntheticHA:
+    """
+    Stato sintetico di un'installazione Home Assistant.
+
+    value_mix: frazioni di entità numeriche (sensor con unità), binarie
+    (binary_sensor/light) ed enum (climate); il resto va in domini extra
+    che il filtro scarta. change_rate: probabilità di cambio per ciclo.
+    """
+
+    def __init__(self, entities: int, change_rate: float, value_mix: dict, seed: int = 1):
+        self.rng = random.Random(seed)
+        self.change_rate = change_rate
+        self.states = []
+        n_num = int(entities * value_mix.get("numeric", 0.6))
+        n_bin = int(entities * value_mix.get("binary", 0.2))
+        n_enum = int(entities * value_mix.get("enum", 0.1))
+        n_other = max(0, entities - n_num - n_bin - n_enum)
+        for i in range(n_num):
+            self.states.append(self._entity(f"sensor.power_{i}", f"{self.rng.uniform(0, 3000):.2f}",
+                                            {"unit_of_measurement": "W", "device_class": "power",
+                                             "friendly_name": f"Power {i}", "state_class": "measurement"}))
+        for i in range(n_bin):
+            dom = "binary_sensor" if i % 2 else "light"
+            self.states.append(self._entity(f"{dom}.item_{i}", self.rng.choice(("on", "off")),
+                                            {"friendly_name": f"Item {i}"}))
+        for i in range(n_enum):
+            self.states.append(self._entity(f"climate.zone_{i}", self.rng.choice(_ENUMS),
+                                            {"friendly_name": f"Zone {i}", "current_temperature": 20.5,
+                                             "hvac_modes": list(_ENUMS)}))
+        for i in range(n_other):
+            self.states.append(self._entity(f"{_EXTRA_DOMAINS[i % len(_EXTRA_DOMAINS)]}.x_{i}", "on", {}))
+
+    @staticmethod
+    def _entity(entity_id, state, attrs):
+        return {"entity_id": entity_id, "state": state, "attributes": attrs, "last_changed": None}
+
+    def step(self, now_us: int) -> bytes:
+        """
+        Avanza di un ciclo e ritorna il payload JSON serializzato.
+        """
+        iso = epoch_us_to_iso_z(now_us)
+        for st in self.states:
+            if st["last_changed"] is not None and self.rng.random() >= self.change_rate:
+                continue
+            dom = st["entity_id"].split(".", 1)[0]
+            if dom == "sensor":
+                st["state"] = f"{max(0.0, float(st['state']) + self.rng.gauss(0, 25)):.2f}"
+            elif dom in ("binary_sensor", "light"):
+                st["state"] = "off" if st["state"] == "on" else "on"
+            elif dom == "climate":
+                st["state"] = self.rng.choice(_ENUMS)
+            st["last_changed"] = iso
+        return json.dumps(self.states).encode("utf-8")
+
+
+def _percentiles(samples):
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "max": 0.0}
+    arr = np.asarray(samples) * 1000.0
+    return {
+        "p50": round(float(np.percentile(arr, 50)), 3),
+        "p95": round(float(np.percentile(arr, 95)), 3),
+        "max": round(float(arr.max()), 3),
+    }
+
+
+def run(args) -> dict:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="hdf5_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    prefix = os.path.join(workdir, "hdf5") + "/"
+
+    value_mix = json.loads(args.value_mix)
+    ha = SyntheticHA(args.entities, args.change_rate, value_mix, seed=args.seed)
+    value_filter = DeadbandFilter.from_options({"deadbands": json.loads(args.deadbands)}) if args.deadbands else None
+    writer = HDF5Writer(
+        prefix,
+        last_values_path=os.path.join(workdir, "last_values.json"),
+        wal_path=os.path.join(workdir, "wal.log"),
+        buffer_max_samples=args.buffer_max_samples,
+        buffer_max_age=0,
+        chunk_size=args.chunk_size,
+        timestamp_format=args.timestamp_format,
+        value_filter=value_filter,
+        layout=args.layout,
+        partition_timezone="utc",
+    )
+
+    timings = {s: [] for s in STAGES}
+    rss = {s: 0.0 for s in STAGES}
+    counters = {"appended_points": 0, "skipped_points": 0, "suppressed_deadband": 0, "suppressed_rate": 0}
+    entities_in = 0
+
+    if args.start:
+        now_us = iso_to_epoch_us(args.start)
+    else:
+        now_us = label_window_us(Partitioner("daily", "utc").current())[0]
+    step_us = int(args.interval * 1_000_000)
+    for _ in range(args.cycles):
+        cycle_us = now_us
+        payload = ha.step(cycle_us)
+        now_us += step_us
+
+        t0 = time.perf_counter()
+        states = json.loads(payload)
+        t1 = time.perf_counter()
+        filtered, _ = filter_states(states)
+        t2 = time.perf_counter()
+        available = discover_available_domains(filtered)
+        selected, _ = build_included_domains([], available, DEFAULT_INCLUDED_DOMAINS)
+        grouped = group_states_by_domain(filtered, selected)
+        flat = [st for ents in grouped.values() for st in ents]
+        t3 = time.perf_counter()
+        stats = writer.append(flat, timestamp_key="last_changed", ts_now=cycle_us)
+        t4 = time.perf_counter()
+
+        for stage, dt in zip(("fetch", "filter", "group", "write"), (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+            timings[stage].append(dt)
+        for stage in ("fetch", "filter", "group", "write"):
+            rss[stage] = max(rss[stage], _peak_rss_mb())
+        for k in counters:
+            counters[k] += stats.get(k, 0)
+        entities_in += len(states)
+
+    t0 = time.perf_counter()
+    writer.close()
+    timings["write"].append(time.perf_counter() - t0)
+    # file di finestra effettivamente scritti (uno per giorno simulato)
+    raw_paths = [path for _, _, path in list_data_files(prefix)]
+    raw_bytes = sum(os.path.getsize(path) for path in raw_paths)
+
+    compressed_bytes = 0
+    for raw_path in raw_paths:
+        compressed_path = raw_path + ".bench_compressed"
+        t0 = time.perf_counter()
+        compress_file(raw_path, compressed_path, codec=args.codec, level=args.level, workers=args.workers)
+        timings["compress"].append(time.perf_counter() - t0)
+        compressed_bytes += os.path.getsize(compressed_path)
+    rss["compress"] = _peak_rss_mb()
+
+    stages = {}
+    for stage in STAGES:
+        total = sum(timings[stage])
+        stages[stage] = {
+            "total_s": round(total, 4),
+            "per_cycle_ms": _percentiles(timings[stage]),
+            "entities_per_s": round(entities_in / total, 1) if total and stage != "compress" else None,
+            "peak_rss_mb": round(rss[stage], 1),
+        }
+    stages["write"]["output_bytes"] = raw_bytes
+    stages["write"]["files"] = len(raw_paths)
+    stages["compress"]["output_bytes"] = compressed_bytes
+    stages["compress"]["mb_per_s"] = round(raw_bytes / 1048576 / max(sum(timings["compress"]), 1e-9), 2)
+
+    result = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "environment": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "h5py": h5py.version.version,
+            "hdf5": h5py.version.hdf5_version,
+            "numpy": np.__version__,
+        },
+        "counters": counters,
+        "entities_processed": entities_in,
+        "stages": stages,
+    }
+
+    if not args.workdir and not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def compare(base_path: str, new_path: str) -> None:
+    with open(base_path, "r", encoding="utf-8") as fh:
+        base = json.load(fh)
+    with open(new_path, "r", encoding="utf-8") as fh:
+        new = json.load(fh)
+    print(f"{'stage':<10} {'metric':<14} {'base':>12} {'new':>12} {'ratio':>8}")
+    for stage in STAGES:
+        b, n = base["stages"].get(stage, {}), new["stages"].get(stage, {})
+        for metric, getter in (
+            ("total_s", lambda d: d.get("total_s")),
+            ("p95_ms", lambda d: d.get("per_cycle_ms", {}).get("p95")),
+            ("peak_rss_mb", lambda d: d.get("peak_rss_mb")),
+            ("output_bytes", lambda d: d.get("output_bytes")),
+        ):
+            bv, nv = getter(b), getter(n)
+            if bv is None or nv is None:
+                continue
+            ratio = f"{nv / bv:.2f}x" if bv else "-"
+            print(f"{stage:<10} {metric:<14} {bv:>12} {nv:>12} {ratio:>8}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark pipeline HDF5 DataLogger")
+    ap.add_argument("--entities", type=int, default=2000)
+    ap.add_argument("--change-rate", type=float, default=0.3)
+    ap.add_argument("--value-mix", default='{"numeric": 0.6, "binary": 0.2, "enum": 0.1}',
+                    help="JSON con le frazioni numeric/binary/enum (il resto: domini esclusi)")
+    ap.add_argument("--cycles", type=int, default=1440, help="cicli simulati (1440 x 60s = un giorno)")
+    ap.add_argument("--interval", type=float, default=60.0, help="secondi simulati tra i cicli")
+    ap.add_argument("--start", default="", help="inizio simulato ISO (default: mezzanotte UTC di oggi)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--buffer-max-samples", type=int, default=60)
+    ap.add_argument("--chunk-size", type=int, default=1024)
+    ap.add_argument("--timestamp-format", default="epoch_us")
+    ap.add_argument("--layout", default="per_entity")
+    ap.add_argument("--deadbands", default="", help="regole deadband in JSON (come l'opzione deadbands)")
+    ap.add_argument("--codec", default="gzip")
+    ap.add_argument("--level", type=int, default=4)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--workdir", default="", help="cartella di lavoro (default: temporanea, rimossa)")
+    ap.add_argument("--keep", action="store_true", help="non rimuovere la cartella temporanea")
+    ap.add_argument("--output", default="", help="file JSON dei risultati (default: stdout)")
+    ap.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="confronta due risultati JSON")
+    args = ap.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    result = run(args)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(text + "\n")
+        print(f"[INFO] Risultati scritti in {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,40 @@
 #!/usr/bin/env python3
 """
-HDF5 Compresser - v0.3.0
-
-- Ogni giorno, all'ora compress_time (HH:MM, ora locale container),
-  comprime il file HDF5 del giorno precedente:
-  <output_path_prefix>HDF5_datalogger_<YYYY-MM-DD>.h5
-
-- Flusso:
-  * crea backup .bak
-  * crea file .tmp.h5 compresso (gzip livello 4)
-  * sostituisce l'originale
-  * rimuove il backup se tutto ok
+HDF5 Compresser - v0.4.0
+
+- Comprime i file HDF5 delle finestre chiuse (ore, giorni o settimane,
+  secondo rotation):
+  <output_path_prefix>HDF5_datalogger_<etichetta>.h5
+
+- Scheduling:
+  * all'avvio esegue subito un catch-up: ogni file precedente a oggi
+    senza marker "compressed" entra in coda (giorni persi per riavvii,
+    spegnimenti o sleep lunghi vengono recuperati)
+  * poi dorme fino alla prossima compress_time (HH:MM, ora locale
+    container), con risvegli brevi che ricontrollano l'orologio di parete
+    (cambi di ora legale, sospensioni) e le opzioni
+  * il file della finestra corrente non viene mai compresso; un file
+    ancora bloccato dal logger (handle della finestra non ancora chiuso)
+    o dal backfill è rimandato di RETRY_SECONDS
+
+- Flusso per file:
+  * crea file .tmp compresso (codec/livello configurabili: gzip, lzf,
+    zstd, blosc), copiando i dataset a slice di dimensione limitata
+  * sostituisce l'originale (os.replace atomico: l'originale resta
+    intatto fino all'ultimo passo, quindi non serve un backup)
+  * logga throughput (MB/s) e rapporto di compressione per dataset
+  * con rollups attivo calcola gli aggregati a 1 minuto / 1 ora delle
+    entità numeriche nel file compagno <file>.rollup.h5
+
+- La coda è smaltita da al più compress_workers processi (ripartiti tra
+  file in parallelo e dataset dello stesso file); lo stato della coda è
+  riportato nel log dopo ogni file.
+
+- Dopo la compressione il gestore dello spazio (storage) fonde i mesi
+  chiusi negli archivi mensili, applica la retention per entità, per età e
+  per budget di spazio e riporta l'occupazione del disco per dominio.
 """
 
-import os
 import sys
 import time
 from datetime import datetime, timedelta
@@ -21,138 +42,82 @@ from datetime import datetime, timedelta
 if "/usr/lib" not in sys.path:
     sys.path.insert(0, "/usr/lib")
 
-import h5py
-
 from hdf5_datalogger.config_loader import load_options
-
-def _build_hdf5_path(prefix: str, date_str: str) -> str:
-    filename = f"HDF5_datalogger_{date_str}.h5"
-    if prefix.endswith("/") or prefix.endswith("\\"):
-        return prefix + filename
-    return os.path.join(prefix, filename)
-
-def _copy_with_compression(src_path: str, tmp_path: str) -> None:
-    with h5py.File(src_path, "r") as fin, h5py.File(tmp_path, "w") as fout:
-        def _recurse_copy(g_in, g_out):
-            # copia attributi del gruppo
-            for aname, aval in g_in.attrs.items():
-                g_out.attrs[aname] = aval
-            for name, item in g_in.items():
-                if isinstance(item, h5py.Dataset):
-                    data = item[()]
-                    # crea dataset compresso (gzip livello 4)
-                    dset = g_out.create_dataset(
-                        name,
-                        data=data,
-                        compression="gzip",
-                        compression_opts=4,
-                    )
-                    for aname, aval in item.attrs.items():
-                        dset.attrs[aname] = aval
-                elif isinstance(item, h5py.Group):
-                    sub = g_out.create_group(name)
-                    _recurse_copy(item, sub)
-        _recurse_copy(fin, fout)
+from hdf5_datalogger.compress_scheduler import RETRY_SECONDS, next_due, pending_files, run_backlog
+from hdf5_datalogger.storage import StorageManager
+
+# risveglio massimo durante l'attesa (s)
+WAKE_INTERVAL = 60
+
+def _compress_settings(opts: dict) -> dict:
+    return {
+        "codec": str(opts.get("compression") or "gzip").strip().lower(),
+        "level": int(opts.get("compression_level", 4)),
+        "workers": max(1, int(opts.get("compress_workers", 2) or 1)),
+        "max_chunk_bytes": max(1, int(opts.get("compress_max_chunk_mb", 16) or 16)) * 1024 * 1024,
+    }
+
+def _load_settings():
+    try:
+        opts = load_options()
+        prefix = opts.get("output_path_prefix") or "/share/hdf5/"
+        compress_time = (opts.get("compress_time") or "02:00").strip()
+        settings = _compress_settings(opts)
+        rollups = bool(opts.get("rollups", True))
+        storage = StorageManager.from_options(opts)
+    except Exception:
+        prefix = "/share/hdf5/"
+        compress_time = "02:00"
+        settings = _compress_settings({})
+        rollups = True
+        storage = StorageManager(prefix)
+    return prefix, compress_time, settings, rollups, storage
+
+def compress_pending() -> int:
+    """
+    Scansione + smaltimento della coda, poi gestione dello spazio.
+    Ritorna il numero di file rimandati (bloccati da un altro processo).
+    """
+    prefix, _, settings, rollups, storage = _load_settings()
+    print("[INFO] ===== HDF5 Compresser =====")
+    print(f"[INFO] Ora locale: {datetime.now().isoformat()}")
+    try:
+        queue, deferred = pending_files(prefix)
+        deferred += run_backlog(queue, settings, rollups)["deferred"]
+    except Exception as e:
+        print(f"[ERROR] Errore nella scansione dei file da comprimere: {e!r}")
+        deferred = 0
+    try:
+        storage.run()
+    except Exception as e:
+        print(f"[ERROR] Errore nella gestione dello spazio: {e!r}")
+    print("[INFO] ===== HDF5 Compresser terminato =====")
+    return deferred
 
 def main():
-    last_compressed_for = None
-
+    # catch-up all'avvio: niente dipende dall'aver "visto" il minuto giusto
+    deferred = compress_pending()
     while True:
-        try:
-            opts = load_options()
-            prefix = opts.get("output_path_prefix") or "/share/hdf5/"
-            compress_time = (opts.get("compress_time") or "02:00").strip()
-        except Exception:
-            prefix = "/share/hdf5/"
-            compress_time = "02:00"
-
-        now = datetime.now()
-        current_hm = now.strftime("%H:%M")
-
-        if current_hm == compress_time:
-            # comprimi il giorno precedente
-            target_date = (now.date() - timedelta(days=1)).isoformat()
-
-            if last_compressed_for == target_date:
-                # già compresso per questa data in questo giro
-                time.sleep(60)
-                continue
-
-            src = _build_hdf5_path(prefix, target_date)
-            if not os.path.exists(src):
-                print(f"[WARNING] Nessun file HDF5 da comprimere per la data {target_date}: {src}")
-                last_compressed_for = target_date
-                time.sleep(60)
-                continue
-
-            backup = src + ".bak"
-            tmp = src + ".tmp"
-
-            print("[INFO] ===== HDF5 Compresser =====")
-            print(f"[INFO] Ora locale: {now.isoformat()}")
-            print(f"[INFO] File da comprimere: {src}")
-            print(f"[INFO] Backup: {backup}")
-            print(f"[INFO] File temporaneo: {tmp}")
-
-            # crea backup
-            try:
-                import shutil
-                shutil.copy2(src, backup)
-            except Exception as e:
-                print(f"[ERROR] Impossibile creare backup {backup}: {e}")
-                last_compressed_for = target_date
-                time.sleep(60)
-                continue
-
-            # comprimi in tmp
-            try:
-                print("[INFO] Inizio compressione (gzip livello 4)...")
-                t0 = time.time()
-                _copy_with_compression(src, tmp)
-                t1 = time.time()
-                size_orig = os.path.getsize(src)
-                size_tmp = os.path.getsize(tmp)
-                print(f"[INFO] Compressione completata in {t1 - t0:.1f}s")
-                print(f"[INFO] Dimensione originale: {size_orig / (1024*1024):.2f} MB")
-                print(f"[INFO] Dimensione compressa: {size_tmp / (1024*1024):.2f} MB")
-                if size_orig > 0:
-                    reduction = 100.0 * (1.0 - (size_tmp / size_orig))
-                    print(f"[INFO] Riduzione: {reduction:.1f}%")
-            except Exception as e:
-                print(f"[ERROR] Errore durante la compressione di {src}: {e}")
-                try:
-                    if os.path.exists(tmp):
-                        os.remove(tmp)
-                except Exception:
-                    pass
-                print(f"[WARNING] File originale e backup mantenuti: {src}, {backup}")
-                last_compressed_for = target_date
-                time.sleep(60)
-                continue
-
-            # sostituisci il file originale con il compresso
-            try:
-                os.replace(tmp, src)
-                print("[INFO] File originale sostituito con la versione compressa.")
-            except Exception as e:
-                print(f"[ERROR] Impossibile sostituire il file originale {src} con {tmp}: {e}")
-                print(f"[WARNING] Backup non rimosso: {backup}")
-                last_compressed_for = target_date
-                time.sleep(60)
-                continue
-
-            # rimuovi backup
-            try:
-                os.remove(backup)
-                print(f"[INFO] Backup rimosso: {backup}")
-            except Exception as e:
-                print(f"[WARNING] Impossibile rimuovere il backup {backup}: {e}")
-
-            print("[INFO] ===== HDF5 Compresser terminato =====")
-            last_compressed_for = target_date
-            time.sleep(60)
-        else:
-            time.sleep(20)
+        _, compress_time, _, _, _ = _load_settings()
+        due = next_due(compress_time)
+        if deferred:
+            # file rimandati: nuovo tentativo dopo che il lock è stato rilasciato
+            due = min(due, datetime.now() + timedelta(seconds=RETRY_SECONDS))
+        print(f"[INFO] Prossima compressione: {due.isoformat(timespec='seconds')}")
+
+        while True:
+            # epoch ricalcolato a ogni risveglio: segue ora legale e salti dell'orologio
+            remaining = due.timestamp() - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, WAKE_INTERVAL))
+            _, new_time, _, _, _ = _load_settings()
+            if new_time != compress_time:
+                compress_time = new_time
+                due = next_due(compress_time)
+                print(f"[INFO] compress_time cambiato: prossima compressione {due.isoformat(timespec='seconds')}")
+
+        deferred = compress_pending()
 
 if __name__ == "__main__":
     main()
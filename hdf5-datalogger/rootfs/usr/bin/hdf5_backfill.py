@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+HDF5 Backfill tool
+
+Importa lo storico del recorder di Home Assistant nei file HDF5 (primo
+avvio dell'add-on o buchi dovuti a un fermo del logger):
+
+  hdf5_backfill.py [--from 2025-01-01] [--to 2025-01-10T12:00] [--days 10]
+                   [--db /share/home-assistant_v2.db] [--slice-hours 6]
+                   [--entities sensor.a,sensor.b] [--workers N]
+                   [--prefix /share/hdf5/] [--force]
+
+Senza --db legge da /api/history/period (serve SUPERVISOR_TOKEN), con --db
+legge direttamente il database SQLite del recorder. L'add-on non ha accesso
+a /config (secrets.yaml, .storage): per --db copiare prima il database in
+/share, ad esempio dall'add-on SSH con
+  sqlite3 /config/home-assistant_v2.db ".backup /share/home-assistant_v2.db"
+(copia coerente anche con Home Assistant in esecuzione). Senza --entities
+importa le entità selezionate dalle opzioni del logger. Senza --from
+importa gli ultimi --days giorni (default 10, il purge_keep_days del
+recorder); la finestra di file corrente è sempre esclusa. Le riesecuzioni
+saltano le finestre già importate (checkpoint in /data).
+
+Può girare con logger e compresser attivi: ogni file è importato sotto lo
+stesso lock per file che usano loro (<file>.h5.lock); i file in uso
+(finestra appena chiusa dal logger, compressione in corso) sono saltati
+con un warning e importati rieseguendo il comando.
+"""
+
+import argparse
+import os
+import sys
+from datetime import datetime
+
+if "/usr/lib" not in sys.path:
+    sys.path.insert(0, "/usr/lib")
+
+from hdf5_datalogger.backfill import (
+    DEFAULT_SLICE_HOURS,
+    ApiHistory,
+    RecorderDatabase,
+    backfill_range,
+    default_start_us,
+)
+from hdf5_datalogger.config_loader import load_options
+from hdf5_datalogger.constants import API_URL, BACKFILL_STATE_PATH
+from hdf5_datalogger.selection import SelectionPlan
+from hdf5_datalogger.timeutils import utc_now_us
+
+def _epoch_us(text: str) -> int:
+    # date o datetime ISO; senza fuso è ora locale
+    return int(datetime.fromisoformat(text).astimezone().timestamp() * 1_000_000)
+
+def main(argv=None):
+    opts = load_options()
+    ap = argparse.ArgumentParser(description="Backfill dello storico del recorder nei file HDF5 DataLogger")
+    ap.add_argument("--from", dest="start", type=_epoch_us, default=None)
+    ap.add_argument("--to", dest="end", type=_epoch_us, default=None)
+    ap.add_argument("--days", type=float, default=10.0, help="giorni da importare senza --from")
+    ap.add_argument("--db", default="", help="copia in /share del database SQLite del recorder (default: API history)")
+    ap.add_argument("--url", default=API_URL, help="URL base dell'API di Home Assistant")
+    ap.add_argument("--slice-hours", type=float, default=DEFAULT_SLICE_HOURS, help="ore per richiesta all'API")
+    ap.add_argument("--entities", default="", help="entity_id separati da virgola (default: selezione del logger)")
+    ap.add_argument("--workers", type=int, default=int(opts.get("compress_workers", 2) or 1))
+    ap.add_argument("--prefix", default=opts.get("output_path_prefix") or "/share/hdf5/")
+    ap.add_argument("--state", default=BACKFILL_STATE_PATH, help="file di checkpoint")
+    ap.add_argument("--force", action="store_true", help="reimporta anche le finestre già importate")
+    args = ap.parse_args(argv)
+
+    if args.db:
+        source = RecorderDatabase(args.db)
+    else:
+        token = os.getenv("SUPERVISOR_TOKEN")
+        if not token:
+            raise SystemExit("ERROR: SUPERVISOR_TOKEN missing. Usa --db per leggere il database del recorder.")
+        source = ApiHistory(token, base_url=args.url, slice_hours=args.slice_hours)
+
+    entity_ids = [e.strip() for e in args.entities.split(",") if e.strip()]
+    if not entity_ids:
+        _, selected = SelectionPlan.from_options(opts).apply(source.entity_states())
+        entity_ids = sorted({st.get("entity_id", "") for st in selected} - {""})
+    if not entity_ids:
+        print("[WARNING] Nessuna entità da importare")
+        return
+
+    start_us = args.start if args.start is not None else default_start_us(args.days)
+    end_us = args.end if args.end is not None else utc_now_us()
+    print(f"[INFO] Backfill di {len(entity_ids)} entità da {source.key}")
+    done = backfill_range(
+        source,
+        args.prefix,
+        start_us,
+        end_us,
+        entity_ids,
+        rotation=opts.get("rotation", "daily"),
+        partition_timezone=opts.get("partition_timezone", "local"),
+        workers=max(1, args.workers),
+        chunk_size=int(opts.get("hdf5_chunk_size", 1024) or 1024),
+        timestamp_format=opts.get("timestamp_format", "epoch_us"),
+        layout=opts.get("hdf5_layout", "per_entity"),
+        state_path=args.state or None,
+        force=args.force,
+    )
+    rows = sum(e["rows"] for e in done.values())
+    print(f"[INFO] Backfill completato: {rows} campioni in {len(done)} file")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+HDF5 Export tool
+
+Export di un intervallo di file giornalieri in CSV / Parquet / Arrow IPC,
+partizionato per dominio e data:
+
+  hdf5_export.py --out /share/export [--from 2025-01-01] [--to 2025-01-31]
+                 [--format csv|parquet|arrow] [--workers N]
+                 [--domains sensor,climate] [--prefix /share/hdf5/] [--force]
+
+Senza --from/--to esporta fino a ieri (il file di oggi è ancora in
+scrittura). Le riesecuzioni saltano i giorni già esportati e invariati.
+
+Il formato di default è csv. Parquet e Arrow richiedono pyarrow, che non
+fa parte dell'immagine dell'add-on: installarlo a parte (pip install
+pyarrow) oppure eseguire lo strumento fuori dal container sui file in
+/share.
+"""
+
+import argparse
+import sys
+from datetime import date, timedelta
+
+if "/usr/lib" not in sys.path:
+    sys.path.insert(0, "/usr/lib")
+
+from hdf5_datalogger.config_loader import load_options
+from hdf5_datalogger.export import DEFAULT_BATCH_ROWS, EXPORT_FORMATS, export_range
+
+def main(argv=None):
+    opts = load_options()
+    ap = argparse.ArgumentParser(description="Export dei file HDF5 DataLogger in Parquet/Arrow/CSV")
+    ap.add_argument("--out", required=True, help="cartella di destinazione")
+    ap.add_argument("--from", dest="start", type=date.fromisoformat, default=date(1970, 1, 1))
+    ap.add_argument("--to", dest="end", type=date.fromisoformat, default=date.today() - timedelta(days=1))
+    ap.add_argument("--format", default="csv", choices=EXPORT_FORMATS,
+                    help="csv (default); parquet e arrow richiedono pyarrow")
+    ap.add_argument("--workers", type=int, default=int(opts.get("compress_workers", 2) or 1))
+    ap.add_argument("--domains", default="", help="domini separati da virgola (default: tutti)")
+    ap.add_argument("--prefix", default=opts.get("output_path_prefix") or "/share/hdf5/")
+    ap.add_argument("--batch-rows", type=int, default=DEFAULT_BATCH_ROWS)
+    ap.add_argument("--force", action="store_true", help="riesporta anche i giorni invariati")
+    args = ap.parse_args(argv)
+
+    domains = [d.strip() for d in args.domains.split(",") if d.strip()] or None
+    try:
+        done = export_range(
+            args.prefix,
+            args.out,
+            args.start,
+            args.end,
+            fmt=args.format,
+            workers=args.workers,
+            domains=domains,
+            batch_rows=max(1, args.batch_rows),
+            force=args.force,
+        )
+    except ImportError:
+        print(f"[ERROR] Il formato {args.format} richiede pyarrow (installazione opzionale: pip install pyarrow); usa --format csv")
+        sys.exit(1)
+    print(f"[INFO] Export completato: {len(done)} giorni esportati in {args.out}")
+
+if __name__ == "__main__":
+    main()
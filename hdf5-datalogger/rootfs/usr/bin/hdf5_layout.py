@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+HDF5 Layout tool
+
+Conversione dei file giornalieri tra layout ed export:
+
+  hdf5_layout.py info    FILE
+  hdf5_layout.py convert FILE --to columnar|per_entity [--out DEST]
+  hdf5_layout.py export  FILE OUT.csv
+  hdf5_layout.py rollup  FILE
+
+Senza --out la conversione avviene sul posto (file temporaneo + os.replace).
+"""
+
+import argparse
+import sys
+
+if "/usr/lib" not in sys.path:
+    sys.path.insert(0, "/usr/lib")
+
+from hdf5_datalogger.constants import DEFAULT_CHUNK_SIZE
+from hdf5_datalogger.layout import LAYOUTS
+from hdf5_datalogger.migrate import convert_file, convert_in_place, describe_json, export_csv
+from hdf5_datalogger.rollup import build_rollups, rollup_path_for
+from hdf5_datalogger.timestamps import TIMESTAMP_FORMATS
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Conversione/export dei file HDF5 DataLogger")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p_info = sub.add_parser("info", help="layout e conteggi per dominio")
+    p_info.add_argument("file")
+
+    p_conv = sub.add_parser("convert", help="converte tra layout per_entity e columnar")
+    p_conv.add_argument("file")
+    p_conv.add_argument("--to", required=True, choices=LAYOUTS)
+    p_conv.add_argument("--out", help="file di destinazione (default: sul posto)")
+    p_conv.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    p_conv.add_argument("--timestamp-format", default="epoch_us", choices=TIMESTAMP_FORMATS)
+
+    p_exp = sub.add_parser("export", help="export CSV in formato lungo")
+    p_exp.add_argument("file")
+    p_exp.add_argument("out")
+
+    p_roll = sub.add_parser("rollup", help="(ri)calcola gli aggregati 1m/1h nel file compagno")
+    p_roll.add_argument("file")
+
+    args = ap.parse_args(argv)
+
+    if args.cmd == "info":
+        print(describe_json(args.file))
+    elif args.cmd == "convert":
+        kwargs = {"chunk_size": args.chunk_size, "timestamp_format": args.timestamp_format}
+        if args.out:
+            n = convert_file(args.file, args.out, args.to, **kwargs)
+        else:
+            n = convert_in_place(args.file, args.to, **kwargs)
+        print(f"[INFO] Convertite {n} entità in layout {args.to}: {args.out or args.file}")
+    elif args.cmd == "export":
+        rows = export_csv(args.file, args.out)
+        print(f"[INFO] Esportate {rows} righe in {args.out}")
+    elif args.cmd == "rollup":
+        n = build_rollups(args.file)
+        print(f"[INFO] Rollup di {n} entità numeriche in {rollup_path_for(args.file)}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 """
-HDF5 DataLogger - v0.3.0
+HDF5 DataLogger - v0.4.0
 
-- REST /api/states
+- REST /api/states, oppure solo domini/entità inclusi via template API
+  (fetch_mode, scelta automatica della strategia più economica)
 - Filtro “fisico”:
   * sensor: incluso solo se ha unit_of_measurement
   * binary_sensor: sempre incluso
@@ -10,80 +11,154 @@ HDF5 DataLogger - v0.3.0
   * climate: sempre incluso
   * light: sempre incluso
 - Filtro domini via include_domains (lista) + domini di default
-- Report testuale + HDF5 giornaliero (solo su cambio di valore)
+- Report testuale + HDF5 orario, giornaliero o settimanale (rotation), solo
+  su cambio di valore; ogni campione va nel file della finestra (locale o
+  UTC, partition_timezone) che contiene il suo timestamp; il report è
+  riscritto solo se cambia (report_update) e dai blocchi in cache
+- Modalità daemon (--daemon): processo residente che mantiene sessione HTTP,
+  opzioni e file HDF5 aperti tra i cicli, con scheduling su clock monotono
+  e hot-reload di /data/options.json
+- Pipeline (write_queue_size > 0): in modalità poll residente il fetch gira
+  in un task asyncio e filtri/scrittura HDF5/report in un thread dedicato,
+  dietro una coda limitata che a coda piena fonde gli snapshot all'ultimo
+  valore per entità
+- ingest_mode=websocket: eventi state_changed via WebSocket (timestamp =
+  last_changed dell'evento), /api/states solo al bootstrap/riconnessione
+- Selezione delle entità con un piano compilato (domini, include_entities,
+  pattern glob/regex include/exclude), ricostruito solo se cambiano le entità
+- Metriche: tempi per fase (fetch, filter, write, report), contatori
+  dei campioni, errori HTTP, crescita dei file e ritardo dei cicli su
+  /metrics (Prometheus, modalità daemon) e in uno snapshot JSON
 """
 
+import asyncio
 import os
+import signal
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 if "/usr/lib" not in sys.path:
     sys.path.insert(0, "/usr/lib")
 
-from hdf5_datalogger.config_loader import load_options
-from hdf5_datalogger.ha_client import get_states
-from hdf5_datalogger.domains import (
-    discover_available_domains,
-    build_included_domains,
-    group_states_by_domain,
-)
-from hdf5_datalogger.filters import filter_states
-from hdf5_datalogger.report import write_report
-from hdf5_datalogger.timeutils import utc_now_z
-from hdf5_datalogger.constants import DEFAULT_INCLUDED_DOMAINS
-from hdf5_datalogger.hdf5_writer import append_states_to_hdf5
+from hdf5_datalogger.config_loader import load_options, OptionsWatcher
+from hdf5_datalogger.ha_client import StateFetcher, make_session
+from hdf5_datalogger.selection import SelectionPlan
+from hdf5_datalogger.report import ReportWriter, WRITTEN, UNCHANGED, write_error_report
+from hdf5_datalogger.timeutils import utc_now_us, utc_now_z
+from hdf5_datalogger.constants import DEFAULT_INCLUDED_DOMAINS, WAL_PATH
+from hdf5_datalogger.hdf5_writer import append_states_to_hdf5, HDF5Writer
+from hdf5_datalogger.deadband import DeadbandFilter
+from hdf5_datalogger.attributes import AttributeCapture
+from hdf5_datalogger.metrics import METRICS, MetricsServer, write_snapshot
+from hdf5_datalogger.pipeline import WritePipeline
 
 TOKEN = os.getenv("SUPERVISOR_TOKEN")
 if not TOKEN:
     raise SystemExit("ERROR: SUPERVISOR_TOKEN missing. Ensure homeassistant_api: true in config.yaml.")
 
-def main():
-    opts = load_options()
+def run_cycle(
+    opts: dict,
+    fetcher: StateFetcher = None,
+    writer: HDF5Writer = None,
+    report: ReportWriter = None,
+    plan: SelectionPlan = None,
+):
+    """
+    Esegue un singolo ciclo: fetch, filtri, scrittura HDF5, report.
+    Con fetcher/writer/report/plan (modalità daemon) riusa le risorse residenti.
+    """
     output_path = opts["output_path"]
-    max_entities = int(opts.get("max_entities", 0) or 0)
-    update_interval = int(opts.get("update_interval", 60) or 60)
-    include_domains_raw = opts.get("include_domains") or []
     output_path_prefix = opts.get("output_path_prefix") or "/share/hdf5/"
 
     ts_run = utc_now_z()
 
     try:
-        all_states = get_states(TOKEN)
+        if fetcher is None:
+            fetcher = StateFetcher.from_options(make_session(TOKEN), opts)
+        with METRICS.time("fetch"):
+            all_states = fetcher.fetch()
     except Exception as e:
+        METRICS.inc("http_errors_total")
         print("[ERROR] Error fetching /states:", repr(e))
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write("===== HOME ASSISTANT STATES REPORT =====\n")
-            f.write(f"Generated at: {ts_run}\n\n")
-            f.write(f"ERROR fetching /states: {e}\n")
-            f.write("===== END =====\n")
+        write_error_report(output_path, ts_run, e)
+        if report is not None:
+            report.invalidate()
         return
 
-    # 1) Filtro fisico
-    filtered_states, filter_stats = filter_states(all_states)
+    if writer is not None:
+        write_fn = writer.append
+    else:
+        chunk_size = int(opts.get("hdf5_chunk_size", 1024) or 1024)
+        timestamp_format = opts.get("timestamp_format") or "epoch_us"
+        value_filter = DeadbandFilter.from_options(opts)
+        layout = opts.get("hdf5_layout") or "per_entity"
+        attribute_capture = AttributeCapture.from_options(opts)
+        write_fn = lambda states: append_states_to_hdf5(
+            states,
+            output_path_prefix,
+            chunk_size=chunk_size,
+            timestamp_format=timestamp_format,
+            value_filter=value_filter,
+            layout=layout,
+            attribute_capture=attribute_capture,
+            wal_path=WAL_PATH if opts.get("write_ahead_log", True) else "",
+            rotation=opts.get("rotation") or "daily",
+            partition_timezone=opts.get("partition_timezone") or "local",
+        )
 
-    # 2) Domini disponibili
-    available_domains = discover_available_domains(filtered_states)
+    process_states(opts, all_states, ts_run, write_fn, report=report, plan=plan, scope=fetcher.scope)
 
-    # 3) include_domains + default
-    selected_domains, domain_warnings = build_included_domains(
-        include_domains_raw,
-        available_domains,
-        DEFAULT_INCLUDED_DOMAINS,
-    )
+def process_states(
+    opts: dict,
+    all_states: list,
+    ts_run: str,
+    write_fn=None,
+    hdf5_stats: dict = None,
+    report: ReportWriter = None,
+    plan: SelectionPlan = None,
+    scope: tuple = None,
+):
+    """
+    Filtri, selezione domini, scrittura HDF5 (tramite write_fn), log e report.
 
-    # 4) Raggruppa per dominio
-    grouped = group_states_by_domain(filtered_states, selected_domains)
+    Con write_fn=None non scrive su HDF5 e logga le hdf5_stats passate
+    (usato dalla modalità websocket, dove la scrittura avviene per evento).
+    Senza report/plan (un processo per ciclo) ReportWriter e SelectionPlan
+    sono creati dalle opzioni. scope è quello del fetch che ha prodotto
+    all_states (StateFetcher.scope; None per il dump completo).
+    Ritorna il set di domini selezionati.
+    """
+    output_path = opts["output_path"]
+    max_entities = int(opts.get("max_entities", 0) or 0)
+    update_interval = int(opts.get("update_interval", 60) or 60)
+    include_domains_raw = opts.get("include_domains") or []
 
-    # Flatten per HDF5: solo gli stati nei domini effettivamente inclusi
-    states_for_hdf5 = []
-    for _, entities in grouped.items():
-        states_for_hdf5.extend(entities)
+    # 1-4) Filtro fisico, domini inclusi e pattern con il piano compilato
+    # (ricostruito solo se cambiano le entità)
+    if plan is None:
+        plan = SelectionPlan.from_options(opts)
+    with METRICS.time("filter"):
+        grouped, states_for_hdf5 = plan.apply(all_states, scope)
+    filter_stats = plan.filter_stats
+    available_domains = plan.available_domains
+    selected_domains = plan.selected_domains
+    domain_warnings = plan.domain_warnings
 
     # 5) Scrittura HDF5
-    hdf5_stats = append_states_to_hdf5(states_for_hdf5, output_path_prefix)
+    if write_fn is not None:
+        with METRICS.time("write"):
+            hdf5_stats = write_fn(states_for_hdf5)
+        METRICS.record_write_stats(hdf5_stats or {})
+    hdf5_stats = hdf5_stats or {}
+    METRICS.set("entities", len(all_states), stage="total")
+    METRICS.set("entities", filter_stats.get("included_after_filter", 0), stage="filtered")
+    METRICS.set("entities", len(states_for_hdf5), stage="selected")
 
     # 6) Log esteso nel log dell'add-on
     total_entities = filter_stats.get("total_entities", len(all_states))
-    included_after_filter = filter_stats.get("included_after_filter", len(filtered_states))
+    included_after_filter = filter_stats.get("included_after_filter", 0)
 
     print("[INFO] ===============================")
     print("[INFO] HDF5 DataLogger run")
@@ -96,6 +171,17 @@ def main():
     print(f"[INFO] Entità dopo filtro fisico: {included_after_filter}")
     print(f"[INFO] HDF5 points appended: {hdf5_stats.get('appended_points', 0)}")
     print(f"[INFO] HDF5 points skipped (unchanged): {hdf5_stats.get('skipped_points', 0)}")
+    for key, label in [
+        ("suppressed_deadband", "HDF5 points suppressed (deadband)"),
+        ("suppressed_rate", "HDF5 points suppressed (min_interval)"),
+        ("heartbeat_points", "HDF5 points forced (heartbeat)"),
+        ("attribute_points", "HDF5 attribute points appended"),
+    ]:
+        if hdf5_stats.get(key):
+            print(f"[INFO] {label}: {hdf5_stats[key]}")
+    if hdf5_stats.get("buffered_points") or hdf5_stats.get("flushed_points") != hdf5_stats.get("appended_points"):
+        print(f"[INFO] HDF5 points flushed: {hdf5_stats.get('flushed_points', 0)}")
+        print(f"[INFO] HDF5 points in buffer: {hdf5_stats.get('buffered_points', 0)}")
 
     for key, label in [
         ("sensor_included", "Sensors inclusi (con unit_of_measurement)"),
@@ -132,22 +218,464 @@ def main():
         for w in domain_warnings:
             print("[WARNING]", w)
 
-    print(f"[INFO] Scrittura report in: {output_path}")
-
-    # 7) Scrivi il report testuale
-    write_report(
-        output_path=output_path,
-        grouped=grouped,
-        max_entities=max_entities,
-        available_domains=available_domains,
-        included_domains_effective=selected_domains,
-        include_domains_raw=include_domains_raw,
-        filter_stats=filter_stats,
-        domain_warnings=domain_warnings,
-    )
+    # 7) Scrivi il report testuale (solo se cambiato, vedi report_update)
+    if report is None:
+        report = ReportWriter.from_options(opts)
+    with METRICS.time("report"):
+        result = report.write(
+            output_path=output_path,
+            grouped=grouped,
+            max_entities=max_entities,
+            available_domains=available_domains,
+            included_domains_effective=selected_domains,
+            include_domains_raw=include_domains_raw,
+            filter_stats=filter_stats,
+            domain_warnings=domain_warnings,
+        )
 
-    print(f"[INFO] Report scritto in: {output_path}")
+    METRICS.inc("reports_total", result=result)
+    if result == WRITTEN:
+        print(f"[INFO] Report scritto in: {output_path}")
+    elif result == UNCHANGED:
+        print(f"[INFO] Report invariato, non riscritto: {output_path}")
+    else:
+        print(f"[INFO] Report rimandato (report_min_interval {report.min_interval:.0f}s): {output_path}")
     print("[INFO] ===============================")
 
+    return selected_domains
+
+def _read_interval(opts: dict) -> int:
+    try:
+        val = int(opts.get("update_interval", 60) or 60)
+    except (TypeError, ValueError):
+        val = 60
+    return max(1, val)
+
+def _metrics_port(opts: dict) -> int:
+    try:
+        return max(0, int(opts.get("metrics_port", 0) or 0))
+    except (TypeError, ValueError):
+        return 0
+
+def _metrics_host(opts: dict) -> str:
+    return str(opts.get("metrics_host") or "127.0.0.1").strip()
+
+def _write_metrics_snapshot(opts: dict, force: bool = False):
+    # snapshot su file al massimo ogni metrics_snapshot_interval secondi
+    try:
+        interval = max(0.0, float(opts.get("metrics_snapshot_interval", 300) or 0))
+    except (TypeError, ValueError):
+        interval = 300.0
+    write_snapshot(opts.get("metrics_snapshot_path") or "", min_interval=0 if force else interval)
+
+def _write_queue_size(opts: dict) -> int:
+    try:
+        return max(0, int(opts.get("write_queue_size", 4) or 0))
+    except (TypeError, ValueError):
+        return 0
+
+def _record_cycle(opts: dict, seconds: float):
+    """
+    Durata del ciclo e rapporto con update_interval (> 1 = il logger non
+    tiene il passo), poi snapshot JSON delle metriche.
+    """
+    interval = _read_interval(opts)
+    METRICS.observe("stage_seconds", seconds, stage="cycle")
+    METRICS.inc("cycles_total")
+    METRICS.set("cycle_overrun_ratio", round(seconds / interval, 4))
+    if seconds > interval:
+        METRICS.inc("cycle_overruns_total")
+        print(f"[WARNING] Ciclo durato {seconds:.1f}s, oltre update_interval ({interval}s)")
+    _write_metrics_snapshot(opts)
+
+def _ingest_mode(opts: dict) -> str:
+    mode = str(opts.get("ingest_mode") or "poll").strip().lower()
+    return mode if mode in ("poll", "websocket") else "poll"
+
+def _writer_config(opts: dict) -> dict:
+    return {
+        "output_path_prefix": opts.get("output_path_prefix") or "/share/hdf5/",
+        "buffer_max_samples": int(opts.get("buffer_max_samples", 60) or 1),
+        "buffer_max_age": float(opts.get("buffer_max_age", 300) or 0),
+        "chunk_size": int(opts.get("hdf5_chunk_size", 1024) or 1024),
+        "timestamp_format": opts.get("timestamp_format") or "epoch_us",
+        "layout": opts.get("hdf5_layout") or "per_entity",
+        "last_values_flush_interval": float(opts.get("last_values_flush_interval", 60) or 0),
+        "deadbands": opts.get("deadbands") or [],
+        "capture_attributes": opts.get("capture_attributes") or [],
+        "wal_path": WAL_PATH if opts.get("write_ahead_log", True) else "",
+        "swmr": bool(opts.get("hdf5_swmr", True)),
+        "rotation": opts.get("rotation") or "daily",
+        "partition_timezone": opts.get("partition_timezone") or "local",
+    }
+
+def _fetch_config(opts: dict) -> tuple:
+    return tuple(
+        repr(opts.get(k))
+        for k in ("fetch_mode", "fetch_workers", "include_domains", "include_entities", "include_patterns")
+    )
+
+def _selection_config(opts: dict) -> tuple:
+    return tuple(
+        repr(opts.get(k))
+        for k in ("include_domains", "include_entities", "include_patterns", "exclude_patterns")
+    )
+
+def _report_config(opts: dict) -> tuple:
+    return (opts.get("report_update"), opts.get("report_min_interval"), opts.get("report_summary_only"))
+
+def _make_writer(cfg: dict) -> HDF5Writer:
+    kwargs = {k: v for k, v in cfg.items() if k not in ("deadbands", "capture_attributes")}
+    return HDF5Writer(
+        value_filter=DeadbandFilter.from_options(cfg),
+        attribute_capture=AttributeCapture.from_options(cfg),
+        **kwargs,
+    )
+
+class DaemonState:
+    """
+    Risorse residenti del logger in modalità daemon: opzioni, sessione HTTP,
+    writer HDF5 e flag di arresto.
+    """
+
+    def __init__(self):
+        self.watcher = OptionsWatcher()
+        self.session = make_session(TOKEN)
+        self._fetch_cfg = _fetch_config(self.options)
+        self.fetcher = StateFetcher.from_options(self.session, self.options)
+        self._writer_cfg = _writer_config(self.options)
+        self.writer = _make_writer(self._writer_cfg)
+        self._report_cfg = _report_config(self.options)
+        self._selection_cfg = _selection_config(self.options)
+        self.plan = SelectionPlan.from_options(self.options)
+        self.report = ReportWriter.from_options(self.options)
+        self.stop = threading.Event()
+        self.metrics_server = None
+        self._start_metrics()
+
+    def _start_metrics(self):
+        port = _metrics_port(self.options)
+        if port:
+            self.metrics_server = MetricsServer(port, host=_metrics_host(self.options))
+            if not self.metrics_server.start():
+                self.metrics_server = None
+
+    @property
+    def options(self) -> dict:
+        return self.watcher.options
+
+    def reload_options(self) -> bool:
+        """
+        Hot-reload di options.json; ritorna True se le opzioni sono cambiate.
+        """
+        old_interval = _read_interval(self.options)
+        if not self.watcher.poll():
+            return False
+        print("[INFO] options.json modificato: opzioni ricaricate")
+        new_cfg = _writer_config(self.options)
+        if new_cfg != self._writer_cfg:
+            # close() svuota i buffer prima di ricreare il writer
+            self.writer.close()
+            self._writer_cfg = new_cfg
+            self.writer = _make_writer(new_cfg)
+        fetch_cfg = _fetch_config(self.options)
+        if fetch_cfg != self._fetch_cfg:
+            self._fetch_cfg = fetch_cfg
+            self.fetcher = StateFetcher.from_options(self.session, self.options)
+        selection_cfg = _selection_config(self.options)
+        if selection_cfg != self._selection_cfg:
+            self._selection_cfg = selection_cfg
+            self.plan = SelectionPlan.from_options(self.options)
+        report_cfg = _report_config(self.options)
+        if report_cfg != self._report_cfg:
+            self._report_cfg = report_cfg
+            self.report = ReportWriter.from_options(self.options)
+        new_interval = _read_interval(self.options)
+        if new_interval != old_interval:
+            print(f"[INFO] Update interval: {old_interval}s -> {new_interval}s")
+        old_bind = (self.metrics_server.port, self.metrics_server.host) if self.metrics_server else (0, "")
+        new_bind = (_metrics_port(self.options), _metrics_host(self.options))
+        if new_bind != old_bind and (new_bind[0] or old_bind[0]):
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+                self.metrics_server = None
+            self._start_metrics()
+        return True
+
+    def close(self):
+        self.writer.close()
+        self.session.close()
+        _write_metrics_snapshot(self.options, force=True)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+
+def _poll_loop(d: DaemonState):
+    # scheduling su clock monotono: i tick sono start + k*interval,
+    # quindi la durata del ciclo non si accumula come deriva
+    next_tick = time.monotonic()
+    while not d.stop.is_set():
+        if d.reload_options() and (_ingest_mode(d.options) != "poll" or _write_queue_size(d.options)):
+            return
+        interval = _read_interval(d.options)
+
+        t0 = time.monotonic()
+        try:
+            run_cycle(d.options, fetcher=d.fetcher, writer=d.writer, report=d.report, plan=d.plan)
+        except Exception as e:
+            print("[ERROR] Errore nel ciclo del logger:", repr(e))
+        _record_cycle(d.options, time.monotonic() - t0)
+
+        next_tick += interval
+        now = time.monotonic()
+        if next_tick <= now:
+            missed = int((now - next_tick) // interval) + 1
+            print(f"[WARNING] Ciclo in ritardo: saltati {missed} tick da {interval}s")
+            METRICS.inc("missed_ticks_total", missed)
+            next_tick += missed * interval
+        d.stop.wait(next_tick - now)
+
+async def _pipeline_loop(d: DaemonState):
+    """
+    Modalità poll con pipeline: il fetch gira in questo task, filtri,
+    scrittura HDF5 e report nel thread writer della WritePipeline, così il
+    tick successivo non aspetta la scrittura. Il ritardo dei cicli misura
+    solo il produttore; il ritardo del writer è la latenza della coda.
+    """
+    loop = asyncio.get_running_loop()
+    # requests è bloccante: il fetch gira in un thread, il loop resta libero
+    fetch_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fetch")
+
+    def _consume(states, fetched_us, ts_run, scope):
+        # campioni con l'istante del fetch, non quello della scrittura
+        process_states(
+            d.options,
+            states,
+            ts_run,
+            lambda s: d.writer.append(s, ts_now=fetched_us),
+            report=d.report,
+            plan=d.plan,
+            scope=scope,
+        )
+
+    def _fetch_failed(ts_run, e):
+        write_error_report(d.options["output_path"], ts_run, e)
+        d.report.invalidate()
+
+    pipeline = WritePipeline(_consume, _write_queue_size(d.options))
+    next_tick = time.monotonic()
+    try:
+        while not d.stop.is_set():
+            if d.watcher.changed():
+                # ricaricamento (che può ricreare il writer HDF5) nel thread
+                # writer, dopo gli snapshot già in coda
+                fut = await loop.run_in_executor(None, pipeline.call, d.reload_options)
+                if await asyncio.wrap_future(fut) and (
+                    _ingest_mode(d.options) != "poll" or _write_queue_size(d.options) != pipeline.maxsize
+                ):
+                    return
+            interval = _read_interval(d.options)
+
+            t0 = time.monotonic()
+            ts_run = utc_now_z()
+            fetched_us = utc_now_us()
+            try:
+                with METRICS.time("fetch"):
+                    states = await loop.run_in_executor(fetch_pool, d.fetcher.fetch)
+            except Exception as e:
+                METRICS.inc("http_errors_total")
+                print("[ERROR] Error fetching /states:", repr(e))
+                await loop.run_in_executor(None, pipeline.call, _fetch_failed, ts_run, e)
+            else:
+                # un solo thread di fetch: scope è ancora quello di questo fetch
+                pipeline.submit(states, fetched_us, ts_run, d.fetcher.scope)
+            pipeline.report()
+            _record_cycle(d.options, time.monotonic() - t0)
+
+            next_tick += interval
+            now = time.monotonic()
+            if next_tick <= now:
+                missed = int((now - next_tick) // interval) + 1
+                print(f"[WARNING] Ciclo in ritardo: saltati {missed} tick da {interval}s")
+                METRICS.inc("missed_ticks_total", missed)
+                next_tick += missed * interval
+            await loop.run_in_executor(None, d.stop.wait, next_tick - now)
+    finally:
+        # gli snapshot in coda (e quello fuso) vengono scritti prima di uscire
+        await loop.run_in_executor(None, pipeline.close)
+        fetch_pool.shutdown(wait=True)
+
+async def _websocket_loop(d: DaemonState):
+    """
+    Ingestione event-driven: gli eventi state_changed vengono scritti con il
+    loro last_changed; /api/states è usato solo al bootstrap/riconnessione.
+    Il report testuale viene controllato ogni update_interval sullo stato
+    corrente tenuto in memoria (e riscritto solo se cambiato).
+    """
+    # import locale: la modalità poll non carica la libreria websocket
+    from hdf5_datalogger.ha_ws import LastUpdatedFilter, stream_state_changes
+
+    loop = asyncio.get_running_loop()
+    opts = d.options
+    # un solo thread per h5py: snapshot, flush eventi e report sono serializzati
+    io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hdf5-io")
+    loop_stop = asyncio.Event()
+
+    current = {}
+    pending = []
+    order = LastUpdatedFilter()
+    event_stats = {
+        "appended_points": 0,
+        "skipped_points": 0,
+        "suppressed_deadband": 0,
+        "suppressed_rate": 0,
+        "heartbeat_points": 0,
+        "attribute_points": 0,
+        "flushed_points": 0,
+        "buffered_points": 0,
+        "file_path": "",
+    }
+    # contatori azzerati a ogni report periodico
+    event_counters = ("appended_points", "skipped_points", "suppressed_deadband",
+                      "suppressed_rate", "heartbeat_points", "attribute_points", "flushed_points")
+
+    def _write_snapshot(states, fresh_ids):
+        # selezione domini e report sull'intero snapshot, scrittura HDF5
+        # solo degli stati più recenti di quanto già registrato
+        process_states(
+            opts,
+            states,
+            utc_now_z(),
+            lambda s: d.writer.append(
+                [st for st in s if st.get("entity_id", "") in fresh_ids],
+                timestamp_key="last_changed",
+            ),
+            report=d.report,
+            plan=d.plan,
+            scope=d.fetcher.scope,
+        )
+
+    def _write_events(batch):
+        filtered = d.plan.select_events(batch)
+        with METRICS.time("write"):
+            stats = d.writer.append(filtered, timestamp_key="last_changed")
+        METRICS.record_write_stats(stats)
+        for key in event_counters:
+            event_stats[key] += stats[key]
+        event_stats["buffered_points"] = stats["buffered_points"]
+        event_stats["file_path"] = stats["file_path"]
+
+    def _write_periodic_report(states):
+        stats = dict(event_stats)
+        for key in event_counters:
+            event_stats[key] = 0
+        process_states(
+            opts, states, utc_now_z(), write_fn=None, hdf5_stats=stats, report=d.report, plan=d.plan
+        )
+        _write_metrics_snapshot(opts)
+
+    def _timed_fetch():
+        try:
+            with METRICS.time("fetch"):
+                return d.fetcher.fetch()
+        except Exception:
+            METRICS.inc("http_errors_total")
+            raise
+
+    async def fetch_snapshot():
+        return await loop.run_in_executor(io, _timed_fetch)
+
+    async def on_snapshot(states):
+        fresh_ids = set()
+        for st in states:
+            if order.accept(st):
+                eid = st.get("entity_id", "")
+                current[eid] = st
+                fresh_ids.add(eid)
+        # atteso prima di leggere gli eventi: stesso ordine di scrittura e
+        # un errore arriva a stream_state_changes (log e riconnessione)
+        await loop.run_in_executor(io, _write_snapshot, states, fresh_ids)
+
+    def on_state(st):
+        if not order.accept(st):
+            return
+        current[st.get("entity_id", "")] = st
+        pending.append(st)
+
+    async def flush_events():
+        while not loop_stop.is_set():
+            await asyncio.sleep(1.0)
+            batch = pending[:]
+            pending.clear()
+            try:
+                # anche senza eventi: scrive i buffer scaduti per età
+                await loop.run_in_executor(io, _write_events, batch)
+            except Exception as e:
+                print("[ERROR] Errore scrittura eventi HDF5:", repr(e))
+
+    async def periodic_report():
+        next_tick = time.monotonic() + _read_interval(opts)
+        while not loop_stop.is_set():
+            if d.stop.is_set() or await loop.run_in_executor(io, d.reload_options):
+                loop_stop.set()
+                return
+            if time.monotonic() >= next_tick and current:
+                next_tick += _read_interval(opts)
+                try:
+                    await loop.run_in_executor(io, _write_periodic_report, list(current.values()))
+                except Exception as e:
+                    print("[ERROR] Errore generazione report:", repr(e))
+            await asyncio.sleep(1.0)
+
+    tasks = [
+        asyncio.create_task(flush_events()),
+        asyncio.create_task(periodic_report()),
+    ]
+    try:
+        await stream_state_changes(TOKEN, fetch_snapshot, on_snapshot, on_state, loop_stop)
+    finally:
+        loop_stop.set()
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if pending:
+            try:
+                await loop.run_in_executor(io, _write_events, pending[:])
+            except Exception as e:
+                print("[ERROR] Errore scrittura eventi HDF5:", repr(e))
+        io.shutdown(wait=True)
+
+def run_daemon():
+    d = DaemonState()
+
+    def _on_signal(signum, _frame):
+        print(f"[INFO] Segnale {signum} ricevuto, arresto del logger in corso...")
+        d.stop.set()
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    try:
+        while not d.stop.is_set():
+            mode = _ingest_mode(d.options)
+            print(f"[INFO] Logger residente avviato (ingest_mode={mode}, update_interval={_read_interval(d.options)}s)")
+            if mode == "websocket":
+                asyncio.run(_websocket_loop(d))
+            elif _write_queue_size(d.options):
+                asyncio.run(_pipeline_loop(d))
+            else:
+                _poll_loop(d)
+    finally:
+        d.close()
+        print("[INFO] Logger residente terminato")
+
+def main():
+    opts = load_options()
+    t0 = time.monotonic()
+    run_cycle(opts)
+    _record_cycle(opts, time.monotonic() - t0)
+
 if __name__ == "__main__":
-    main()
+    if "--daemon" in sys.argv[1:]:
+        run_daemon()
+    else:
+        main()
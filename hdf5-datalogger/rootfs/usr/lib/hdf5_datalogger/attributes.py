@@ -0,0 +1,94 @@
+"""
+Cattura di attributi come serie temporali.
+
+Regole da options.json (lista "capture_attributes"), ognuna con:
+  match:      entity_id, "device_class:<classe>", "domain:<dominio>" o "*"
+  attributes: nomi degli attributi separati da virgola
+
+Precedenza: entity_id > device_class > domain > "*" (come per deadbands).
+
+Ogni attributo catturato finisce in /<dominio>/<entity_id>/attributes/<nome>
+con i suoi dataset value/timestamp/availability (stessa codifica dei
+valori di stato: float per i numerici, enum per i testi) e viene scritto
+solo quando cambia. Gli ultimi valori stanno nella stessa cache degli
+stati, con chiave "<entity_id>#<attributo>".
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+from .domains import domain_of
+
+ATTRIBUTES_GROUP = "attributes"
+
+
+def last_value_key(entity_id: str, attribute: str) -> str:
+    return f"{entity_id}#{attribute}"
+
+
+def last_value_entity(key: str) -> str:
+    # entity_id di una chiave degli ultimi valori (stato o attributo)
+    return key.split("#", 1)[0]
+
+
+def attribute_raw(value) -> str:
+    """
+    Valore "raw" di un attributo, confrontabile come gli stati.
+    None (es. current_temperature di un termostato spento) diventa "unknown".
+    """
+    if value is None:
+        return "unknown"
+    if isinstance(value, bool):
+        return "on" if value else "off"
+    return str(value)
+
+
+def _parse_names(raw) -> Tuple[str, ...]:
+    if isinstance(raw, (list, tuple)):
+        names = raw
+    else:
+        names = str(raw or "").split(",")
+    return tuple(n.strip() for n in names if n and n.strip())
+
+
+class AttributeCapture:
+    def __init__(self, rules: List[Tuple[str, Tuple[str, ...]]]):
+        self._by_entity: Dict[str, Tuple[str, ...]] = {}
+        self._by_device_class: Dict[str, Tuple[str, ...]] = {}
+        self._by_domain: Dict[str, Tuple[str, ...]] = {}
+        self._default: Tuple[str, ...] = ()
+        for match, names in rules:
+            if match == "*":
+                self._default = names
+            elif match.startswith("device_class:"):
+                self._by_device_class[match.split(":", 1)[1].strip().lower()] = names
+            elif match.startswith("domain:"):
+                self._by_domain[match.split(":", 1)[1].strip().lower()] = names
+            else:
+                self._by_entity[match] = names
+        self._cache: Dict[str, Tuple[str, ...]] = {}
+
+    @classmethod
+    def from_options(cls, opts: dict) -> Optional["AttributeCapture"]:
+        rules = []
+        for raw in opts.get("capture_attributes") or []:
+            if not isinstance(raw, dict) or not raw.get("match"):
+                continue
+            names = _parse_names(raw.get("attributes"))
+            if names:
+                rules.append((str(raw["match"]).strip(), names))
+        return cls(rules) if rules else None
+
+    def attributes_for(self, entity_id: str, attrs: dict) -> Tuple[str, ...]:
+        names = self._cache.get(entity_id)
+        if names is not None:
+            return names
+        names = self._by_entity.get(entity_id)
+        if names is None:
+            dc = str(attrs.get("device_class") or "").lower()
+            names = self._by_device_class.get(dc) if dc else None
+        if names is None:
+            names = self._by_domain.get(domain_of(entity_id))
+        if names is None:
+            names = self._default
+        self._cache[entity_id] = names
+        return names
@@ -0,0 +1,548 @@
+"""
+Backfill dello storico del recorder di Home Assistant nei file HDF5.
+Usato da /usr/bin/hdf5_backfill.py (primo avvio, buchi dovuti a un fermo
+del logger); può girare con logger e compresser attivi.
+
+Sorgenti:
+- ApiHistory: GET /api/history/period a pagine, per fette di slice_hours
+  ore e gruppi di ENTITY_BATCH entità (minimal_response: attributi solo
+  sul primo stato di ogni entità);
+- RecorderDatabase: lettura diretta del file SQLite del recorder (schema
+  con states_meta, HA >= 2023.4), in sola lettura.
+
+Ogni finestra di file (rotation e partition_timezone come il logger) è
+un'unità di lavoro indipendente: i campioni (solo i cambi di stato, con il
+timestamp di last_changed) sono scritti con gli stessi helper del writer,
+quindi con il layout, la codifica per dominio e l'indice sidecar del
+logger, con un resize e una scrittura a slice per dataset. Nel file di
+destinazione:
+- file assente: creato, con la finestra negli attributi;
+- campioni tutti successivi all'ultimo dell'entità nel file: append;
+- altrimenti (buchi a metà file) il file è riscritto con le serie fuse
+  per timestamp (a parità vince il campione già nel file) e ordinate; i
+  campioni consecutivi con lo stesso valore (numeri confrontati come
+  float) sono tolti, quindi rieseguire il backfill non duplica nulla. Il file riscritto perde il
+  marker di compressione e viene ricompresso dal compresser.
+Il file della finestra corrente (aperto dal logger) non viene mai toccato.
+Ogni file è bloccato (filelock, lo stesso lock di logger e compresser)
+per tutta l'importazione; un file tenuto da un altro processo (la finestra
+appena chiusa dal logger, una compressione in corso) è saltato e non entra
+nel checkpoint, quindi viene importato alla prossima esecuzione.
+
+Il checkpoint (BACKFILL_STATE_PATH) registra le finestre completate per
+sorgente: un'esecuzione interrotta riparte da quelle mancanti. Con
+workers > 1 le finestre sono elaborate da un pool di processi.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List, Optional, Tuple
+
+import h5py
+import numpy as np
+
+from . import compression  # noqa: F401  (filtri zstd/blosc opzionali)
+from .attributes import ATTRIBUTES_GROUP
+from .compression import COMPRESSED_ATTR
+from .constants import API_URL, BACKFILL_STATE_PATH, DEFAULT_CHUNK_SIZE
+from .domains import domain_of
+from .encoding import AVAILABLE, _to_float, availability_of
+from .file_index import load_or_build_index, new_index, save_index
+from .filelock import FileLock
+from .ha_client import loads, make_session
+from .hdf5_writer import _EntityBuffer, _flush_buffers, _write_partition, build_hdf5_path
+from .layout import PER_ENTITY, file_layout, normalize_layout
+from .migrate import _raw_values, iter_entities
+from .query import _read_entity
+from .rollup import build_rollups, rollup_path_for
+from .rotation import DAILY, LOCAL, Partitioner, label_window_us
+from .swmr import open_read
+from .timestamps import normalize_format
+from .timeutils import epoch_us_to_iso_z, iso_to_epoch_us, utc_now_us
+
+# entity_id per richiesta all'API (lunghezza dell'URL)
+ENTITY_BATCH = 50
+DEFAULT_SLICE_HOURS = 6
+_HOUR_US = 3600 * 1_000_000
+
+# (attributi, timestamp us, valori) di un'entità
+Series = Tuple[dict, np.ndarray, np.ndarray]
+
+
+def _iso_array_us(values: List[str]) -> np.ndarray:
+    """
+    Timestamp ISO-8601 -> epoch us; parsing vettoriale con numpy quando
+    sono tutti in UTC (il formato dell'API), altrimenti uno per uno.
+    """
+    if all(v.endswith("+00:00") for v in values):
+        return np.array([v[:-6] for v in values], dtype="datetime64[us]").astype("i8")
+    return np.array([iso_to_epoch_us(v) for v in values], dtype="i8")
+
+
+def _value_changes(values: np.ndarray) -> np.ndarray:
+    """
+    Maschera dei campioni (raw, in ordine di tempo) diversi dal precedente.
+    I numeri sono confrontati come float della codifica ("20" == "20.0"),
+    il resto come stato testuale (unavailable/unknown dalla maschera).
+    """
+    keep = np.ones(len(values), dtype=bool)
+    if len(values) < 2:
+        return keep
+    nums = np.fromiter((_to_float(v) for v in values), dtype="f8", count=len(values))
+    nums[availability_of(values) != AVAILABLE] = np.nan
+    text = np.where(np.isnan(nums), values, "")
+    same_num = (nums[1:] == nums[:-1]) | (np.isnan(nums[1:]) & np.isnan(nums[:-1]))
+    keep[1:] = ~(same_num & (text[1:] == text[:-1]))
+    return keep
+
+
+def _changes(ts_us: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Ordina per timestamp e tiene solo i cambi di valore (come il logger).
+    """
+    order = np.argsort(ts_us, kind="stable")
+    ts_us, values = ts_us[order], values[order]
+    keep = _value_changes(values)
+    return ts_us[keep], values[keep]
+
+
+def _merge_series(
+    old_ts: np.ndarray,
+    old_values: List[str],
+    new_ts: List[int],
+    new_values: List[str],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fonde la serie del file con quella importata: sullo stesso timestamp
+    vince il campione già nel file, poi restano solo i cambi di valore.
+    """
+    ts_us = np.concatenate([np.asarray(old_ts, dtype="i8"), np.asarray(new_ts, dtype="i8")])
+    values = np.array(list(old_values) + list(new_values), dtype=object)
+    imported = np.r_[np.zeros(len(old_values), dtype=bool), np.ones(len(new_values), dtype=bool)]
+    order = np.lexsort((imported, ts_us))
+    ts_us, values = ts_us[order], values[order]
+    first = np.ones(len(ts_us), dtype=bool)
+    first[1:] = ts_us[1:] != ts_us[:-1]
+    ts_us, values = ts_us[first], values[first]
+    keep = _value_changes(values)
+    return ts_us[keep], values[keep]
+
+
+class ApiHistory:
+    """
+    Storico da /api/history/period; la sessione HTTP è creata nel processo
+    che legge (l'oggetto viaggia verso i worker del pool).
+    """
+
+    def __init__(self, token: str, base_url: str = API_URL, slice_hours: float = DEFAULT_SLICE_HOURS):
+        self.token = token
+        self.base_url = base_url.rstrip("/")
+        self.slice_us = max(1, int(float(slice_hours) * _HOUR_US))
+        self._session = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_session"] = None
+        return state
+
+    @property
+    def key(self) -> str:
+        return f"api:{self.base_url}"
+
+    def _get(self, path: str, params: dict = None):
+        if self._session is None:
+            self._session = make_session(self.token)
+        r = self._session.get(f"{self.base_url}{path}", params=params, timeout=120)
+        r.raise_for_status()
+        return loads(r.content)
+
+    def entity_states(self) -> list:
+        return self._get("/states")
+
+    def read(self, entity_ids: List[str], start_us: int, end_us: int) -> Dict[str, Series]:
+        parts: Dict[str, list] = {}
+        attrs: Dict[str, dict] = {}
+        for i in range(0, len(entity_ids), ENTITY_BATCH):
+            batch = entity_ids[i:i + ENTITY_BATCH]
+            t0 = start_us
+            while t0 < end_us:
+                t1 = min(end_us, t0 + self.slice_us)
+                pages = self._get(
+                    f"/history/period/{epoch_us_to_iso_z(t0)}",
+                    {
+                        "end_time": epoch_us_to_iso_z(t1),
+                        "filter_entity_id": ",".join(batch),
+                        "minimal_response": "",
+                        "significant_changes_only": "0",
+                        "skip_initial_state": "",
+                    },
+                )
+                for states in pages or []:
+                    if not states:
+                        continue
+                    entity_id = states[0].get("entity_id", "")
+                    if states[0].get("attributes"):
+                        attrs[entity_id] = states[0]["attributes"]
+                    parts.setdefault(entity_id, []).append(states)
+                t0 = t1
+
+        out: Dict[str, Series] = {}
+        for entity_id, pages in parts.items():
+            states = [st for page in pages for st in page]
+            ts_us = _iso_array_us([st.get("last_changed") or st.get("last_updated") for st in states])
+            values = np.array([str(st.get("state", "")) for st in states], dtype=object)
+            # la pagina può sconfinare di qualche us: resta solo la finestra
+            inside = (ts_us >= start_us) & (ts_us < end_us)
+            out[entity_id] = (attrs.get(entity_id, {}), ts_us[inside], values[inside])
+        return out
+
+
+class RecorderDatabase:
+    """
+    Storico dal database SQLite del recorder (aperto in sola lettura).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @property
+    def key(self) -> str:
+        return f"sqlite:{os.path.abspath(self.path)}"
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        tables = {r[0] for r in con.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        if "states_meta" not in tables:
+            con.close()
+            raise ValueError(f"Schema del recorder non supportato (manca states_meta, HA < 2023.4): {self.path}")
+        return con
+
+    def entity_states(self) -> list:
+        """
+        Ultimo stato registrato di ogni entità (per la selezione).
+        """
+        con = self._connect()
+        try:
+            rows = con.execute(
+                "SELECT m.entity_id, s.state, a.shared_attrs FROM states s"
+                " JOIN states_meta m ON s.metadata_id = m.metadata_id"
+                " LEFT JOIN state_attributes a ON s.attributes_id = a.attributes_id"
+                " WHERE s.state_id IN (SELECT MAX(state_id) FROM states GROUP BY metadata_id)"
+            ).fetchall()
+        finally:
+            con.close()
+        return [
+            {"entity_id": eid, "state": state, "attributes": json.loads(shared) if shared else {}}
+            for eid, state, shared in rows
+        ]
+
+    def read(self, entity_ids: List[str], start_us: int, end_us: int) -> Dict[str, Series]:
+        con = self._connect()
+        out: Dict[str, Series] = {}
+        try:
+            for i in range(0, len(entity_ids), ENTITY_BATCH):
+                batch = entity_ids[i:i + ENTITY_BATCH]
+                marks = ",".join("?" * len(batch))
+                # solo i cambi di stato: last_changed_ts è NULL quando coincide con last_updated_ts
+                rows = con.execute(
+                    "SELECT m.entity_id, s.last_updated_ts, s.state, a.shared_attrs FROM states s"
+                    " JOIN states_meta m ON s.metadata_id = m.metadata_id"
+                    " LEFT JOIN state_attributes a ON s.attributes_id = a.attributes_id"
+                    f" WHERE m.entity_id IN ({marks})"
+                    " AND s.last_updated_ts >= ? AND s.last_updated_ts < ?"
+                    " AND (s.last_changed_ts IS NULL OR s.last_changed_ts = s.last_updated_ts)"
+                    " ORDER BY m.entity_id, s.last_updated_ts",
+                    (*batch, start_us / 1_000_000, end_us / 1_000_000),
+                ).fetchall()
+                if not rows:
+                    continue
+                eids, ts, states, shared = zip(*rows)
+                eids = np.array(eids, dtype=object)
+                ts_us = np.round(np.array(ts, dtype="f8") * 1_000_000).astype("i8")
+                values = np.array([str(s) if s is not None else "unknown" for s in states], dtype=object)
+                # righe già ordinate per entità: una fetta contigua per entità
+                bounds = np.flatnonzero(eids[1:] != eids[:-1]) + 1
+                for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(eids)]):
+                    last_attrs = next((s for s in reversed(shared[lo:hi]) if s), None)
+                    out[str(eids[lo])] = (
+                        json.loads(last_attrs) if last_attrs else {},
+                        ts_us[lo:hi],
+                        values[lo:hi],
+                    )
+        finally:
+            con.close()
+        return out
+
+
+def _merge_rewrite(
+    path: str,
+    buffers: Dict[str, _EntityBuffer],
+    chunk_size: int,
+    timestamp_format: str,
+) -> dict:
+    """
+    Riscrive path con le serie esistenti fuse con quelle importate
+    (tmp + os.replace). Ritorna l'indice del file nuovo.
+    """
+    tmp = path + ".backfill.tmp"
+    index = new_index()
+    try:
+        with open_read(path) as fin, h5py.File(tmp, "w", libver="latest") as fout:
+            for aname, aval in fin.attrs.items():
+                if aname not in (COMPRESSED_ATTR, "compressed_at"):
+                    fout.attrs[aname] = aval
+            merged: Dict[str, _EntityBuffer] = {}
+            for entity_id, domain, attrs, ts_us, values, states in iter_entities(fin):
+                buf = merged[entity_id] = _EntityBuffer(domain or domain_of(entity_id), attrs)
+                new = buffers.pop(entity_id, None)
+                if new is None:
+                    buf.values, buf.timestamps = _raw_values(values, states), ts_us.tolist()
+                    continue
+                all_ts, all_values = _merge_series(ts_us, _raw_values(values, states), new.timestamps, new.values)
+                buf.values, buf.timestamps = all_values.tolist(), all_ts.tolist()
+            merged.update(buffers)
+            _flush_buffers(fout, merged, chunk_size, timestamp_format, index=index, layout=file_layout(fin))
+            # serie degli attributi catturati: copiate così come sono
+            for domain, dgrp in fin.items():
+                if not isinstance(dgrp, h5py.Group):
+                    continue
+                for name, grp in dgrp.items():
+                    if isinstance(grp, h5py.Group) and ATTRIBUTES_GROUP in grp:
+                        parent = fout.require_group(f"/{domain}/{name}")
+                        fin.copy(grp[ATTRIBUTES_GROUP], parent, name=ATTRIBUTES_GROUP)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return index
+
+
+def _drop_repeats(path: str, index: dict, buffers: Dict[str, _EntityBuffer]) -> None:
+    """
+    Append: toglie dai buffer i primi campioni uguali all'ultimo valore
+    dell'entità già nel file (non sono cambi di stato).
+    """
+    with open_read(path) as f:
+        for entity_id in list(buffers):
+            ent = index["entities"].get(entity_id)
+            part = _read_entity(f, entity_id, ent[1], ent[1] + 1) if ent else None
+            if part is None:
+                continue
+            buf = buffers[entity_id]
+            last = _raw_values(part[1], part[2])[-1]
+            keep = _value_changes(np.array([last] + buf.values, dtype=object))[1:]
+            if keep.all():
+                continue
+            buf.values = [v for v, k in zip(buf.values, keep) if k]
+            buf.timestamps = [t for t, k in zip(buf.timestamps, keep) if k]
+            if not buf.values:
+                del buffers[entity_id]
+
+
+def import_partition(
+    path: str,
+    buffers: Dict[str, _EntityBuffer],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timestamp_format: str = "epoch_us",
+    layout: str = PER_ENTITY,
+) -> Tuple[str, int]:
+    """
+    Scrive i buffer (campioni ordinati di una sola finestra) nel file path.
+    Ritorna la modalità usata ("created", "appended" o "merged") e i
+    campioni importati; ("busy", 0) senza toccare il file se un altro
+    processo lo tiene bloccato.
+    """
+    lock = FileLock(path)
+    if not lock.acquire(blocking=False):
+        return "busy", 0
+    try:
+        return _import_locked(path, buffers, chunk_size, timestamp_format, layout)
+    finally:
+        lock.release()
+
+
+def _import_locked(
+    path: str,
+    buffers: Dict[str, _EntityBuffer],
+    chunk_size: int,
+    timestamp_format: str,
+    layout: str,
+) -> Tuple[str, int]:
+    if not os.path.exists(path):
+        rows = sum(len(b.values) for b in buffers.values())
+        _write_partition(path, buffers, chunk_size, timestamp_format, layout, lock=False)
+        return "created", rows
+    index = load_or_build_index(path)
+    overlap = any(
+        eid in index["entities"] and buf.timestamps[0] <= index["entities"][eid][1]
+        for eid, buf in buffers.items()
+    )
+    if overlap:
+        rows = sum(len(b.values) for b in buffers.values())
+        save_index(path, _merge_rewrite(path, buffers, chunk_size, timestamp_format))
+        mode = "merged"
+    else:
+        _drop_repeats(path, index, buffers)
+        rows = sum(len(b.values) for b in buffers.values())
+        if not rows:
+            return "appended", 0
+        _write_partition(path, buffers, chunk_size, timestamp_format, layout, index, lock=False)
+        mode = "appended"
+    if os.path.exists(rollup_path_for(path)):
+        # il rollup del file chiuso resta allineato ai dati importati
+        build_rollups(path)
+    return mode, rows
+
+
+def backfill_window(
+    source,
+    label: str,
+    start_us: int,
+    end_us: int,
+    entity_ids: List[str],
+    output_path_prefix: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timestamp_format: str = "epoch_us",
+    layout: str = PER_ENTITY,
+) -> dict:
+    """
+    Importa [start_us, end_us) della finestra label. Eseguita nei worker
+    del pool: ritorna {"rows", "entities", "mode", "path"}.
+    """
+    buffers: Dict[str, _EntityBuffer] = {}
+    for entity_id, (attrs, ts_us, values) in source.read(entity_ids, start_us, end_us).items():
+        ts_us, values = _changes(ts_us, values)
+        if not len(ts_us):
+            continue
+        buf = buffers[entity_id] = _EntityBuffer(domain_of(entity_id), attrs)
+        buf.values, buf.timestamps = values.tolist(), ts_us.tolist()
+    path = build_hdf5_path(output_path_prefix, label)
+    entities = len(buffers)
+    if not buffers:
+        return {"rows": 0, "entities": 0, "mode": "empty", "path": path}
+    mode, rows = import_partition(path, buffers, chunk_size, normalize_format(timestamp_format), normalize_layout(layout))
+    return {"rows": rows, "entities": entities, "mode": mode, "path": path}
+
+
+def plan_windows(
+    start_us: int,
+    end_us: int,
+    rotation: str = DAILY,
+    partition_timezone: str = LOCAL,
+) -> List[Tuple[str, int, int]]:
+    """
+    (etichetta, inizio, fine) delle finestre di file che coprono
+    [start_us, end_us), esclusa la finestra corrente del logger.
+    """
+    partitioner = Partitioner(rotation, partition_timezone)
+    end_us = min(end_us, label_window_us(partitioner.current())[0])
+    out = []
+    t = start_us
+    while t < end_us:
+        label = partitioner.label_for(t)
+        w_start, w_end = label_window_us(label)
+        out.append((label, max(w_start, start_us), min(w_end, end_us)))
+        t = w_end
+    return out
+
+
+def load_state(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path: str, state: dict) -> None:
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(state, fh, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _entities_signature(entity_ids: List[str]) -> str:
+    return hashlib.sha1("\n".join(sorted(entity_ids)).encode("utf-8")).hexdigest()[:16]
+
+
+def backfill_range(
+    source,
+    output_path_prefix: str,
+    start_us: int,
+    end_us: int,
+    entity_ids: List[str],
+    rotation: str = DAILY,
+    partition_timezone: str = LOCAL,
+    workers: int = 1,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timestamp_format: str = "epoch_us",
+    layout: str = PER_ENTITY,
+    state_path: Optional[str] = BACKFILL_STATE_PATH,
+    force: bool = False,
+) -> Dict[str, dict]:
+    """
+    Importa [start_us, end_us) per le entità indicate, una finestra di file
+    per volta. Ritorna {etichetta: voce del checkpoint} delle finestre
+    importate in questa esecuzione.
+    """
+    state = load_state(state_path) if state_path else {}
+    done_windows = state.setdefault(source.key, {})
+    sig = _entities_signature(entity_ids)
+
+    todo = []
+    for label, w_start, w_end in plan_windows(start_us, end_us, rotation, partition_timezone):
+        entry = done_windows.get(label)
+        if (
+            not force and entry and entry.get("entities_sig") == sig
+            and entry.get("start", w_end) <= w_start and entry.get("end", w_start) >= w_end
+        ):
+            print(f"[INFO] {label}: già importato")
+            continue
+        todo.append((label, w_start, w_end))
+
+    done = {}
+    if not todo:
+        return done
+
+    def _record(label, w_start, w_end, res):
+        if res["mode"] == "busy":
+            print(f"[WARNING] {label}: {res['path']} in uso dal logger o dal compresser, rimandato alla prossima esecuzione")
+            return
+        entry = {"start": w_start, "end": w_end, "entities_sig": sig, "rows": res["rows"], "mode": res["mode"]}
+        done_windows[label] = done[label] = entry
+        # checkpoint a ogni finestra: un'interruzione non perde il lavoro fatto
+        if state_path:
+            save_state(state_path, state)
+        print(f"[INFO] {label}: {res['rows']} campioni di {res['entities']} entità ({res['mode']})")
+
+    args = (entity_ids, output_path_prefix, chunk_size, timestamp_format, layout)
+    workers = max(1, min(int(workers or 1), len(todo)))
+    if workers == 1:
+        for label, w_start, w_end in todo:
+            _record(label, w_start, w_end, backfill_window(source, label, w_start, w_end, *args))
+        return done
+
+    # spawn: i worker non ereditano handle HDF5 né sessioni HTTP del padre
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        futures = [
+            (label, w_start, w_end, pool.submit(backfill_window, source, label, w_start, w_end, *args))
+            for label, w_start, w_end in todo
+        ]
+        for label, w_start, w_end, fut in futures:
+            try:
+                res = fut.result()
+            except Exception as e:
+                # finestra non registrata: ripresa alla prossima esecuzione
+                print(f"[ERROR] {label}: backfill non riuscito: {e!r}")
+                continue
+            _record(label, w_start, w_end, res)
+    return done
+
+
+def default_start_us(days: float) -> int:
+    return utc_now_us() - int(float(days) * 24 * _HOUR_US)
@@ -0,0 +1,237 @@
+"""
+Pianificazione del compresser.
+
+- next_due: prossima occorrenza locale di compress_time (HH:MM), calcolata
+  sul calendario e convertita in epoch solo al momento dell'attesa, quindi
+  corretta anche a cavallo dei cambi di ora legale;
+- pending_files: catch-up di tutti i file la cui finestra (ora, giorno o
+  settimana, vedi rotation) è chiusa e che non hanno il marker di
+  compressione (riavvii, sleep lunghi, giorni saltati); il file corrente
+  non viene mai toccato, e un file bloccato dal logger (handle della
+  finestra ancora aperto) o dal backfill è rimandato (vedi filelock);
+- run_backlog: comprime la coda con un pool limitato di processi e logga
+  lo stato della coda (in attesa / in corso / completati / falliti).
+"""
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+from typing import Dict, List, Tuple
+
+from .compression import compress_file, is_compressed, log_dataset_stats
+from .file_index import load_or_build_index
+from .filelock import FileLock, try_lock
+from .metrics import record_compression
+from .rollup import build_rollups, rollup_path_for
+from .rotation import label_of, list_data_files
+from .swmr import open_read
+
+# nuovo tentativo (s) per i file rimandati perché bloccati da un altro processo
+RETRY_SECONDS = 60
+
+
+def parse_compress_time(value) -> Tuple[int, int]:
+    try:
+        hh, mm = str(value).strip().split(":")
+        hour, minute = int(hh), int(mm)
+        if 0 <= hour < 24 and 0 <= minute < 60:
+            return hour, minute
+    except ValueError:
+        pass
+    print(f"[WARNING] compress_time non valido ({value!r}), uso 02:00")
+    return 2, 0
+
+
+def next_due(compress_time, now: datetime = None) -> datetime:
+    """
+    Prossima occorrenza (ora locale, naive) di compress_time dopo now.
+    """
+    now = now or datetime.now()
+    hour, minute = parse_compress_time(compress_time)
+    due = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due <= now:
+        due = (now + timedelta(days=1)).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return due
+
+
+def pending_files(output_path_prefix: str, now: datetime = None) -> Tuple[List[Tuple[str, str]], int]:
+    """
+    ([(etichetta, path)] da comprimere, numero di file rimandati perché
+    bloccati dal logger o dal backfill).
+    """
+    now = now or datetime.now()
+    queue, deferred = [], 0
+    for _, end, path in list_data_files(output_path_prefix):
+        if end > now:
+            continue
+        try:
+            with open_read(path) as f:
+                if is_compressed(f):
+                    continue
+        except OSError as e:
+            print(f"[WARNING] File non leggibile, escluso dalla compressione: {path} ({e})")
+            continue
+        with try_lock(path) as free:
+            if not free:
+                print(f"[INFO] {path}: ancora in uso, compressione rimandata")
+                deferred += 1
+                continue
+        queue.append((label_of(path), path))
+    return queue, deferred
+
+
+def compress_job(src: str, settings: dict, rollups: bool = True) -> Dict:
+    """
+    Comprime un file dati (tmp + os.replace atomico: l'originale resta
+    intatto fino all'ultimo passo), poi aggiorna indice e rollup.
+    Il file resta bloccato per tutto il job; se un altro processo lo tiene
+    il job non parte e il risultato ha busy=True.
+    Eseguito nei processi del pool: ritorna un riepilogo per il log.
+    """
+    result = {
+        "path": src,
+        "ok": False,
+        "busy": False,
+        "error": "",
+        "size_orig": 0,
+        "size_new": 0,
+        "seconds": 0.0,
+        "stats": [],
+        "rollup_entities": None,
+    }
+    lock = FileLock(src)
+    if not lock.acquire(blocking=False):
+        result["busy"] = True
+        return result
+    try:
+        return _compress_locked(src, settings, rollups, result)
+    finally:
+        lock.release()
+
+
+def _compress_locked(src: str, settings: dict, rollups: bool, result: Dict) -> Dict:
+    tmp = src + ".tmp"
+    t0 = time.time()
+    try:
+        result["stats"] = compress_file(src, tmp, **settings)
+        result["size_orig"] = os.path.getsize(src)
+        result["size_new"] = os.path.getsize(tmp)
+        os.replace(tmp, src)
+    except Exception as e:
+        result["error"] = repr(e)
+        try:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        except Exception:
+            pass
+        return result
+    result["seconds"] = time.time() - t0
+    result["ok"] = True
+
+    # aggiorna l'indice sidecar del file riscritto
+    try:
+        load_or_build_index(src)
+    except Exception as e:
+        print(f"[WARNING] Impossibile aggiornare l'indice di {src}: {e}")
+
+    # aggregati 1m / 1h per i grafici su intervalli lunghi
+    if rollups:
+        try:
+            result["rollup_entities"] = build_rollups(src)
+        except Exception as e:
+            print(f"[WARNING] Impossibile calcolare i rollup di {src}: {e}")
+    return result
+
+
+def _log_result(res: Dict) -> None:
+    src = res["path"]
+    if res.get("busy"):
+        print(f"[INFO] {src}: preso da un altro processo, compressione rimandata")
+        return
+    if not res["ok"]:
+        print(f"[ERROR] Errore durante la compressione di {src}: {res['error']}")
+        print(f"[WARNING] File originale mantenuto: {src}")
+        return
+    size_orig, size_new, secs = res["size_orig"], res["size_new"], res["seconds"]
+    log_dataset_stats(res["stats"])
+    print(f"[INFO] {src}: compresso in {secs:.1f}s")
+    print(f"[INFO] Dimensione originale: {size_orig / (1024*1024):.2f} MB")
+    print(f"[INFO] Dimensione compressa: {size_new / (1024*1024):.2f} MB")
+    if secs > 0:
+        print(f"[INFO] Throughput: {size_orig / (1024*1024) / secs:.1f} MB/s")
+    if size_orig > 0:
+        print(f"[INFO] Riduzione: {100.0 * (1.0 - size_new / size_orig):.1f}%")
+    if res["rollup_entities"] is not None:
+        print(f"[INFO] Rollup 1m/1h di {res['rollup_entities']} entità numeriche: {rollup_path_for(src)}")
+
+
+def _log_queue(state: Dict[str, int]) -> None:
+    print(
+        f"[INFO] Coda compressione: {state['pending']} in attesa, {state['running']} in corso, "
+        f"{state['done']} completati, {state['failed']} falliti, {state['deferred']} rimandati"
+    )
+
+
+def _finish(state: Dict[str, int], res: Dict) -> None:
+    state["running"] -= 1
+    if res.get("busy"):
+        state["deferred"] += 1
+    else:
+        state["done" if res["ok"] else "failed"] += 1
+        record_compression(res)
+    _log_result(res)
+    _log_queue(state)
+
+
+def run_backlog(queue: List[Tuple[str, str]], settings: dict, rollups: bool = True) -> Dict[str, int]:
+    """
+    Comprime i file in coda. Il budget settings["workers"] è diviso tra
+    file in parallelo e processi per file: con un solo file (il caso
+    quotidiano) tutti i worker lavorano sui suoi dataset.
+    """
+    state = {"pending": len(queue), "running": 0, "done": 0, "failed": 0, "deferred": 0}
+    if not queue:
+        print("[INFO] Coda compressione vuota: nessun file da comprimere")
+        return state
+
+    budget = max(1, int(settings.get("workers", 1) or 1))
+    parallel = min(budget, len(queue))
+    per_file = dict(settings, workers=max(1, budget // parallel))
+    print(
+        f"[INFO] Coda compressione: {len(queue)} file ({', '.join(day for day, _ in queue)}); "
+        f"{parallel} in parallelo x {per_file['workers']} worker, "
+        f"{settings.get('codec')} livello {settings.get('level')}"
+    )
+
+    if parallel == 1:
+        for day, path in queue:
+            state["pending"] -= 1
+            state["running"] += 1
+            print(f"[INFO] Compressione di {path}")
+            _finish(state, compress_job(path, per_file, rollups))
+        return state
+
+    # spawn: i worker non ereditano handle HDF5 del processo padre;
+    # al più `parallel` file in corso, il resto resta in coda
+    todo = list(queue)
+    with ProcessPoolExecutor(max_workers=parallel, mp_context=get_context("spawn")) as pool:
+        running = {}
+        while todo or running:
+            while todo and len(running) < parallel:
+                day, path = todo.pop(0)
+                state["pending"] -= 1
+                state["running"] += 1
+                print(f"[INFO] Compressione di {path}")
+                running[pool.submit(compress_job, path, per_file, rollups)] = path
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                path = running.pop(fut)
+                try:
+                    res = fut.result()
+                except Exception as e:
+                    # processo del pool terminato (es. memoria esaurita)
+                    res = {"path": path, "ok": False, "error": repr(e)}
+                _finish(state, res)
+    return state
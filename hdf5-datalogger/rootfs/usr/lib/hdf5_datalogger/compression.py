@@ -0,0 +1,277 @@
+"""
+Copia compressa di file HDF5 a blocchi, con pool di processi.
+
+- ogni dataset viene copiato a slice allineate ai chunk, con un tetto di
+  memoria per slice (max_chunk_bytes), mai caricato per intero;
+- con workers > 1 i dataset vengono ripartiti tra processi: ognuno scrive
+  un file parziale compresso, poi il processo principale li unisce con
+  H5Ocopy (copia dei chunk già compressi, senza ricompressione);
+- codec: gzip, lzf, zstd, blosc (zstd/blosc richiedono hdf5plugin, se
+  assente si ripiega su gzip);
+- il file prodotto porta sulla radice il marker "compressed" (codec:livello)
+  e "compressed_at", usati dal compresser per non ripassare i file già fatti.
+"""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import Dict, List, Tuple
+
+import h5py
+
+from .swmr import open_read
+from .timeutils import utc_now_z
+
+try:
+    # registra i filtri zstd/blosc anche per la lettura dei file compressi
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+COMPRESSION_CODECS = ("gzip", "lzf", "zstd", "blosc")
+DEFAULT_MAX_CHUNK_BYTES = 16 * 1024 * 1024
+COMPRESSED_ATTR = "compressed"
+
+
+def compression_kwargs(codec: str, level: int, dtype) -> Dict:
+    """
+    Argomenti di create_dataset per il codec richiesto.
+    Lo shuffle è attivato solo per i tipi numerici.
+    """
+    codec = str(codec or "gzip").strip().lower()
+    numeric = dtype.kind in ("f", "i", "u", "b")
+
+    if codec in ("zstd", "blosc"):
+        if hdf5plugin is None:
+            print(f"[WARNING] Codec {codec} non disponibile (manca hdf5plugin), uso gzip")
+            codec = "gzip"
+        else:
+            if codec == "zstd":
+                kw = dict(hdf5plugin.Zstd(clevel=int(level)))
+            else:
+                shuffle = hdf5plugin.Blosc.SHUFFLE if numeric else hdf5plugin.Blosc.NOSHUFFLE
+                kw = dict(hdf5plugin.Blosc(cname="zstd", clevel=int(level), shuffle=shuffle))
+            if codec == "zstd" and numeric:
+                kw["shuffle"] = True
+            return kw
+
+    if codec == "lzf":
+        return {"compression": "lzf", "shuffle": numeric}
+
+    return {
+        "compression": "gzip",
+        "compression_opts": max(0, min(9, int(level))),
+        "shuffle": numeric,
+    }
+
+
+def _copy_attrs(src, dst) -> None:
+    for aname, aval in src.attrs.items():
+        dst.attrs[aname] = aval
+
+
+def _slice_rows(ds: h5py.Dataset, max_chunk_bytes: int) -> int:
+    """
+    Righe per slice: multiplo della dimensione del chunk che sta nel budget.
+    """
+    row_bytes = max(1, ds.dtype.itemsize * int(max(1, _prod(ds.shape[1:]))))
+    chunk_rows = ds.chunks[0] if ds.chunks else 1024
+    rows = max(1, max_chunk_bytes // row_bytes)
+    if rows >= chunk_rows:
+        rows -= rows % chunk_rows
+    return max(1, rows)
+
+
+def _prod(shape) -> int:
+    n = 1
+    for s in shape:
+        n *= int(s)
+    return n
+
+
+def copy_dataset_streaming(
+    ds: h5py.Dataset,
+    dst_group: h5py.Group,
+    name: str,
+    codec: str,
+    level: int,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+) -> Dict:
+    """
+    Copia ds in dst_group/name compresso, a slice di al più max_chunk_bytes.
+    Ritorna statistiche: raw_bytes, stored_bytes, seconds.
+    """
+    t0 = time.monotonic()
+    kw = compression_kwargs(codec, level, ds.dtype)
+    n = ds.shape[0] if ds.shape else 0
+    if ds.shape == () or n == 0:
+        # scalari / dataset vuoti: niente compressione a chunk
+        out = dst_group.create_dataset(name, data=ds[()] if ds.shape == () else None,
+                                       shape=ds.shape, dtype=ds.dtype, maxshape=ds.maxshape)
+    else:
+        chunks = ds.chunks or (min(n, 1024),) + tuple(ds.shape[1:])
+        out = dst_group.create_dataset(
+            name,
+            shape=ds.shape,
+            maxshape=ds.maxshape,
+            dtype=ds.dtype,
+            chunks=chunks,
+            **kw,
+        )
+        step = _slice_rows(ds, max_chunk_bytes)
+        for start in range(0, n, step):
+            end = min(n, start + step)
+            out[start:end] = ds[start:end]
+    _copy_attrs(ds, out)
+    raw = ds.dtype.itemsize * _prod(ds.shape)
+    return {
+        "raw_bytes": raw,
+        "stored_bytes": out.id.get_storage_size(),
+        "seconds": time.monotonic() - t0,
+    }
+
+
+def list_datasets(f: h5py.File) -> List[Tuple[str, int]]:
+    """
+    (path, byte non compressi) di tutti i dataset del file.
+    """
+    out = []
+
+    def _visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            out.append((name, obj.dtype.itemsize * _prod(obj.shape)))
+
+    f.visititems(_visit)
+    return out
+
+
+def _copy_groups(g_in: h5py.Group, g_out: h5py.Group) -> None:
+    # copia gerarchia e attributi dei gruppi (i dataset vengono copiati a parte)
+    _copy_attrs(g_in, g_out)
+    for name, item in g_in.items():
+        if isinstance(item, h5py.Group):
+            _copy_groups(item, g_out.require_group(name))
+
+
+def _ensure_parent(f: h5py.File, path: str) -> h5py.Group:
+    parent = path.rsplit("/", 1)[0] if "/" in path else ""
+    return f.require_group(parent) if parent else f
+
+
+def _compress_part(
+    src_path: str,
+    part_path: str,
+    ds_paths: List[str],
+    codec: str,
+    level: int,
+    max_chunk_bytes: int,
+) -> List[Tuple[str, Dict]]:
+    stats = []
+    with open_read(src_path) as fin, h5py.File(part_path, "w") as fout:
+        for path in ds_paths:
+            parent = _ensure_parent(fout, path)
+            name = path.rsplit("/", 1)[-1]
+            stats.append((path, copy_dataset_streaming(fin[path], parent, name, codec, level, max_chunk_bytes)))
+    return stats
+
+
+def mark_compressed(f: h5py.File, codec: str, level: int) -> None:
+    f.attrs[COMPRESSED_ATTR] = f"{codec}:{level}"
+    f.attrs["compressed_at"] = utc_now_z()
+
+
+def is_compressed(f: h5py.File) -> bool:
+    """
+    True se il file porta il marker; i file compressi prima del marker
+    vengono riconosciuti dal filtro sul primo dataset a chunk non vuoto.
+    """
+    if COMPRESSED_ATTR in f.attrs:
+        return True
+    found = []
+
+    def _visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and obj.chunks and obj.shape and obj.shape[0] > 0:
+            found.append(obj.id.get_create_plist().get_nfilters() > 0)
+            return True
+
+    f.visititems(_visit)
+    return bool(found and found[0])
+
+
+def _partition(datasets: List[Tuple[str, int]], n: int) -> List[List[str]]:
+    # bilanciamento greedy per dimensione: il dataset più grande al worker più scarico
+    bins = [[0, []] for _ in range(n)]
+    for path, size in sorted(datasets, key=lambda x: -x[1]):
+        b = min(bins, key=lambda x: x[0])
+        b[0] += size
+        b[1].append(path)
+    return [b[1] for b in bins if b[1]]
+
+
+def compress_file(
+    src_path: str,
+    dst_path: str,
+    codec: str = "gzip",
+    level: int = 4,
+    workers: int = 1,
+    max_chunk_bytes: int = DEFAULT_MAX_CHUNK_BYTES,
+) -> List[Tuple[str, Dict]]:
+    """
+    Scrive in dst_path una copia compressa di src_path.
+    Ritorna [(path_dataset, stats)] per il log di throughput/rapporto.
+    """
+    with open_read(src_path) as fin:
+        datasets = list_datasets(fin)
+
+    workers = max(1, min(int(workers or 1), len(datasets) or 1))
+    parts = _partition(datasets, workers)
+
+    if workers == 1:
+        with open_read(src_path) as fin, h5py.File(dst_path, "w") as fout:
+            _copy_groups(fin, fout)
+            stats = []
+            for path, _ in datasets:
+                parent = _ensure_parent(fout, path)
+                name = path.rsplit("/", 1)[-1]
+                stats.append((path, copy_dataset_streaming(fin[path], parent, name, codec, level, max_chunk_bytes)))
+            mark_compressed(fout, codec, level)
+        return stats
+
+    part_paths = [f"{dst_path}.part{i}" for i in range(len(parts))]
+    stats = []
+    try:
+        # spawn: i worker non ereditano handle HDF5 del processo padre
+        with ProcessPoolExecutor(max_workers=len(parts), mp_context=get_context("spawn")) as pool:
+            futures = [
+                pool.submit(_compress_part, src_path, pp, paths, codec, level, max_chunk_bytes)
+                for pp, paths in zip(part_paths, parts)
+            ]
+            for fut in futures:
+                stats.extend(fut.result())
+
+        with open_read(src_path) as fin, h5py.File(dst_path, "w") as fout:
+            _copy_groups(fin, fout)
+            for pp, paths in zip(part_paths, parts):
+                with h5py.File(pp, "r") as fpart:
+                    for path in paths:
+                        parent = _ensure_parent(fout, path)
+                        # H5Ocopy: copia i chunk già compressi così come sono
+                        fpart.copy(fpart[path], parent, name=path.rsplit("/", 1)[-1])
+            mark_compressed(fout, codec, level)
+    finally:
+        for pp in part_paths:
+            try:
+                if os.path.exists(pp):
+                    os.remove(pp)
+            except Exception:
+                pass
+    return stats
+
+
+def log_dataset_stats(stats: List[Tuple[str, Dict]]) -> None:
+    for path, st in stats:
+        mb = st["raw_bytes"] / (1024 * 1024)
+        secs = max(st["seconds"], 1e-9)
+        ratio = st["raw_bytes"] / st["stored_bytes"] if st["stored_bytes"] else 0.0
+        print(f"[INFO]   {path}: {mb:.2f} MB, {mb / secs:.1f} MB/s, ratio {ratio:.2f}x")
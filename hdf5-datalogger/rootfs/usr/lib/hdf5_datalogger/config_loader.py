@@ -1,7 +1,8 @@
 import json
-from .constants import OPTIONS_PATH
+import os
+from .constants import OPTIONS_PATH, DEFAULT_CAPTURE_ATTRIBUTES
 
-def load_options():
+def load_options(path: str = OPTIONS_PATH):
     """
     Carica le opzioni dal file /data/options.json con default sensati.
     """
@@ -10,11 +11,48 @@ def load_options():
         "max_entities": 0,
         "update_interval": 60,
         "include_domains": [],
+        "include_entities": [],
+        "include_patterns": [],
+        "exclude_patterns": [],
+        "fetch_mode": "auto",
+        "fetch_workers": 4,
         "output_path_prefix": "/share/hdf5/",
+        "rotation": "daily",
+        "partition_timezone": "local",
         "compress_time": "02:00",
+        "compression": "gzip",
+        "compression_level": 4,
+        "compress_workers": 2,
+        "compress_max_chunk_mb": 16,
+        "retention_days": 0,
+        "rollup_retention_days": 0,
+        "storage_max_mb": 0,
+        "archive_monthly": False,
+        "retention": [],
+        "daemon_mode": True,
+        "ingest_mode": "poll",
+        "write_queue_size": 4,
+        "buffer_max_samples": 60,
+        "buffer_max_age": 300,
+        "hdf5_chunk_size": 1024,
+        "hdf5_layout": "per_entity",
+        "timestamp_format": "epoch_us",
+        "last_values_flush_interval": 60,
+        "deadbands": [],
+        "capture_attributes": [dict(r) for r in DEFAULT_CAPTURE_ATTRIBUTES],
+        "rollups": True,
+        "write_ahead_log": True,
+        "hdf5_swmr": True,
+        "metrics_port": 9464,
+        "metrics_host": "127.0.0.1",
+        "metrics_snapshot_path": "/data/hdf5_datalogger_metrics.json",
+        "metrics_snapshot_interval": 300,
+        "report_update": "on_change",
+        "report_min_interval": 0,
+        "report_summary_only": False,
     }
     try:
-        with open(OPTIONS_PATH, "r", encoding="utf-8") as f:
+        with open(path, "r", encoding="utf-8") as f:
             data = json.load(f)
         for key in list(opts.keys()):
             if key in data:
@@ -23,3 +61,43 @@ def load_options():
         # fallback ai default se qualcosa va storto
         pass
     return opts
+
+
+class OptionsWatcher:
+    """
+    Tiene in memoria le opzioni e le ricarica solo quando options.json
+    cambia (mtime/size), per l'hot-reload del logger residente.
+    """
+
+    def __init__(self, path: str = OPTIONS_PATH):
+        self.path = path
+        self._signature = self._stat_signature()
+        self.options = load_options(path)
+
+    def _stat_signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def changed(self) -> bool:
+        """
+        True se options.json è cambiato su disco dall'ultimo poll, senza
+        ricaricarlo.
+        """
+        return self._stat_signature() != self._signature
+
+    def poll(self) -> bool:
+        """
+        Ritorna True se le opzioni sono state ricaricate.
+        """
+        sig = self._stat_signature()
+        if sig == self._signature:
+            return False
+        self._signature = sig
+        new_opts = load_options(self.path)
+        if new_opts == self.options:
+            return False
+        self.options = new_opts
+        return True
@@ -1,4 +1,5 @@
 API_URL = "http://supervisor/core/api"
+WS_URL = "ws://supervisor/core/websocket"
 OPTIONS_PATH = "/data/options.json"
 
 # Domini inclusi di default se include_domains è vuoto
@@ -12,3 +13,34 @@ DEFAULT_INCLUDED_DOMAINS = {
 
 # Percorso per lo stato degli ultimi valori (per il log "solo se cambia")
 LAST_VALUES_PATH = "/data/hdf5_last_values.json"
+
+# Dimensione (in campioni) dei chunk dei dataset value/timestamp
+DEFAULT_CHUNK_SIZE = 1024
+
+# Attributi statici delle entità copiati nei metadati HDF5
+STATIC_ATTR_KEYS = (
+    "friendly_name",
+    "unit_of_measurement",
+    "device_class",
+    "state_class",
+    "area_id",
+    "device_id",
+)
+
+# Attributi catturati come serie temporali (opzione capture_attributes)
+DEFAULT_CAPTURE_ATTRIBUTES = [
+    {"match": "domain:climate", "attributes": "current_temperature,temperature,hvac_action"},
+    {"match": "domain:light", "attributes": "brightness,color_temp"},
+]
+
+# Journal write-ahead dei campioni non ancora scritti nel file HDF5
+WAL_PATH = "/data/hdf5_wal.log"
+
+# Totali del compresser (processo separato) esposti dalle metriche del logger
+COMPRESS_METRICS_PATH = "/data/hdf5_compress_metrics.json"
+
+# Occupazione del disco per dominio calcolata dal gestore dello spazio (compresser)
+STORAGE_USAGE_PATH = "/data/hdf5_storage_usage.json"
+
+# Checkpoint del backfill dallo storico del recorder (finestre già importate)
+BACKFILL_STATE_PATH = "/data/hdf5_backfill_state.json"
@@ -0,0 +1,138 @@
+"""
+Filtro deadband / rate-limit / heartbeat applicato prima della scrittura.
+
+Regole da options.json (lista "deadbands"), ognuna con:
+  match:        entity_id, "device_class:<classe>", "domain:<dominio>" o "*"
+  abs:          deadband assoluta (valori numerici)
+  rel:          deadband relativa, frazione dell'ultimo valore scritto
+  min_interval: secondi minimi tra due campioni scritti
+  heartbeat:    secondi dopo i quali un campione viene scritto comunque,
+                anche se invariato
+
+Precedenza: entity_id > device_class > domain > "*".
+min_interval e heartbeat sono misurati sull'orologio del writer (istante
+di arrivo dello stato), non su last_changed, che resta fermo finché il
+valore non cambia.
+I confronti sono sempre rispetto all'ultimo valore *scritto*: un cambio
+soppresso resta in attesa e viene scritto appena supera la deadband o
+l'intervallo minimo.
+"""
+
+from typing import Dict, List, Optional
+
+from .domains import domain_of
+
+WRITE = "write"
+UNCHANGED = "unchanged"
+DEADBAND = "deadband"
+RATE = "rate"
+HEARTBEAT = "heartbeat"
+
+
+class DeadbandRule:
+    __slots__ = ("match", "abs", "rel", "min_interval_us", "heartbeat_us")
+
+    def __init__(self, match: str, abs=None, rel=None, min_interval=None, heartbeat=None):
+        self.match = str(match).strip()
+        self.abs = float(abs) if abs not in (None, "") else None
+        self.rel = float(rel) if rel not in (None, "") else None
+        self.min_interval_us = int(float(min_interval) * 1_000_000) if min_interval else 0
+        self.heartbeat_us = int(float(heartbeat) * 1_000_000) if heartbeat else 0
+
+
+def _to_float(raw: str) -> Optional[float]:
+    try:
+        v = float(raw)
+    except (TypeError, ValueError):
+        return None
+    return v if v == v else None
+
+
+class DeadbandFilter:
+    def __init__(self, rules: List[DeadbandRule]):
+        self._by_entity: Dict[str, DeadbandRule] = {}
+        self._by_device_class: Dict[str, DeadbandRule] = {}
+        self._by_domain: Dict[str, DeadbandRule] = {}
+        self._default: Optional[DeadbandRule] = None
+        for r in rules:
+            if r.match == "*":
+                self._default = r
+            elif r.match.startswith("device_class:"):
+                self._by_device_class[r.match.split(":", 1)[1].strip().lower()] = r
+            elif r.match.startswith("domain:"):
+                self._by_domain[r.match.split(":", 1)[1].strip().lower()] = r
+            else:
+                self._by_entity[r.match] = r
+        self._rule_cache: Dict[str, Optional[DeadbandRule]] = {}
+        # timestamp (us) dell'ultimo campione scritto per entità
+        self._last_ts: Dict[str, int] = {}
+
+    @classmethod
+    def from_options(cls, opts: dict) -> Optional["DeadbandFilter"]:
+        rules = []
+        for raw in opts.get("deadbands") or []:
+            if not isinstance(raw, dict) or not raw.get("match"):
+                continue
+            try:
+                rules.append(DeadbandRule(
+                    raw["match"],
+                    abs=raw.get("abs"),
+                    rel=raw.get("rel"),
+                    min_interval=raw.get("min_interval"),
+                    heartbeat=raw.get("heartbeat"),
+                ))
+            except (TypeError, ValueError) as e:
+                print(f"[WARNING] Regola deadband non valida {raw}: {e}")
+        return cls(rules) if rules else None
+
+    def rule_for(self, entity_id: str, attrs: dict) -> Optional[DeadbandRule]:
+        if entity_id in self._rule_cache:
+            return self._rule_cache[entity_id]
+        rule = self._by_entity.get(entity_id)
+        if rule is None:
+            dc = str(attrs.get("device_class") or "").lower()
+            rule = self._by_device_class.get(dc) if dc else None
+        if rule is None:
+            rule = self._by_domain.get(domain_of(entity_id))
+        if rule is None:
+            rule = self._default
+        self._rule_cache[entity_id] = rule
+        return rule
+
+    def seed(self, entity_id: str, last_ts_us: int) -> None:
+        """
+        Imposta l'ultimo timestamp scritto (es. dall'indice del file) se ignoto.
+        """
+        self._last_ts.setdefault(entity_id, int(last_ts_us))
+
+    def decide(self, entity_id: str, attrs: dict, new_raw: str, last_raw: Optional[str], ts_us: int) -> str:
+        rule = self.rule_for(entity_id, attrs)
+        unchanged = last_raw is not None and last_raw == new_raw
+        if rule is None:
+            return UNCHANGED if unchanged else WRITE
+
+        last_ts = self._last_ts.get(entity_id)
+        elapsed = None if last_ts is None else ts_us - last_ts
+
+        if rule.heartbeat_us and last_raw is not None and elapsed is not None and elapsed >= rule.heartbeat_us:
+            return HEARTBEAT
+        if unchanged:
+            return UNCHANGED
+        if last_raw is None or elapsed is None:
+            return WRITE
+        if rule.min_interval_us and elapsed < rule.min_interval_us:
+            return RATE
+
+        if rule.abs is not None or rule.rel is not None:
+            new_v = _to_float(new_raw)
+            old_v = _to_float(last_raw)
+            if new_v is not None and old_v is not None:
+                diff = abs(new_v - old_v)
+                if rule.abs is not None and diff < rule.abs:
+                    return DEADBAND
+                if rule.rel is not None and diff < rule.rel * abs(old_v):
+                    return DEADBAND
+        return WRITE
+
+    def committed(self, entity_id: str, ts_us: int) -> None:
+        self._last_ts[entity_id] = int(ts_us)
@@ -0,0 +1,316 @@
+"""
+Codifica compatta dei valori per il layout per-entità.
+
+Il tipo del dataset value dipende dal dominio, non più dal primo valore:
+
+  - "bool":   uint8 per i domini binari (binary_sensor, light, switch, ...);
+              tabella stati iniziale ["off", "on"], così 0/1 = off/on
+  - "enum":   codici uint16 per gli stati enumerati (climate, cover, ...),
+              con la tabella degli stati nell'attributo "states" del dataset
+  - "float":  float64 per i valori numerici
+  - "string": S256, come in passato, per i testi liberi
+
+Accanto a value c'è il dataset "availability" (uint8: 0 = disponibile,
+1 = unavailable, 2 = unknown). Questi campioni non decidono il tipo di
+value e non ne sporcano il contenuto. Se un'entità nasce "unavailable",
+value viene creato solo al primo valore valido (le righe precedenti
+restano al fillvalue, mascherate da availability).
+
+In lettura (read_values) il tipo dipende solo dalla codifica del gruppo:
+float64 per "float" (NaN dove il campione non è disponibile), testo S256
+per le altre. Lo stato testuale di ogni campione (unavailable/unknown,
+stato della tabella, testo) è in un array parallelo (read_states).
+
+I gruppi scritti prima di questa codifica (value senza availability)
+continuano a essere scritti e letti come prima.
+"""
+
+from typing import Callable, Dict, List, Optional
+
+import h5py
+import numpy as np
+
+BOOL = "bool"
+ENUM = "enum"
+FLOAT = "float"
+STRING = "string"
+
+AVAILABLE = 0
+AVAILABILITY_CODES = {"unavailable": 1, "unknown": 2}
+AVAILABILITY_LABELS = ("available", "unavailable", "unknown")
+
+BOOL_DOMAINS = {
+    "binary_sensor",
+    "light",
+    "switch",
+    "input_boolean",
+    "fan",
+    "siren",
+    "remote",
+    "automation",
+    "script",
+    "schedule",
+}
+
+ENUM_DOMAINS = {
+    "climate",
+    "cover",
+    "lock",
+    "alarm_control_panel",
+    "media_player",
+    "vacuum",
+    "water_heater",
+    "humidifier",
+    "valve",
+    "lawn_mower",
+    "person",
+    "device_tracker",
+    "select",
+    "input_select",
+    "sun",
+    "weather",
+    "update",
+}
+
+_CODE_DTYPES = {BOOL: "u1", ENUM: "u2"}
+_INITIAL_STATES = {BOOL: ["off", "on"], ENUM: []}
+
+
+def _is_number(raw: str) -> bool:
+    try:
+        float(raw)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def _to_float(raw: str) -> float:
+    try:
+        return float(raw)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _text(v) -> str:
+    return v.decode("utf-8", errors="replace") if isinstance(v, bytes) else str(v)
+
+
+def availability_of(raw_values: List[str]) -> np.ndarray:
+    return np.fromiter(
+        (AVAILABILITY_CODES.get(v, AVAILABLE) for v in raw_values), dtype="u1", count=len(raw_values)
+    )
+
+
+def choose_encoding(domain: str, attrs: dict, raw_values: List[str], text_encoding: str = STRING) -> Optional[str]:
+    """
+    Codifica per un nuovo dataset value; None se ancora indecidibile
+    (solo campioni unavailable/unknown e nessun indizio dagli attributi).
+    text_encoding è la codifica dei valori non numerici fuori dai domini noti.
+    """
+    if domain in BOOL_DOMAINS:
+        return BOOL
+    if domain in ENUM_DOMAINS:
+        return ENUM
+    for raw in raw_values:
+        if raw in AVAILABILITY_CODES:
+            continue
+        return FLOAT if _is_number(raw) else text_encoding
+    if attrs.get("unit_of_measurement") or attrs.get("state_class"):
+        return FLOAT
+    return None
+
+
+def is_encoded_group(grp: h5py.Group) -> bool:
+    return "availability" in grp
+
+
+def _create_value(
+    grp: h5py.Group,
+    encoding: str,
+    length: int,
+    chunks: tuple,
+    filters: Callable[[np.dtype], Dict] = None,
+) -> h5py.Dataset:
+    if encoding == FLOAT:
+        dtype = np.dtype("f8")
+    elif encoding == STRING:
+        dtype = np.dtype("S256")
+    else:
+        dtype = np.dtype(_CODE_DTYPES[encoding])
+    kw = filters(dtype) if filters is not None else {}
+    if encoding == FLOAT:
+        kw["fillvalue"] = np.nan
+    ds = grp.create_dataset("value", shape=(length,), maxshape=(None,), dtype=dtype, chunks=chunks, **kw)
+    if encoding not in (FLOAT, STRING):
+        ds.attrs["states"] = np.array(_INITIAL_STATES[encoding], dtype=h5py.string_dtype())
+    ds.attrs["encoding"] = encoding
+    return ds
+
+
+def _encode_codes(ds: h5py.Dataset, raw_values: List[str], avail: np.ndarray) -> np.ndarray:
+    states = [_text(s) for s in ds.attrs.get("states", [])]
+    lookup = {s: i for i, s in enumerate(states)}
+    limit = np.iinfo(ds.dtype).max + 1
+    codes = np.zeros(len(raw_values), dtype=ds.dtype)
+    grown = False
+    for i, raw in enumerate(raw_values):
+        if avail[i] != AVAILABLE:
+            continue
+        code = lookup.get(raw)
+        if code is None:
+            if len(states) >= limit:
+                print(f"[WARNING] Tabella stati piena per {ds.parent.name}: '{raw}' marcato unknown")
+                avail[i] = AVAILABILITY_CODES["unknown"]
+                continue
+            code = lookup[raw] = len(states)
+            states.append(raw)
+            grown = True
+        codes[i] = code
+    if grown:
+        # la tabella cambia solo con stati mai visti: una scrittura di metadati rara
+        ds.attrs["states"] = np.array(states, dtype=h5py.string_dtype())
+    return codes
+
+
+def append_values(
+    grp: h5py.Group,
+    domain: str,
+    attrs: dict,
+    raw_values: List[str],
+    chunk_size: int,
+    text_encoding: str = STRING,
+    filters: Callable[[np.dtype], Dict] = None,
+) -> None:
+    """
+    Accoda value + availability per un gruppo codificato (o nuovo).
+    Il dataset timestamp è a carico del chiamante.
+
+    filters(dtype), se presente, dà gli argomenti di compressione dei
+    dataset creati qui (es. compression_kwargs per gli archivi).
+    """
+    chunks = (max(1, int(chunk_size)),)
+    if "availability" not in grp:
+        kw = filters(np.dtype("u1")) if filters is not None else {}
+        avail_ds = grp.create_dataset(
+            "availability", shape=(0,), maxshape=(None,), dtype="u1", chunks=chunks, **kw
+        )
+        avail_ds.attrs["labels"] = np.array(AVAILABILITY_LABELS, dtype=h5py.string_dtype())
+    else:
+        avail_ds = grp["availability"]
+
+    avail = availability_of(raw_values)
+    start = avail_ds.shape[0]
+    end = start + len(raw_values)
+
+    val_ds = grp.get("value")
+    if val_ds is None:
+        encoding = choose_encoding(domain, attrs, raw_values, text_encoding)
+        if encoding is not None:
+            val_ds = _create_value(grp, encoding, start, chunks, filters)
+
+    if val_ds is not None:
+        encoding = _text(val_ds.attrs.get("encoding", FLOAT))
+        if encoding == FLOAT:
+            values = np.fromiter((_to_float(v) for v in raw_values), dtype="f8", count=len(raw_values))
+            values[avail != AVAILABLE] = np.nan
+        elif encoding == STRING:
+            values = np.array(
+                [b"" if a != AVAILABLE else v.encode("utf-8") for v, a in zip(raw_values, avail)],
+                dtype=val_ds.dtype,
+            )
+        else:
+            values = _encode_codes(val_ds, raw_values, avail)
+        val_ds.resize((end,))
+        val_ds[start:end] = values
+
+    avail_ds.resize((end,))
+    avail_ds[start:end] = avail
+
+
+def needs_structure(
+    grp: Optional[h5py.Group],
+    domain: str,
+    attrs: dict,
+    raw_values: List[str],
+    text_encoding: str = STRING,
+) -> bool:
+    """
+    True se accodare raw_values a grp creerebbe dataset o riscriverebbe la
+    tabella degli stati (operazioni non ammesse con il file in SWMR).
+    """
+    if grp is None or "timestamp" not in grp:
+        return True
+    if not is_encoded_group(grp):
+        # gruppo storico: solo append; senza value è un gruppo nuovo
+        return "value" not in grp
+    val_ds = grp.get("value")
+    if val_ds is None:
+        return choose_encoding(domain, attrs, raw_values, text_encoding) is not None
+    if _text(val_ds.attrs.get("encoding", FLOAT)) in (FLOAT, STRING):
+        return False
+    known = {_text(s) for s in val_ds.attrs.get("states", [])}
+    return any(raw not in known for raw in raw_values if raw not in AVAILABILITY_CODES)
+
+
+def text_states(values: np.ndarray) -> np.ndarray:
+    """
+    Stati di valori già decodificati in un solo array (gruppi storici):
+    il testo stesso, b"" per i numerici.
+    """
+    if values.dtype.kind == "S":
+        return values.astype("S256")
+    return np.zeros(len(values), dtype="S256")
+
+
+def _labels(avail: np.ndarray) -> np.ndarray:
+    labels = np.array([lab.encode("utf-8") for lab in AVAILABILITY_LABELS], dtype="S256")
+    return labels[avail]
+
+
+def read_values(grp: h5py.Group, sel: slice = slice(None)) -> np.ndarray:
+    """
+    Valori decodificati di un gruppo per-entità: float64 per la codifica
+    "float" (NaN dove il campione non è disponibile, anche se lo è tutta la
+    fetta), altrimenti stringhe S256 (stati dalla tabella, testo,
+    "unavailable"/"unknown" dalla maschera).
+    """
+    if not is_encoded_group(grp):
+        return grp["value"][sel]
+
+    avail = grp["availability"][sel]
+    missing = avail != AVAILABLE
+    val_ds = grp.get("value")
+    if val_ds is None:
+        return _labels(avail)
+    encoding = _text(val_ds.attrs.get("encoding", FLOAT))
+    raw = val_ds[sel]
+    if encoding == FLOAT:
+        raw[missing] = np.nan
+        return raw
+    if encoding == STRING:
+        out = raw.astype("S256")
+    else:
+        states = np.array(
+            [_text(s).encode("utf-8") for s in val_ds.attrs.get("states", [])] or [b""], dtype="S256"
+        )
+        out = states[np.minimum(raw, len(states) - 1)]
+    out[missing] = _labels(avail[missing])
+    return out
+
+
+def read_states(grp: h5py.Group, sel: slice = slice(None)) -> np.ndarray:
+    """
+    Stato testuale di ogni campione, parallelo a read_values: b"" dove il
+    campione è un numero disponibile, altrimenti il testo (unavailable/
+    unknown dalla maschera, stato o testo libero).
+    """
+    if not is_encoded_group(grp):
+        return text_states(grp["value"][sel])
+    val_ds = grp.get("value")
+    if val_ds is not None and _text(val_ds.attrs.get("encoding", FLOAT)) != FLOAT:
+        return read_values(grp, sel)
+    avail = grp["availability"][sel]
+    out = np.zeros(len(avail), dtype="S256")
+    missing = avail != AVAILABLE
+    out[missing] = _labels(avail[missing])
+    return out
@@ -0,0 +1,314 @@
+"""
+Export dei file giornalieri verso Parquet, Arrow IPC o CSV.
+
+Output partizionato per dominio e data (stile Hive):
+
+  <out_dir>/domain=<dominio>/date=<etichetta>/part-0.<parquet|arrow|csv>
+
+L'etichetta è quella del file sorgente (YYYY-MM-DD, YYYY-MM-DDTHH,
+YYYY-Www o YYYY-MM per gli archivi mensili, vedi rotation).
+
+Colonne: entity_id, timestamp (us UTC), value (float64, vuoto se lo stato
+non è numerico), state (testo, vuoto se numerico).
+
+- ogni giorno è elaborato da un processo del pool; dentro il file i
+  dataset vengono letti a slice di batch_rows righe, quindi la memoria
+  resta limitata anche per giorni grandi;
+- il manifest <out_dir>/_export_manifest.json registra size/mtime di ogni
+  file sorgente: i giorni già esportati e non più modificati vengono
+  saltati alla riesecuzione;
+- il CSV (default) usa solo la libreria standard; Parquet/Arrow richiedono
+  pyarrow, che non è installato nell'immagine dell'add-on (installazione
+  opzionale: pip install pyarrow). Senza pyarrow export_range fallisce con
+  ImportError prima di iniziare.
+"""
+
+import csv
+import importlib.util
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, timedelta
+from multiprocessing import get_context
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import h5py
+import numpy as np
+
+from . import compression  # noqa: F401  (filtri zstd/blosc opzionali)
+from .encoding import is_encoded_group, read_states, read_values
+from .layout import is_columnar_group
+from .rotation import label_of, list_data_files
+from .swmr import open_read
+from .timestamps import read_timestamps_us
+from .timeutils import epoch_us_to_iso_z
+
+EXPORT_FORMATS = ("parquet", "arrow", "csv")
+MANIFEST_NAME = "_export_manifest.json"
+DEFAULT_BATCH_ROWS = 65536
+
+_EXTENSIONS = {"parquet": "parquet", "arrow": "arrow", "csv": "csv"}
+
+
+def _text(v) -> str:
+    return v.decode("utf-8", errors="replace") if isinstance(v, bytes) else str(v)
+
+
+def _split_values(values: np.ndarray, states: np.ndarray) -> Tuple[list, list]:
+    """
+    (value, state) per riga: numerici in value, il resto in state.
+    """
+    if values.dtype.kind == "f":
+        return (
+            [None if v != v else float(v) for v in values],
+            [_text(st) if st else None for st in states],
+        )
+    nums, texts = [], []
+    for raw in values:
+        s = _text(raw)
+        try:
+            nums.append(float(s))
+            texts.append(None)
+        except ValueError:
+            nums.append(None)
+            texts.append(s)
+    return nums, texts
+
+
+def _entity_batches(grp: h5py.Group, entity_id: str, batch_rows: int) -> Iterator[Tuple[list, np.ndarray, list, list]]:
+    ts_ds = grp["timestamp"]
+    n = ts_ds.shape[0]
+    if "value" not in grp and not is_encoded_group(grp):
+        return
+    for start in range(0, n, batch_rows):
+        sl = slice(start, min(n, start + batch_rows))
+        nums, texts = _split_values(read_values(grp, sl), read_states(grp, sl))
+        yield [entity_id] * (sl.stop - sl.start), read_timestamps_us(ts_ds, sl), nums, texts
+
+
+def _columnar_batches(grp: h5py.Group, batch_rows: int) -> Iterator[Tuple[list, np.ndarray, list, list]]:
+    entities = [_text(e) for e in grp["entities"][()]]
+    states = [_text(s) for s in grp["states"][()]]
+    n = grp["timestamp"].shape[0]
+    for start in range(0, n, batch_rows):
+        sl = slice(start, min(n, start + batch_rows))
+        idx = grp["entity_index"][sl]
+        values = grp["value"][sl]
+        codes = grp["state_code"][sl]
+        nums = [None if c or v != v else float(v) for v, c in zip(values, codes)]
+        texts = [states[c] if c else None for c in codes]
+        yield [entities[i] for i in idx], read_timestamps_us(grp["timestamp"], sl), nums, texts
+
+
+def iter_domain_batches(f: h5py.File, domain: str, batch_rows: int = DEFAULT_BATCH_ROWS):
+    """
+    Batch (entity_ids, timestamps_us, value, state) di un dominio, in
+    entrambi i layout.
+    """
+    dgrp = f.get(domain)
+    if not isinstance(dgrp, h5py.Group):
+        return
+    if is_columnar_group(dgrp):
+        yield from _columnar_batches(dgrp, batch_rows)
+        return
+    for name, grp in dgrp.items():
+        if not isinstance(grp, h5py.Group) or "timestamp" not in grp:
+            continue
+        entity_id = _text(grp.attrs.get("entity_id", name))
+        yield from _entity_batches(grp, entity_id, batch_rows)
+
+
+class _PartWriter:
+    """
+    Scrittore incrementale di una partizione (file .tmp rinominato a fine giorno).
+    """
+
+    def __init__(self, path: str, fmt: str):
+        self.path = path
+        self.tmp = path + ".tmp"
+        self.fmt = fmt
+        self.rows = 0
+        self._writer = None
+        self._fh = None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if fmt == "csv":
+            self._fh = open(self.tmp, "w", encoding="utf-8", newline="")
+            self._writer = csv.writer(self._fh)
+            self._writer.writerow(["entity_id", "timestamp", "value", "state"])
+        else:
+            import pyarrow as pa
+
+            self._pa = pa
+            self._schema = pa.schema([
+                ("entity_id", pa.string()),
+                ("timestamp", pa.timestamp("us", tz="UTC")),
+                ("value", pa.float64()),
+                ("state", pa.string()),
+            ])
+            if fmt == "parquet":
+                import pyarrow.parquet as pq
+
+                self._writer = pq.ParquetWriter(self.tmp, self._schema, compression="zstd")
+            else:
+                self._writer = pa.ipc.new_file(self.tmp, self._schema)
+
+    def write(self, entity_ids: list, ts_us: np.ndarray, nums: list, texts: list) -> None:
+        if not entity_ids:
+            return
+        if self.fmt == "csv":
+            for eid, t, v, s in zip(entity_ids, ts_us, nums, texts):
+                self._writer.writerow([eid, epoch_us_to_iso_z(int(t)), "" if v is None else repr(v), s or ""])
+        else:
+            pa = self._pa
+            batch = pa.record_batch(
+                [
+                    pa.array(entity_ids, pa.string()),
+                    pa.array(np.asarray(ts_us, dtype="i8"), pa.int64()).cast(self._schema.field("timestamp").type),
+                    pa.array(nums, pa.float64()),
+                    pa.array(texts, pa.string()),
+                ],
+                schema=self._schema,
+            )
+            self._writer.write_batch(batch)
+        self.rows += len(entity_ids)
+
+    def close(self, commit: bool = True) -> None:
+        if self._fh is not None:
+            self._fh.close()
+        elif self._writer is not None:
+            self._writer.close()
+        if commit:
+            os.replace(self.tmp, self.path)
+        elif os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def partition_path(out_dir: str, domain: str, day: str, fmt: str) -> str:
+    return os.path.join(out_dir, f"domain={domain}", f"date={day}", f"part-0.{_EXTENSIONS[fmt]}")
+
+
+def export_day(
+    h5_path: str,
+    day: str,
+    out_dir: str,
+    fmt: str = "csv",
+    domains: Optional[List[str]] = None,
+    batch_rows: int = DEFAULT_BATCH_ROWS,
+) -> Dict[str, int]:
+    """
+    Esporta un file giornaliero; ritorna {dominio: righe}.
+    """
+    rows = {}
+    with open_read(h5_path) as f:
+        for domain in f.keys():
+            if domains and domain not in domains:
+                continue
+            writer = None
+            try:
+                for batch in iter_domain_batches(f, domain, batch_rows):
+                    if writer is None:
+                        writer = _PartWriter(partition_path(out_dir, domain, day, fmt), fmt)
+                    writer.write(*batch)
+            except BaseException:
+                if writer is not None:
+                    writer.close(commit=False)
+                raise
+            if writer is not None:
+                writer.close()
+                rows[domain] = writer.rows
+    return rows
+
+
+def _source_signature(path: str) -> dict:
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def load_manifest(out_dir: str) -> dict:
+    try:
+        with open(os.path.join(out_dir, MANIFEST_NAME), "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(out_dir: str, manifest: dict) -> None:
+    path = os.path.join(out_dir, MANIFEST_NAME)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def _up_to_date(entry: Optional[dict], sig: dict, fmt: str, domains: Optional[List[str]], out_dir: str, day: str) -> bool:
+    if not entry or entry.get("format") != fmt or entry.get("domains_filter") != (sorted(domains) if domains else None):
+        return False
+    if entry.get("size") != sig["size"] or entry.get("mtime_ns") != sig["mtime_ns"]:
+        return False
+    return all(os.path.exists(partition_path(out_dir, d, day, fmt)) for d in entry.get("rows", {}))
+
+
+def export_range(
+    output_path_prefix: str,
+    out_dir: str,
+    start_day: date,
+    end_day: date,
+    fmt: str = "csv",
+    workers: int = 1,
+    domains: Optional[List[str]] = None,
+    batch_rows: int = DEFAULT_BATCH_ROWS,
+    force: bool = False,
+) -> Dict[str, dict]:
+    """
+    Esporta i file la cui finestra interseca [start_day, end_day].
+    Ritorna {etichetta: voce del manifest} dei file esportati in questa esecuzione.
+    """
+    fmt = str(fmt).strip().lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Formato di export non valido: {fmt}")
+    if fmt != "csv" and importlib.util.find_spec("pyarrow") is None:
+        # subito, non nei worker a metà export
+        raise ImportError(f"Il formato {fmt} richiede pyarrow")
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = load_manifest(out_dir)
+
+    t0 = datetime(start_day.year, start_day.month, start_day.day)
+    t1 = datetime(end_day.year, end_day.month, end_day.day) + timedelta(days=1)
+    todo = []
+    for start, end, path in list_data_files(output_path_prefix):
+        if end <= t0 or start >= t1:
+            continue
+        day = label_of(path)
+        sig = _source_signature(path)
+        if not force and _up_to_date(manifest.get(day), sig, fmt, domains, out_dir, day):
+            print(f"[INFO] {day}: già esportato, invariato")
+            continue
+        todo.append((day, path, sig))
+
+    done = {}
+    if not todo:
+        return done
+
+    def _record(day, path, sig, rows):
+        entry = dict(sig, source=path, format=fmt, domains_filter=sorted(domains) if domains else None, rows=rows)
+        manifest[day] = done[day] = entry
+        # manifest aggiornato a ogni giorno: un'interruzione non perde il lavoro fatto
+        save_manifest(out_dir, manifest)
+        print(f"[INFO] {day}: esportate {sum(rows.values())} righe ({', '.join(sorted(rows)) or 'nessun dominio'})")
+
+    workers = max(1, min(int(workers or 1), len(todo)))
+    if workers == 1:
+        for day, path, sig in todo:
+            _record(day, path, sig, export_day(path, day, out_dir, fmt, domains, batch_rows))
+        return done
+
+    # spawn: i worker non ereditano handle HDF5 del processo padre
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        futures = [
+            (day, path, sig, pool.submit(export_day, path, day, out_dir, fmt, domains, batch_rows))
+            for day, path, sig in todo
+        ]
+        for day, path, sig, fut in futures:
+            _record(day, path, sig, fut.result())
+    return done
@@ -0,0 +1,127 @@
+"""
+Indice sidecar per file giornaliero: <file>.index.json
+
+Per ogni entità registra primo/ultimo timestamp (microsecondi epoch UTC)
+e numero di campioni, così il read path può scartare i file fuori
+intervallo senza aprirli. "window" riporta la finestra [inizio, fine)
+registrata negli attributi del file (solo file creati dal partizionamento
+per timestamp: i campioni sono tutti dentro la finestra).
+"""
+
+import json
+import os
+import tempfile
+from typing import Dict, Optional
+
+import h5py
+
+from .layout import columnar_entity_stats, is_columnar_group
+from .rotation import WINDOW_END_ATTR, WINDOW_START_ATTR
+from .swmr import open_read
+from .timestamps import read_timestamps_us
+
+INDEX_VERSION = 1
+
+
+def index_path_for(h5_path: str) -> str:
+    return h5_path + ".index.json"
+
+
+def new_index() -> dict:
+    return {"version": INDEX_VERSION, "first": None, "last": None, "entities": {}}
+
+
+def update_index(index: dict, entity_id: str, first_us: int, last_us: int, count: int) -> None:
+    ent = index["entities"].get(entity_id)
+    if ent is None:
+        index["entities"][entity_id] = [int(first_us), int(last_us), int(count)]
+    else:
+        ent[0] = min(ent[0], int(first_us))
+        ent[1] = max(ent[1], int(last_us))
+        ent[2] += int(count)
+    if index["first"] is None or first_us < index["first"]:
+        index["first"] = int(first_us)
+    if index["last"] is None or last_us > index["last"]:
+        index["last"] = int(last_us)
+
+
+def build_index(f: h5py.File) -> dict:
+    """
+    Ricostruisce l'indice leggendo solo primo/ultimo timestamp di ogni entità.
+    """
+    index = new_index()
+
+    def _visit(name, obj):
+        if is_columnar_group(obj):
+            for entity_id, (first, last, count) in columnar_entity_stats(obj).items():
+                update_index(index, entity_id, first, last, count)
+            return
+        if not isinstance(obj, h5py.Group) or "timestamp" not in obj:
+            return
+        if "attribute" in obj.attrs:
+            # serie di un attributo catturato, non un'entità
+            return
+        ts_ds = obj["timestamp"]
+        if not isinstance(ts_ds, h5py.Dataset) or ts_ds.shape[0] == 0:
+            return
+        entity_id = obj.attrs.get("entity_id", name.rsplit("/", 1)[-1])
+        if isinstance(entity_id, bytes):
+            entity_id = entity_id.decode("utf-8")
+        n = ts_ds.shape[0]
+        ends = read_timestamps_us(ts_ds, [0, n - 1]) if n > 1 else read_timestamps_us(ts_ds, slice(0, 1))
+        update_index(index, str(entity_id), int(ends[0]), int(ends[-1]), n)
+
+    f.visititems(_visit)
+    if WINDOW_START_ATTR in f.attrs and WINDOW_END_ATTR in f.attrs:
+        index["window"] = [int(f.attrs[WINDOW_START_ATTR]), int(f.attrs[WINDOW_END_ATTR])]
+    return index
+
+
+def save_index(h5_path: str, index: dict) -> None:
+    # file temporaneo univoco nella stessa cartella: più processi (logger,
+    # compresser, query) possono salvare lo stesso indice insieme
+    path = index_path_for(h5_path)
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            json.dump(index, fh, separators=(",", ":"))
+        # mkstemp crea il file 0600: stessi permessi di un open() normale
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[WARNING] Impossibile salvare l'indice {path}: {e}")
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def load_index(h5_path: str) -> Optional[dict]:
+    """
+    Ritorna l'indice sidecar se esiste ed è aggiornato rispetto al file HDF5
+    (mtime indice >= mtime file), altrimenti None.
+    """
+    path = index_path_for(h5_path)
+    try:
+        if os.path.getmtime(path) < os.path.getmtime(h5_path):
+            return None
+        with open(path, "r", encoding="utf-8") as fh:
+            index = json.load(fh)
+    except Exception:
+        return None
+    if not isinstance(index, dict) or index.get("version") != INDEX_VERSION:
+        return None
+    return index
+
+
+def load_or_build_index(h5_path: str, save: bool = True) -> Dict:
+    index = load_index(h5_path)
+    if index is not None:
+        return index
+    with open_read(h5_path) as f:
+        index = build_index(f)
+    if save:
+        save_index(h5_path, index)
+    return index
@@ -0,0 +1,111 @@
+"""
+Lock tra i processi che scrivono i file dati (logger, compresser,
+gestione dello spazio, backfill).
+
+Ogni <file>.h5 ha un compagno vuoto <file>.h5.lock su cui si prende un
+flock esclusivo:
+- il logger lo tiene finché ha aperto l'handle della finestra e lo
+  rilascia quando la chiude; le scritture su file di altre finestre lo
+  prendono per la durata del flush (attendendo se occupato);
+- compresser, storage e backfill lo provano senza attendere e saltano il
+  file se occupato, così nessun os.replace/rimozione avviene sotto un
+  handle aperto (il logger continuerebbe a scrivere sull'inode scollegato).
+
+Il lock è per descrittore aperto: due FileLock sullo stesso file si
+escludono anche nello stesso processo. Il file .lock può essere
+cancellato da chi tiene il lock (insieme al file dati): acquire verifica
+di aver bloccato il file ancora presente su disco e altrimenti riprova.
+"""
+
+import fcntl
+import os
+from contextlib import contextmanager
+from typing import Iterator
+
+LOCK_SUFFIX = ".lock"
+
+
+def lock_path_for(path: str) -> str:
+    return path + LOCK_SUFFIX
+
+
+class FileLock:
+    def __init__(self, path: str):
+        self.path = lock_path_for(path)
+        self._fd = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def _try(self, fd: int, blocking: bool) -> bool:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if not blocking:
+                return False
+        print(f"[INFO] {self.path[: -len(LOCK_SUFFIX)]} in uso da un altro processo: attendo")
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return True
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        True se il lock è preso (o se il filesystem non supporta i lock:
+        in quel caso si procede senza, con un warning); False solo con
+        blocking=False e lock occupato.
+        """
+        if self._fd is not None:
+            return True
+        while True:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError as e:
+                print(f"[WARNING] Lock {self.path} non disponibile ({e}): procedo senza")
+                return True
+            try:
+                if not self._try(fd, blocking):
+                    os.close(fd)
+                    return False
+            except OSError as e:
+                os.close(fd)
+                print(f"[WARNING] Lock {self.path} non disponibile ({e}): procedo senza")
+                return True
+            try:
+                same = os.fstat(fd).st_ino == os.stat(self.path).st_ino
+            except FileNotFoundError:
+                same = False
+            if same:
+                self._fd = fd
+                return True
+            # file .lock cancellato da chi teneva il lock: riprova sul nuovo
+            os.close(fd)
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+@contextmanager
+def try_lock(path: str) -> Iterator[bool]:
+    """
+    with try_lock(path) as ok: ok è False se un altro processo tiene il
+    file (nessuna attesa); il lock, se preso, è rilasciato all'uscita.
+    """
+    lock = FileLock(path)
+    try:
+        yield lock.acquire(blocking=False)
+    finally:
+        lock.release()
@@ -1,5 +1,75 @@
+"""
+Accesso REST a Home Assistant.
+
+- make_session: sessione keep-alive con pool di connessioni, condivisa dai
+  fetch concorrenti;
+- il JSON è decodificato con orjson se installato (opzionale), altrimenti
+  con il modulo json;
+- StateFetcher sceglie tra due strategie:
+    full:    GET /api/states (dump completo)
+    include: solo i domini inclusi, quelli dei pattern glob di
+             include_patterns e le entità di include_entities, con una
+             POST /api/template e, per poche entità, GET /api/states/<id>
+             concorrenti
+  con fetch_mode="auto" le due strategie vengono misurate (media mobile dei
+  secondi per fetch) e si usa la più economica, rimisurando l'altra ogni
+  PROBE_EVERY fetch. StateFetcher.scope dice quali entità copre l'ultimo
+  fetch, per il confronto con il piano di selezione (SelectionPlan.apply).
+"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
 import requests
-from .constants import API_URL
+from requests.adapters import HTTPAdapter
+
+from .constants import API_URL, DEFAULT_INCLUDED_DOMAINS
+from .domains import domain_of
+from .metrics import METRICS
+from .selection import pattern_domains
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# connessioni keep-alive tenute nel pool della sessione
+POOL_MAXSIZE = 16
+# fetch dopo i quali la strategia scartata viene rimisurata
+PROBE_EVERY = 50
+# oltre questo numero le entità singole passano dalla template API
+PER_ENTITY_MAX = 32
+# peso dell'ultima misura nella media mobile dei costi
+_EWMA_ALPHA = 0.3
+
+FETCH_MODES = ("auto", "full", "include")
+
+# una riga JSON per stato, nello stesso formato di /api/states
+_STATE_JSON = (
+    '{{- {"entity_id": s.entity_id, "state": s.state, "attributes": s.attributes,'
+    ' "last_changed": s.last_changed.isoformat(), "last_updated": s.last_updated.isoformat()}'
+    ' | tojson -}}'
+)
+_TEMPLATE = (
+    "[{%- set ns = namespace(first=true) -%}"
+    "{%- for d in domains -%}{%- for s in states[d] -%}"
+    '{{- "" if ns.first else "," -}}{%- set ns.first = false -%}' + _STATE_JSON +
+    "{%- endfor -%}{%- endfor -%}"
+    "{%- for d, o in entities -%}{%- set s = states[d][o] -%}{%- if s -%}"
+    '{{- "" if ns.first else "," -}}{%- set ns.first = false -%}' + _STATE_JSON +
+    "{%- endif -%}{%- endfor -%}]"
+)
+# entity_id.attributo dei valori che tojson non sa serializzare (né
+# stringhe, né numeri, né liste o dizionari: es. datetime), separati da ";"
+_UNSERIALIZABLE_TEMPLATE = (
+    "{%- for s in states if s.domain in domains or s.entity_id in entity_ids -%}"
+    "{%- for k, v in s.attributes.items() -%}"
+    "{%- if not (v is string or v is number or v is none or v is mapping or v is sequence) -%}"
+    "{{- s.entity_id ~ '.' ~ k ~ ';' -}}"
+    "{%- endif -%}{%- endfor -%}{%- endfor -%}"
+)
 
 def _headers(token: str) -> dict:
     return {
@@ -7,10 +77,210 @@ def _headers(token: str) -> dict:
         "Content-Type": "application/json",
     }
 
-def get_states(token: str):
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def make_session(token: str) -> requests.Session:
+    """
+    Sessione HTTP keep-alive riutilizzabile tra i cicli del logger residente.
+    """
+    s = requests.Session()
+    s.headers.update(_headers(token))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+def get_states(token: str, session: requests.Session = None):
     """
     Chiama /api/states via Supervisor.
+    Se viene passata una sessione, riusa la sua connessione.
+    """
+    if session is not None:
+        r = session.get(f"{API_URL}/states", timeout=30)
+    else:
+        r = requests.get(f"{API_URL}/states", headers=_headers(token), timeout=30)
+    r.raise_for_status()
+    return loads(r.content)
+
+def get_entity_state(session: requests.Session, entity_id: str) -> Optional[dict]:
     """
-    r = requests.get(f"{API_URL}/states", headers=_headers(token), timeout=30)
+    Stato di una singola entità; None se l'entità non esiste.
+    """
+    r = session.get(f"{API_URL}/states/{entity_id}", timeout=30)
+    if r.status_code == 404:
+        return None
     r.raise_for_status()
-    return r.json()
+    return loads(r.content)
+
+def render_states_template(session: requests.Session, domains: List[str], entity_ids: List[str]) -> list:
+    """
+    Stati dei domini e delle entità indicati in una sola richiesta alla
+    template API (il risultato è testo JSON, decodificato qui).
+    """
+    entities = [list(eid.split(".", 1)) for eid in entity_ids if "." in eid]
+    r = session.post(
+        f"{API_URL}/template",
+        json={"template": _TEMPLATE, "variables": {"domains": list(domains), "entities": entities}},
+        timeout=30,
+    )
+    r.raise_for_status()
+    return loads(r.content)
+
+def find_unserializable_attributes(session: requests.Session, domains: List[str], entity_ids: List[str]) -> List[str]:
+    """
+    Attributi (entity_id.attributo) che fanno fallire il tojson di
+    render_states_template, cercati con una seconda template che non
+    serializza nulla. Solo il primo livello: un valore annidato in una
+    lista o in un dizionario non viene trovato.
+    """
+    r = session.post(
+        f"{API_URL}/template",
+        json={
+            "template": _UNSERIALIZABLE_TEMPLATE,
+            "variables": {"domains": list(domains), "entity_ids": list(entity_ids)},
+        },
+        timeout=30,
+    )
+    r.raise_for_status()
+    return [a.strip() for a in r.text.split(";") if a.strip()]
+
+
+class StateFetcher:
+    def __init__(
+        self,
+        session: requests.Session,
+        mode: str = "auto",
+        include_domains=None,
+        include_entities=None,
+        workers: int = 4,
+    ):
+        self.session = session
+        self.mode = mode if mode in FETCH_MODES else "auto"
+        self.domains = sorted({str(d).strip().lower() for d in include_domains or [] if str(d).strip()})
+        self.entities = sorted({str(e).strip() for e in include_entities or [] if str(e).strip()})
+        self.workers = max(1, min(int(workers or 1), POOL_MAXSIZE))
+        # media mobile dei secondi per fetch, per strategia
+        self.cost: Dict[str, float] = {}
+        self.strategy = ""
+        self._fetches = 0
+        self._include_ok = bool(self.domains or self.entities)
+        self._scope = (frozenset(self.domains), frozenset(self.entities))
+
+    @classmethod
+    def from_options(cls, session: requests.Session, opts: dict) -> "StateFetcher":
+        mode = str(opts.get("fetch_mode") or "auto").strip().lower()
+        domains = list(opts.get("include_domains") or sorted(DEFAULT_INCLUDED_DOMAINS))
+        extra = pattern_domains(opts.get("include_patterns"))
+        if extra is None:
+            # un pattern può selezionare entità di qualsiasi dominio
+            if mode != "full":
+                print("[INFO] include_patterns con regex o jolly nel dominio: fetch completo di /api/states")
+            mode = "full"
+        else:
+            domains += extra
+        return cls(
+            session,
+            mode=mode,
+            include_domains=domains,
+            include_entities=opts.get("include_entities") or [],
+            workers=opts.get("fetch_workers", 4),
+        )
+
+    @property
+    def scope(self) -> Optional[Tuple[frozenset, frozenset]]:
+        """
+        Entità coperte dall'ultimo fetch: None per il dump completo,
+        (domini, entity_id) per l'include-list.
+        """
+        return self._scope if self.strategy == "include" else None
+
+    def _choose(self) -> str:
+        if self.mode == "full" or not self._include_ok:
+            return "full"
+        if self.mode == "include":
+            return "include"
+        # auto: prima una misura per strategia, poi la più economica
+        for strategy in ("full", "include"):
+            if strategy not in self.cost:
+                return strategy
+        best = min(self.cost, key=self.cost.get)
+        if self._fetches % PROBE_EVERY == 0:
+            return "include" if best == "full" else "full"
+        return best
+
+    def _fetch_include(self) -> list:
+        # entità già coperte da un dominio incluso non vanno richieste di nuovo
+        extra = [e for e in self.entities if domain_of(e) not in self.domains]
+        single = extra if len(extra) <= PER_ENTITY_MAX else []
+        states = []
+        if self.domains or len(extra) > PER_ENTITY_MAX:
+            entity_ids = extra if not single else []
+            try:
+                states = render_states_template(self.session, self.domains, entity_ids)
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code == 400:
+                    self._log_render_error(e.response, entity_ids)
+                raise
+        if single:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(single))) as pool:
+                for st in pool.map(lambda eid: get_entity_state(self.session, eid), single):
+                    if st is not None:
+                        states.append(st)
+        return states
+
+    def _log_render_error(self, response: requests.Response, entity_ids: List[str]) -> None:
+        """
+        Rendering rifiutato da Home Assistant (HTTP 400): messaggio
+        dell'errore e attributi non serializzabili che lo causano.
+        """
+        message = " ".join(response.text.split())[:300]
+        try:
+            bad = find_unserializable_attributes(self.session, self.domains, entity_ids)
+        except (requests.RequestException, ValueError) as e:
+            print(f"[WARNING] Template API: rendering non riuscito ({message}); ricerca degli attributi fallita: {e!r}")
+            return
+        if not bad:
+            print(f"[WARNING] Template API: rendering non riuscito ({message})")
+            return
+        more = f" e altri {len(bad) - 10}" if len(bad) > 10 else ""
+        print(
+            f"[WARNING] Template API: rendering non riuscito ({message}); "
+            f"attributi non serializzabili in JSON: {', '.join(bad[:10])}{more}"
+        )
+
+    def fetch(self) -> list:
+        strategy = self._choose()
+        t0 = time.perf_counter()
+        if strategy == "include":
+            try:
+                states = self._fetch_include()
+            except (requests.HTTPError, ValueError) as e:
+                # template API non disponibile o risposta non valida
+                print(f"[WARNING] Fetch per include-list non riuscito ({e}), uso /api/states fino al ricaricamento delle opzioni")
+                states = None
+            else:
+                if not states:
+                    print("[WARNING] Nessuno stato dall'include-list, uso /api/states fino al ricaricamento delle opzioni")
+                    states = None
+            if states is None:
+                # fino al prossimo ricaricamento delle opzioni resta il dump completo
+                self._include_ok = False
+                strategy = "full"
+                t0 = time.perf_counter()
+                states = get_states("", session=self.session)
+        else:
+            states = get_states("", session=self.session)
+        elapsed = time.perf_counter() - t0
+
+        prev = self.cost.get(strategy)
+        self.cost[strategy] = elapsed if prev is None else prev + _EWMA_ALPHA * (elapsed - prev)
+        self._fetches += 1
+        METRICS.inc("fetches_total", strategy=strategy)
+        if strategy != self.strategy:
+            costs = ", ".join(f"{k} {v:.3f}s" for k, v in sorted(self.cost.items()))
+            print(f"[INFO] Fetch stati: strategia {strategy} ({len(states)} entità; costo medio {costs})")
+            self.strategy = strategy
+        return states
@@ -0,0 +1,146 @@
+import asyncio
+import inspect
+import json
+from typing import Dict
+
+import websockets
+
+from .constants import WS_URL
+from .metrics import METRICS
+from .timeutils import iso_to_epoch_us
+
+
+class HAWebSocketError(Exception):
+    pass
+
+
+async def _recv_json(ws) -> dict:
+    raw = await ws.recv()
+    return json.loads(raw)
+
+
+async def _authenticate(ws, token: str) -> None:
+    msg = await _recv_json(ws)
+    if msg.get("type") != "auth_required":
+        raise HAWebSocketError(f"Messaggio inatteso in fase di auth: {msg.get('type')}")
+    await ws.send(json.dumps({"type": "auth", "access_token": token}))
+    msg = await _recv_json(ws)
+    if msg.get("type") != "auth_ok":
+        raise HAWebSocketError(f"Autenticazione websocket fallita: {msg.get('message', msg.get('type'))}")
+
+
+async def _subscribe_state_changed(ws, msg_id: int) -> None:
+    await ws.send(json.dumps({
+        "id": msg_id,
+        "type": "subscribe_events",
+        "event_type": "state_changed",
+    }))
+    # gli eventi arrivano solo dopo il result della subscribe
+    while True:
+        msg = await _recv_json(ws)
+        if msg.get("type") == "result" and msg.get("id") == msg_id:
+            if not msg.get("success"):
+                raise HAWebSocketError(f"subscribe_events fallita: {msg.get('error')}")
+            return
+
+
+def _new_states_from_message(msg) -> list:
+    """
+    Estrae i new_state da un messaggio (o da una lista di messaggi) state_changed.
+    Gli eventi di rimozione entità (new_state nullo) vengono ignorati.
+    """
+    msgs = msg if isinstance(msg, list) else [msg]
+    out = []
+    for m in msgs:
+        if m.get("type") != "event":
+            continue
+        event = m.get("event") or {}
+        if event.get("event_type") != "state_changed":
+            continue
+        new_state = (event.get("data") or {}).get("new_state")
+        if new_state:
+            out.append(new_state)
+    return out
+
+
+class LastUpdatedFilter:
+    """
+    Scarta gli stati non più recenti dell'ultimo visto per l'entità: eventi
+    già coperti dallo snapshot, snapshot dopo una riconnessione, eventi
+    arrivati fuori ordine. L'ordine è su last_updated (last_changed se
+    manca): un cambio di soli attributi lascia last_changed invariato, che
+    resta solo il timestamp del campione. Gli stati senza timestamp
+    leggibile passano sempre.
+    """
+
+    def __init__(self):
+        self._last: Dict[str, int] = {}
+
+    def accept(self, st: dict) -> bool:
+        entity_id = st.get("entity_id", "")
+        try:
+            ts = iso_to_epoch_us(st.get("last_updated") or st.get("last_changed"))
+        except Exception:
+            return True
+        prev = self._last.get(entity_id)
+        if prev is not None and ts <= prev:
+            return False
+        self._last[entity_id] = ts
+        return True
+
+
+async def _sleep_or_stop(stop: asyncio.Event, delay: float) -> None:
+    try:
+        await asyncio.wait_for(stop.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def stream_state_changes(
+    token: str,
+    fetch_snapshot,
+    on_snapshot,
+    on_state,
+    stop: asyncio.Event,
+    url: str = WS_URL,
+    max_backoff: float = 60.0,
+) -> None:
+    """
+    Sottoscrive gli eventi state_changed di Home Assistant e li consegna
+    a on_state(new_state) finché stop non viene impostato.
+
+    A ogni (ri)connessione, dopo la subscribe, viene chiamata la coroutine
+    fetch_snapshot() (tipicamente un singolo /api/states) e il risultato
+    passato a on_snapshot(states): così gli stati cambiati durante la
+    disconnessione non vanno persi. Se on_snapshot ritorna un awaitable
+    (es. la scrittura su un executor) gli eventi sono letti solo dopo che
+    è terminato, e un suo errore fa ripartire la connessione.
+    """
+    backoff = 1.0
+    while not stop.is_set():
+        try:
+            async with websockets.connect(url, max_size=None, ping_interval=30) as ws:
+                await _authenticate(ws, token)
+                await _subscribe_state_changed(ws, msg_id=1)
+                pending = on_snapshot(await fetch_snapshot())
+                if inspect.isawaitable(pending):
+                    await pending
+                print(f"[INFO] Websocket connesso e sottoscritto a state_changed: {url}")
+                backoff = 1.0
+
+                while not stop.is_set():
+                    try:
+                        raw = await asyncio.wait_for(ws.recv(), timeout=1.0)
+                    except asyncio.TimeoutError:
+                        continue
+                    for new_state in _new_states_from_message(json.loads(raw)):
+                        on_state(new_state)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if stop.is_set():
+                break
+            METRICS.inc("http_errors_total")
+            print(f"[WARNING] Connessione websocket persa ({e!r}), nuovo tentativo tra {backoff:.0f}s")
+            await _sleep_or_stop(stop, backoff)
+            backoff = min(backoff * 2, max_backoff)
@@ -1,63 +1,94 @@
 import os
-import json
+import time
 from typing import Dict, Tuple, List, Any
 import h5py
+import numpy as np
 
 from .domains import domain_of
-from .timeutils import utc_now_z, today_str_local
-from .constants import LAST_VALUES_PATH
+from .filelock import FileLock
+from .rotation import DAILY, LOCAL, Partitioner, label_of, window_attrs
+from .timeutils import utc_now_us, iso_to_epoch_us
+from .timestamps import create_timestamp_dataset, encode_timestamps, normalize_format, read_timestamps_us
+from .file_index import build_index, load_index, load_or_build_index, save_index, update_index
+from .last_values import LastValueStore
+from . import deadband, encoding
+from .attributes import ATTRIBUTES_GROUP, AttributeCapture, attribute_raw, last_value_key
+from .layout import (
+    COLUMNAR,
+    COLUMNS,
+    PER_ENTITY,
+    ColumnarCache,
+    columnar_append,
+    file_layout,
+    is_columnar_group,
+    normalize_layout,
+    static_meta,
+)
+from .swmr import enable_swmr, open_write
+from .wal import WriteAheadLog
+from .constants import LAST_VALUES_PATH, DEFAULT_CHUNK_SIZE, STATIC_ATTR_KEYS, WAL_PATH
 
+# oltre questa dimensione il journal forza la scrittura di tutti i buffer
+WAL_MAX_BYTES = 8 * 1024 * 1024
 
-def _load_last_values(path: str = LAST_VALUES_PATH) -> Dict[str, str]:
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        if isinstance(data, dict):
-            return {str(k): str(v) for k, v in data.items()}
-    except Exception:
-        pass
-    return {}
 
+def _static_signature(domain: str, entity_id: str, attrs: dict) -> tuple:
+    return (domain, entity_id) + tuple(attrs.get(key) for key in STATIC_ATTR_KEYS)
 
-def _save_last_values(last_values: Dict[str, str], path: str = LAST_VALUES_PATH) -> None:
-    try:
-        os.makedirs(os.path.dirname(path), exist_ok=True)
-    except Exception:
-        pass
-    tmp = path + ".tmp"
-    try:
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(last_values, f)
-        os.replace(tmp, path)
-    except Exception:
-        # non bloccare il logger se fallisce il salvataggio
-        pass
 
-
-def _ensure_group(f: h5py.File, domain: str, entity_id: str, attrs: dict) -> h5py.Group:
+def _ensure_group(
+    f: h5py.File,
+    domain: str,
+    entity_id: str,
+    attrs: dict,
+    group_cache: Dict[str, tuple] = None,
+) -> h5py.Group:
     group_path = f"/{domain}/{entity_id}"
+    signature = _static_signature(domain, entity_id, attrs)
+    if group_cache is not None:
+        cached = group_cache.get(group_path)
+        if cached is not None and cached[0] == signature:
+            # attributi statici invariati: nessuna scrittura di metadati
+            if cached[1].id.valid:
+                return cached[1]
+            # file riaperto (passaggio SWMR): stesso gruppo, nuovo handle
+            grp = f[group_path]
+            group_cache[group_path] = (signature, grp)
+            return grp
     grp = f.require_group(group_path)
-    # aggiorna attributi statici utili
-    for key in ("friendly_name", "unit_of_measurement", "device_class", "state_class", "area_id", "device_id"):
-        if key in attrs:
-            try:
-                grp.attrs[key] = attrs[key]
-            except Exception:
-                grp.attrs[key] = str(attrs[key])
-    grp.attrs["domain"] = domain
-    grp.attrs["entity_id"] = entity_id
+    # aggiorna attributi statici utili, solo se cambiati
+    wanted = {key: attrs[key] for key in STATIC_ATTR_KEYS if key in attrs}
+    wanted["domain"] = domain
+    wanted["entity_id"] = entity_id
+    for key, val in wanted.items():
+        current = grp.attrs.get(key)
+        if isinstance(current, bytes):
+            current = current.decode("utf-8", errors="replace")
+        if current is not None and (current == val or current == str(val)):
+            continue
+        try:
+            grp.attrs[key] = val
+        except Exception:
+            grp.attrs[key] = str(val)
+    if group_cache is not None:
+        group_cache[group_path] = (signature, grp)
     return grp
 
 
-def _ensure_datasets(grp: h5py.Group, first_value_is_numeric: bool) -> Tuple[h5py.Dataset, h5py.Dataset]:
-    # dataset timestamp: stringhe ISO-8601
+def _ensure_datasets(
+    grp: h5py.Group,
+    first_value_is_numeric: bool,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timestamp_format: str = "iso",
+) -> Tuple[h5py.Dataset, h5py.Dataset]:
+    # chunk 1-D espliciti dimensionati per l'append: evitano i chunk minuscoli
+    # scelti dall'auto-chunking di h5py per dataset nati vuoti
+    chunks = (max(1, int(chunk_size)),)
+
+    # dataset timestamp: int64 epoch (us/ns) o stringhe ISO-8601 (storico);
+    # un dataset esistente mantiene il suo formato
     if "timestamp" not in grp:
-        ts_ds = grp.create_dataset(
-            "timestamp",
-            shape=(0,),
-            maxshape=(None,),
-            dtype="S32",
-        )
+        ts_ds = create_timestamp_dataset(grp, timestamp_format, chunks)
     else:
         ts_ds = grp["timestamp"]
 
@@ -69,6 +100,7 @@ def _ensure_datasets(grp: h5py.Group, first_value_is_numeric: bool) -> Tuple[h5p
                 shape=(0,),
                 maxshape=(None,),
                 dtype="f8",
+                chunks=chunks,
             )
         else:
             val_ds = grp.create_dataset(
@@ -76,6 +108,7 @@ def _ensure_datasets(grp: h5py.Group, first_value_is_numeric: bool) -> Tuple[h5p
                 shape=(0,),
                 maxshape=(None,),
                 dtype="S256",
+                chunks=chunks,
             )
     else:
         val_ds = grp["value"]
@@ -83,95 +116,993 @@ def _ensure_datasets(grp: h5py.Group, first_value_is_numeric: bool) -> Tuple[h5p
     return val_ds, ts_ds
 
 
-def _parse_value(raw: str, prefer_numeric: bool) -> Tuple[Any, bool]:
-    if not prefer_numeric:
-        return raw, False
+def _to_float(raw: str) -> float:
     try:
-        return float(raw), True
+        return float(raw)
     except Exception:
-        return raw, False
+        return np.nan
+
+
+def build_hdf5_path(prefix: str, date_str: str) -> str:
+    filename = f"HDF5_datalogger_{date_str}.h5"
+    # gestisci eventuale slash finale nel prefisso
+    if prefix.endswith("/") or prefix.endswith("\\"):
+        return prefix + filename
+    return os.path.join(prefix, filename)
+
+
+def _ensure_parent_dir(filepath: str) -> None:
+    try:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    except Exception:
+        pass
+
+
+def _open_partition(filepath: str) -> h5py.File:
+    """
+    Apre (o crea) in scrittura il file di una finestra. Un file nuovo
+    registra la finestra [inizio, fine) negli attributi radice; i file
+    esistenti senza (scritti prima dell'instradamento per timestamp, con
+    possibili campioni oltre i confini) restano senza.
+    """
+    _ensure_parent_dir(filepath)
+    new = not os.path.exists(filepath)
+    f = open_write(filepath)
+    label = label_of(filepath)
+    if new and label is not None:
+        f.attrs.update(window_attrs(label))
+    return f
+
+
+def _fsync_path(filepath: str) -> None:
+    try:
+        fd = os.open(filepath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"[WARNING] fsync fallito per {filepath}: {e}")
+
+
+def _static_attrs(attrs: dict) -> dict:
+    # attributi statici serializzabili in JSON (per il journal)
+    out = {}
+    for key in STATIC_ATTR_KEYS:
+        if key in attrs:
+            val = attrs[key]
+            out[key] = val if isinstance(val, (str, int, float, bool)) or val is None else str(val)
+    return out
+
+
+def _state_timestamp(st: dict, timestamp_key: str, default: int) -> int:
+    if not timestamp_key or not st.get(timestamp_key):
+        return default
+    try:
+        return iso_to_epoch_us(st[timestamp_key])
+    except Exception:
+        return default
+
+
+def _clamp_timestamp(ts: int, ts_now: int, min_ts: int, last_ts: Dict[str, int], key: str) -> int:
+    if ts == ts_now:
+        return ts
+    if min_ts is not None and ts < min_ts:
+        return ts_now
+    if last_ts is not None and ts <= last_ts.get(key, ts - 1):
+        return ts_now
+    return ts
+
+
+class _EntityBuffer:
+    """
+    Campioni in attesa di scrittura per una singola entità.
+    """
+
+    __slots__ = ("domain", "attrs", "values", "timestamps", "attr_samples", "created")
+
+    def __init__(self, domain: str, attrs: dict):
+        self.domain = domain
+        self.attrs = attrs
+        self.values: List[str] = []
+        # microsecondi epoch UTC, convertiti nel formato del dataset al flush
+        self.timestamps: List[int] = []
+        # attributi catturati: nome -> ([raw], [timestamp us])
+        self.attr_samples: Dict[str, Tuple[List[str], List[int]]] = {}
+        self.created = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.values) + sum(len(v) for v, _ in self.attr_samples.values())
+
+
+def _split_buffer(buf: _EntityBuffer, partitioner: Partitioner) -> Dict[str, _EntityBuffer]:
+    """
+    Divide i campioni del buffer (stato e attributi) per finestra di file.
+    Nel caso comune, tutti nella stessa finestra, ritorna il buffer stesso.
+    """
+    series = [buf.timestamps] + [ts for _, ts in buf.attr_samples.values()]
+    lo = min(min(ts) for ts in series if ts)
+    hi = max(max(ts) for ts in series if ts)
+    bounds = partitioner.split([lo, hi])
+    if len(bounds) == 1:
+        return {next(iter(bounds)): buf}
+
+    out: Dict[str, _EntityBuffer] = {}
+
+    def _part(label: str) -> _EntityBuffer:
+        part = out.get(label)
+        if part is None:
+            part = out[label] = _EntityBuffer(buf.domain, buf.attrs)
+            part.created = buf.created
+        return part
+
+    for label, idx in partitioner.split(buf.timestamps).items():
+        part = _part(label)
+        part.values = [buf.values[i] for i in idx] if idx is not None else buf.values
+        part.timestamps = [buf.timestamps[i] for i in idx] if idx is not None else buf.timestamps
+    for name, (values, timestamps) in buf.attr_samples.items():
+        for label, idx in partitioner.split(timestamps).items():
+            if idx is None:
+                _part(label).attr_samples[name] = (values, timestamps)
+            else:
+                _part(label).attr_samples[name] = ([values[i] for i in idx], [timestamps[i] for i in idx])
+    return out
+
+
+def _partition_buffers(
+    buffers: Dict[str, _EntityBuffer],
+    entity_ids: List[str],
+    partitioner: Partitioner,
+) -> Dict[str, Dict[str, _EntityBuffer]]:
+    """
+    Toglie da buffers le entità indicate e ne raggruppa i campioni per
+    etichetta del file che li contiene: {etichetta: {entity_id: buffer}}.
+    """
+    parts: Dict[str, Dict[str, _EntityBuffer]] = {}
+    for entity_id in entity_ids:
+        buf = buffers.pop(entity_id, None)
+        if buf is None or not len(buf):
+            continue
+        for label, part in _split_buffer(buf, partitioner).items():
+            parts.setdefault(label, {})[entity_id] = part
+    return parts
+
+
+def _partition_records(records: list, partitioner: Partitioner) -> Dict[str, list]:
+    # record del journal per etichetta di file (timestamp in posizione 3)
+    out: Dict[str, list] = {}
+    for rec in records:
+        out.setdefault(partitioner.label_for(rec[3]), []).append(rec)
+    return out
+
+
+def _collect_states(
+    states: List[dict],
+    last_values: LastValueStore,
+    buffers: Dict[str, _EntityBuffer],
+    ts_now: int,
+    stats: Dict[str, Any],
+    timestamp_key: str = None,
+    value_filter: "deadband.DeadbandFilter" = None,
+    attribute_capture: AttributeCapture = None,
+    accepted: list = None,
+    min_ts: int = None,
+    last_ts: Dict[str, int] = None,
+) -> None:
+    """
+    Deduplica sugli ultimi valori (più deadband / rate-limit / heartbeat se
+    value_filter è impostato) e accoda i campioni nei buffer per entità.
+    Gli attributi catturati hanno una deduplica propria, indipendente
+    dallo stato.
+
+    accepted (se passato) riceve i record per il journal write-ahead:
+    (entity_id, attributo o None, raw, timestamp_us, attributi statici).
+
+    Con timestamp_key, un timestamp dello stato precedente a min_ts (inizio
+    della finestra corrente) o non successivo all'ultimo accettato per la
+    serie (last_ts, aggiornato qui) diventa ts_now: un'entità vista per la
+    prima volta o dopo un riavvio può avere un last_changed di settimane fa,
+    che riaprirebbe file chiusi, compressi o già cancellati dalla retention.
+    """
+    for st in states:
+        entity_id = st.get("entity_id", "")
+        if not entity_id:
+            continue
+
+        new_state_raw = str(st.get("state", ""))
+        old_state_raw = last_values.get(entity_id)
+        attrs = st.get("attributes", {}) or {}
+        # timestamp (quello dello stato stesso se richiesto, es. last_changed)
+        ts = _clamp_timestamp(_state_timestamp(st, timestamp_key, ts_now), ts_now, min_ts, last_ts, entity_id)
+
+        if attribute_capture is not None:
+            _collect_attributes(st, entity_id, attrs, attribute_capture, last_values, buffers,
+                                ts_now, stats, timestamp_key, accepted, min_ts, last_ts)
+
+        if value_filter is None:
+            if old_state_raw is not None and old_state_raw == new_state_raw:
+                stats["skipped_points"] += 1
+                continue
+        else:
+            # intervalli misurati sull'orologio del writer: last_changed non
+            # avanza finché il valore resta uguale
+            decision = value_filter.decide(entity_id, attrs, new_state_raw, old_state_raw, ts_now)
+            if decision == deadband.UNCHANGED:
+                stats["skipped_points"] += 1
+                continue
+            if decision == deadband.DEADBAND:
+                stats["suppressed_deadband"] += 1
+                continue
+            if decision == deadband.RATE:
+                stats["suppressed_rate"] += 1
+                continue
+            if decision == deadband.HEARTBEAT:
+                stats["heartbeat_points"] += 1
+                if new_state_raw == old_state_raw:
+                    # campione di conferma di un valore invariato: vale adesso
+                    ts = ts_now
+            value_filter.committed(entity_id, ts_now)
+
+        buf = buffers.get(entity_id)
+        if buf is None:
+            buf = buffers[entity_id] = _EntityBuffer(domain_of(entity_id), {})
+        # attributi più recenti: applicati al gruppo al momento del flush
+        buf.attrs = attrs
+        buf.values.append(new_state_raw)
+        buf.timestamps.append(ts)
+
+        last_values[entity_id] = new_state_raw
+        if last_ts is not None:
+            last_ts[entity_id] = ts
+        stats["appended_points"] += 1
+        if accepted is not None:
+            accepted.append((entity_id, None, new_state_raw, ts, _static_attrs(attrs)))
+
+
+def _collect_attributes(
+    st: dict,
+    entity_id: str,
+    attrs: dict,
+    attribute_capture: AttributeCapture,
+    last_values: LastValueStore,
+    buffers: Dict[str, "_EntityBuffer"],
+    ts_now: int,
+    stats: Dict[str, Any],
+    timestamp_key: str = None,
+    accepted: list = None,
+    min_ts: int = None,
+    last_ts: Dict[str, int] = None,
+) -> None:
+    names = attribute_capture.attributes_for(entity_id, attrs)
+    if not names:
+        return
+    # un cambio di soli attributi aggiorna last_updated, non last_changed
+    updated = _state_timestamp(st, "last_updated" if timestamp_key else None, ts_now)
+    buf = None
+    for name in names:
+        if name not in attrs:
+            continue
+        raw = attribute_raw(attrs[name])
+        key = last_value_key(entity_id, name)
+        if last_values.get(key) == raw:
+            continue
+        ts = _clamp_timestamp(updated, ts_now, min_ts, last_ts, key)
+        if buf is None:
+            buf = buffers.get(entity_id)
+            if buf is None:
+                buf = buffers[entity_id] = _EntityBuffer(domain_of(entity_id), attrs)
+        values, timestamps = buf.attr_samples.setdefault(name, ([], []))
+        values.append(raw)
+        timestamps.append(ts)
+        last_values[key] = raw
+        if last_ts is not None:
+            last_ts[key] = ts
+        stats["attribute_points"] += 1
+        if accepted is not None:
+            accepted.append((entity_id, name, raw, ts, None))
+
+
+def _flush_attributes(
+    f: h5py.File,
+    entity_id: str,
+    buf: _EntityBuffer,
+    chunk_size: int,
+    timestamp_format: str,
+) -> int:
+    written = 0
+    for name, (values, timestamps) in buf.attr_samples.items():
+        if not values:
+            continue
+        path = f"/{buf.domain}/{entity_id}/{ATTRIBUTES_GROUP}/{name}"
+        grp = f.get(path)
+        if grp is None:
+            grp = f.require_group(path)
+            grp.attrs["entity_id"] = entity_id
+            grp.attrs["attribute"] = name
+            ts_ds = create_timestamp_dataset(grp, timestamp_format, (max(1, int(chunk_size)),))
+        else:
+            ts_ds = grp["timestamp"]
+        # testi degli attributi (es. hvac_action) come enum
+        encoding.append_values(grp, "", {}, values, chunk_size, text_encoding=encoding.ENUM)
+        start = ts_ds.shape[0]
+        ts_ds.resize((start + len(values),))
+        ts_ds[start:] = encode_timestamps(ts_ds, timestamps)
+        written += len(values)
+    return written
+
+
+def _flush_entity(
+    f: h5py.File,
+    entity_id: str,
+    buf: _EntityBuffer,
+    chunk_size: int,
+    timestamp_format: str,
+    index: dict = None,
+    group_cache: Dict[str, tuple] = None,
+) -> int:
+    grp = _ensure_group(f, buf.domain, entity_id, buf.attrs, group_cache)
+    n = len(buf.values)
+    if not n:
+        return 0
+
+    if "value" in grp and not encoding.is_encoded_group(grp):
+        # gruppo storico: tipo deciso dal primo valore mai scritto
+        val_ds, ts_ds = _ensure_datasets(grp, False, chunk_size, timestamp_format)
+        if val_ds.dtype.kind in ("f", "i"):
+            values = np.fromiter((_to_float(v) for v in buf.values), dtype="f8", count=n)
+        else:
+            values = np.array([v.encode("utf-8") for v in buf.values], dtype=val_ds.dtype)
+        start = val_ds.shape[0]
+        val_ds.resize((start + n,))
+        val_ds[start:] = values
+    else:
+        # codifica per dominio (bool/enum/float/string) + maschera availability
+        if "timestamp" in grp:
+            ts_ds = grp["timestamp"]
+        else:
+            ts_ds = create_timestamp_dataset(grp, timestamp_format, (max(1, int(chunk_size)),))
+        encoding.append_values(grp, buf.domain, buf.attrs, buf.values, chunk_size)
+
+    # un solo resize e una sola scrittura a slice per dataset
+    start = ts_ds.shape[0]
+    end = start + n
+    ts_ds.resize((end,))
+    ts_ds[start:end] = encode_timestamps(ts_ds, buf.timestamps)
+
+    if index is not None:
+        update_index(index, entity_id, min(buf.timestamps), max(buf.timestamps), n)
+    return n
+
+
+def _flush_buffers(
+    f: h5py.File,
+    buffers: Dict[str, _EntityBuffer],
+    chunk_size: int,
+    timestamp_format: str,
+    entity_ids: List[str] = None,
+    index: dict = None,
+    layout: str = PER_ENTITY,
+    columnar_cache: ColumnarCache = None,
+    group_cache: Dict[str, tuple] = None,
+) -> int:
+    written = 0
+    by_domain: Dict[str, list] = {}
+    for entity_id in list(entity_ids if entity_ids is not None else buffers.keys()):
+        buf = buffers.pop(entity_id, None)
+        if buf is None or not len(buf):
+            continue
+        if layout == COLUMNAR:
+            if buf.values:
+                by_domain.setdefault(buf.domain, []).append((entity_id, buf.attrs, buf.values, buf.timestamps))
+                if index is not None:
+                    update_index(index, entity_id, min(buf.timestamps), max(buf.timestamps), len(buf.values))
+        else:
+            written += _flush_entity(f, entity_id, buf, chunk_size, timestamp_format, index, group_cache)
+        if buf.attr_samples:
+            written += _flush_attributes(f, entity_id, buf, chunk_size, timestamp_format)
+
+    # layout colonnare: una scrittura per colonna per dominio
+    for domain, entries in by_domain.items():
+        written += columnar_append(f, domain, entries, chunk_size, timestamp_format, columnar_cache)
+    return written
+
+
+def _write_partition(
+    filepath: str,
+    buffers: Dict[str, _EntityBuffer],
+    chunk_size: int,
+    timestamp_format: str,
+    layout: str,
+    index: dict = None,
+    lock: bool = True,
+) -> int:
+    """
+    Scrive i buffer nel file filepath con un handle aperto e chiuso qui
+    (campioni di una finestra diversa da quella corrente). Ritorna i
+    campioni scritti. Con lock il file è bloccato (vedi filelock) per la
+    durata della scrittura; lock=False se il chiamante lo tiene già.
+    """
+    guard = FileLock(filepath) if lock else None
+    if guard is not None:
+        guard.acquire()
+    try:
+        with _open_partition(filepath) as f:
+            if index is None:
+                index = load_index(filepath) or build_index(f)
+            written = _flush_buffers(
+                f, buffers, chunk_size, timestamp_format,
+                index=index, layout=file_layout(f, layout),
+            )
+        save_index(filepath, index)
+    finally:
+        if guard is not None:
+            guard.release()
+    return written
+
+
+def _needs_structure(
+    f: h5py.File,
+    buffers: Dict[str, _EntityBuffer],
+    entity_ids: List[str],
+    layout: str,
+    group_cache: Dict[str, tuple],
+    columnar_cache: ColumnarCache,
+) -> bool:
+    """
+    True se il flush deve creare gruppi/dataset o scrivere attributi HDF5:
+    in SWMR il writer può solo estendere i dataset esistenti.
+    """
+    for entity_id in entity_ids:
+        buf = buffers.get(entity_id)
+        if buf is None or not len(buf):
+            continue
+        for name, (values, _) in buf.attr_samples.items():
+            grp = f.get(f"/{buf.domain}/{entity_id}/{ATTRIBUTES_GROUP}/{name}")
+            if values and encoding.needs_structure(grp, "", {}, values, encoding.ENUM):
+                return True
+        if not buf.values:
+            continue
+        if layout == COLUMNAR:
+            grp = f.get(f"/{buf.domain}")
+            if grp is None or "entity_index" not in grp:
+                return True
+            columnar_cache.load(grp, buf.domain)
+            idx = columnar_cache.entities[buf.domain].get(entity_id)
+            # entità nuove e metadati cambiati finiscono in entity_meta (stringhe vlen)
+            if idx is None or columnar_cache.meta[buf.domain].get(idx) != static_meta(buf.attrs):
+                return True
+            continue
+        path = f"/{buf.domain}/{entity_id}"
+        cached = group_cache.get(path)
+        if cached is None or cached[0] != _static_signature(buf.domain, entity_id, buf.attrs):
+            return True
+        if encoding.needs_structure(f.get(path), buf.domain, buf.attrs, buf.values):
+            return True
+    return False
+
+
+def _repair_lengths(f: h5py.File) -> int:
+    """
+    Un crash a metà flush può lasciare i dataset di un gruppo con lunghezze
+    diverse: li riallinea alla lunghezza comune più corta.
+    Ritorna il numero di gruppi corretti.
+    """
+    groups = []
+
+    def _visit(name, obj):
+        if not isinstance(obj, h5py.Group):
+            return
+        if is_columnar_group(obj):
+            names = COLUMNS
+        elif "timestamp" in obj:
+            names = ("timestamp", "value", "availability")
+        else:
+            return
+        dsets = [obj[n] for n in names if isinstance(obj.get(n), h5py.Dataset)]
+        if len({ds.shape[0] for ds in dsets}) > 1:
+            groups.append(dsets)
+
+    f.visititems(_visit)
+    for dsets in groups:
+        n = min(ds.shape[0] for ds in dsets)
+        for ds in dsets:
+            ds.resize((n,))
+    if groups:
+        print(f"[WARNING] {f.filename}: riallineati {len(groups)} gruppi dopo chiusura non pulita")
+    return len(groups)
+
+
+def _attribute_last_us(f: h5py.File, domain: str, entity_id: str, name: str) -> int:
+    grp = f.get(f"/{domain}/{entity_id}/{ATTRIBUTES_GROUP}/{name}")
+    if grp is None or "timestamp" not in grp or grp["timestamp"].shape[0] == 0:
+        return np.iinfo("i8").min
+    n = grp["timestamp"].shape[0]
+    return int(read_timestamps_us(grp["timestamp"], slice(n - 1, n))[0])
+
+
+def _replay_wal(
+    wal: WriteAheadLog,
+    layout: str,
+    chunk_size: int,
+    timestamp_format: str,
+    last_values: LastValueStore,
+) -> int:
+    """
+    Riapplica i campioni del journal più recenti dell'ultimo timestamp già
+    presente nel file (per entità o attributo). Ritorna i campioni scritti.
+    """
+    replayed = 0
+    for filepath, records in wal.read().items():
+        if not records:
+            continue
+        with FileLock(filepath), _open_partition(filepath) as f:
+            _repair_lengths(f)
+            index = build_index(f)
+            buffers: Dict[str, _EntityBuffer] = {}
+            attr_last: Dict[tuple, int] = {}
+            static: Dict[str, dict] = {}
+            for rec in records:
+                entity_id, raw, ts = rec["e"], str(rec["v"]), int(rec["t"])
+                if "s" in rec:
+                    static[entity_id] = rec["s"]
+                domain = domain_of(entity_id)
+                name = rec.get("a")
+                if name:
+                    key = (entity_id, name)
+                    if key not in attr_last:
+                        attr_last[key] = _attribute_last_us(f, domain, entity_id, name)
+                    if ts <= attr_last[key]:
+                        continue
+                else:
+                    ent = index["entities"].get(entity_id)
+                    if ent is not None and ts <= ent[1]:
+                        continue
+                buf = buffers.get(entity_id)
+                if buf is None:
+                    buf = buffers[entity_id] = _EntityBuffer(domain, {})
+                buf.attrs = static.get(entity_id, buf.attrs)
+                if name:
+                    values, timestamps = buf.attr_samples.setdefault(name, ([], []))
+                    values.append(raw)
+                    timestamps.append(ts)
+                    last_values[last_value_key(entity_id, name)] = raw
+                else:
+                    buf.values.append(raw)
+                    buf.timestamps.append(ts)
+                    last_values[entity_id] = raw
+            if buffers:
+                replayed += _flush_buffers(
+                    f, buffers, chunk_size, timestamp_format,
+                    index=index, layout=file_layout(f, layout),
+                )
+            save_index(filepath, index)
+            _fsync_path(filepath)
+    return replayed
+
+
+def _recover_wal(
+    wal: WriteAheadLog,
+    layout: str,
+    chunk_size: int,
+    timestamp_format: str,
+    last_values: LastValueStore,
+) -> None:
+    if not wal.pending():
+        return
+    try:
+        n = _replay_wal(wal, layout, chunk_size, timestamp_format, last_values)
+        print(f"[INFO] Journal {wal.path}: riapplicati {n} campioni dopo chiusura non pulita")
+    except Exception as e:
+        # journal conservato a parte: i campioni restano recuperabili a mano
+        aside = f"{wal.path}.failed-{int(time.time())}"
+        print(f"[ERROR] Replay del journal fallito ({e!r}), spostato in {aside}")
+        wal.close()
+        try:
+            os.replace(wal.path, aside)
+        except OSError:
+            pass
+        return
+    wal.reset()
+
+
+def _new_stats(filepath: str = "") -> Dict[str, Any]:
+    return {
+        "appended_points": 0,
+        "skipped_points": 0,
+        "suppressed_deadband": 0,
+        "suppressed_rate": 0,
+        "heartbeat_points": 0,
+        "attribute_points": 0,
+        "flushed_points": 0,
+        "buffered_points": 0,
+        "file_path": filepath,
+    }
+
+
+def _seed_filter(value_filter: "deadband.DeadbandFilter", index: dict) -> None:
+    for entity_id, ent in index.get("entities", {}).items():
+        value_filter.seed(entity_id, ent[1])
 
 
 def append_states_to_hdf5(
     states: List[dict],
     output_path_prefix: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timestamp_format: str = "iso",
+    value_filter: "deadband.DeadbandFilter" = None,
+    layout: str = PER_ENTITY,
+    attribute_capture: AttributeCapture = None,
+    wal_path: str = WAL_PATH,
+    rotation: str = DAILY,
+    partition_timezone: str = LOCAL,
 ) -> Dict[str, Any]:
     """
-    Scrive i dati nel file HDF5 del giorno corrente in modalità append,
-    solo se il valore è cambiato rispetto all'ultimo loggato.
+    Scrive i dati in modalità append, solo se il valore è cambiato rispetto
+    all'ultimo loggato, nel file HDF5 la cui finestra (giorno, ora o
+    settimana secondo rotation, in ora locale o UTC secondo
+    partition_timezone) contiene il timestamp di ogni campione.
+
+    Con wal_path i campioni sono prima registrati nel journal write-ahead
+    (riapplicato al ciclo successivo se questo si interrompe a metà).
 
     Ritorna un dict con statistiche: appended_points, skipped_points, file_path
     """
-    stats: Dict[str, Any] = {
-        "appended_points": 0,
-        "skipped_points": 0,
-        "file_path": "",
-    }
+    stats = _new_stats()
 
     if not states:
         return stats
 
-    today_str = today_str_local()
-    filename = f"HDF5_datalogger_{today_str}.h5"
+    partitioner = Partitioner(rotation, partition_timezone)
+    filepath = build_hdf5_path(output_path_prefix, partitioner.current())
+    stats["file_path"] = filepath
 
-    # gestisci eventuale slash finale nel prefisso
-    if output_path_prefix.endswith("/") or output_path_prefix.endswith("\\"):
-        filepath = output_path_prefix + filename
-    else:
-        filepath = os.path.join(output_path_prefix, filename)
+    last_values = LastValueStore()
+    ts_now = utc_now_us()
+    fmt = normalize_format(timestamp_format)
 
-    stats["file_path"] = filepath
+    wal = WriteAheadLog(wal_path) if wal_path else None
+    if wal is not None:
+        _recover_wal(wal, layout, chunk_size, fmt, last_values)
 
-    # assicura cartella
-    try:
-        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    except Exception:
-        pass
+    buffers: Dict[str, _EntityBuffer] = {}
+    index = None
+    if value_filter is not None and os.path.exists(filepath):
+        # processo nuovo a ogni ciclo: min_interval/heartbeat ripartono
+        # dagli ultimi timestamp scritti, presi dall'indice del file
+        index = load_index(filepath)
+        if index is not None:
+            _seed_filter(value_filter, index)
+    accepted = [] if wal is not None else None
+    _collect_states(
+        states, last_values, buffers, ts_now, stats,
+        value_filter=value_filter, attribute_capture=attribute_capture, accepted=accepted,
+    )
+    if buffers:
+        if accepted:
+            for label, records in _partition_records(accepted, partitioner).items():
+                wal.log(build_hdf5_path(output_path_prefix, label), records)
+        parts = _partition_buffers(buffers, list(buffers), partitioner)
+        for label, part in sorted(parts.items()):
+            path = build_hdf5_path(output_path_prefix, label)
+            stats["flushed_points"] += _write_partition(
+                path, part, chunk_size, fmt, normalize_layout(layout),
+                index if path == filepath else None,
+            )
+            if wal is not None:
+                _fsync_path(path)
+        if wal is not None:
+            wal.reset()
 
-    last_values = _load_last_values()
-    ts_now = utc_now_z().encode("utf-8")
+    # journal: solo le entità cambiate, senza riscrivere tutto il JSON
+    last_values.flush()
+    return stats
 
-    with h5py.File(filepath, "a") as f:
-        for st in states:
-            entity_id = st.get("entity_id", "")
-            if not entity_id:
-                continue
 
-            domain = domain_of(entity_id)
-            new_state_raw = str(st.get("state", ""))
+class HDF5Writer:
+    """
+    Writer residente per il logger in modalità daemon.
+
+    Mantiene aperto l'handle del file HDF5 del giorno corrente (ruotandolo
+    al cambio data) e la tabella degli ultimi valori in memoria, così ogni
+    ciclo evita open/close del file e la rilettura del JSON.
 
-            old_state_raw = last_values.get(entity_id)
-            if old_state_raw is not None and old_state_raw == new_state_raw:
-                stats["skipped_points"] += 1
-                continue
+    I campioni vengono accumulati in buffer per entità e scritti a blocchi
+    (un resize + una scrittura a slice per dataset) quando un'entità
+    raggiunge buffer_max_samples, quando il buffer più vecchio supera
+    buffer_max_age secondi e alla chiusura.
+    buffer_max_samples <= 1 equivale a scrittura immediata.
+
+    timestamp_format ("iso", "epoch_us", "epoch_ns") vale per i dataset
+    timestamp creati da qui in avanti; quelli esistenti restano invariati.
+    Lo stesso vale per layout ("per_entity", "columnar"): si applica solo
+    ai file giornalieri nuovi.
 
-            attrs = st.get("attributes", {}) or {}
-            grp = _ensure_group(f, domain, entity_id, attrs)
-
-            # decidiamo il tipo al primo valore
-            _, is_numeric = _parse_value(new_state_raw, prefer_numeric=True)
-            val_ds, ts_ds = _ensure_datasets(grp, first_value_is_numeric=is_numeric)
-
-            # ridimensiona e scrivi
-            new_len = val_ds.shape[0] + 1
-            val_ds.resize((new_len,))
-            ts_ds.resize((new_len,))
-
-            # scrivi valore
-            if val_ds.dtype.kind in ("f", "i"):
-                from math import nan
-                try:
-                    val_ds[-1] = float(new_state_raw)
-                except Exception:
-                    val_ds[-1] = nan
+    rotation ("hourly", "daily", "weekly") decide la finestra di ogni file,
+    partition_timezone ("local", "utc") se le finestre seguono l'ora locale
+    o UTC. Al flush ogni campione va nel file la cui finestra contiene il
+    suo timestamp: un buffer a cavallo di un confine (mezzanotte, cambio
+    d'ora) è diviso tra i due file. Con timestamp_key un last_changed
+    precedente alla finestra corrente o all'ultimo campione scritto della
+    serie è sostituito dall'ora di arrivo: i file delle finestre chiuse non
+    vengono riaperti. L'handle residente segue la finestra corrente; i
+    campioni di altre finestre sono scritti con un handle aperto solo per
+    quel flush. Il file della finestra aperta resta bloccato (filelock) fino
+    alla sua chiusura, che avviene al primo ciclo dopo il cambio di finestra
+    anche senza campioni da scrivere: il compresser non lo tocca prima.
+
+    attribute_capture (AttributeCapture) aggiunge le serie temporali degli
+    attributi selezionati sotto /<dominio>/<entity_id>/attributes/.
+
+    wal_path: journal write-ahead ("" lo disattiva). Ogni campione accettato
+    vi è registrato (fsync per ciclo) prima di finire nei buffer; il journal
+    è troncato quando tutti i buffer sono scritti e il file è su disco, e
+    riapplicato alla creazione del writer dopo una chiusura non pulita.
+
+    swmr: il file del giorno resta in modalità SWMR, così query, export e
+    compresser possono leggerlo mentre il logger scrive. I flush che creano
+    gruppi/dataset o scrivono attributi riaprono il file fuori da SWMR.
+    """
+
+    def __init__(
+        self,
+        output_path_prefix: str,
+        last_values_path: str = LAST_VALUES_PATH,
+        buffer_max_samples: int = 1,
+        buffer_max_age: float = 0,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        timestamp_format: str = "iso",
+        last_values_flush_interval: float = 60.0,
+        value_filter: "deadband.DeadbandFilter" = None,
+        layout: str = PER_ENTITY,
+        attribute_capture: AttributeCapture = None,
+        wal_path: str = WAL_PATH,
+        swmr: bool = False,
+        rotation: str = DAILY,
+        partition_timezone: str = LOCAL,
+    ):
+        self.output_path_prefix = output_path_prefix
+        self.partitioner = Partitioner(rotation, partition_timezone)
+        self.rotation = self.partitioner.rotation
+        self.last_values_path = last_values_path
+        self.buffer_max_samples = max(1, int(buffer_max_samples or 1))
+        self.buffer_max_age = max(0.0, float(buffer_max_age or 0))
+        self.chunk_size = max(1, int(chunk_size or DEFAULT_CHUNK_SIZE))
+        self.timestamp_format = normalize_format(timestamp_format)
+        self.value_filter = value_filter
+        self.attribute_capture = attribute_capture
+        self.layout = normalize_layout(layout)
+        self.swmr = bool(swmr)
+        self._file_layout = self.layout
+        self._columnar_cache = ColumnarCache()
+        # gruppi entità del file aperto con la firma degli attributi statici
+        self._group_cache: Dict[str, tuple] = {}
+        self.last_values = LastValueStore(last_values_path, flush_interval=last_values_flush_interval)
+        self._wal = WriteAheadLog(wal_path) if wal_path else None
+        if self._wal is not None:
+            # prima della ricostruzione: il file del giorno torna completo
+            _recover_wal(self._wal, self.layout, self.chunk_size, self.timestamp_format, self.last_values)
+        if not self.last_values.loaded_from_disk:
+            # nessuno stato salvato: riparti dalla coda del file del giorno
+            current = build_hdf5_path(output_path_prefix, self.partitioner.current())
+            if os.path.exists(current):
+                n = self.last_values.rebuild_from_hdf5(current)
+                print(f"[INFO] Ultimi valori ricostruiti da {current}: {n} entità")
+        self._buffers: Dict[str, _EntityBuffer] = {}
+        self._file = None
+        self._file_path = ""
+        # lock del file aperto, rilasciato alla chiusura dell'handle
+        self._lock = None
+        # indice sidecar (primo/ultimo timestamp e conteggi) del file aperto
+        self._index = None
+        # ultimo timestamp accettato per serie nella finestra _last_ts_label
+        self._last_ts: Dict[str, int] = {}
+        self._last_ts_label = ""
+        # file aperto in SWMR / SWMR attivabile sul file aperto
+        self._swmr_active = False
+        self._swmr_ok = self.swmr
+
+    @property
+    def file_path(self) -> str:
+        return self._file_path
+
+    @property
+    def buffered_points(self) -> int:
+        return sum(len(b) for b in self._buffers.values())
+
+    def _current_file(self) -> h5py.File:
+        filepath = build_hdf5_path(self.output_path_prefix, self.partitioner.current())
+        if self._file is not None and filepath == self._file_path:
+            return self._file
+        # cambio di finestra (o primo ciclo): i campioni ancora nei buffer
+        # andranno nel file della propria finestra al flush
+        self._close_file()
+        self._lock = FileLock(filepath)
+        self._lock.acquire()
+        try:
+            self._file = _open_partition(filepath)
+        except Exception:
+            self._lock.release()
+            self._lock = None
+            raise
+        self._file_path = filepath
+        self._file_layout = file_layout(self._file, self.layout)
+        self._columnar_cache = ColumnarCache()
+        self._group_cache = {}
+        self._index = load_index(filepath) or build_index(self._file)
+        if self.value_filter is not None:
+            _seed_filter(self.value_filter, self._index)
+        self._swmr_ok = self.swmr
+        if self._swmr_ok:
+            self._swmr_ok = self._swmr_active = enable_swmr(self._file)
+        return self._file
+
+    def _reopen(self, swmr: bool) -> h5py.File:
+        """
+        Riapre il file corrente dentro/fuori SWMR (la modalità SWMR non si
+        può disattivare su un handle aperto). Indice e cache restano validi.
+        """
+        self._file.close()
+        self._file = open_write(self._file_path)
+        self._swmr_active = swmr and enable_swmr(self._file)
+        return self._file
+
+    def _close_file(self) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+            # la chiusura aggiorna l'mtime del file: riscrivi l'indice
+            # perché resti valido (mtime indice >= mtime file)
+            if self._index is not None:
+                save_index(self._file_path, self._index)
+        except Exception as e:
+            print(f"[WARNING] Errore chiusura file HDF5 {self._file_path}: {e}")
+        finally:
+            # file e indice completi: il compresser può prenderlo
+            if self._lock is not None:
+                self._lock.release()
+                self._lock = None
+        self._file = None
+        self._group_cache = {}
+        self._index = None
+        self._swmr_active = False
+
+    def _flush_to(self, f: h5py.File, buffers: Dict[str, _EntityBuffer]) -> int:
+        entity_ids = list(buffers.keys())
+        try:
+            structural = self._swmr_active and _needs_structure(
+                f, buffers, entity_ids, self._file_layout, self._group_cache, self._columnar_cache
+            )
+            if structural:
+                f = self._reopen(swmr=False)
+            written = _flush_buffers(
+                f,
+                buffers,
+                self.chunk_size,
+                self.timestamp_format,
+                entity_ids,
+                self._index,
+                self._file_layout,
+                self._columnar_cache,
+                self._group_cache,
+            )
+            f.flush()
+            if structural:
+                self._reopen(swmr=True)
+            save_index(self._file_path, self._index)
+        except Exception:
+            # handle potenzialmente in stato incoerente: riapri al prossimo ciclo
+            # (senza salvare l'indice, verrà ricostruito dal file)
+            self._index = None
+            self._close_file()
+            raise
+        return written
+
+    def _due_entities(self) -> List[str]:
+        if self.buffer_max_age > 0:
+            now = time.monotonic()
+            if any(now - b.created >= self.buffer_max_age for b in self._buffers.values()):
+                # flush per età: svuota tutto in un unico passaggio
+                return list(self._buffers.keys())
+        return [eid for eid, b in self._buffers.items() if len(b) >= self.buffer_max_samples]
+
+    def flush(self, force: bool = True) -> int:
+        """
+        Scrive su disco i buffer (tutti, o solo quelli scaduti con force=False).
+        Ritorna il numero di campioni scritti.
+        """
+        entity_ids = list(self._buffers.keys()) if force else self._due_entities()
+        current_label = self.partitioner.current()
+        parts = _partition_buffers(self._buffers, entity_ids, self.partitioner) if entity_ids else {}
+        written = 0
+        for label, buffers in sorted(parts.items()):
+            filepath = build_hdf5_path(self.output_path_prefix, label)
+            if label == current_label:
+                # l'handle residente si apre solo se la finestra corrente ha
+                # righe: niente file (e indice) vuoti per la finestra nuova
+                written += self._flush_to(self._current_file(), buffers)
+                continue
+            if self._file is not None and filepath == self._file_path:
+                # finestra appena chiusa: ultime righe con l'handle (e il
+                # lock) ancora aperti, senza riaprire il file
+                written += self._flush_to(self._file, buffers)
             else:
-                val_ds[-1] = str(new_state_raw).encode("utf-8")
+                written += _write_partition(filepath, buffers, self.chunk_size, self.timestamp_format, self.layout)
+            if self._wal is not None:
+                _fsync_path(filepath)
+        if self._file is not None and self._file_path != build_hdf5_path(self.output_path_prefix, current_label):
+            # cambio di finestra: il file della finestra chiusa (e il suo
+            # lock) va rilasciato anche se in questo ciclo non c'è nulla da scrivere
+            self._close_file()
+        if self._wal is not None and not self._buffers:
+            # tutto il journal è nei file HDF5: su disco e troncato
+            if self._file is not None:
+                _fsync_path(self._file_path)
+            self._wal.reset()
+        return written
 
-            # scrivi timestamp
-            ts_ds[-1] = ts_now
+    def _window_last_ts(self, ts_now: int) -> Dict[str, int]:
+        """
+        Ultimi timestamp per serie della finestra di ts_now, ripartendo
+        dall'indice del file (senza aprire l'handle residente) a ogni
+        cambio di finestra.
+        """
+        label = self.partitioner.label_for(ts_now)
+        if label == self._last_ts_label:
+            return self._last_ts
+        filepath = build_hdf5_path(self.output_path_prefix, label)
+        index = None
+        if self._index is not None and filepath == self._file_path:
+            index = self._index
+        elif os.path.exists(filepath):
+            try:
+                index = load_or_build_index(filepath, save=False)
+            except Exception as e:
+                print(f"[WARNING] Impossibile leggere l'indice di {filepath}: {e}")
+        entities = index.get("entities", {}) if index else {}
+        self._last_ts = {entity_id: int(ent[1]) for entity_id, ent in entities.items()}
+        self._last_ts_label = label
+        return self._last_ts
 
-            last_values[entity_id] = new_state_raw
-            stats["appended_points"] += 1
+    def append(self, states: List[dict], timestamp_key: str = None, ts_now: int = None) -> Dict[str, Any]:
+        """
+        Con timestamp_key (es. "last_changed") ogni campione usa il timestamp
+        dello stato invece dell'ora corrente; ts_now (epoch us) sostituisce
+        l'ora corrente, es. l'istante del fetch per gli snapshot accodati.
+        """
+        stats = _new_stats(self._file_path)
+        force = False
+        if states:
+            ts_now = ts_now or utc_now_us()
+            accepted = [] if self._wal is not None else None
+            min_ts = last_ts = None
+            if timestamp_key:
+                min_ts = self.partitioner.window_start(ts_now)
+                last_ts = self._window_last_ts(ts_now)
+            _collect_states(
+                states, self.last_values, self._buffers, ts_now, stats, timestamp_key,
+                self.value_filter, self.attribute_capture, accepted, min_ts, last_ts,
+            )
+            if accepted:
+                # ogni campione è registrato col file della sua finestra
+                for label, records in _partition_records(accepted, self.partitioner).items():
+                    self._wal.log(build_hdf5_path(self.output_path_prefix, label), records)
+                force = self._wal.size > WAL_MAX_BYTES
 
-    _save_last_values(last_values)
-    return stats
+        stats["flushed_points"] = self.flush(force=force)
+        # persistenza pigra degli ultimi valori (timer), dopo il flush HDF5
+        # e solo per le entità senza campioni ancora nei buffer
+        self.last_values.maybe_flush(pending=self._buffers)
+        stats["buffered_points"] = self.buffered_points
+        stats["file_path"] = self._file_path or build_hdf5_path(self.output_path_prefix, self.partitioner.current())
+        return stats
+
+    def close(self) -> None:
+        try:
+            if self._buffers:
+                self.flush(force=True)
+        finally:
+            self._close_file()
+            self.last_values.close()
+            if self._wal is not None:
+                self._wal.close()
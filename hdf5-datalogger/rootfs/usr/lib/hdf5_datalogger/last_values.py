@@ -0,0 +1,222 @@
+"""
+Cache residente degli ultimi valori loggati (per il log "solo se cambia").
+
+Persistenza:
+- snapshot: LAST_VALUES_PATH, JSON {entity_id: valore} (stesso formato storico)
+- journal:  LAST_VALUES_PATH + ".journal", righe JSON [entity_id, valore]
+  aggiunte in coda solo per le entità cambiate
+
+flush() appende le modifiche al journal (una write + un fsync), compact()
+riscrive lo snapshot e svuota il journal quando questo supera la taglia
+dello snapshot. Le entità passate in pending (campioni ancora nei buffer
+del writer, non su disco) restano da salvare al flush successivo: dopo un
+crash senza journal write-ahead il loro valore va riscritto, non saltato. All'avvio lo stato è snapshot + replay del journal; se non
+esiste nulla può essere ricostruito dalla coda del file HDF5 corrente.
+"""
+
+import json
+import os
+import time
+from typing import Container, Dict, Iterator, Optional
+
+import h5py
+
+from .constants import LAST_VALUES_PATH
+from .attributes import last_value_entity, last_value_key
+from .encoding import is_encoded_group, read_states, read_values
+from .layout import is_columnar_group, iter_columnar_entities
+from .swmr import open_read
+
+
+def _fsync(fh) -> None:
+    fh.flush()
+    try:
+        os.fsync(fh.fileno())
+    except OSError:
+        pass
+
+
+class LastValueStore:
+    def __init__(self, path: str = LAST_VALUES_PATH, flush_interval: float = 60.0):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.flush_interval = max(0.0, float(flush_interval))
+        self._values: Dict[str, str] = {}
+        self._dirty: Dict[str, str] = {}
+        self._journal_entries = 0
+        self._last_flush = time.monotonic()
+        self.loaded_from_disk = False
+        self._load()
+
+    # --- accesso tipo dict -------------------------------------------------
+
+    def get(self, entity_id: str, default: Optional[str] = None) -> Optional[str]:
+        return self._values.get(entity_id, default)
+
+    def __getitem__(self, entity_id: str) -> str:
+        return self._values[entity_id]
+
+    def __setitem__(self, entity_id: str, value: str) -> None:
+        value = str(value)
+        if self._values.get(entity_id) == value:
+            return
+        self._values[entity_id] = value
+        self._dirty[entity_id] = value
+
+    def __contains__(self, entity_id: str) -> bool:
+        return entity_id in self._values
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._values)
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    # --- persistenza -------------------------------------------------------
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._values = {str(k): str(v) for k, v in data.items()}
+                self.loaded_from_disk = True
+        except Exception:
+            pass
+
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        eid, value = json.loads(line)
+                    except Exception:
+                        # riga troncata da un crash: ignora
+                        continue
+                    self._values[str(eid)] = str(value)
+                    self._journal_entries += 1
+            self.loaded_from_disk = True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[WARNING] Journal ultimi valori illeggibile {self.journal_path}: {e}")
+
+    def flush(self, pending: Container[str] = ()) -> int:
+        """
+        Appende al journal le entità cambiate dall'ultimo flush, tranne
+        quelle in pending. Ritorna il numero di righe scritte.
+        """
+        self._last_flush = time.monotonic()
+        items = [(key, value) for key, value in self._dirty.items() if last_value_entity(key) not in pending]
+        if not items:
+            return 0
+        lines = "".join(
+            json.dumps([key, value], ensure_ascii=False, separators=(",", ":")) + "\n"
+            for key, value in items
+        )
+        try:
+            os.makedirs(os.path.dirname(self.journal_path) or ".", exist_ok=True)
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                _fsync(f)
+        except Exception as e:
+            # non bloccare il logger se fallisce il salvataggio
+            print(f"[WARNING] Impossibile aggiornare il journal {self.journal_path}: {e}")
+            return 0
+        for key, _ in items:
+            del self._dirty[key]
+        self._journal_entries += len(items)
+        # lo snapshot contiene tutti i valori: solo senza modifiche in attesa
+        if not self._dirty and self._journal_entries > max(1000, len(self._values)):
+            self.compact()
+        return len(items)
+
+    def maybe_flush(self, pending: Container[str] = ()) -> int:
+        if self._dirty and time.monotonic() - self._last_flush >= self.flush_interval:
+            return self.flush(pending)
+        return 0
+
+    def compact(self) -> None:
+        """
+        Riscrive lo snapshot completo e svuota il journal.
+        """
+        tmp = self.path + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._values, f)
+                _fsync(f)
+            os.replace(tmp, self.path)
+            # le modifiche non ancora nel journal ora sono nello snapshot
+            self._dirty.clear()
+            with open(self.journal_path, "w", encoding="utf-8"):
+                pass
+            self._journal_entries = 0
+        except Exception as e:
+            print(f"[WARNING] Impossibile compattare gli ultimi valori {self.path}: {e}")
+
+    def close(self) -> None:
+        self.flush()
+        if self._journal_entries:
+            self.compact()
+
+    # --- ricostruzione -----------------------------------------------------
+
+    def rebuild_from_hdf5(self, h5_path: str) -> int:
+        """
+        Ricostruisce gli ultimi valori dall'ultimo campione di ogni entità
+        del file HDF5 indicato. Ritorna il numero di entità recuperate.
+        Le chiavi già presenti (raw esatti, es. riapplicati dal journal
+        write-ahead) restano invariate.
+        """
+        recovered = 0
+
+        def _visit(name, obj):
+            nonlocal recovered
+            if is_columnar_group(obj) or not isinstance(obj, h5py.Group):
+                return
+            if "value" not in obj and not is_encoded_group(obj):
+                return
+            ds = obj["availability"] if is_encoded_group(obj) else obj["value"]
+            if not isinstance(ds, h5py.Dataset) or not ds.shape or ds.shape[0] == 0:
+                return
+            entity_id = obj.attrs.get("entity_id", name.rsplit("/", 1)[-1])
+            if isinstance(entity_id, bytes):
+                entity_id = entity_id.decode("utf-8")
+            n = ds.shape[0]
+            last = read_values(obj, slice(n - 1, n))[0]
+            state = read_states(obj, slice(n - 1, n))[0]
+            if state:
+                last = state.decode("utf-8", errors="replace")
+            elif isinstance(last, bytes):
+                last = last.decode("utf-8", errors="replace")
+            else:
+                # il raw originale non è recuperabile: al peggio il primo
+                # campione dopo il riavvio viene riscritto una volta
+                last = repr(float(last))
+            attribute = obj.attrs.get("attribute")
+            if attribute is not None:
+                if isinstance(attribute, bytes):
+                    attribute = attribute.decode("utf-8")
+                key = last_value_key(str(entity_id), str(attribute))
+                if key not in self:
+                    self[key] = last
+                return
+            if str(entity_id) not in self:
+                self[str(entity_id)] = last
+                recovered += 1
+
+        try:
+            with open_read(h5_path) as f:
+                f.visititems(_visit)
+                for entity_id, _, _, _, values, states in iter_columnar_entities(f):
+                    if len(values) and entity_id not in self:
+                        state = states[-1]
+                        self[entity_id] = state.decode("utf-8", errors="replace") if state else repr(float(values[-1]))
+                        recovered += 1
+        except Exception as e:
+            print(f"[WARNING] Impossibile ricostruire gli ultimi valori da {h5_path}: {e}")
+        return recovered
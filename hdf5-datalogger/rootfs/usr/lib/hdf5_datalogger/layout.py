@@ -0,0 +1,306 @@
+"""
+Layout dei file HDF5 giornalieri.
+
+- per_entity (storico): /<domain>/<entity_id>/{value,timestamp}
+- columnar: una tabella in formato lungo per dominio
+
+    /<domain>/entities      S255, dizionario entity_id (posizione = indice)
+    /<domain>/entity_meta   JSON degli attributi statici, parallelo a entities
+    /<domain>/states        S256, dizionario degli stati testuali (0 = numerico)
+    /<domain>/entity_index  uint32, indice in entities
+    /<domain>/timestamp     come nel layout per entità (epoch int64 o S32)
+    /<domain>/value         float64 (NaN se lo stato non è numerico)
+    /<domain>/state_code    uint32, indice in states
+
+Le righe della tabella sono sempre ordinate per timestamp (le letture per
+intervallo usano la ricerca binaria di time_slice): un flush con campioni
+precedenti a righe già scritte (es. una entità in ritardo rispetto alle
+altre) riscrive fusa solo la coda della tabella dal punto di inserimento.
+
+Il layout è una proprietà del file (attributo "layout" sulla radice):
+un file esistente mantiene sempre il suo, quello configurato vale solo
+per i file nuovi.
+"""
+
+import json
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import h5py
+import numpy as np
+
+from .constants import STATIC_ATTR_KEYS
+from .timestamps import create_timestamp_dataset, encode_timestamps, read_timestamps_us, time_slice
+
+PER_ENTITY = "per_entity"
+COLUMNAR = "columnar"
+LAYOUTS = (PER_ENTITY, COLUMNAR)
+
+COLUMNS = ("entity_index", "timestamp", "value", "state_code")
+
+
+def normalize_layout(layout: str) -> str:
+    layout = str(layout or PER_ENTITY).strip().lower()
+    return layout if layout in LAYOUTS else PER_ENTITY
+
+
+def file_layout(f: h5py.File, default: str = PER_ENTITY) -> str:
+    """
+    Layout del file; un file nuovo (vuoto) adotta default e lo registra.
+    """
+    layout = f.attrs.get("layout")
+    if layout is not None:
+        return layout.decode("utf-8") if isinstance(layout, bytes) else str(layout)
+    if len(f.keys()) == 0 and f.mode != "r":
+        f.attrs["layout"] = normalize_layout(default)
+        return normalize_layout(default)
+    return PER_ENTITY
+
+
+def is_columnar_group(grp) -> bool:
+    return isinstance(grp, h5py.Group) and grp.attrs.get("layout") == COLUMNAR
+
+
+def static_meta(attrs: dict) -> str:
+    meta = {}
+    for key in STATIC_ATTR_KEYS:
+        if key in attrs:
+            val = attrs[key]
+            meta[key] = val if isinstance(val, (str, int, float, bool)) or val is None else str(val)
+    return json.dumps(meta, ensure_ascii=False, sort_keys=True)
+
+
+def _text(v) -> str:
+    return v.decode("utf-8", errors="replace") if isinstance(v, bytes) else str(v)
+
+
+class ColumnarCache:
+    """
+    Dizionari entity_id/stati (e metadati) già letti dal file aperto, per
+    evitare di rileggerli a ogni flush. Va azzerata quando cambia il file.
+    """
+
+    def __init__(self):
+        self.entities: Dict[str, Dict[str, int]] = {}
+        self.meta: Dict[str, Dict[int, str]] = {}
+        self.states: Dict[str, Dict[str, int]] = {}
+
+    def load(self, grp: h5py.Group, domain: str) -> None:
+        if domain in self.entities:
+            return
+        self.entities[domain] = {_text(e): i for i, e in enumerate(grp["entities"][()])}
+        self.meta[domain] = {i: _text(m) for i, m in enumerate(grp["entity_meta"][()])}
+        self.states[domain] = {_text(s): i for i, s in enumerate(grp["states"][()])}
+
+
+def _ensure_table(f: h5py.File, domain: str, chunk_size: int, timestamp_format: str) -> h5py.Group:
+    grp = f.require_group(f"/{domain}")
+    if "entity_index" in grp:
+        return grp
+    chunks = (max(1, int(chunk_size)),)
+    grp.attrs["layout"] = COLUMNAR
+    grp.attrs["domain"] = domain
+    grp.create_dataset("entities", shape=(0,), maxshape=(None,), dtype="S255", chunks=(256,))
+    grp.create_dataset("entity_meta", shape=(0,), maxshape=(None,),
+                       dtype=h5py.string_dtype("utf-8"), chunks=(256,))
+    states = grp.create_dataset("states", shape=(1,), maxshape=(None,), dtype="S256", chunks=(256,))
+    states[0] = b""
+    grp.create_dataset("entity_index", shape=(0,), maxshape=(None,), dtype="u4", chunks=chunks)
+    create_timestamp_dataset(grp, timestamp_format, chunks)
+    grp.create_dataset("value", shape=(0,), maxshape=(None,), dtype="f8", chunks=chunks)
+    grp.create_dataset("state_code", shape=(0,), maxshape=(None,), dtype="u4", chunks=chunks)
+    return grp
+
+
+def _append_1d(ds: h5py.Dataset, data, start: int = None) -> None:
+    # start < lunghezza: riscrive la coda da start in poi
+    start = ds.shape[0] if start is None else start
+    ds.resize((start + len(data),))
+    ds[start:] = data
+
+
+def _to_float(raw: str) -> float:
+    try:
+        return float(raw)
+    except Exception:
+        return np.nan
+
+
+def columnar_append(
+    f: h5py.File,
+    domain: str,
+    entries: List[Tuple[str, dict, List[str], List[int]]],
+    chunk_size: int,
+    timestamp_format: str,
+    cache: ColumnarCache = None,
+) -> int:
+    """
+    Accoda alla tabella del dominio i campioni di più entità.
+    entries: [(entity_id, attrs, valori_raw, timestamps_us)].
+    Un solo resize per colonna; righe ordinate per timestamp, anche
+    rispetto a quelle già nel file (a parità di timestamp le righe già
+    scritte restano prima).
+    """
+    cache = cache or ColumnarCache()
+    grp = _ensure_table(f, domain, chunk_size, timestamp_format)
+    cache.load(grp, domain)
+    ent_map = cache.entities[domain]
+    meta_map = cache.meta[domain]
+    state_map = cache.states[domain]
+
+    new_entities, new_meta = [], []
+    meta_updates = {}
+    idx_rows, ts_rows, raw_rows = [], [], []
+    for entity_id, attrs, values, timestamps in entries:
+        meta = static_meta(attrs)
+        idx = ent_map.get(entity_id)
+        if idx is None:
+            idx = len(ent_map)
+            ent_map[entity_id] = idx
+            meta_map[idx] = meta
+            new_entities.append(entity_id.encode("utf-8"))
+            new_meta.append(meta)
+        elif meta_map.get(idx) != meta:
+            # metadati riscritti solo quando cambiano
+            meta_map[idx] = meta
+            meta_updates[idx] = meta
+        idx_rows.extend([idx] * len(values))
+        ts_rows.extend(timestamps)
+        raw_rows.extend(values)
+
+    if new_entities:
+        _append_1d(grp["entities"], np.array(new_entities, dtype="S255"))
+        _append_1d(grp["entity_meta"], np.array(new_meta, dtype=object))
+    for idx, meta in meta_updates.items():
+        grp["entity_meta"][idx] = meta
+
+    if not raw_rows:
+        return 0
+
+    values = np.fromiter((_to_float(v) for v in raw_rows), dtype="f8", count=len(raw_rows))
+    codes = np.zeros(len(raw_rows), dtype="u4")
+    new_states = []
+    for i in np.flatnonzero(np.isnan(values)):
+        raw = raw_rows[i]
+        code = state_map.get(raw)
+        if code is None:
+            code = len(state_map)
+            state_map[raw] = code
+            new_states.append(raw.encode("utf-8"))
+        codes[i] = code
+    if new_states:
+        _append_1d(grp["states"], np.array(new_states, dtype="S256"))
+
+    order = np.argsort(np.asarray(ts_rows, dtype="i8"), kind="stable")
+    columns = {
+        "entity_index": np.asarray(idx_rows, dtype="u4")[order],
+        "timestamp": np.asarray(ts_rows, dtype="i8")[order],
+        "value": values[order],
+        "state_code": codes[order],
+    }
+    ts_ds = grp["timestamp"]
+    n = ts_ds.shape[0]
+    pos = None
+    if n and int(read_timestamps_us(ts_ds, slice(n - 1, n))[0]) > columns["timestamp"][0]:
+        # campioni in ritardo: fusi con la coda già scritta dal primo
+        # timestamp successivo al più vecchio del batch
+        pos = time_slice(ts_ds, int(columns["timestamp"][0]) + 1).start
+        tail = {name: grp[name][pos:n] for name in COLUMNS}
+        tail["timestamp"] = read_timestamps_us(ts_ds, slice(pos, n))
+        merged = np.argsort(np.concatenate([tail["timestamp"], columns["timestamp"]]), kind="stable")
+        columns = {name: np.concatenate([tail[name], columns[name]])[merged] for name in COLUMNS}
+    columns["timestamp"] = encode_timestamps(ts_ds, columns["timestamp"])
+    for name in COLUMNS:
+        _append_1d(grp[name], columns[name], pos)
+    return len(raw_rows)
+
+
+def entity_position(grp: h5py.Group, entity_id: str) -> Optional[int]:
+    target = entity_id.encode("utf-8")
+    hits = np.flatnonzero(grp["entities"][()] == target)
+    return int(hits[0]) if hits.size else None
+
+
+def _decode_states(grp: h5py.Group, codes: np.ndarray) -> np.ndarray:
+    """
+    Stato testuale di ogni riga (b"" per i numerici, codice 0); value
+    resta float64 con NaN dove lo stato non è numerico.
+    """
+    if not codes.any():
+        return np.zeros(len(codes), dtype="S256")
+    return grp["states"][()].astype("S256")[codes]
+
+
+def read_columnar_entity(
+    grp: h5py.Group,
+    entity_id: str,
+    start_us: int = None,
+    end_us: int = None,
+) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    (timestamps_us, value float64, state S256) di un'entità in [start_us, end_us).
+    """
+    idx = entity_position(grp, entity_id)
+    if idx is None:
+        return None
+    sl = time_slice(grp["timestamp"], start_us, end_us)
+    if sl.stop <= sl.start:
+        return None
+    mask = grp["entity_index"][sl] == idx
+    if not mask.any():
+        return None
+    ts = read_timestamps_us(grp["timestamp"], sl)[mask]
+    values = grp["value"][sl][mask]
+    codes = grp["state_code"][sl][mask]
+    return ts, values, _decode_states(grp, codes)
+
+
+def columnar_entity_stats(grp: h5py.Group) -> Dict[str, Tuple[int, int, int]]:
+    """
+    {entity_id: (primo_us, ultimo_us, conteggio)} per una tabella di dominio.
+    """
+    entities = [_text(e) for e in grp["entities"][()]]
+    idx = grp["entity_index"][()]
+    if idx.size == 0:
+        return {}
+    ts = read_timestamps_us(grp["timestamp"])
+    n = len(entities)
+    counts = np.bincount(idx, minlength=n)
+    first = np.full(n, np.iinfo("i8").max, dtype="i8")
+    last = np.full(n, np.iinfo("i8").min, dtype="i8")
+    np.minimum.at(first, idx, ts)
+    np.maximum.at(last, idx, ts)
+    return {
+        entities[i]: (int(first[i]), int(last[i]), int(counts[i]))
+        for i in range(n) if counts[i]
+    }
+
+
+def iter_columnar_entities(f: h5py.File) -> Iterator[Tuple[str, str, dict, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    (entity_id, domain, attrs statici, timestamps_us, value, state) di ogni entità.
+    """
+    for domain, grp in f.items():
+        if not is_columnar_group(grp):
+            continue
+        entities = [_text(e) for e in grp["entities"][()]]
+        metas = [_text(m) for m in grp["entity_meta"][()]]
+        idx = grp["entity_index"][()]
+        order = np.argsort(idx, kind="stable")
+        bounds = np.searchsorted(idx[order], np.arange(len(entities) + 1))
+        ts_all = read_timestamps_us(grp["timestamp"])
+        values_all = grp["value"][()]
+        codes_all = grp["state_code"][()]
+        for i, entity_id in enumerate(entities):
+            rows = order[bounds[i]:bounds[i + 1]]
+            try:
+                attrs = json.loads(metas[i]) if i < len(metas) and metas[i] else {}
+            except ValueError:
+                attrs = {}
+            yield (
+                entity_id,
+                domain,
+                attrs,
+                ts_all[rows],
+                values_all[rows],
+                _decode_states(grp, codes_all[rows]),
+            )
@@ -0,0 +1,329 @@
+"""
+Metriche del logger in formato Prometheus e come snapshot JSON.
+
+- contatori (*_total), gauge e timer per fase (fetch, filter, write,
+  report, cycle: conteggio, somma, ultimo e massimo in secondi);
+- MetricsServer espone GET /metrics (testo Prometheus) e GET /metrics.json
+  (snapshot) su una porta locale (default solo 127.0.0.1), in un thread
+  daemon;
+- write_snapshot salva lo stesso snapshot su file (tmp + os.replace), al
+  massimo ogni min_interval secondi per non consumare la scheda SD;
+- il compresser, processo separato, registra gli esiti in
+  COMPRESS_METRICS_PATH (record_compression) e l'occupazione del disco in
+  STORAGE_USAGE_PATH (storage), letti a ogni esposizione.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+
+from .constants import COMPRESS_METRICS_PATH, STORAGE_USAGE_PATH
+from .timeutils import utc_now_z
+
+PREFIX = "hdf5_datalogger_"
+
+_HELP = {
+    "stage_seconds": ("summary", "Durata delle fasi del ciclo (fetch, filter, write, report, cycle; queue = fetch -> scrittura)"),
+    "stage_seconds_last": ("gauge", "Durata dell'ultima esecuzione di ogni fase"),
+    "stage_seconds_max": ("gauge", "Durata massima di ogni fase dall'avvio"),
+    "fetches_total": ("counter", "Fetch degli stati per strategia (full, include)"),
+    "http_errors_total": ("counter", "Errori HTTP/rete verso Home Assistant"),
+    "cycles_total": ("counter", "Cicli eseguiti"),
+    "cycle_overrun_ratio": ("gauge", "Durata dell'ultimo ciclo / update_interval (> 1 = in ritardo)"),
+    "cycle_overruns_total": ("counter", "Cicli più lunghi di update_interval"),
+    "missed_ticks_total": ("counter", "Tick saltati dallo scheduler per ritardo"),
+    "reports_total": ("counter", "Report testuali per esito (written, unchanged, deferred)"),
+    "selection_rebuilds_total": ("counter", "Ricostruzioni del piano di selezione delle entità"),
+    "entities": ("gauge", "Entità nell'ultimo ciclo, per fase (total, filtered, selected)"),
+    "points_total": ("counter", "Campioni per esito (appended, skipped, suppressed_*, ...)"),
+    "buffered_points": ("gauge", "Campioni nei buffer di scrittura"),
+    "write_queue_depth": ("gauge", "Snapshot in attesa del thread di scrittura"),
+    "write_queue_coalesced_entities": ("gauge", "Entità fuse all'ultimo valore per coda piena"),
+    "write_queue_coalesced_total": ("counter", "Snapshot fusi per coda di scrittura piena"),
+    "file_bytes": ("gauge", "Dimensione del file HDF5 corrente"),
+    "file_growth_bytes_total": ("counter", "Crescita cumulata dei file HDF5 scritti"),
+    "compress_files_total": ("counter", "File compressi dal compresser, per esito"),
+    "compress_bytes_total": ("counter", "Byte letti (in) e scritti (out) dal compresser"),
+    "compress_last_ratio": ("gauge", "Rapporto originale/compresso dell'ultimo file"),
+    "compress_last_seconds": ("gauge", "Durata della compressione dell'ultimo file"),
+    "disk_bytes": ("gauge", "Spazio su disco dei dataset per dominio e tipo (raw, rollup)"),
+    "disk_total_bytes": ("gauge", "Spazio su disco di tutti i file sotto output_path_prefix"),
+    "storage_deleted_files_total": ("counter", "File cancellati da retention e budget di spazio"),
+    "storage_archived_files_total": ("counter", "File fusi negli archivi mensili"),
+    "uptime_seconds": ("gauge", "Secondi dall'avvio del processo"),
+}
+
+# esiti del writer esportati come points_total{outcome=...}
+_POINT_OUTCOMES = (
+    "appended_points",
+    "skipped_points",
+    "suppressed_deadband",
+    "suppressed_rate",
+    "heartbeat_points",
+    "attribute_points",
+    "flushed_points",
+)
+
+
+def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _label_str(labels: tuple) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{v}"' for k, v in labels)
+    return "{" + inner + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.gauges: Dict[Tuple[str, tuple], float] = {}
+        # timer: [conteggio, somma, ultimo, massimo]
+        self.timers: Dict[Tuple[str, tuple], list] = {}
+        self.started = time.time()
+        self._file_sizes: Dict[str, int] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            self.counters[k] = self.counters.get(k, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        k = _key(name, labels)
+        with self._lock:
+            t = self.timers.get(k)
+            if t is None:
+                t = self.timers[k] = [0, 0.0, 0.0, 0.0]
+            t[0] += 1
+            t[1] += seconds
+            t[2] = seconds
+            t[3] = max(t[3], seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - t0, stage=stage)
+
+    def record_write_stats(self, stats: dict) -> None:
+        for outcome in _POINT_OUTCOMES:
+            if stats.get(outcome):
+                self.inc("points_total", stats[outcome], outcome=outcome.replace("_points", ""))
+        self.set("buffered_points", stats.get("buffered_points", 0))
+        if stats.get("file_path"):
+            self.observe_file(stats["file_path"])
+
+    def observe_file(self, path: str) -> None:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        prev = self._file_sizes.get(path)
+        self._file_sizes = {path: size}
+        self.set("file_bytes", size)
+        if prev is not None and size > prev:
+            self.inc("file_growth_bytes_total", size - prev)
+
+    def _collect(self) -> Tuple[dict, dict, dict]:
+        counters, gauges = {}, {}
+        comp = load_compression_metrics()
+        if comp:
+            counters[_key("compress_files_total", {"outcome": "ok"})] = comp.get("files_ok", 0)
+            counters[_key("compress_files_total", {"outcome": "failed"})] = comp.get("files_failed", 0)
+            counters[_key("compress_bytes_total", {"direction": "in"})] = comp.get("bytes_in", 0)
+            counters[_key("compress_bytes_total", {"direction": "out"})] = comp.get("bytes_out", 0)
+            gauges[_key("compress_last_ratio", {})] = comp.get("last_ratio", 0.0)
+            gauges[_key("compress_last_seconds", {})] = comp.get("last_seconds", 0.0)
+        usage = load_storage_usage()
+        if usage:
+            for kind in ("raw", "rollup"):
+                for domain, n in (usage.get(kind) or {}).items():
+                    gauges[_key("disk_bytes", {"domain": domain, "kind": kind})] = n
+            gauges[_key("disk_total_bytes", {})] = usage.get("total_bytes", 0)
+            counters[_key("storage_deleted_files_total", {})] = usage.get("deleted_files", 0)
+            counters[_key("storage_archived_files_total", {})] = usage.get("archived_files", 0)
+        gauges[_key("uptime_seconds", {})] = round(time.time() - self.started, 3)
+        with self._lock:
+            counters.update(self.counters)
+            gauges.update(self.gauges)
+            timers = {k: list(v) for k, v in self.timers.items()}
+        return counters, gauges, timers
+
+    def snapshot(self) -> dict:
+        counters, gauges, timers = self._collect()
+        return {
+            "timestamp": utc_now_z(),
+            "counters": {n + _label_str(l): v for (n, l), v in sorted(counters.items())},
+            "gauges": {n + _label_str(l): v for (n, l), v in sorted(gauges.items())},
+            "timers": {
+                n + _label_str(l): {"count": t[0], "sum": t[1], "last": t[2], "max": t[3]}
+                for (n, l), t in sorted(timers.items())
+            },
+        }
+
+    def render(self) -> str:
+        """
+        Testo nel formato di esposizione Prometheus 0.0.4.
+        """
+        counters, gauges, timers = self._collect()
+        lines = []
+        seen = set()
+
+        def _header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            help_text = _HELP.get(name, (kind, name))[1]
+            lines.append(f"# HELP {PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+
+        for (name, labels), v in sorted(counters.items()):
+            _header(name, "counter")
+            lines.append(f"{PREFIX}{name}{_label_str(labels)} {v}")
+        for (name, labels), v in sorted(gauges.items()):
+            _header(name, "gauge")
+            lines.append(f"{PREFIX}{name}{_label_str(labels)} {v}")
+        for (name, labels), t in sorted(timers.items()):
+            _header(name, "summary")
+            ls = _label_str(labels)
+            lines.append(f"{PREFIX}{name}_count{ls} {t[0]}")
+            lines.append(f"{PREFIX}{name}_sum{ls} {t[1]:.6f}")
+        for suffix, idx in (("last", 2), ("max", 3)):
+            for (name, labels), t in sorted(timers.items()):
+                _header(f"{name}_{suffix}", "gauge")
+                lines.append(f"{PREFIX}{name}_{suffix}{_label_str(labels)} {t[idx]:.6f}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+# ultimo salvataggio (clock monotono) per path dello snapshot
+_SNAPSHOT_WRITTEN: Dict[str, float] = {}
+
+
+def write_snapshot(path: str, metrics: Metrics = METRICS, min_interval: float = 0) -> None:
+    if not path:
+        return
+    now = time.monotonic()
+    last = _SNAPSHOT_WRITTEN.get(path)
+    if last is not None and now - last < min_interval:
+        return
+    _SNAPSHOT_WRITTEN[path] = now
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(metrics.snapshot(), fh, indent=2)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[WARNING] Impossibile salvare le metriche in {path}: {e}")
+
+
+def load_compression_metrics(path: str = COMPRESS_METRICS_PATH) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def load_storage_usage(path: str = STORAGE_USAGE_PATH) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def record_compression(res: dict, path: str = COMPRESS_METRICS_PATH) -> None:
+    """
+    Aggiorna i totali del compresser con l'esito di un file (vedi
+    compress_scheduler.compress_job).
+    """
+    data = load_compression_metrics(path)
+    if res.get("ok"):
+        data["files_ok"] = data.get("files_ok", 0) + 1
+        data["bytes_in"] = data.get("bytes_in", 0) + res.get("size_orig", 0)
+        data["bytes_out"] = data.get("bytes_out", 0) + res.get("size_new", 0)
+        data["last_ratio"] = res["size_orig"] / res["size_new"] if res.get("size_new") else 0.0
+        data["last_seconds"] = res.get("seconds", 0.0)
+        data["last_file"] = res.get("path", "")
+    else:
+        data["files_failed"] = data.get("files_failed", 0) + 1
+    data["updated"] = utc_now_z()
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(data, fh, indent=2)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[WARNING] Impossibile salvare le metriche di compressione in {path}: {e}")
+
+
+class MetricsServer:
+    """
+    Endpoint HTTP locale: /metrics (Prometheus) e /metrics.json.
+    """
+
+    def __init__(self, port: int, metrics: Metrics = METRICS, host: str = "127.0.0.1"):
+        self.port = int(port)
+        self.host = host
+        self.metrics = metrics
+        self._server = None
+        self._thread = None
+
+    def start(self) -> bool:
+        metrics = self.metrics
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/metrics":
+                    body = metrics.render().encode("utf-8")
+                    ctype = "text/plain; version=0.0.4; charset=utf-8"
+                elif path == "/metrics.json":
+                    body = json.dumps(metrics.snapshot(), indent=2).encode("utf-8")
+                    ctype = "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # niente log di accesso nel log dell'add-on
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        except OSError as e:
+            print(f"[WARNING] Endpoint metriche non avviato sulla porta {self.port}: {e}")
+            return False
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True)
+        self._thread.start()
+        print(f"[INFO] Metriche esposte su http://{self.host}:{self.port}/metrics (e /metrics.json)")
+        return True
+
+    def close(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
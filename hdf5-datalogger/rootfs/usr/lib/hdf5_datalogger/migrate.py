@@ -0,0 +1,178 @@
+"""
+Conversione tra layout (per_entity <-> columnar) ed export CSV dei file
+giornalieri. Usato da /usr/bin/hdf5_layout.py.
+"""
+
+import csv
+import json
+import os
+from typing import Iterator, Tuple
+
+import h5py
+import numpy as np
+
+from .constants import DEFAULT_CHUNK_SIZE
+from .attributes import ATTRIBUTES_GROUP
+from .domains import domain_of
+from .encoding import append_values, is_encoded_group, read_states, read_values
+from .file_index import load_or_build_index
+from .hdf5_writer import _ensure_group
+from .layout import (
+    COLUMNAR,
+    ColumnarCache,
+    columnar_append,
+    file_layout,
+    is_columnar_group,
+    iter_columnar_entities,
+    normalize_layout,
+)
+from .swmr import open_read
+from .timestamps import create_timestamp_dataset, encode_timestamps, normalize_format, read_timestamps_us
+from .timeutils import epoch_us_to_iso_z
+
+
+def _text(v) -> str:
+    return v.decode("utf-8", errors="replace") if isinstance(v, bytes) else str(v)
+
+
+def _attrs_dict(attrs) -> dict:
+    out = {}
+    for k, v in attrs.items():
+        if isinstance(v, bytes):
+            v = v.decode("utf-8", errors="replace")
+        elif isinstance(v, np.generic):
+            v = v.item()
+        out[k] = v
+    return out
+
+
+def iter_entities(f: h5py.File) -> Iterator[Tuple[str, str, dict, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    (entity_id, domain, attrs, timestamps_us, valori, stati) per ogni
+    entità del file, indipendentemente dal layout (stati come read_states).
+    """
+    yield from iter_columnar_entities(f)
+    for domain, dgrp in f.items():
+        if not isinstance(dgrp, h5py.Group) or is_columnar_group(dgrp):
+            continue
+        for name, grp in dgrp.items():
+            if not isinstance(grp, h5py.Group) or "timestamp" not in grp:
+                continue
+            if "value" not in grp and not is_encoded_group(grp):
+                continue
+            attrs = _attrs_dict(grp.attrs)
+            entity_id = str(attrs.pop("entity_id", name))
+            attrs.pop("domain", None)
+            yield entity_id, domain, attrs, read_timestamps_us(grp["timestamp"]), read_values(grp), read_states(grp)
+
+
+def _raw_values(values: np.ndarray, states: np.ndarray = None) -> list:
+    """
+    Valori raw (testo come nel JSON di HA) da valori e stati letti: lo
+    stato dove c'è, altrimenti il numero formattato con repr.
+    """
+    if values.dtype.kind == "S":
+        return [_text(v) for v in values]
+    if states is None:
+        return [repr(float(v)) for v in values]
+    return [_text(st) if st else repr(float(v)) for v, st in zip(values, states)]
+
+
+def convert_file(
+    src_path: str,
+    dst_path: str,
+    target_layout: str,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timestamp_format: str = "epoch_us",
+) -> int:
+    """
+    Scrive in dst_path il contenuto di src_path nel layout richiesto.
+    Ritorna il numero di entità convertite.
+
+    Per il layout colonnare le entità di un dominio vengono accumulate e
+    scritte insieme, così la tabella resta ordinata per timestamp.
+    """
+    target_layout = normalize_layout(target_layout)
+    timestamp_format = normalize_format(timestamp_format)
+    converted = 0
+    with open_read(src_path) as fin, h5py.File(dst_path, "w") as fout:
+        fout.attrs["layout"] = target_layout
+        for aname, aval in fin.attrs.items():
+            if aname != "layout":
+                fout.attrs[aname] = aval
+
+        if target_layout == COLUMNAR:
+            by_domain = {}
+            for entity_id, domain, attrs, ts_us, values, states in iter_entities(fin):
+                by_domain.setdefault(domain, []).append(
+                    (entity_id, attrs, _raw_values(values, states), [int(t) for t in ts_us])
+                )
+                converted += 1
+            cache = ColumnarCache()
+            for domain, entries in by_domain.items():
+                columnar_append(fout, domain, entries, chunk_size, timestamp_format, cache)
+        else:
+            for entity_id, domain, attrs, ts_us, values, states in iter_entities(fin):
+                domain = domain or domain_of(entity_id)
+                grp = _ensure_group(fout, domain, entity_id, attrs)
+                # i gruppi escono sempre nella codifica per dominio
+                ts_ds = create_timestamp_dataset(grp, timestamp_format, (max(1, int(chunk_size)),))
+                append_values(grp, domain, attrs, _raw_values(values, states), chunk_size)
+                n = len(values)
+                ts_ds.resize((n,))
+                if n:
+                    ts_ds[:] = encode_timestamps(ts_ds, ts_us)
+                converted += 1
+
+        # serie degli attributi: stesso percorso in entrambi i layout
+        for domain, dgrp in fin.items():
+            if not isinstance(dgrp, h5py.Group):
+                continue
+            for name, grp in dgrp.items():
+                if isinstance(grp, h5py.Group) and ATTRIBUTES_GROUP in grp:
+                    parent = fout.require_group(f"/{domain}/{name}")
+                    fin.copy(grp[ATTRIBUTES_GROUP], parent, name=ATTRIBUTES_GROUP)
+    return converted
+
+
+def convert_in_place(path: str, target_layout: str, **kwargs) -> int:
+    tmp = path + ".convert.tmp"
+    try:
+        n = convert_file(path, tmp, target_layout, **kwargs)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    load_or_build_index(path)
+    return n
+
+
+def export_csv(src_path: str, out_path: str) -> int:
+    """
+    Export in formato lungo: entity_id, domain, timestamp (ISO UTC), value.
+    Ritorna il numero di righe scritte.
+    """
+    rows = 0
+    with open_read(src_path) as fin, open(out_path, "w", encoding="utf-8", newline="") as fh:
+        w = csv.writer(fh)
+        w.writerow(["entity_id", "domain", "timestamp", "value"])
+        for entity_id, domain, _, ts_us, values, states in iter_entities(fin):
+            for t, raw in zip(ts_us, _raw_values(values, states)):
+                w.writerow([entity_id, domain, epoch_us_to_iso_z(int(t)), raw])
+                rows += 1
+    return rows
+
+
+def describe(path: str) -> dict:
+    with open_read(path) as f:
+        layout = file_layout(f)
+        domains = {}
+        for entity_id, domain, _, ts_us, _, _ in iter_entities(f):
+            d = domains.setdefault(domain, {"entities": 0, "samples": 0})
+            d["entities"] += 1
+            d["samples"] += int(len(ts_us))
+    return {"path": path, "layout": layout, "domains": domains}
+
+
+def describe_json(path: str) -> str:
+    return json.dumps(describe(path), indent=2, sort_keys=True)
@@ -0,0 +1,181 @@
+"""
+Pipeline produttore/consumatore del logger residente (ingest_mode=poll).
+
+Il fetch degli stati gira in un task asyncio; filtri, scrittura HDF5 e
+report girano in un thread dedicato ("hdf5-writer") dietro una coda
+limitata di write_queue_size snapshot. Un flush lento su SD o un report
+grande non ritardano più il poll successivo, e un poll lento non ritarda
+le scritture già in coda.
+
+Backpressure: con la coda piena lo snapshot non viene scartato né fa
+attendere il produttore, ma è fuso in memoria con quelli in attesa
+(ultimo valore per entità); lo snapshot fuso entra in coda appena il
+writer libera un posto. Nessuna entità si perde: si perdono solo i valori
+intermedi delle entità cambiate più volte mentre il writer era indietro.
+
+Profondità della coda, entità in attesa di fusione e latenza (dal fetch
+alla fine della scrittura) sono riportate a ogni ciclo nel log e nelle
+metriche (write_queue_*, stage_seconds{stage="queue"}).
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple
+
+from .metrics import METRICS
+
+# sentinella di chiusura del thread writer
+_STOP = object()
+
+
+class WritePipeline:
+    """
+    consume(states, fetched_us, ts_run, scope) è chiamata nel thread writer
+    per ogni snapshot, nell'ordine di arrivo; fetched_us è l'istante del
+    fetch (epoch us), da usare come timestamp dei campioni; scope è quello
+    del fetch (StateFetcher.scope), unito tra gli snapshot fusi.
+    """
+
+    def __init__(self, consume: Callable[[list, int, str, Optional[tuple]], None], maxsize: int = 4):
+        self.maxsize = max(1, int(maxsize or 1))
+        self._consume = consume
+        self._queue: "queue.Queue" = queue.Queue(maxsize=self.maxsize)
+        self._lock = threading.Lock()
+        # entity_id -> stato più recente tra gli snapshot fusi
+        self._coalesced: Dict[str, dict] = {}
+        # (monotonic del primo snapshot fuso, fetched_us e ts_run dell'ultimo,
+        # unione degli scope)
+        self._coalesced_meta: Optional[Tuple[float, int, str, Optional[tuple]]] = None
+        self.stats = {
+            "submitted": 0,
+            "coalesced_snapshots": 0,
+            "written": 0,
+            "errors": 0,
+            "last_latency": 0.0,
+            "max_latency": 0.0,
+        }
+        self._thread = threading.Thread(target=self._run, name="hdf5-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self) -> int:
+        """
+        Snapshot in attesa: in coda più quello in fusione.
+        """
+        return self._queue.qsize() + (1 if self._coalesced else 0)
+
+    @property
+    def coalesced_entities(self) -> int:
+        return len(self._coalesced)
+
+    def _merge(self, states: list, fetched_us: int, ts_run: str, scope: Optional[tuple], t0: float) -> None:
+        for st in states:
+            self._coalesced[st.get("entity_id", "")] = st
+        if self._coalesced_meta:
+            first, prev = self._coalesced_meta[0], self._coalesced_meta[3]
+            # None (dump completo) assorbe qualsiasi scope
+            scope = None if scope is None or prev is None else (prev[0] | scope[0], prev[1] | scope[1])
+        else:
+            first = t0
+        self._coalesced_meta = (first, fetched_us, ts_run, scope)
+        self.stats["coalesced_snapshots"] += 1
+        METRICS.inc("write_queue_coalesced_total")
+
+    def _enqueue_coalesced(self) -> None:
+        # chiamata con il lock: il fuso passa in coda se c'è posto
+        if not self._coalesced:
+            return
+        first, fetched_us, ts_run, scope = self._coalesced_meta
+        try:
+            self._queue.put_nowait(("write", first, list(self._coalesced.values()), fetched_us, ts_run, scope))
+        except queue.Full:
+            return
+        self._coalesced = {}
+        self._coalesced_meta = None
+
+    def submit(self, states: list, fetched_us: int, ts_run: str, scope: Optional[tuple] = None) -> None:
+        """
+        Accoda uno snapshot senza mai bloccare il produttore.
+        """
+        t0 = time.monotonic()
+        with self._lock:
+            self.stats["submitted"] += 1
+            if self._coalesced:
+                # c'è già un fuso in attesa: l'ordine degli snapshot resta quello di arrivo
+                self._merge(states, fetched_us, ts_run, scope, t0)
+                self._enqueue_coalesced()
+                return
+            try:
+                self._queue.put_nowait(("write", t0, states, fetched_us, ts_run, scope))
+            except queue.Full:
+                self._merge(states, fetched_us, ts_run, scope, t0)
+
+    def call(self, fn: Callable, *args) -> Future:
+        """
+        Esegue fn(*args) nel thread writer dopo gli snapshot già accodati
+        (es. ricaricamento delle opzioni che ricrea il writer HDF5).
+        """
+        fut: Future = Future()
+        with self._lock:
+            self._enqueue_coalesced()
+        self._queue.put(("call", fut, fn, args))
+        return fut
+
+    def _run(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is _STOP:
+                return
+            if job[0] == "call":
+                _, fut, fn, args = job
+                try:
+                    fut.set_result(fn(*args))
+                except BaseException as e:
+                    fut.set_exception(e)
+            else:
+                _, t0, states, fetched_us, ts_run, scope = job
+                try:
+                    self._consume(states, fetched_us, ts_run, scope)
+                    self.stats["written"] += 1
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print("[ERROR] Errore nel thread di scrittura HDF5:", repr(e))
+                latency = time.monotonic() - t0
+                self.stats["last_latency"] = latency
+                self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+                METRICS.observe("stage_seconds", latency, stage="queue")
+            with self._lock:
+                self._enqueue_coalesced()
+
+    def report(self) -> None:
+        """
+        Stato della coda, a ogni ciclo del produttore.
+        """
+        depth, coalesced = self.depth, self.coalesced_entities
+        METRICS.set("write_queue_depth", depth)
+        METRICS.set("write_queue_coalesced_entities", coalesced)
+        msg = (
+            f"Coda di scrittura: {depth} snapshot in attesa (coda da {self.maxsize}), "
+            f"latenza ultima {self.stats['last_latency']:.2f}s (max {self.stats['max_latency']:.2f}s)"
+        )
+        if coalesced:
+            print(f"[WARNING] {msg}; writer in ritardo, {coalesced} entità fuse all'ultimo valore")
+        else:
+            print(f"[INFO] {msg}")
+
+    def close(self, timeout: float = None) -> None:
+        """
+        Scrive quanto è ancora in coda (fuso compreso) e ferma il thread.
+        """
+        with self._lock:
+            pending = list(self._coalesced.values())
+            meta = self._coalesced_meta
+            self._coalesced = {}
+            self._coalesced_meta = None
+        if pending:
+            first, fetched_us, ts_run = meta
+            self._queue.put(("write", first, pending, fetched_us, ts_run))
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
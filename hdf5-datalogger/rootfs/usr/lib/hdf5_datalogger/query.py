@@ -0,0 +1,307 @@
+"""
+Read path sui file HDF5 giornalieri.
+
+    from hdf5_datalogger.query import read_range
+    data = read_range(["sensor.power"], "2025-11-15T10:00", "2025-11-15T11:00")
+    ts_us, values = data["sensor.power"]["timestamp"], data["sensor.power"]["value"]
+
+- i file <prefix>HDF5_datalogger_<etichetta>.h5 (giornalieri, orari,
+  settimanali o archivi mensili, vedi rotation) vengono selezionati per
+  finestra esatta (ricavata dall'etichetta) e poi filtrati con l'indice
+  sidecar (file_index) senza aprirli;
+- con resolution i rollup dei file grezzi già cancellati dalla retention
+  restano leggibili;
+- dentro il file la ricerca dell'intervallo è binaria sul dataset timestamp
+  ordinato, quindi vengono letti solo i chunk che servono.
+
+I datetime/ISO senza fuso orario sono interpretati come ora locale del
+container (la stessa dei nomi dei file con partition_timezone "local").
+
+Per query ripetute (dashboard) reader.HistoryReader offre la stessa
+interfaccia con handle e blocchi decodificati in cache.
+"""
+
+import glob
+import os
+from datetime import date, datetime, timezone
+from typing import Dict, Iterable, List, Tuple, Union
+
+import h5py
+import numpy as np
+
+from . import compression  # noqa: F401  (filtri zstd/blosc opzionali)
+from .attributes import ATTRIBUTES_GROUP
+from .domains import domain_of
+from .encoding import is_encoded_group, read_states, read_values
+from .file_index import load_index, load_or_build_index
+from .layout import is_columnar_group, read_columnar_entity
+from .rollup import RESOLUTIONS, ROLLUP_FIELDS, choose_resolution, compute_rollup, load_rollup, numeric_values
+from .rotation import FILE_PREFIX, label_of, label_window_us, list_data_files, list_data_windows
+from .swmr import open_read
+from .timestamps import read_timestamps_us, time_slice
+
+TimeLike = Union[datetime, date, str, int, float, np.datetime64]
+
+# margine per i file senza finestra registrata: il writer precedente
+# all'instradamento per timestamp poteva scrivervi campioni oltre i confini
+_LEGACY_MARGIN_US = 86_400 * 1_000_000
+
+# sotto questa soglia un intero è in secondi: in microsecondi sarebbe
+# entro i primi 12 giorni del 1970, in secondi arriva oltre l'anno 30000
+_SECONDS_MAX = 10**12
+
+
+def to_epoch_us(value: TimeLike) -> int:
+    """
+    Converte datetime/date/ISO/epoch in microsecondi epoch UTC. Un epoch
+    float è in secondi, un intero in secondi (es. int(time.time())) se
+    minore di 10**12, altrimenti in microsecondi.
+    """
+    if isinstance(value, np.datetime64):
+        return int(value.astype("datetime64[us]").astype("i8"))
+    if isinstance(value, (bool, np.bool_)):
+        raise TypeError("timestamp non valido")
+    if isinstance(value, (int, np.integer)):
+        value = int(value)
+        return value * 1_000_000 if abs(value) < _SECONDS_MAX else value
+    if isinstance(value, (float, np.floating)):
+        return int(round(value * 1_000_000))
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    if value.tzinfo is None:
+        # ora locale del container
+        value = value.astimezone()
+    delta = value - datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+
+def list_daily_files(output_path_prefix: str) -> List[Tuple[date, str]]:
+    """
+    (data di inizio, path) dei file dati sotto il prefisso, ordinati; con
+    rotazione oraria più file condividono la stessa data.
+    """
+    return [(start.date(), path) for start, _, path in list_data_files(output_path_prefix)]
+
+
+def _window_files(output_path_prefix: str, start_us: int, end_us: int) -> List[str]:
+    """
+    File la cui finestra interseca [start_us, end_us). I file vicini sono
+    aggiunti solo se l'indice non riporta la finestra (file storici, con
+    possibili campioni oltre i confini) o manca.
+    """
+    out = []
+    for start, end, path in list_data_windows(output_path_prefix):
+        if end > start_us and start < end_us:
+            out.append(path)
+        elif end > start_us - _LEGACY_MARGIN_US and start < end_us + _LEGACY_MARGIN_US:
+            index = load_index(path)
+            if index is None or "window" not in index:
+                out.append(path)
+    return out
+
+
+def orphan_rollups(output_path_prefix: str, start_us: int, end_us: int) -> List[str]:
+    """
+    Path (del file grezzo) dei rollup nella finestra il cui file grezzo è
+    stato cancellato dalla retention: l'unica copia rimasta di quei giorni.
+    """
+    out = []
+    for rpath in sorted(glob.glob(f"{output_path_prefix}{FILE_PREFIX}*.rollup.h5")):
+        path = rpath[: -len(".rollup.h5")] + ".h5"
+        label = label_of(path)
+        if label is None or os.path.exists(path):
+            continue
+        start, end = label_window_us(label)
+        if end > start_us - _LEGACY_MARGIN_US and start < end_us + _LEGACY_MARGIN_US:
+            out.append(path)
+    return out
+
+
+def candidate_files(output_path_prefix: str, start_us: int, end_us: int) -> List[Tuple[str, dict]]:
+    """
+    (path, indice) dei file che possono contenere campioni in [start_us, end_us):
+    selezione per finestra del file (vedi _window_files) e poi per indice.
+    """
+    paths = []
+    for path in _window_files(output_path_prefix, start_us, end_us):
+        index = load_or_build_index(path)
+        if index["first"] is None or index["last"] < start_us or index["first"] >= end_us:
+            continue
+        paths.append((path, index))
+    return paths
+
+
+def _read_entity(f: h5py.File, entity_id: str, start_us: int, end_us: int):
+    domain_grp = f.get(f"/{domain_of(entity_id)}")
+    if is_columnar_group(domain_grp):
+        return read_columnar_entity(domain_grp, entity_id, start_us, end_us)
+    grp = f.get(f"/{domain_of(entity_id)}/{entity_id}")
+    if grp is None or "timestamp" not in grp:
+        return None
+    if "value" not in grp and not is_encoded_group(grp):
+        return None
+    ts_ds = grp["timestamp"]
+    sl = time_slice(ts_ds, start_us, end_us)
+    if sl.stop <= sl.start:
+        return None
+    return read_timestamps_us(ts_ds, sl), read_values(grp, sl), read_states(grp, sl)
+
+
+def _read_attribute(f: h5py.File, entity_id: str, attribute: str, start_us: int, end_us: int):
+    grp = f.get(f"/{domain_of(entity_id)}/{entity_id}/{ATTRIBUTES_GROUP}/{attribute}")
+    if grp is None or "timestamp" not in grp:
+        return None
+    ts_ds = grp["timestamp"]
+    sl = time_slice(ts_ds, start_us, end_us)
+    if sl.stop <= sl.start:
+        return None
+    return read_timestamps_us(ts_ds, sl), read_values(grp, sl), read_states(grp, sl)
+
+
+def _concat(parts: list) -> Dict[str, np.ndarray]:
+    if not parts:
+        return {
+            "timestamp": np.empty(0, dtype="i8"),
+            "value": np.empty(0, dtype="f8"),
+            "state": np.empty(0, dtype="S256"),
+        }
+    ts = np.concatenate([p[0] for p in parts])
+    values = [p[1] for p in parts]
+    if len({v.dtype.kind for v in values}) > 1:
+        # stesso entity con tipi diversi in giorni diversi: ripiega su stringhe
+        values = [v.astype("S256") if v.dtype.kind != "S" else v for v in values]
+    val = np.concatenate(values)
+    states = np.concatenate([p[2] for p in parts])
+    order = np.argsort(ts, kind="stable")
+    return {"timestamp": ts[order], "value": val[order], "state": states[order]}
+
+
+def _read_rollup(f: h5py.File, path: str, entity_id: str, res: str, start_us: int, end_us: int):
+    stored = load_rollup(path, res, domain_of(entity_id), entity_id, start_us, end_us)
+    if stored is None:
+        # rollup assente o non aggiornato (es. file del giorno): calcolo al volo
+        raw = _read_entity(f, entity_id, start_us, end_us)
+        if raw is None:
+            return None
+        nums = numeric_values(raw[1])
+        if nums is None:
+            return None
+        stored = compute_rollup(raw[0], nums, RESOLUTIONS[res])
+    if not stored or not len(stored["bucket"]):
+        return None
+    return stored
+
+
+def _concat_rollups(parts: list) -> Dict[str, np.ndarray]:
+    if not parts:
+        out = {"timestamp": np.empty(0, dtype="i8"), "value": np.empty(0, dtype="f8")}
+        out.update({name: np.empty(0, dtype="u4" if name == "count" else "f8") for name in ROLLUP_FIELDS})
+        return out
+    buckets = np.concatenate([p["bucket"] for p in parts])
+    order = np.argsort(buckets, kind="stable")
+    out = {"timestamp": buckets[order]}
+    for name in ROLLUP_FIELDS:
+        out[name] = np.concatenate([p[name] for p in parts])[order]
+    out["value"] = out["twa"]
+    return out
+
+
+def read_range(
+    entity_ids: Union[str, Iterable[str]],
+    start: TimeLike,
+    end: TimeLike,
+    output_path_prefix: str = "/share/hdf5/",
+    as_dataframe: bool = False,
+    attribute: str = None,
+    resolution=None,
+    max_points: int = 2000,
+):
+    """
+    Legge i campioni delle entità richieste con start <= t < end.
+    Con attribute legge la serie dell'attributo catturato invece dello stato.
+
+    resolution (secondi tra i punti, "auto", "1m", "1h"; None = grezzo)
+    sceglie il livello di rollup più grossolano che la rispetta: con
+    "auto" circa max_points punti sull'intervallo. In quel caso timestamp
+    è l'inizio del bucket, value la media pesata sul tempo e ci sono
+    anche min, max, mean, last, count, twa (solo entità numeriche).
+
+    Ritorna {entity_id: {"timestamp": int64 us epoch UTC, "value": ndarray,
+    "state": S256}} oppure, con as_dataframe=True, un pandas.DataFrame in
+    formato lungo (entity_id, timestamp, value, state). value è float64
+    per le serie numeriche (NaN dove il campione non è un numero), state
+    il testo del campione non numerico (unavailable, unknown, ...), b""
+    altrove.
+    """
+    if isinstance(entity_ids, str):
+        entity_ids = [entity_ids]
+    entity_ids = list(dict.fromkeys(entity_ids))
+    start_us = to_epoch_us(start)
+    end_us = to_epoch_us(end)
+    res = choose_resolution(end_us - start_us, resolution, max_points) if attribute is None else None
+
+    parts: Dict[str, list] = {eid: [] for eid in entity_ids}
+    if end_us > start_us:
+        for path, index in candidate_files(output_path_prefix, start_us, end_us):
+            wanted = []
+            for eid in entity_ids:
+                ent = index["entities"].get(eid)
+                # entità assente o fuori intervallo in questo file: salta
+                # (l'indice copre solo gli stati, non gli attributi)
+                if attribute is None and (ent is None or ent[1] < start_us or ent[0] >= end_us):
+                    continue
+                wanted.append(eid)
+            if not wanted:
+                continue
+            with open_read(path) as f:
+                for eid in wanted:
+                    if res is not None:
+                        part = _read_rollup(f, path, eid, res, start_us, end_us)
+                    elif attribute is None:
+                        part = _read_entity(f, eid, start_us, end_us)
+                    else:
+                        part = _read_attribute(f, eid, attribute, start_us, end_us)
+                    if part is not None:
+                        parts[eid].append(part)
+        if res is not None:
+            for path in orphan_rollups(output_path_prefix, start_us, end_us):
+                for eid in entity_ids:
+                    part = load_rollup(path, res, domain_of(eid), eid, start_us, end_us)
+                    if part:
+                        parts[eid].append(part)
+
+    concat = _concat if res is None else _concat_rollups
+    result = {eid: concat(p) for eid, p in parts.items()}
+    if as_dataframe:
+        return to_dataframe(result)
+    return result
+
+
+def to_dataframe(result: Dict[str, Dict[str, np.ndarray]]):
+    try:
+        import pandas as pd
+    except ImportError as e:
+        raise ImportError("as_dataframe=True richiede pandas") from e
+
+    frames = []
+    for eid, cols in result.items():
+        values = cols["value"]
+        if values.dtype.kind == "S":
+            values = np.char.decode(values, "utf-8")
+        columns = {
+            "entity_id": eid,
+            "timestamp": pd.to_datetime(cols["timestamp"], unit="us", utc=True),
+            "value": values,
+        }
+        if "state" in cols:
+            columns["state"] = np.char.decode(cols["state"], "utf-8")
+        # colonne degli aggregati, se il risultato viene dai rollup
+        for name in ROLLUP_FIELDS:
+            if name in cols:
+                columns[name] = cols[name]
+        frames.append(pd.DataFrame(columns))
+    if not frames:
+        return pd.DataFrame(columns=["entity_id", "timestamp", "value"])
+    return pd.concat(frames, ignore_index=True)
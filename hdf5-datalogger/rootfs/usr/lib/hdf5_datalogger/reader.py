@@ -0,0 +1,386 @@
+"""
+Servizio di lettura con cache, per i consumatori che ripetono le stesse
+query (dashboard, API) sul file corrente e sui file passati.
+
+    from hdf5_datalogger.reader import HistoryReader
+    reader = HistoryReader("/share/hdf5/", cache_mb=64)
+    data = reader.read(["sensor.power"], time.time() - 86400, time.time())
+
+Stessa interfaccia e stesso risultato di query.read_range, ma:
+
+- handle: LRU di file aperti in sola lettura (max_handles). Un file chiuso
+  viene riaperto solo se cambia (nuovo inode dopo compressione, archivio o
+  retention). Il file corrente resta aperto: in SWMR i dataset vengono
+  aggiornati con refresh(), altrimenti il file è riaperto quando cresce;
+- blocchi: timestamp e valori decodificati a blocchi di BLOCK_ROWS righe,
+  in una LRU con budget di memoria (cache_mb). I file crescono solo in
+  append: un blocco pieno non cambia più e l'ultimo blocco del file
+  corrente viene completato leggendo solo le righe nuove;
+- per ogni serie la cache tiene il primo timestamp di ogni blocco, così la
+  ricerca dell'intervallo avviene in memoria;
+- i file (orari, giornalieri, settimanali, archivi mensili e file
+  corrente) sono fusi in un'unica serie per entità, ordinata e senza
+  timestamp duplicati (es. giorno archiviato ma non ancora cancellato);
+- gli indici sidecar dei file chiusi restano in memoria; il file corrente
+  non viene filtrato per indice, che cambierebbe a ogni ciclo.
+
+Le tabelle colonnari passano dagli handle in cache ma non dalla cache dei
+blocchi. Con resolution i rollup dei file chiusi sono tenuti in cache per
+entità; per il file corrente sono calcolati dai blocchi in cache.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+import h5py
+import numpy as np
+
+from .attributes import ATTRIBUTES_GROUP
+from .domains import domain_of
+from .encoding import is_encoded_group, read_states, read_values
+from .file_index import load_or_build_index
+from .layout import is_columnar_group, read_columnar_entity
+from .query import TimeLike, _concat, _concat_rollups, _window_files, orphan_rollups, to_dataframe, to_epoch_us
+from .rollup import RESOLUTIONS, choose_resolution, compute_rollup, load_rollup, numeric_values, rollup_path_for
+from .rotation import label_of, label_window_us
+from .swmr import open_read
+from .timestamps import read_timestamps_us
+from .timeutils import utc_now_us
+
+# righe per blocco in cache (multiplo dei chunk da 1024 campioni)
+BLOCK_ROWS = 8192
+_ALL_US = (-(2 ** 62), 2 ** 62)
+
+
+def _signature(path: str) -> Tuple[int, int, int]:
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _join(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    if a.dtype.kind != b.dtype.kind:
+        # blocchi numerici e testuali: ripiega su stringhe, come query._concat
+        a = a.astype("S256") if a.dtype.kind != "S" else a
+        b = b.astype("S256") if b.dtype.kind != "S" else b
+    return np.concatenate([a, b])
+
+
+def _dedup(out: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    ts = out["timestamp"]
+    if len(ts) < 2:
+        return out
+    keep = np.empty(len(ts), dtype=bool)
+    keep[0] = True
+    np.not_equal(ts[1:], ts[:-1], out=keep[1:])
+    if keep.all():
+        return out
+    return {k: v[keep] for k, v in out.items()}
+
+
+class HistoryReader:
+    def __init__(self, output_path_prefix: str = "/share/hdf5/", max_handles: int = 16, cache_mb: float = 64):
+        self.output_path_prefix = output_path_prefix
+        self.max_handles = max(1, int(max_handles))
+        self.cache_bytes = max(0, int(float(cache_mb) * 1024 * 1024))
+        # path -> [h5py.File, firma all'apertura]
+        self._handles: "OrderedDict[str, list]" = OrderedDict()
+        # chiave -> (valore, byte)
+        self._cache: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._bytes = 0
+        # path -> (firma, indice sidecar)
+        self._indexes: Dict[str, tuple] = {}
+        self._lock = threading.RLock()
+        self.stats = {
+            "handle_hits": 0,
+            "handle_opens": 0,
+            "block_hits": 0,
+            "block_reads": 0,
+            "evictions": 0,
+        }
+
+    def __enter__(self) -> "HistoryReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            for f, _ in self._handles.values():
+                f.close()
+            self._handles.clear()
+            self._cache.clear()
+            self._indexes.clear()
+            self._bytes = 0
+
+    @property
+    def cached_bytes(self) -> int:
+        return self._bytes
+
+    def _get(self, key: tuple):
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        self._cache.move_to_end(key)
+        return entry[0]
+
+    def _put(self, key: tuple, value, nbytes: int) -> None:
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        if nbytes > self.cache_bytes:
+            return
+        self._cache[key] = (value, nbytes)
+        self._bytes += nbytes
+        while self._bytes > self.cache_bytes:
+            _, (_, b) = self._cache.popitem(last=False)
+            self._bytes -= b
+            self.stats["evictions"] += 1
+
+    def _forget(self, path: str) -> None:
+        """
+        Il file è stato sostituito o cancellato: via handle, indice e blocchi.
+        """
+        entry = self._handles.pop(path, None)
+        if entry is not None:
+            entry[0].close()
+        self._indexes.pop(path, None)
+        for key in [k for k in self._cache if k[1] == path]:
+            self._bytes -= self._cache.pop(key)[1]
+
+    def _handle(self, path: str, live: bool, reopen: bool = False) -> Optional[list]:
+        try:
+            sig = _signature(path)
+        except OSError:
+            self._forget(path)
+            return None
+        entry = self._handles.get(path)
+        if entry is not None:
+            f, opened = entry
+            if sig[0] != opened[0]:
+                self._forget(path)
+            elif not reopen and (sig == opened or (live and f.swmr_mode)):
+                self._handles.move_to_end(path)
+                self.stats["handle_hits"] += 1
+                return entry
+            else:
+                # stesso file cresciuto: i blocchi in cache restano validi
+                f.close()
+                del self._handles[path]
+        entry = [open_read(path), sig]
+        self._handles[path] = entry
+        self.stats["handle_opens"] += 1
+        while len(self._handles) > self.max_handles:
+            _, (old, _) = self._handles.popitem(last=False)
+            old.close()
+        return entry
+
+    def _index(self, path: str) -> Optional[dict]:
+        try:
+            sig = _signature(path)
+        except OSError:
+            return None
+        cached = self._indexes.get(path)
+        if cached is not None and cached[0] == sig:
+            return cached[1]
+        index = load_or_build_index(path)
+        self._indexes[path] = (sig, index)
+        return index
+
+    def _rows(self, grp: h5py.Group, live: bool) -> int:
+        datasets = [grp[name] for name in ("timestamp", "value", "availability") if name in grp]
+        if live and grp.file.swmr_mode:
+            for ds in datasets:
+                ds.refresh()
+        if is_encoded_group(grp):
+            # value può nascere più tardi (entità nata unavailable)
+            datasets = [ds for ds in datasets if ds.name.rsplit("/", 1)[-1] != "value"]
+        # in SWMR un dataset può essere già esteso e l'altro non ancora
+        return min(ds.shape[0] for ds in datasets)
+
+    def _anchors(self, base: tuple, ts_ds: h5py.Dataset, n: int) -> np.ndarray:
+        """
+        Primo timestamp di ogni blocco della serie.
+        """
+        key = ("anchors",) + base
+        anchors = self._get(key)
+        blocks = (n + BLOCK_ROWS - 1) // BLOCK_ROWS
+        if anchors is None or len(anchors) < blocks:
+            done = 0 if anchors is None else len(anchors)
+            new = read_timestamps_us(ts_ds, slice(done * BLOCK_ROWS, n, BLOCK_ROWS))
+            anchors = new if anchors is None else np.concatenate([anchors, new])
+            self._put(key, anchors, anchors.nbytes)
+        return anchors
+
+    def _block(self, base: tuple, grp: h5py.Group, k: int, n: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        lo = k * BLOCK_ROWS
+        hi = min(n, lo + BLOCK_ROWS)
+        key = ("block",) + base + (k,)
+        cached = self._get(key)
+        if cached is not None and len(cached[0]) >= hi - lo:
+            self.stats["block_hits"] += 1
+            return cached
+        self.stats["block_reads"] += 1
+        if cached is not None:
+            # ultimo blocco del file corrente: solo le righe nuove
+            sl = slice(lo + len(cached[0]), hi)
+            ts = np.concatenate([cached[0], read_timestamps_us(grp["timestamp"], sl)])
+            values = _join(cached[1], read_values(grp, sl))
+            states = np.concatenate([cached[2], read_states(grp, sl)])
+        else:
+            sl = slice(lo, hi)
+            ts = read_timestamps_us(grp["timestamp"], sl)
+            values = read_values(grp, sl)
+            states = read_states(grp, sl)
+        self._put(key, (ts, values, states), ts.nbytes + values.nbytes + states.nbytes)
+        return ts, values, states
+
+    def _series(self, base: tuple, grp: h5py.Group, start_us: int, end_us: int, live: bool):
+        n = self._rows(grp, live)
+        if not n:
+            return None
+        anchors = self._anchors(base, grp["timestamp"], n)
+        k0 = max(0, int(np.searchsorted(anchors, start_us, side="right")) - 1)
+        k1 = int(np.searchsorted(anchors, end_us, side="left"))
+        if k1 <= k0:
+            return None
+        blocks = [self._block(base, grp, k, n) for k in range(k0, k1)]
+        ts = np.concatenate([b[0] for b in blocks])
+        values = blocks[0][1]
+        for b in blocks[1:]:
+            values = _join(values, b[1])
+        states = np.concatenate([b[2] for b in blocks])
+        i0 = int(np.searchsorted(ts, start_us, side="left"))
+        i1 = int(np.searchsorted(ts, end_us, side="left"))
+        if i1 <= i0:
+            return None
+        return ts[i0:i1], values[i0:i1], states[i0:i1]
+
+    def _read_raw(self, entry: list, path: str, entity_id: str, attribute: str, start_us: int, end_us: int, live: bool):
+        domain = domain_of(entity_id)
+        if attribute is None:
+            dgrp = entry[0].get(f"/{domain}")
+            if is_columnar_group(dgrp):
+                if live and entry[0].swmr_mode:
+                    for ds in dgrp.values():
+                        ds.refresh()
+                return read_columnar_entity(dgrp, entity_id, start_us, end_us)
+            gpath = f"/{domain}/{entity_id}"
+        else:
+            gpath = f"/{domain}/{entity_id}/{ATTRIBUTES_GROUP}/{attribute}"
+        grp = entry[0].get(gpath)
+        if grp is None and live and _signature(path) != entry[1]:
+            # gruppo creato dopo l'apertura (fuori da SWMR): riapre il file
+            entry = self._handle(path, live, reopen=True)
+            grp = entry[0].get(gpath) if entry is not None else None
+        if grp is None or "timestamp" not in grp:
+            return None
+        if "value" not in grp and not is_encoded_group(grp):
+            return None
+        return self._series((path, entry[1][0], gpath), grp, start_us, end_us, live)
+
+    def _stored_rollup(self, path: str, res: str, entity_id: str):
+        """
+        Rollup salvato dell'intera serie (in cache), None se assente o non
+        aggiornato, {} se l'entità non ha rollup.
+        """
+        try:
+            mtime = os.stat(rollup_path_for(path)).st_mtime_ns
+        except OSError:
+            return None
+        key = ("rollup", path, mtime, res, entity_id)
+        stored = self._get(key)
+        if stored is None:
+            stored = load_rollup(path, res, domain_of(entity_id), entity_id, *_ALL_US)
+            if stored is None:
+                return None
+            self._put(key, stored, sum(v.nbytes for v in stored.values()) or 64)
+        return stored
+
+    def _read_rollup(self, entry: Optional[list], path: str, entity_id: str, res: str, start_us: int, end_us: int, live: bool):
+        stored = None if live else self._stored_rollup(path, res, entity_id)
+        if stored is None:
+            if entry is None:
+                return None
+            # file corrente o rollup assente: calcolo dai blocchi grezzi
+            raw = self._read_raw(entry, path, entity_id, None, start_us, end_us, live)
+            if raw is None:
+                return None
+            nums = numeric_values(raw[1])
+            if nums is None:
+                return None
+            stored = compute_rollup(raw[0], nums, RESOLUTIONS[res])
+            return stored if len(stored["bucket"]) else None
+        if not stored or not len(stored["bucket"]):
+            return None
+        lo = int(np.searchsorted(stored["bucket"], start_us, side="left"))
+        hi = int(np.searchsorted(stored["bucket"], end_us, side="left"))
+        if hi <= lo:
+            return None
+        return {name: v[lo:hi] for name, v in stored.items()}
+
+    def read(
+        self,
+        entity_ids: Union[str, Iterable[str]],
+        start: TimeLike,
+        end: TimeLike,
+        as_dataframe: bool = False,
+        attribute: str = None,
+        resolution=None,
+        max_points: int = 2000,
+    ):
+        """
+        Come query.read_range: {entity_id: {"timestamp", "value", "state"}} (più gli
+        aggregati con resolution) oppure un pandas.DataFrame.
+        """
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        entity_ids = list(dict.fromkeys(entity_ids))
+        start_us = to_epoch_us(start)
+        end_us = to_epoch_us(end)
+        res = choose_resolution(end_us - start_us, resolution, max_points) if attribute is None else None
+
+        parts: Dict[str, list] = {eid: [] for eid in entity_ids}
+        with self._lock:
+            if end_us > start_us:
+                now = utc_now_us()
+                for path in _window_files(self.output_path_prefix, start_us, end_us):
+                    live = label_window_us(label_of(path))[1] > now
+                    wanted = entity_ids
+                    index = None if live else self._index(path)
+                    if index is not None:
+                        if index["first"] is None or index["last"] < start_us or index["first"] >= end_us:
+                            continue
+                        if attribute is None:
+                            # l'indice copre solo gli stati, non gli attributi
+                            wanted = []
+                            for eid in entity_ids:
+                                ent = index["entities"].get(eid)
+                                if ent is not None and ent[1] >= start_us and ent[0] < end_us:
+                                    wanted.append(eid)
+                    if not wanted:
+                        continue
+                    entry = self._handle(path, live)
+                    if entry is None:
+                        continue
+                    for eid in wanted:
+                        if res is not None:
+                            part = self._read_rollup(entry, path, eid, res, start_us, end_us, live)
+                        else:
+                            part = self._read_raw(entry, path, eid, attribute, start_us, end_us, live)
+                        if part is not None:
+                            parts[eid].append(part)
+                if res is not None:
+                    for path in orphan_rollups(self.output_path_prefix, start_us, end_us):
+                        for eid in entity_ids:
+                            part = self._read_rollup(None, path, eid, res, start_us, end_us, False)
+                            if part is not None:
+                                parts[eid].append(part)
+
+        concat = _concat if res is None else _concat_rollups
+        result = {eid: _dedup(concat(p)) for eid, p in parts.items()}
+        if as_dataframe:
+            return to_dataframe(result)
+        return result
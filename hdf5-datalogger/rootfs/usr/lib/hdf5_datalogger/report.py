@@ -1,6 +1,42 @@
+"""
+Report testuale degli stati.
+
+ReportWriter (usato dal logger residente) evita di rigenerare il report
+da zero a ogni ciclo:
+
+- ogni entità ha un blocco di testo in cache, riformattato solo quando
+  cambia il suo token (state + last_updated, che Home Assistant aggiorna
+  a ogni cambio di stato o di attributi; in mancanza, hash degli attributi);
+- un digest dell'intestazione e dei token decide se il report è cambiato:
+  con report_update="on_change" un report invariato non viene riscritto;
+- report_min_interval limita la frequenza delle riscritture (con
+  report_update="always" diventa una cadenza propria, più lenta del ciclo);
+- il file è scritto in streaming dai blocchi in cache (tmp + os.replace);
+- report_summary_only scrive solo intestazione e conteggi per dominio
+  (disponibili / unavailable / unknown).
+
+Il digest è salvato nell'intestazione ("Content hash"), così anche la
+modalità a processo singolo e il primo ciclo dopo un riavvio riconoscono
+un report invariato.
+"""
+
+import hashlib
 import json
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
 from .timeutils import utc_now_z
 
+WRITTEN = "written"
+UNCHANGED = "unchanged"
+DEFERRED = "deferred"
+
+HASH_PREFIX = "Content hash: "
+# righe di intestazione lette per recuperare il digest del report esistente
+_HEADER_SCAN_LINES = 4
+_STREAM_BUFFER = 1024 * 1024
+
 def _format_state_lines_all_attrs(state: dict) -> list:
     lines = []
     entity_id = state.get("entity_id", "unknown")
@@ -29,60 +65,249 @@ def _format_state_lines_all_attrs(state: dict) -> list:
 
     return lines
 
-def write_report(
-    output_path: str,
-    grouped: dict,
-    max_entities: int,
+def _state_token(state: dict) -> str:
+    """
+    Identifica il contenuto di un'entità senza formattarne gli attributi.
+    """
+    last_updated = state.get("last_updated")
+    if last_updated:
+        return f"{state.get('state', '')}|{last_updated}"
+    try:
+        attrs = json.dumps(state.get("attributes") or {}, sort_keys=True, default=str)
+    except Exception:
+        attrs = repr(state.get("attributes"))
+    return f"{state.get('state', '')}|" + hashlib.blake2b(attrs.encode("utf-8"), digest_size=8).hexdigest()
+
+def _availability_counts(states: list) -> tuple:
+    unavailable = unknown = 0
+    for s in states:
+        st = s.get("state")
+        if st == "unavailable":
+            unavailable += 1
+        elif st == "unknown":
+            unknown += 1
+    return (
+        ("available", len(states) - unavailable - unknown),
+        ("unavailable", unavailable),
+        ("unknown", unknown),
+    )
+
+def _header_lines(
     available_domains: set,
     included_domains_effective: set,
     include_domains_raw: list,
     filter_stats: dict,
     domain_warnings: list,
-):
-    ts = utc_now_z()
+) -> List[str]:
+    lines = []
+
+    # Info domini
+    if included_domains_effective:
+        lines.append("Included domains (effective): " + ", ".join(sorted(included_domains_effective)))
+    else:
+        lines.append("Included domains (effective): (all)")
+
+    if include_domains_raw:
+        cfg = sorted({str(d).strip().lower() for d in include_domains_raw if str(d).strip()})
+        lines.append("include_domains (config): " + ", ".join(cfg))
+    else:
+        lines.append("include_domains (config): (empty => default domains)")
+
+    lines.append("Available domains (after physical filter): " + ", ".join(sorted(available_domains)))
+
+    # Statistiche filtro fisico
+    if filter_stats:
+        lines.append("Physical filter stats:")
+        for k, v in filter_stats.items():
+            lines.append(f"  {k}: {v}")
+
+    # Warnings sui domini
+    for w in domain_warnings or []:
+        lines.append("WARNING: " + w)
+
+    return lines
+
+def read_report_hash(output_path: str) -> Optional[str]:
+    """
+    Digest salvato nell'intestazione del report esistente, se presente.
+    """
+    try:
+        with open(output_path, "r", encoding="utf-8") as f:
+            for _ in range(_HEADER_SCAN_LINES):
+                line = f.readline()
+                if line.startswith(HASH_PREFIX):
+                    return line[len(HASH_PREFIX):].strip()
+    except OSError:
+        pass
+    return None
+
+def write_error_report(output_path: str, ts: str, error) -> None:
     with open(output_path, "w", encoding="utf-8") as f:
         f.write("===== HOME ASSISTANT STATES REPORT =====\n")
         f.write(f"Generated at: {ts}\n\n")
+        f.write(f"ERROR fetching /states: {error}\n")
+        f.write("===== END =====\n")
 
-        # Info domini
-        if included_domains_effective:
-            f.write("Included domains (effective): " + ", ".join(sorted(included_domains_effective)) + "\n")
-        else:
-            f.write("Included domains (effective): (all)\n")
-
-        if include_domains_raw:
-            cfg = sorted({str(d).strip().lower() for d in include_domains_raw if str(d).strip()})
-            f.write("include_domains (config): " + ", ".join(cfg) + "\n")
-        else:
-            f.write("include_domains (config): (empty => default domains)\n")
 
-        f.write("Available domains (after physical filter): " + ", ".join(sorted(available_domains)) + "\n")
+class ReportWriter:
+    def __init__(self, update: str = "on_change", min_interval: float = 0, summary_only: bool = False):
+        self.update = update if update in ("always", "on_change") else "on_change"
+        self.min_interval = max(0.0, float(min_interval or 0))
+        self.summary_only = bool(summary_only)
+        # entity_id -> (token, blocco di testo formattato)
+        self._blocks: Dict[str, Tuple[str, str]] = {}
+        self._last_hash: Optional[str] = None
+        self._last_path: Optional[str] = None
+        self._last_written = 0.0
+        self.stats = {WRITTEN: 0, UNCHANGED: 0, DEFERRED: 0, "rendered_blocks": 0}
 
-        # Statistiche filtro fisico
-        if filter_stats:
-            f.write("Physical filter stats:\n")
-            for k, v in filter_stats.items():
-                f.write(f"  {k}: {v}\n")
+    @classmethod
+    def from_options(cls, opts: dict) -> "ReportWriter":
+        return cls(
+            update=str(opts.get("report_update") or "on_change").strip().lower(),
+            min_interval=opts.get("report_min_interval", 0) or 0,
+            summary_only=bool(opts.get("report_summary_only", False)),
+        )
 
-        # Warnings sui domini
-        if domain_warnings:
-            for w in domain_warnings:
-                f.write("WARNING: " + w + "\n")
+    def invalidate(self) -> None:
+        """
+        Il file è stato sovrascritto da altri (es. report di errore):
+        il prossimo write lo rigenera comunque.
+        """
+        self._last_hash = None
 
-        f.write("\n")
+    def _block(self, state: dict) -> str:
+        eid = state.get("entity_id", "")
+        token = _state_token(state)
+        cached = self._blocks.get(eid)
+        if cached is not None and cached[0] == token:
+            return cached[1]
+        text = "\n".join(_format_state_lines_all_attrs(state)) + "\n\n"
+        self._blocks[eid] = (token, text)
+        self.stats["rendered_blocks"] += 1
+        return text
 
-        # Corpo del report
+    def _plan(self, grouped: dict, max_entities: int):
+        """
+        [(dominio, totale, stati mostrati o conteggi)] ordinati, più il
+        digest del contenuto calcolato dai soli token (nessuna formattazione).
+        """
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"summary={self.summary_only};max={max_entities}\n".encode("utf-8"))
+        plan = []
         for domain in sorted(grouped.keys()):
+            total = len(grouped[domain])
+            h.update(f"#{domain}:{total}\n".encode("utf-8"))
+            if self.summary_only:
+                # solo i conteggi: i valori che cambiano non riscrivono il report
+                counts = _availability_counts(grouped[domain])
+                h.update(repr(counts).encode("utf-8"))
+                plan.append((domain, total, counts))
+                continue
             entities = sorted(grouped[domain], key=lambda x: x.get("entity_id", ""))
-            total = len(entities)
-            f.write(f"=== DOMAIN: {domain} ({total}) ===\n")
             if max_entities and total > max_entities:
                 entities = entities[:max_entities]
-                f.write(f"(showing first {max_entities} entities)\n")
-
             for s in entities:
-                for ln in _format_state_lines_all_attrs(s):
-                    f.write(ln + "\n")
-                f.write("\n")
+                h.update(f"{s.get('entity_id', '')}={_state_token(s)}\n".encode("utf-8"))
+            plan.append((domain, total, entities))
+        return plan, h
 
-        f.write("===== END =====\n")
+    def write(
+        self,
+        output_path: str,
+        grouped: dict,
+        max_entities: int,
+        available_domains: set,
+        included_domains_effective: set,
+        include_domains_raw: list,
+        filter_stats: dict,
+        domain_warnings: list,
+    ) -> str:
+        """
+        Esito: WRITTEN, UNCHANGED (digest invariato) o DEFERRED
+        (report_min_interval non ancora trascorso).
+        """
+        header = _header_lines(
+            available_domains, included_domains_effective, include_domains_raw, filter_stats, domain_warnings
+        )
+        plan, h = self._plan(grouped, max_entities)
+        h.update("\n".join(header).encode("utf-8"))
+        digest = h.hexdigest()
+
+        if output_path != self._last_path:
+            self._last_path = output_path
+            self._last_hash = read_report_hash(output_path)
+        now = time.monotonic()
+        if self.update == "on_change" and digest == self._last_hash and os.path.exists(output_path):
+            self.stats[UNCHANGED] += 1
+            return UNCHANGED
+        if self._last_written and now - self._last_written < self.min_interval:
+            self.stats[DEFERRED] += 1
+            return DEFERRED
+
+        self._stream(output_path, header, plan, digest, max_entities)
+        self._last_hash = digest
+        self._last_written = now
+        self.stats[WRITTEN] += 1
+
+        # blocchi di entità non più presenti
+        if self.summary_only:
+            self._blocks = {}
+        elif len(self._blocks) > sum(len(e) for _, _, e in plan):
+            shown = {s.get("entity_id", "") for _, _, entities in plan for s in entities}
+            self._blocks = {k: v for k, v in self._blocks.items() if k in shown}
+        return WRITTEN
+
+    def _stream(self, output_path: str, header: List[str], plan: list, digest: str, max_entities: int) -> None:
+        tmp = output_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8", buffering=_STREAM_BUFFER) as f:
+            f.write("===== HOME ASSISTANT STATES REPORT =====\n")
+            f.write(f"Generated at: {utc_now_z()}\n")
+            f.write(HASH_PREFIX + digest + "\n\n")
+            for ln in header:
+                f.write(ln + "\n")
+            f.write("\n")
+
+            # Corpo del report
+            for domain, total, entities in plan:
+                f.write(f"=== DOMAIN: {domain} ({total}) ===\n")
+                if self.summary_only:
+                    for key, n in entities:
+                        if n:
+                            f.write(f"  {key}: {n}\n")
+                    f.write("\n")
+                    continue
+                if max_entities and total > max_entities:
+                    f.write(f"(showing first {max_entities} entities)\n")
+                for s in entities:
+                    f.write(self._block(s))
+
+            f.write("===== END =====\n")
+        os.replace(tmp, output_path)
+
+def write_report(
+    output_path: str,
+    grouped: dict,
+    max_entities: int,
+    available_domains: set,
+    included_domains_effective: set,
+    include_domains_raw: list,
+    filter_stats: dict,
+    domain_warnings: list,
+    report: ReportWriter = None,
+) -> str:
+    """
+    Scrive il report; senza ReportWriter (un processo per ciclo) usa un
+    writer temporaneo, che confronta comunque il digest del file esistente.
+    """
+    report = report or ReportWriter()
+    return report.write(
+        output_path,
+        grouped,
+        max_entities,
+        available_domains,
+        included_domains_effective,
+        include_domains_raw,
+        filter_stats,
+        domain_warnings,
+    )
@@ -0,0 +1,194 @@
+"""
+Aggregati (rollup) a 1 minuto e 1 ora delle entità numeriche.
+
+Per ogni file chiuso il compresser scrive un file compagno
+HDF5_datalogger_<etichetta>.rollup.h5 (gli archivi mensili fondono anche
+i rollup dei loro giorni) con:
+
+  /<risoluzione>/<dominio>/<entity_id>/{bucket, min, max, mean, last, count, twa}
+
+bucket è l'inizio dell'intervallo (int64 us epoch UTC, allineato in UTC);
+twa è la media pesata sul tempo con tenuta del valore (sample-and-hold,
+come la semantica "solo se cambia" del logger): ogni campione vale fino
+al successivo o alla fine del bucket, e il bucket eredita il valore
+dell'ultimo campione precedente. I campioni unavailable/unknown (NaN)
+interrompono la tenuta e non entrano nelle statistiche.
+
+Sono emessi solo i bucket con almeno un campione valido.
+"""
+
+import os
+from typing import Dict, Optional
+
+import h5py
+import numpy as np
+
+from . import compression  # noqa: F401  (filtri zstd/blosc opzionali)
+from .migrate import iter_entities
+from .swmr import open_read
+
+RESOLUTIONS = {"1m": 60 * 1_000_000, "1h": 3600 * 1_000_000}
+ROLLUP_FIELDS = ("min", "max", "mean", "last", "count", "twa")
+
+
+def rollup_path_for(h5_path: str) -> str:
+    base = h5_path[:-3] if h5_path.endswith(".h5") else h5_path
+    return base + ".rollup.h5"
+
+
+def numeric_values(values: np.ndarray) -> Optional[np.ndarray]:
+    """
+    float64 con NaN per i campioni non numerici; None se nessun campione
+    è numerico (entità di stato, es. on/off).
+    """
+    if values.dtype.kind == "f":
+        # layout colonnare: gli stati testuali sono NaN in value
+        return values if np.isfinite(values).any() else None
+    out = np.full(len(values), np.nan)
+    for i, raw in enumerate(values):
+        try:
+            out[i] = float(raw)
+        except (TypeError, ValueError):
+            pass
+    if not np.isfinite(out).any():
+        return None
+    return out
+
+
+def compute_rollup(ts_us: np.ndarray, values: np.ndarray, bucket_us: int) -> Dict[str, np.ndarray]:
+    """
+    Aggregati vettoriali per bucket di bucket_us microsecondi.
+    """
+    empty = {"bucket": np.empty(0, dtype="i8"), "count": np.empty(0, dtype="u4")}
+    for name in ("min", "max", "mean", "last", "twa"):
+        empty[name] = np.empty(0, dtype="f8")
+    if len(ts_us) == 0:
+        return empty
+
+    order = np.argsort(ts_us, kind="stable")
+    ts = np.asarray(ts_us, dtype="i8")[order]
+    v = np.asarray(values, dtype="f8")[order]
+    valid = np.isfinite(v)
+
+    b = (ts // bucket_us) * bucket_us
+    starts, first_idx = np.unique(b, return_index=True)
+    bid = np.repeat(np.arange(len(starts)), np.diff(np.append(first_idx, len(ts))))
+    ends = starts + bucket_us
+
+    # tenuta: fino al campione successivo o alla fine del bucket
+    next_t = np.append(ts[1:], np.iinfo("i8").max)
+    dur = (np.minimum(next_t, ends[bid]) - ts).astype("f8")
+    w = np.where(valid, dur, 0.0)
+    sum_w = np.add.reduceat(w, first_idx)
+    sum_wv = np.add.reduceat(np.where(valid, v, 0.0) * w, first_idx)
+
+    # valore ereditato dal campione precedente il bucket
+    prev = np.maximum(first_idx - 1, 0)
+    carry = (first_idx > 0) & valid[prev]
+    carry_dur = np.where(carry, ts[first_idx] - starts, 0).astype("f8")
+    sum_w += carry_dur
+    sum_wv += np.where(carry, v[prev], 0.0) * carry_dur
+
+    count = np.add.reduceat(valid.astype("i8"), first_idx)
+    vmin = np.minimum.reduceat(np.where(valid, v, np.inf), first_idx)
+    vmax = np.maximum.reduceat(np.where(valid, v, -np.inf), first_idx)
+    vsum = np.add.reduceat(np.where(valid, v, 0.0), first_idx)
+    last_idx = np.maximum.reduceat(np.where(valid, np.arange(len(ts)), -1), first_idx)
+
+    keep = count > 0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        twa = np.where(sum_w > 0, sum_wv / sum_w, vsum / np.maximum(count, 1))
+    return {
+        "bucket": starts[keep],
+        "min": vmin[keep],
+        "max": vmax[keep],
+        "mean": vsum[keep] / count[keep],
+        "last": v[last_idx[keep]],
+        "count": count[keep].astype("u4"),
+        "twa": twa[keep],
+    }
+
+
+def _write_entity(parent: h5py.Group, rollup: Dict[str, np.ndarray]) -> None:
+    n = len(rollup["bucket"])
+    chunks = (max(1, min(n, 4096)),) if n else None
+    for name in ("bucket",) + ROLLUP_FIELDS:
+        data = rollup[name]
+        kw = {"compression": "gzip", "compression_opts": 4, "shuffle": True} if n else {}
+        parent.create_dataset(name, data=data, chunks=chunks, **kw)
+
+
+def build_rollups(h5_path: str, out_path: str = None) -> int:
+    """
+    Scrive il file compagno dei rollup (tmp + os.replace).
+    Ritorna il numero di entità numeriche aggregate.
+    """
+    out_path = out_path or rollup_path_for(h5_path)
+    tmp = out_path + ".tmp"
+    entities = 0
+    try:
+        with open_read(h5_path) as fin, h5py.File(tmp, "w") as fout:
+            fout.attrs["source"] = os.path.basename(h5_path)
+            fout.attrs["resolutions"] = ",".join(RESOLUTIONS)
+            for entity_id, domain, _, ts_us, values, _ in iter_entities(fin):
+                nums = numeric_values(values)
+                if nums is None:
+                    continue
+                for res, bucket_us in RESOLUTIONS.items():
+                    grp = fout.require_group(f"/{res}/{domain}/{entity_id}")
+                    _write_entity(grp, compute_rollup(ts_us, nums, bucket_us))
+                entities += 1
+        os.replace(tmp, out_path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return entities
+
+
+def load_rollup(h5_path: str, res: str, domain: str, entity_id: str, start_us: int, end_us: int):
+    """
+    Rollup salvato di un'entità nell'intervallo [start_us, end_us), oppure
+    None se il file compagno manca o è più vecchio del file giornaliero.
+    Ritorna {} se il file è valido ma l'entità non ha rollup. Se il file
+    giornaliero è stato cancellato dalla retention il rollup vale comunque.
+    """
+    path = rollup_path_for(h5_path)
+    try:
+        rollup_mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if os.path.exists(h5_path) and rollup_mtime < os.path.getmtime(h5_path):
+        return None
+    with h5py.File(path, "r") as f:
+        grp = f.get(f"/{res}/{domain}/{entity_id}")
+        if grp is None:
+            return {}
+        buckets = grp["bucket"][()]
+        lo = int(np.searchsorted(buckets, start_us, side="left"))
+        hi = int(np.searchsorted(buckets, end_us, side="left"))
+        out = {"bucket": buckets[lo:hi]}
+        for name in ROLLUP_FIELDS:
+            out[name] = grp[name][lo:hi]
+        return out
+
+
+def choose_resolution(span_us: int, resolution=None, max_points: int = 2000) -> Optional[str]:
+    """
+    Livello da leggere: None = campioni grezzi, altrimenti "1m" o "1h".
+
+    resolution: secondi desiderati tra i punti, "auto" (span / max_points),
+    "raw", o direttamente "1m"/"1h".
+    """
+    if resolution is None or resolution == "raw":
+        return None
+    if resolution in RESOLUTIONS:
+        return resolution
+    if resolution == "auto":
+        wanted_us = span_us / max(1, int(max_points))
+    else:
+        wanted_us = float(resolution) * 1_000_000
+    best = None
+    for res, bucket_us in sorted(RESOLUTIONS.items(), key=lambda x: x[1]):
+        if bucket_us <= wanted_us:
+            best = res
+    return best
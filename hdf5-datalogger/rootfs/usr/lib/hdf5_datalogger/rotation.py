@@ -0,0 +1,268 @@
+"""
+Granularità di rotazione dei file HDF5 e nomi dei file.
+
+    <prefix>HDF5_datalogger_<etichetta>.h5
+
+  hourly:  2025-11-15T10   (un file per ora locale)
+  daily:   2025-11-15      (un file per giorno locale, storico)
+  weekly:  2025-W46        (settimana ISO, da lunedì)
+  monthly: 2025-11         (solo archivi mensili del gestore dello spazio)
+
+Politica di partizione (partition_timezone): con "local" le finestre sono
+in ora locale del container (storico: un giorno con cambio d'ora dura 23 o
+25 ore); con "utc" sono in UTC e l'etichetta ha il suffisso "Z"
+(2025-11-15Z, 2025-11-15T10Z, 2025-W46Z, 2025-11Z). L'etichetta basta a
+ricavare la finestra esatta in epoch us (label_window_us) senza aprire il
+file; i file creati dal Partitioner la registrano anche negli attributi
+WINDOW_START_ATTR / WINDOW_END_ATTR.
+
+I file compagni (<file>.rollup.h5, .index.json) e i temporanei non
+corrispondono al pattern.
+"""
+
+import glob
+import os
+import re
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from .timeutils import utc_now_us
+
+HOURLY = "hourly"
+DAILY = "daily"
+WEEKLY = "weekly"
+MONTHLY = "monthly"
+ROTATIONS = (HOURLY, DAILY, WEEKLY)
+
+LOCAL = "local"
+UTC = "utc"
+PARTITION_TIMEZONES = (LOCAL, UTC)
+
+# attributi radice con la finestra [inizio, fine) del file, epoch us UTC
+WINDOW_START_ATTR = "window_start_us"
+WINDOW_END_ATTR = "window_end_us"
+
+FILE_PREFIX = "HDF5_datalogger_"
+_LABEL_RE = re.compile(
+    r"^(?:(?P<day>\d{4}-\d{2}-\d{2})(?:T(?P<hour>\d{2}))?|(?P<wy>\d{4})-W(?P<week>\d{2})|(?P<my>\d{4})-(?P<month>\d{2}))"
+    r"(?P<utc>Z)?$"
+)
+_FILE_RE = re.compile(re.escape(FILE_PREFIX) + r"(?P<label>[0-9TWZ-]+)\.h5$")
+_EPOCH = datetime(1970, 1, 1)
+_US = timedelta(microseconds=1)
+
+
+def normalize_rotation(rotation: str) -> str:
+    rotation = str(rotation or DAILY).strip().lower()
+    return rotation if rotation in ROTATIONS else DAILY
+
+
+def normalize_partition_timezone(tz: str) -> str:
+    tz = str(tz or LOCAL).strip().lower()
+    return tz if tz in PARTITION_TIMEZONES else LOCAL
+
+
+def partition_label(rotation: str = DAILY, when: datetime = None, tz: str = LOCAL) -> str:
+    """
+    Etichetta del file che contiene l'istante when (naive, nell'ora della
+    politica tz: locale o UTC).
+    """
+    tz = normalize_partition_timezone(tz)
+    if when is None:
+        when = datetime.now() if tz == LOCAL else _EPOCH + utc_now_us() * _US
+    rotation = normalize_rotation(rotation)
+    if rotation == HOURLY:
+        label = when.strftime("%Y-%m-%dT%H")
+    elif rotation == WEEKLY:
+        year, week, _ = when.isocalendar()
+        label = f"{year}-W{week:02d}"
+    else:
+        label = when.date().isoformat()
+    return label + "Z" if tz == UTC else label
+
+
+def label_for_us(ts_us: int, rotation: str = DAILY, tz: str = LOCAL) -> str:
+    """
+    Etichetta del file la cui finestra contiene il timestamp ts_us (epoch us).
+    """
+    if normalize_partition_timezone(tz) == UTC:
+        when = _EPOCH + int(ts_us) * _US
+    else:
+        when = datetime.fromtimestamp(int(ts_us) // 1_000_000)
+    return partition_label(rotation, when, tz)
+
+
+def month_label(d: date, tz: str = LOCAL) -> str:
+    label = f"{d.year:04d}-{d.month:02d}"
+    return label + "Z" if normalize_partition_timezone(tz) == UTC else label
+
+
+def label_month(label: str) -> str:
+    """
+    Etichetta dell'archivio mensile che contiene il file giornaliero/orario
+    label (stessa politica di partizione).
+    """
+    m = _LABEL_RE.match(label)
+    if m is None or not m.group("day"):
+        raise ValueError(f"Etichetta senza mese univoco: {label}")
+    return month_label(date.fromisoformat(m.group("day")), UTC if m.group("utc") else LOCAL)
+
+
+def label_kind(label: str) -> Optional[str]:
+    m = _LABEL_RE.match(label)
+    if m is None:
+        return None
+    if m.group("day"):
+        return HOURLY if m.group("hour") else DAILY
+    return WEEKLY if m.group("week") else MONTHLY
+
+
+def label_timezone(label: str) -> str:
+    return UTC if label.endswith("Z") else LOCAL
+
+
+def _naive_bounds(label: str) -> Tuple[datetime, datetime]:
+    # finestra naive nell'ora della politica dell'etichetta
+    m = _LABEL_RE.match(label)
+    if m is None:
+        raise ValueError(f"Etichetta di file non valida: {label}")
+    if m.group("day"):
+        start = datetime.fromisoformat(m.group("day"))
+        if m.group("hour"):
+            start = start.replace(hour=int(m.group("hour")))
+            return start, start + timedelta(hours=1)
+        return start, start + timedelta(days=1)
+    if m.group("week"):
+        start = datetime.fromisocalendar(int(m.group("wy")), int(m.group("week")), 1)
+        return start, start + timedelta(days=7)
+    year, month = int(m.group("my")), int(m.group("month"))
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+def label_window_us(label: str) -> Tuple[int, int]:
+    """
+    Finestra esatta [inizio, fine) dell'etichetta in epoch us UTC. Per le
+    etichette locali vale l'ora legale del giorno: finestre consecutive
+    sono contigue anche attorno ai cambi d'ora.
+    """
+    start, end = _naive_bounds(label)
+    if label_timezone(label) == UTC:
+        return (start - _EPOCH) // _US, (end - _EPOCH) // _US
+    return int(start.timestamp()) * 1_000_000, int(end.timestamp()) * 1_000_000
+
+
+def label_bounds(label: str) -> Tuple[datetime, datetime]:
+    """
+    Finestra [inizio, fine) dell'etichetta in ora locale naive (per i
+    confronti con datetime.now()).
+    """
+    if label_timezone(label) == LOCAL:
+        return _naive_bounds(label)
+    start_us, end_us = label_window_us(label)
+    return datetime.fromtimestamp(start_us / 1_000_000), datetime.fromtimestamp(end_us / 1_000_000)
+
+
+def window_attrs(label: str) -> Dict[str, object]:
+    """
+    Attributi radice di un file nuovo: finestra esatta e politica.
+    """
+    start_us, end_us = label_window_us(label)
+    return {
+        WINDOW_START_ATTR: start_us,
+        WINDOW_END_ATTR: end_us,
+        "partition_timezone": label_timezone(label),
+    }
+
+
+def label_of(path: str) -> Optional[str]:
+    m = _FILE_RE.search(os.path.basename(path))
+    if m is None or label_kind(m.group("label")) is None:
+        return None
+    return m.group("label")
+
+
+def list_data_files(output_path_prefix: str) -> List[Tuple[datetime, datetime, str]]:
+    """
+    (inizio, fine, path) dei file dati sotto il prefisso, di qualsiasi
+    granularità (archivi mensili compresi), ordinati per inizio.
+    """
+    out = []
+    for path in glob.glob(f"{output_path_prefix}{FILE_PREFIX}*.h5"):
+        label = label_of(path)
+        if label is None:
+            continue
+        start, end = label_bounds(label)
+        out.append((start, end, path))
+    out.sort()
+    return out
+
+
+def list_data_windows(output_path_prefix: str) -> List[Tuple[int, int, str]]:
+    """
+    Come list_data_files, con le finestre esatte in epoch us: il pruning
+    per tempo dei lettori non apre nessun file.
+    """
+    out = []
+    for path in glob.glob(f"{output_path_prefix}{FILE_PREFIX}*.h5"):
+        label = label_of(path)
+        if label is None:
+            continue
+        start_us, end_us = label_window_us(label)
+        out.append((start_us, end_us, path))
+    out.sort()
+    return out
+
+
+class Partitioner:
+    """
+    Instrada i campioni verso il file la cui finestra contiene il loro
+    timestamp (epoch us), con la granularità rotation e la politica tz
+    ("local" o "utc"). L'ultima finestra risolta resta in cache: per i
+    campioni della stessa finestra il costo è un confronto.
+    """
+
+    def __init__(self, rotation: str = DAILY, tz: str = LOCAL):
+        self.rotation = normalize_rotation(rotation)
+        self.tz = normalize_partition_timezone(tz)
+        # (inizio us, fine us, etichetta) dell'ultima finestra usata
+        self._window = (0, 0, "")
+
+    @classmethod
+    def from_options(cls, opts: dict) -> "Partitioner":
+        return cls(opts.get("rotation") or DAILY, opts.get("partition_timezone") or LOCAL)
+
+    def label_for(self, ts_us: int) -> str:
+        start, end, label = self._window
+        if start <= ts_us < end:
+            return label
+        label = label_for_us(ts_us, self.rotation, self.tz)
+        start, end = label_window_us(label)
+        self._window = (start, end, label)
+        return label
+
+    def current(self) -> str:
+        return self.label_for(utc_now_us())
+
+    def window_start(self, ts_us: int) -> int:
+        """
+        Inizio (epoch us) della finestra che contiene ts_us.
+        """
+        self.label_for(ts_us)
+        return self._window[0]
+
+    def split(self, timestamps: List[int]) -> Dict[str, Optional[List[int]]]:
+        """
+        {etichetta: indici dei campioni}; None come indici se tutti i
+        campioni cadono nella stessa finestra (il caso comune).
+        """
+        if not timestamps:
+            return {}
+        label = self.label_for(min(timestamps))
+        if max(timestamps) < self._window[1]:
+            return {label: None}
+        out: Dict[str, Optional[List[int]]] = {}
+        for i, ts in enumerate(timestamps):
+            out.setdefault(self.label_for(ts), []).append(i)
+        return out
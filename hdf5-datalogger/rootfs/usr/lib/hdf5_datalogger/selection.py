@@ -0,0 +1,228 @@
+"""
+Piano di selezione delle entità, compilato e riusato tra i cicli.
+
+Il piano registra, per ogni entity_id visto, il dominio e la decisione
+include/exclude (filtro fisico compreso). I filtri classici
+(filter_states, discover_available_domains, build_included_domains)
+girano solo alla ricostruzione del piano. Il piano si ricostruisce quando:
+
+- compare o sparisce un'entità;
+- un sensor acquista o perde unit_of_measurement;
+- le opzioni cambiano (il logger residente crea un nuovo piano).
+
+Negli altri cicli il costo per entità è un lookup nel dizionario.
+
+Un fetch per include-list (ha_client.StateFetcher) copre solo una parte
+delle entità: apply riceve lo scope del fetch (domini, entity_id) e
+confronta gli stati con le sole entità del piano in quello scope, così
+l'alternanza tra dump completo e include-list di fetch_mode=auto non
+ricostruisce il piano. Una ricostruzione da un fetch parziale conserva le
+entità fuori scope.
+
+Il piano non tiene handle HDF5: dura quanto le opzioni, mentre gli handle
+valgono solo per il file della finestra aperta. La cache per entità dei
+gruppi (e dei loro attributi statici) è nel writer (HDF5Writer._group_cache,
+layout.ColumnarCache per il layout colonnare), che la azzera a ogni
+rotazione o riapertura del file.
+
+Regole di selezione, in ordine di precedenza:
+  1. exclude_patterns: entity_id esclusi sempre
+  2. include_entities / include_patterns: inclusi anche fuori dai domini
+     selezionati
+  3. domini selezionati (include_domains o default, come in passato)
+
+I pattern sono glob sull'entity_id ("sensor.*_power") o espressioni
+regolari con prefisso "re:" ("re:^sensor\\.(pzem|shelly)_.*"). Il filtro
+fisico (es. sensor senza unit_of_measurement) vale anche per le entità
+incluse esplicitamente.
+"""
+
+import fnmatch
+import re
+from typing import Dict, List, Optional, Tuple
+
+from .constants import DEFAULT_INCLUDED_DOMAINS
+from .domains import build_included_domains, discover_available_domains, domain_of
+from .filters import filter_states
+from .metrics import METRICS
+
+def _compile(patterns) -> Optional["re.Pattern"]:
+    """
+    Una sola regex per tutti i pattern (glob o "re:<regex>"); None se vuota.
+    """
+    parts = []
+    for p in patterns or []:
+        p = str(p).strip()
+        if not p:
+            continue
+        if p.startswith("re:"):
+            parts.append(f"(?:{p[3:]})")
+        else:
+            parts.append(f"(?:{fnmatch.translate(p)})")
+    return re.compile("|".join(parts)) if parts else None
+
+
+def in_scope(entity_id: str, domain: str, scope) -> bool:
+    """
+    True se l'entità è coperta dallo scope di un fetch: None (dump
+    completo) oppure (domini, entity_id) dell'include-list.
+    """
+    return scope is None or domain in scope[0] or entity_id in scope[1]
+
+
+def pattern_domains(patterns) -> Optional[List[str]]:
+    """
+    Domini coperti dai pattern glob (parte prima del punto senza jolly),
+    per il fetch per include-list; None se un pattern può toccare qualsiasi
+    dominio (regex o jolly nel dominio).
+    """
+    domains = set()
+    for p in patterns or []:
+        p = str(p).strip()
+        if not p:
+            continue
+        head = p.split(".", 1)[0]
+        if p.startswith("re:") or "." not in p or any(c in head for c in "*?["):
+            return None
+        domains.add(head.lower())
+    return sorted(domains)
+
+
+class SelectionPlan:
+    def __init__(
+        self,
+        include_domains_raw=None,
+        include_entities=None,
+        include_patterns=None,
+        exclude_patterns=None,
+        default_domains=DEFAULT_INCLUDED_DOMAINS,
+    ):
+        self.include_domains_raw = list(include_domains_raw or [])
+        self.include_entities = {str(e).strip() for e in include_entities or [] if str(e).strip()}
+        self.default_domains = default_domains
+        self._include_re = _compile(include_patterns)
+        self._exclude_re = _compile(exclude_patterns)
+        # entity_id -> (dominio, selezionata, uom al momento della compilazione o None)
+        self._entries: Dict[str, Tuple[str, bool, Optional[bool]]] = {}
+        # scope del fetch -> entità del piano in quello scope
+        self._scope_sizes: dict = {}
+        self.filter_stats: dict = {}
+        self.available_domains: set = set()
+        self.selected_domains: set = set()
+        self.domain_warnings: List[str] = []
+        self.rebuilds = 0
+
+    @classmethod
+    def from_options(cls, opts: dict) -> "SelectionPlan":
+        return cls(
+            include_domains_raw=opts.get("include_domains") or [],
+            include_entities=opts.get("include_entities") or [],
+            include_patterns=opts.get("include_patterns") or [],
+            exclude_patterns=opts.get("exclude_patterns") or [],
+        )
+
+    def _decide(self, entity_id: str, domain: str) -> bool:
+        if self._exclude_re is not None and self._exclude_re.match(entity_id):
+            return False
+        if entity_id in self.include_entities:
+            return True
+        if self._include_re is not None and self._include_re.match(entity_id):
+            return True
+        return not self.selected_domains or domain in self.selected_domains
+
+    def _scope_size(self, scope) -> int:
+        if scope is None:
+            return len(self._entries)
+        size = self._scope_sizes.get(scope)
+        if size is None:
+            size = sum(1 for eid, e in self._entries.items() if in_scope(eid, e[0], scope))
+            self._scope_sizes[scope] = size
+        return size
+
+    def _rebuild(self, states: list, scope=None) -> None:
+        filtered, self.filter_stats = filter_states(states)
+        self.available_domains = discover_available_domains(filtered)
+        self.selected_domains, self.domain_warnings = build_included_domains(
+            self.include_domains_raw,
+            self.available_domains,
+            self.default_domains,
+        )
+        entries = {}
+        if scope is not None:
+            # fuori dallo scope del fetch il piano precedente resta valido,
+            # con la decisione rifatta sui domini appena selezionati
+            for eid, (dom, _, has_uom) in self._entries.items():
+                if not in_scope(eid, dom, scope):
+                    selected = self._decide(eid, dom)
+                    entries[eid] = (dom, selected if has_uom is None else has_uom and selected, has_uom)
+        for st in states:
+            eid = st.get("entity_id", "") or ""
+            dom = domain_of(eid)
+            if dom == "sensor":
+                has_uom = bool((st.get("attributes") or {}).get("unit_of_measurement"))
+                entries[eid] = (dom, has_uom and self._decide(eid, dom), has_uom)
+            else:
+                entries[eid] = (dom, self._decide(eid, dom), None)
+        self._entries = entries
+        self._scope_sizes = {}
+        self.rebuilds += 1
+        METRICS.inc("selection_rebuilds_total")
+        selected = sum(1 for e in entries.values() if e[1])
+        print(f"[INFO] Piano di selezione compilato: {len(entries)} entità, {selected} selezionate")
+
+    def _select(self, states: list, scope=None) -> Optional[Tuple[Dict[str, list], list]]:
+        """
+        (stati per dominio, lista piatta) con il piano corrente; None se il
+        piano non copre più gli stati ricevuti (nello scope del fetch).
+        """
+        entries = self._entries
+        if len(states) != self._scope_size(scope):
+            return None
+        grouped: Dict[str, list] = {}
+        flat = []
+        for st in states:
+            e = entries.get(st.get("entity_id", "") or "")
+            if e is None:
+                return None
+            if e[2] is not None and bool((st.get("attributes") or {}).get("unit_of_measurement")) != e[2]:
+                return None
+            if e[1]:
+                lst = grouped.get(e[0])
+                if lst is None:
+                    lst = grouped[e[0]] = []
+                lst.append(st)
+                flat.append(st)
+        return grouped, flat
+
+    def apply(self, states: list, scope=None) -> Tuple[Dict[str, list], list]:
+        """
+        Stati selezionati raggruppati per dominio e in lista piatta (per il
+        writer HDF5), per il ciclo completo (snapshot di tutte le entità, o
+        di quelle nello scope del fetch: vedi StateFetcher.scope).
+        """
+        result = self._select(states, scope)
+        if result is None:
+            self._rebuild(states, scope)
+            result = self._select(states, scope)
+        return result
+
+    def select_events(self, states: list) -> list:
+        """
+        Filtro per i batch di eventi (modalità websocket): le entità non
+        ancora nel piano sono decise con i domini correnti, senza
+        ricostruire il piano (lo farà il prossimo snapshot completo).
+        """
+        out = []
+        for st in states:
+            eid = st.get("entity_id", "") or ""
+            e = self._entries.get(eid)
+            if e is not None and e[2] is None:
+                if e[1]:
+                    out.append(st)
+                continue
+            dom = e[0] if e is not None else domain_of(eid)
+            if dom == "sensor" and not (st.get("attributes") or {}).get("unit_of_measurement"):
+                continue
+            if self._decide(eid, dom):
+                out.append(st)
+        return out
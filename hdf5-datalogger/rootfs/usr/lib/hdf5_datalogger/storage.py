@@ -0,0 +1,595 @@
+"""
+Gestione dello spazio dei file HDF5, eseguita dal compresser dopo la
+compressione. Il file della finestra corrente non viene mai toccato, e
+nemmeno un file bloccato da un altro processo (logger o backfill, vedi
+filelock): è saltato e ripreso al passaggio successivo.
+
+- archivio mensile (archive_monthly): i file orari/giornalieri compressi
+  di un mese chiuso vengono fusi in HDF5_datalogger_<YYYY-MM>.h5 in un solo
+  passaggio in streaming: ogni sorgente è letta una volta, in ordine
+  cronologico, e ogni entità è accodata a dataset già compressi (nessun
+  file intermedio da ricomprimere); i rollup seguono nello stesso modo.
+  Le sorgenti sono cancellate solo dopo il rename atomico dell'archivio.
+  L'archivio è sempre nel layout per-entità;
+- retention per entità (regole "retention", match come per deadbands):
+  i gruppi delle entità scadute vengono tolti dai file chiusi riscrivendoli
+  con H5Ocopy dei soli gruppi da tenere (chunk copiati già compressi); le
+  tabelle colonnari restano intere;
+- retention per età: retention_days per i file grezzi, rollup_retention_days
+  per i rollup; un rollup non è mai cancellato prima del suo file grezzo e
+  query.read_range lo usa anche quando il file grezzo non c'è più;
+- budget di spazio (storage_max_mb): oltre il budget vengono cancellati i
+  file grezzi più vecchi e, solo quando non ne restano, i rollup più vecchi;
+- occupazione per dominio: somma delle dimensioni su disco dei dataset di
+  ogni dominio (file grezzi e rollup separati), nel log, in
+  STORAGE_USAGE_PATH e nelle metriche (disk_bytes). I file non modificati
+  dall'ultimo calcolo non vengono riaperti.
+"""
+
+import glob
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import h5py
+import numpy as np
+
+from .attributes import ATTRIBUTES_GROUP
+from .compression import compression_kwargs, is_compressed, mark_compressed
+from .constants import DEFAULT_CHUNK_SIZE, STORAGE_USAGE_PATH
+from .domains import domain_of
+from .encoding import ENUM, append_values, read_states, read_values
+from .file_index import index_path_for, load_or_build_index
+from .filelock import FileLock, lock_path_for, try_lock
+from .hdf5_writer import _ensure_group
+from .layout import is_columnar_group
+from .metrics import load_storage_usage
+from .migrate import _raw_values, iter_entities
+from .rollup import ROLLUP_FIELDS, rollup_path_for
+from .rotation import (
+    DAILY,
+    FILE_PREFIX,
+    HOURLY,
+    WINDOW_START_ATTR,
+    label_bounds,
+    label_kind,
+    label_month,
+    label_of,
+    label_window_us,
+    list_data_files,
+    window_attrs,
+)
+from .swmr import open_read
+from .timestamps import create_timestamp_dataset, encode_timestamps, read_timestamps_us
+from .timeutils import utc_now_z
+
+_MB = 1024 * 1024
+
+
+def _remove(path: str) -> int:
+    """
+    Cancella path se esiste; ritorna i byte liberati.
+    """
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def _remove_data_file(path: str) -> int:
+    # il rollup resta: viene gestito dalla sua retention; il lock è
+    # cancellato da chi lo tiene (vedi filelock)
+    return _remove(path) + _remove(index_path_for(path)) + _remove(lock_path_for(path))
+
+
+class RetentionRules:
+    """
+    Giorni di conservazione per entità. Precedenza:
+    entity_id > device_class > domain > "*" (come per deadbands).
+    """
+
+    def __init__(self, rules: List[Tuple[str, int]]):
+        self._by_entity: Dict[str, int] = {}
+        self._by_device_class: Dict[str, int] = {}
+        self._by_domain: Dict[str, int] = {}
+        self._default: Optional[int] = None
+        for match, days in rules:
+            if match == "*":
+                self._default = days
+            elif match.startswith("device_class:"):
+                self._by_device_class[match.split(":", 1)[1].strip().lower()] = days
+            elif match.startswith("domain:"):
+                self._by_domain[match.split(":", 1)[1].strip().lower()] = days
+            else:
+                self._by_entity[match] = days
+        self.min_days = min((d for _, d in rules), default=0)
+
+    @classmethod
+    def from_options(cls, opts: dict) -> Optional["RetentionRules"]:
+        rules = []
+        for raw in opts.get("retention") or []:
+            if not isinstance(raw, dict) or not raw.get("match"):
+                continue
+            try:
+                days = int(raw.get("days"))
+            except (TypeError, ValueError):
+                print(f"[WARNING] Regola di retention non valida {raw}")
+                continue
+            if days > 0:
+                rules.append((str(raw["match"]).strip(), days))
+        return cls(rules) if rules else None
+
+    def days_for(self, entity_id: str, attrs) -> Optional[int]:
+        days = self._by_entity.get(entity_id)
+        if days is None:
+            dc = attrs.get("device_class")
+            dc = dc.decode("utf-8", errors="replace") if isinstance(dc, bytes) else str(dc or "")
+            days = self._by_device_class.get(dc.lower()) if dc else None
+        if days is None:
+            days = self._by_domain.get(domain_of(entity_id))
+        if days is None:
+            days = self._default
+        return days
+
+
+def prune_file(path: str, rules: RetentionRules, now: datetime = None) -> int:
+    """
+    Toglie dal file chiuso path i gruppi delle entità la cui retention è
+    scaduta (fine della finestra del file più vecchia di days).
+    Ritorna il numero di entità tolte.
+    """
+    now = now or datetime.now()
+    _, end = label_bounds(label_of(path))
+    with open_read(path) as fin:
+        drop = set()
+        for domain, dgrp in fin.items():
+            if not isinstance(dgrp, h5py.Group) or is_columnar_group(dgrp):
+                continue
+            for name, grp in dgrp.items():
+                if not isinstance(grp, h5py.Group):
+                    continue
+                days = rules.days_for(name, grp.attrs)
+                if days and end <= now - timedelta(days=days):
+                    drop.add(f"/{domain}/{name}")
+    if not drop:
+        return 0
+
+    tmp = path + ".prune.tmp"
+    try:
+        with open_read(path) as fin, h5py.File(tmp, "w") as fout:
+            for aname, aval in fin.attrs.items():
+                fout.attrs[aname] = aval
+            for domain, dgrp in fin.items():
+                if not isinstance(dgrp, h5py.Group) or is_columnar_group(dgrp):
+                    fin.copy(dgrp, fout, name=domain)
+                    continue
+                keep = [name for name in dgrp if f"/{domain}/{name}" not in drop]
+                if not keep:
+                    continue
+                out = fout.create_group(domain)
+                for aname, aval in dgrp.attrs.items():
+                    out.attrs[aname] = aval
+                for name in keep:
+                    # H5Ocopy: i chunk compressi sono copiati così come sono
+                    fin.copy(dgrp[name], out, name=name)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    load_or_build_index(path)
+    rpath = rollup_path_for(path)
+    if os.path.exists(rpath):
+        # il rollup resta valido: le entità tolte restano nei rollup fino alla loro retention
+        os.utime(rpath)
+    return len(drop)
+
+
+def _append_series(
+    grp: h5py.Group,
+    domain: str,
+    attrs: dict,
+    ts_us: np.ndarray,
+    values: np.ndarray,
+    states: np.ndarray,
+    chunk_size: int,
+    timestamp_format: str,
+    filters,
+    text_encoding: str = None,
+) -> None:
+    ts_ds = grp.get("timestamp")
+    if ts_ds is None:
+        ts_ds = create_timestamp_dataset(grp, timestamp_format, (max(1, int(chunk_size)),), filters=filters)
+    kw = {"text_encoding": text_encoding} if text_encoding else {}
+    append_values(grp, domain, attrs, _raw_values(values, states), chunk_size, filters=filters, **kw)
+    start = ts_ds.shape[0]
+    ts_ds.resize((start + len(ts_us),))
+    ts_ds[start:] = encode_timestamps(ts_ds, ts_us)
+
+
+def _append_attributes(fin: h5py.File, fout: h5py.File, chunk_size: int, timestamp_format: str, filters) -> None:
+    for domain, dgrp in fin.items():
+        if not isinstance(dgrp, h5py.Group):
+            continue
+        for name, egrp in dgrp.items():
+            if not isinstance(egrp, h5py.Group) or ATTRIBUTES_GROUP not in egrp:
+                continue
+            for attr, agrp in egrp[ATTRIBUTES_GROUP].items():
+                if not isinstance(agrp, h5py.Group) or "timestamp" not in agrp:
+                    continue
+                ts_us = read_timestamps_us(agrp["timestamp"])
+                if not len(ts_us):
+                    continue
+                out = fout.require_group(f"/{domain}/{name}/{ATTRIBUTES_GROUP}/{attr}")
+                if "entity_id" not in out.attrs:
+                    out.attrs["entity_id"] = name
+                    out.attrs["attribute"] = attr
+                # testi degli attributi come enum, come nel writer
+                _append_series(
+                    out, "", {}, ts_us, read_values(agrp), read_states(agrp),
+                    chunk_size, timestamp_format, filters, ENUM,
+                )
+
+
+def _append_rollups(src: str, fout: h5py.File, filters) -> None:
+    with h5py.File(src, "r") as fin:
+        for res, rgrp in fin.items():
+            for domain, dgrp in rgrp.items():
+                for entity_id, grp in dgrp.items():
+                    if "bucket" not in grp or not grp["bucket"].shape[0]:
+                        continue
+                    out = fout.require_group(f"/{res}/{domain}/{entity_id}")
+                    for name in ("bucket",) + ROLLUP_FIELDS:
+                        data = grp[name][()]
+                        ds = out.get(name)
+                        if ds is None:
+                            ds = out.create_dataset(
+                                name, shape=(0,), maxshape=(None,), dtype=data.dtype,
+                                chunks=(4096,), **filters(data.dtype),
+                            )
+                        start = ds.shape[0]
+                        ds.resize((start + len(data),))
+                        ds[start:] = data
+
+
+def archive_month(
+    output_path_prefix: str,
+    month: str,
+    sources: List[str],
+    codec: str = "gzip",
+    level: int = 4,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    timestamp_format: str = "epoch_us",
+) -> int:
+    """
+    Fonde sources (in ordine cronologico; un archivio esistente dello
+    stesso mese va per primo) in <prefix>HDF5_datalogger_<month>.h5.
+    L'archivio registra la finestra del mese solo se tutte le sorgenti
+    hanno la propria (nessun campione oltre i confini).
+    Ritorna i byte liberati cancellando le sorgenti.
+    """
+    dst = f"{output_path_prefix}{FILE_PREFIX}{month}.h5"
+    tmp = dst + ".archive.tmp"
+    rtmp = rollup_path_for(dst) + ".archive.tmp"
+    chunk_size = max(int(chunk_size), DEFAULT_CHUNK_SIZE)
+
+    def filters(dtype):
+        return compression_kwargs(codec, level, dtype)
+
+    rollups = [rollup_path_for(p) for p in sources if os.path.exists(rollup_path_for(p))]
+    try:
+        with h5py.File(tmp, "w") as fout:
+            fout.attrs["archive"] = month
+            fout.attrs["sources"] = ",".join(os.path.basename(p) for p in sources)
+            windowed = True
+            for src in sources:
+                with open_read(src) as fin:
+                    windowed = windowed and WINDOW_START_ATTR in fin.attrs
+                    for entity_id, domain, attrs, ts_us, values, states in iter_entities(fin):
+                        if not len(ts_us):
+                            continue
+                        grp = _ensure_group(fout, domain or domain_of(entity_id), entity_id, attrs)
+                        _append_series(grp, domain, attrs, ts_us, values, states, chunk_size, timestamp_format, filters)
+                    _append_attributes(fin, fout, chunk_size, timestamp_format, filters)
+            if windowed:
+                fout.attrs.update(window_attrs(month))
+            mark_compressed(fout, codec, level)
+        if rollups:
+            with h5py.File(rtmp, "w") as rout:
+                rout.attrs["source"] = os.path.basename(dst)
+                for rsrc in rollups:
+                    _append_rollups(rsrc, rout, filters)
+        os.replace(tmp, dst)
+        # il rollup dopo l'archivio: mtime più recente, quindi valido per load_rollup
+        if rollups:
+            os.replace(rtmp, rollup_path_for(dst))
+    finally:
+        for p in (tmp, rtmp):
+            if os.path.exists(p):
+                os.remove(p)
+
+    load_or_build_index(dst)
+    freed = 0
+    for src in sources:
+        if src == dst:
+            continue
+        freed += _remove_data_file(src) + _remove(rollup_path_for(src))
+    return freed
+
+
+def _domain_bytes(path: str, rollup: bool) -> Dict[str, int]:
+    out: Dict[str, int] = {}
+
+    def _visit(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            parts = name.split("/")
+            # rollup: /<risoluzione>/<dominio>/...
+            domain = parts[1] if rollup and len(parts) > 1 else parts[0]
+            out[domain] = out.get(domain, 0) + obj.id.get_storage_size()
+
+    with open_read(path) as f:
+        f.visititems(_visit)
+    return out
+
+
+def disk_usage(output_path_prefix: str, cache: dict = None) -> dict:
+    """
+    {"raw": {dominio: byte}, "rollup": {dominio: byte}, "total_bytes",
+    "files": cache per file}; cache è il "files" del calcolo precedente.
+    """
+    cache = cache or {}
+    files = {}
+    usage = {"raw": {}, "rollup": {}, "total_bytes": 0}
+    for path in sorted(glob.glob(f"{output_path_prefix}{FILE_PREFIX}*")):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        usage["total_bytes"] += st.st_size
+        rollup = path.endswith(".rollup.h5")
+        data_path = path[: -len(".rollup.h5")] + ".h5" if rollup else path
+        if label_of(data_path) is None:
+            continue
+        entry = cache.get(path)
+        if not entry or entry.get("size") != st.st_size or entry.get("mtime_ns") != st.st_mtime_ns:
+            try:
+                entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "domains": _domain_bytes(path, rollup)}
+            except OSError as e:
+                print(f"[WARNING] File non leggibile, escluso dal calcolo dello spazio: {path} ({e})")
+                continue
+        files[path] = entry
+        kind = usage["rollup" if rollup else "raw"]
+        for domain, n in entry["domains"].items():
+            kind[domain] = kind.get(domain, 0) + n
+    usage["files"] = files
+    return usage
+
+
+def save_storage_usage(usage: dict, path: str = STORAGE_USAGE_PATH) -> None:
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(dict(usage, updated=utc_now_z()), fh, separators=(",", ":"))
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[WARNING] Impossibile salvare l'occupazione del disco in {path}: {e}")
+
+
+class StorageManager:
+    def __init__(
+        self,
+        output_path_prefix: str,
+        retention_days: int = 0,
+        rollup_retention_days: int = 0,
+        max_total_mb: int = 0,
+        archive_monthly: bool = False,
+        rules: RetentionRules = None,
+        codec: str = "gzip",
+        level: int = 4,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        timestamp_format: str = "epoch_us",
+        usage_path: str = STORAGE_USAGE_PATH,
+    ):
+        self.output_path_prefix = output_path_prefix
+        self.retention_days = max(0, int(retention_days or 0))
+        self.rollup_retention_days = max(0, int(rollup_retention_days or 0))
+        self.max_total_bytes = max(0, int(max_total_mb or 0)) * _MB
+        self.archive_monthly = bool(archive_monthly)
+        self.rules = rules
+        self.codec = codec
+        self.level = level
+        self.chunk_size = chunk_size
+        self.timestamp_format = timestamp_format
+        self.usage_path = usage_path
+
+    @classmethod
+    def from_options(cls, opts: dict) -> "StorageManager":
+        return cls(
+            opts.get("output_path_prefix") or "/share/hdf5/",
+            retention_days=opts.get("retention_days", 0),
+            rollup_retention_days=opts.get("rollup_retention_days", 0),
+            max_total_mb=opts.get("storage_max_mb", 0),
+            archive_monthly=bool(opts.get("archive_monthly", False)),
+            rules=RetentionRules.from_options(opts),
+            codec=str(opts.get("compression") or "gzip").strip().lower(),
+            level=int(opts.get("compression_level", 4)),
+            chunk_size=int(opts.get("hdf5_chunk_size", DEFAULT_CHUNK_SIZE) or DEFAULT_CHUNK_SIZE),
+            timestamp_format=opts.get("timestamp_format") or "epoch_us",
+        )
+
+    def _closed_files(self, now: datetime) -> List[Tuple[datetime, datetime, str]]:
+        return [f for f in list_data_files(self.output_path_prefix) if f[1] <= now]
+
+    def archive(self, now: datetime) -> int:
+        """
+        Archivia i mesi chiusi; ritorna il numero di file sorgente fusi.
+        """
+        month_start = datetime(now.year, now.month, 1)
+        by_month: Dict[str, List[str]] = {}
+        for _, end, path in self._closed_files(now):
+            if end > month_start or label_kind(label_of(path)) not in (HOURLY, DAILY):
+                continue
+            try:
+                with open_read(path) as f:
+                    if not is_compressed(f):
+                        # ancora da comprimere: archiviato al prossimo passaggio
+                        continue
+            except OSError as e:
+                print(f"[WARNING] File non leggibile, escluso dall'archivio: {path} ({e})")
+                continue
+            by_month.setdefault(label_month(label_of(path)), []).append(path)
+
+        merged = 0
+        for month, sources in sorted(by_month.items()):
+            existing = f"{self.output_path_prefix}{FILE_PREFIX}{month}.h5"
+            if os.path.exists(existing):
+                # solo file successivi all'archivio: le serie restano ordinate
+                last_us = load_or_build_index(existing)["last"] or 0
+                late = [p for p in sources if label_window_us(label_of(p))[0] < last_us]
+                if late:
+                    print(f"[WARNING] Archivio {month}: {len(late)} file precedenti all'ultimo campione archiviato, lasciati separati")
+                sources = [existing] + [p for p in sources if p not in late]
+                if len(sources) == 1:
+                    continue
+            locks = [FileLock(p) for p in sources]
+            try:
+                if not all(lock.acquire(blocking=False) for lock in locks):
+                    print(f"[INFO] Archivio {month}: file in uso da un altro processo, rimandato")
+                    continue
+                t0 = time.monotonic()
+                freed = archive_month(
+                    self.output_path_prefix, month, sources,
+                    self.codec, self.level, self.chunk_size, self.timestamp_format,
+                )
+            except Exception as e:
+                print(f"[ERROR] Archiviazione del mese {month} non riuscita: {e!r}")
+                continue
+            finally:
+                for lock in locks:
+                    lock.release()
+            size = os.path.getsize(existing)
+            merged += len(sources)
+            print(
+                f"[INFO] Archivio {month}: {len(sources)} file fusi in {time.monotonic() - t0:.1f}s "
+                f"({size / _MB:.2f} MB, liberati {freed / _MB:.2f} MB)"
+            )
+        return merged
+
+    def prune(self, now: datetime) -> int:
+        if self.rules is None:
+            return 0
+        limit = now - timedelta(days=self.rules.min_days)
+        removed = 0
+        for _, end, path in self._closed_files(now):
+            if end > limit:
+                continue
+            try:
+                with open_read(path) as f:
+                    if not is_compressed(f):
+                        continue
+                with try_lock(path) as free:
+                    if not free:
+                        print(f"[INFO] {path}: in uso da un altro processo, retention per entità rimandata")
+                        continue
+                    n = prune_file(path, self.rules, now)
+            except Exception as e:
+                print(f"[WARNING] Retention per entità non applicata a {path}: {e!r}")
+                continue
+            if n:
+                print(f"[INFO] {path}: tolte {n} entità scadute")
+                removed += n
+        return removed
+
+    def _rollups(self) -> List[Tuple[datetime, str]]:
+        out = []
+        for rpath in glob.glob(f"{self.output_path_prefix}{FILE_PREFIX}*.rollup.h5"):
+            label = label_of(rpath[: -len(".rollup.h5")] + ".h5")
+            if label is not None:
+                out.append((label_bounds(label)[1], rpath))
+        out.sort()
+        return out
+
+    def expire(self, now: datetime) -> int:
+        """
+        Retention per età; ritorna il numero di file cancellati.
+        """
+        deleted = 0
+        if self.retention_days:
+            limit = now - timedelta(days=self.retention_days)
+            for _, end, path in self._closed_files(now):
+                if end <= limit:
+                    with try_lock(path) as free:
+                        if not free:
+                            print(f"[INFO] Retention: {path} in uso da un altro processo, rimandato")
+                            continue
+                        _remove_data_file(path)
+                    deleted += 1
+                    print(f"[INFO] Retention: cancellato {path} (più vecchio di {self.retention_days} giorni)")
+        if self.rollup_retention_days:
+            limit = now - timedelta(days=self.rollup_retention_days)
+            for end, rpath in self._rollups():
+                raw = rpath[: -len(".rollup.h5")] + ".h5"
+                if end <= limit and not os.path.exists(raw):
+                    _remove(rpath)
+                    deleted += 1
+                    print(f"[INFO] Retention: cancellato {rpath} (più vecchio di {self.rollup_retention_days} giorni)")
+        return deleted
+
+    def enforce_budget(self, now: datetime) -> int:
+        """
+        Cancella i file più vecchi finché lo spazio usato supera il budget:
+        prima i file grezzi (chiusi), poi i rollup senza file grezzo.
+        """
+        if not self.max_total_bytes:
+            return 0
+        total = sum(os.path.getsize(p) for p in glob.glob(f"{self.output_path_prefix}{FILE_PREFIX}*"))
+        if total <= self.max_total_bytes:
+            return 0
+        victims = [path for _, _, path in self._closed_files(now)]
+        victims += [rpath for _, rpath in self._rollups()]
+        deleted = 0
+        for path in victims:
+            if total <= self.max_total_bytes:
+                break
+            if path.endswith(".rollup.h5"):
+                if os.path.exists(path[: -len(".rollup.h5")] + ".h5"):
+                    continue
+                freed = _remove(path)
+            else:
+                with try_lock(path) as free:
+                    if not free:
+                        continue
+                    freed = _remove_data_file(path)
+            total -= freed
+            deleted += 1
+            print(f"[INFO] Budget di spazio: cancellato {path} ({freed / _MB:.2f} MB)")
+        if total > self.max_total_bytes:
+            print(
+                f"[WARNING] Spazio usato {total / _MB:.1f} MB oltre storage_max_mb "
+                f"({self.max_total_bytes / _MB:.0f} MB): resta solo il file corrente"
+            )
+        return deleted
+
+    def run(self, now: datetime = None) -> dict:
+        now = now or datetime.now()
+        stats = {"archived": 0, "pruned_entities": 0, "deleted": 0}
+        if self.archive_monthly:
+            stats["archived"] = self.archive(now)
+        stats["pruned_entities"] = self.prune(now)
+        stats["deleted"] = self.expire(now) + self.enforce_budget(now)
+
+        previous = load_storage_usage(self.usage_path)
+        usage = disk_usage(self.output_path_prefix, previous.get("files"))
+        usage["deleted_files"] = previous.get("deleted_files", 0) + stats["deleted"]
+        usage["archived_files"] = previous.get("archived_files", 0) + stats["archived"]
+        save_storage_usage(usage, self.usage_path)
+
+        print(f"[INFO] Spazio usato: {usage['total_bytes'] / _MB:.2f} MB")
+        for kind in ("raw", "rollup"):
+            for domain, n in sorted(usage[kind].items(), key=lambda x: -x[1]):
+                print(f"[INFO]   {kind} {domain}: {n / _MB:.2f} MB")
+        return stats
@@ -0,0 +1,161 @@
+"""
+Apertura dei file giornalieri per SWMR (single writer, multiple readers).
+
+Il writer apre il file del giorno con libver="latest" e, se richiesto,
+passa in modalità SWMR: lettori (query, export, compresser) possono
+aprirlo in sola lettura con swmr=True mentre il logger accoda dati.
+In SWMR il writer può solo estendere/scrivere dataset esistenti: la
+creazione di gruppi, dataset o attributi avviene fuori da SWMR (vedi
+HDF5Writer).
+
+Un writer terminato senza chiudere il file lascia nel superblocco i flag
+"aperto in scrittura" e il file non è più riapribile (servirebbe
+h5clear -s): open_write azzera i flag se nessun processo tiene il lock
+del file e, se il file resta illeggibile, lo ricopia con recover_file.
+"""
+
+import fcntl
+import os
+import time
+
+import h5py
+
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+_M32 = 0xFFFFFFFF
+
+
+def _rot(x: int, k: int) -> int:
+    return ((x << k) | (x >> (32 - k))) & _M32
+
+
+def _lookup3(data: bytes) -> int:
+    """
+    Checksum Jenkins lookup3 (hashlittle, initval 0) usato da HDF5 per il
+    superblocco v2/v3.
+    """
+    length = len(data)
+    a = b = c = (0xDEADBEEF + length) & _M32
+    i = 0
+    while length - i > 12:
+        a = (a + int.from_bytes(data[i:i + 4], "little")) & _M32
+        b = (b + int.from_bytes(data[i + 4:i + 8], "little")) & _M32
+        c = (c + int.from_bytes(data[i + 8:i + 12], "little")) & _M32
+        a = (a - c) & _M32; a ^= _rot(c, 4); c = (c + b) & _M32
+        b = (b - a) & _M32; b ^= _rot(a, 6); a = (a + c) & _M32
+        c = (c - b) & _M32; c ^= _rot(b, 8); b = (b + a) & _M32
+        a = (a - c) & _M32; a ^= _rot(c, 16); c = (c + b) & _M32
+        b = (b - a) & _M32; b ^= _rot(a, 19); a = (a + c) & _M32
+        c = (c - b) & _M32; c ^= _rot(b, 4); b = (b + a) & _M32
+        i += 12
+    if length == i:
+        return c
+    tail = data[i:].ljust(12, b"\0")
+    a = (a + int.from_bytes(tail[0:4], "little")) & _M32
+    b = (b + int.from_bytes(tail[4:8], "little")) & _M32
+    c = (c + int.from_bytes(tail[8:12], "little")) & _M32
+    c ^= b; c = (c - _rot(b, 14)) & _M32
+    a ^= c; a = (a - _rot(c, 11)) & _M32
+    b ^= a; b = (b - _rot(a, 25)) & _M32
+    c ^= b; c = (c - _rot(b, 16)) & _M32
+    a ^= c; a = (a - _rot(c, 4)) & _M32
+    b ^= a; b = (b - _rot(a, 14)) & _M32
+    c ^= b; c = (c - _rot(b, 24)) & _M32
+    return c
+
+
+def _locked_by_other(path: str) -> bool:
+    try:
+        with open(path, "rb") as fh:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+        return False
+    except OSError:
+        return True
+
+
+def clear_status_flags(path: str) -> bool:
+    """
+    Equivalente di "h5clear -s": azzera i flag di consistenza del
+    superblocco (v2/v3) e ne ricalcola il checksum.
+    Ritorna True se i flag erano impostati e sono stati azzerati.
+    """
+    with open(path, "r+b") as fh:
+        head = fh.read(48 + 4 * 8)
+        if head[:8] != HDF5_SIGNATURE or len(head) < 12 or head[8] not in (2, 3):
+            return False
+        end = 12 + 4 * head[9]
+        if head[11] == 0 or len(head) < end + 4:
+            return False
+        sb = bytearray(head[:end])
+        sb[11] = 0
+        fh.seek(0)
+        fh.write(bytes(sb) + _lookup3(bytes(sb)).to_bytes(4, "little"))
+        fh.flush()
+        os.fsync(fh.fileno())
+    return True
+
+
+def open_read(path: str) -> h5py.File:
+    """
+    Apertura in sola lettura, compatibile con un writer SWMR attivo.
+    """
+    try:
+        return h5py.File(path, "r", swmr=True)
+    except OSError:
+        return h5py.File(path, "r")
+
+
+def enable_swmr(f: h5py.File) -> bool:
+    try:
+        f.swmr_mode = True
+        return True
+    except Exception as e:
+        # es. file in formato precedente a libver="latest"
+        print(f"[WARNING] SWMR non attivabile su {f.filename}: {e}")
+        return False
+
+
+def recover_file(path: str) -> bool:
+    """
+    Ricopia un file rimasto "aperto in scrittura" dopo un crash.
+    Se nemmeno la lettura è possibile lo sposta in <path>.corrupt-<epoch>.
+    Ritorna True se il contenuto è stato recuperato.
+    """
+    tmp = path + ".recover.tmp"
+    try:
+        with open_read(path) as fin, h5py.File(tmp, "w", libver="latest") as fout:
+            for aname, aval in fin.attrs.items():
+                fout.attrs[aname] = aval
+            for name in fin:
+                fin.copy(fin[name], fout, name=name)
+        os.replace(tmp, path)
+        print(f"[WARNING] File HDF5 recuperato dopo chiusura non pulita: {path}")
+        return True
+    except Exception as e:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        aside = f"{path}.corrupt-{int(time.time())}"
+        os.replace(path, aside)
+        print(f"[ERROR] File HDF5 illeggibile ({e}), spostato in {aside}")
+        return False
+
+
+def open_write(path: str) -> h5py.File:
+    """
+    Apre (o crea) il file in scrittura con libver="latest", recuperandolo
+    se è rimasto bloccato da un writer terminato male.
+    """
+    try:
+        return h5py.File(path, "a", libver="latest")
+    except OSError as e:
+        if not os.path.exists(path) or "already open for" not in str(e) or _locked_by_other(path):
+            raise
+    # flag rimasti da un writer terminato male
+    if clear_status_flags(path):
+        print(f"[WARNING] Flag di scrittura azzerati dopo chiusura non pulita: {path}")
+        try:
+            return h5py.File(path, "a", libver="latest")
+        except OSError:
+            pass
+    recover_file(path)
+    return h5py.File(path, "a", libver="latest")
@@ -0,0 +1,124 @@
+"""
+Formati di memorizzazione del dataset timestamp.
+
+- iso:      stringhe ISO-8601 UTC a 32 byte (S32), formato storico
+- epoch_us: int64, microsecondi dall'epoch Unix (attrs unit="us")
+- epoch_ns: int64, nanosecondi dall'epoch Unix (attrs unit="ns")
+
+I reader qui sotto accettano tutti i formati e restituiscono sempre
+int64 in microsecondi UTC, così le ricerche per intervallo diventano
+np.searchsorted su array ordinati invece del parsing di stringhe.
+"""
+
+from typing import Callable, Dict, Tuple
+
+import h5py
+import numpy as np
+
+TIMESTAMP_FORMATS = ("iso", "epoch_us", "epoch_ns")
+DEFAULT_TIMESTAMP_FORMAT = "epoch_us"
+EPOCH_ATTR = "1970-01-01T00:00:00Z"
+
+# unità -> fattore rispetto ai microsecondi
+_UNIT_PER_US = {
+    "us": 1,
+    "ns": 1000,
+}
+
+
+def normalize_format(fmt: str) -> str:
+    fmt = str(fmt or DEFAULT_TIMESTAMP_FORMAT).strip().lower()
+    return fmt if fmt in TIMESTAMP_FORMATS else DEFAULT_TIMESTAMP_FORMAT
+
+
+def create_timestamp_dataset(
+    grp: h5py.Group,
+    fmt: str,
+    chunks: Tuple[int, ...],
+    name: str = "timestamp",
+    filters: Callable[[np.dtype], Dict] = None,
+) -> h5py.Dataset:
+    fmt = normalize_format(fmt)
+    dtype = np.dtype("S32" if fmt == "iso" else "i8")
+    kw = filters(dtype) if filters is not None else {}
+    if fmt == "iso":
+        return grp.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=chunks, **kw)
+
+    unit = fmt.split("_", 1)[1]
+    ds = grp.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=chunks, **kw)
+    ds.attrs["unit"] = unit
+    ds.attrs["epoch"] = EPOCH_ATTR
+    return ds
+
+
+def is_epoch_dataset(ds: h5py.Dataset) -> bool:
+    return ds.dtype.kind in ("i", "u")
+
+
+def _unit_factor(ds: h5py.Dataset) -> int:
+    unit = ds.attrs.get("unit", "us")
+    if isinstance(unit, bytes):
+        unit = unit.decode("utf-8")
+    return _UNIT_PER_US.get(str(unit), 1)
+
+
+def encode_timestamps(ds: h5py.Dataset, epoch_us) -> np.ndarray:
+    """
+    Converte microsecondi epoch nel formato nativo del dataset.
+    """
+    us = np.asarray(epoch_us, dtype="i8")
+    if is_epoch_dataset(ds):
+        return us * _unit_factor(ds)
+    iso = np.datetime_as_string(us.astype("datetime64[us]"), unit="us", timezone="UTC")
+    return np.char.encode(iso, "utf-8").astype(ds.dtype)
+
+
+def decode_timestamps(ds: h5py.Dataset, raw: np.ndarray) -> np.ndarray:
+    """
+    Valori grezzi letti da ds -> int64 microsecondi epoch UTC.
+    """
+    raw = np.asarray(raw)
+    if is_epoch_dataset(ds):
+        factor = _unit_factor(ds)
+        return raw.astype("i8") // factor if factor != 1 else raw.astype("i8")
+    if raw.size == 0:
+        return np.empty(raw.shape, dtype="i8")
+    # stringhe ISO storiche "....Z": numpy le interpreta come UTC senza suffisso
+    text = np.char.rstrip(np.char.decode(raw, "utf-8"), "Z")
+    return text.astype("datetime64[us]").astype("i8")
+
+
+def read_timestamps_us(ds: h5py.Dataset, sel=slice(None)) -> np.ndarray:
+    return decode_timestamps(ds, ds[sel])
+
+
+# sotto questa soglia conviene leggere tutti i timestamp in un colpo solo
+_FULL_READ_THRESHOLD = 4096
+
+
+def _bisect_left(ds: h5py.Dataset, target_us: int, lo: int, hi: int) -> int:
+    # ricerca binaria leggendo singoli elementi: tocca O(log n) chunk
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if int(decode_timestamps(ds, ds[mid:mid + 1])[0]) < target_us:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def time_slice(ds: h5py.Dataset, start_us: int = None, end_us: int = None) -> slice:
+    """
+    Indici [i0, i1) dei campioni con start_us <= t < end_us in un dataset
+    timestamp ordinato. Per dataset piccoli np.searchsorted sull'intero
+    array, altrimenti ricerca binaria sul dataset (solo i chunk necessari).
+    """
+    n = ds.shape[0]
+    if n <= _FULL_READ_THRESHOLD:
+        ts = read_timestamps_us(ds)
+        i0 = 0 if start_us is None else int(np.searchsorted(ts, start_us, side="left"))
+        i1 = n if end_us is None else int(np.searchsorted(ts, end_us, side="left"))
+    else:
+        i0 = 0 if start_us is None else _bisect_left(ds, start_us, 0, n)
+        i1 = n if end_us is None else _bisect_left(ds, end_us, i0, n)
+    return slice(i0, max(i0, i1))
@@ -1,4 +1,7 @@
-from datetime import datetime, timezone, date
+import time
+from datetime import datetime, timezone, date, timedelta
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
 def utc_now_z() -> str:
     """
@@ -11,3 +14,29 @@ def today_str_local() -> str:
     Data odierna in formato YYYY-MM-DD (ora locale del container).
     """
     return date.today().isoformat()
+
+def utc_now_us() -> int:
+    """
+    Ora corrente UTC in microsecondi dall'epoch Unix.
+    """
+    return time.time_ns() // 1000
+
+def iso_to_epoch_us(iso_ts) -> int:
+    """
+    Converte un timestamp ISO-8601 (con o senza offset, 'Z' ammesso)
+    in microsecondi dall'epoch Unix. Senza offset si assume UTC.
+    """
+    if isinstance(iso_ts, bytes):
+        iso_ts = iso_ts.decode("utf-8")
+    dt = datetime.fromisoformat(str(iso_ts).strip().replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    delta = dt - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+
+def epoch_us_to_iso_z(us: int) -> str:
+    """
+    Microsecondi dall'epoch Unix -> ISO-8601 UTC con suffisso 'Z'.
+    """
+    dt = _EPOCH + timedelta(microseconds=int(us))
+    return dt.isoformat().replace("+00:00", "Z")
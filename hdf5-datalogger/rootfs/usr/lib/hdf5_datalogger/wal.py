@@ -0,0 +1,119 @@
+"""
+Journal write-ahead dei campioni destinati al file HDF5 del giorno.
+
+Ogni campione accettato dal writer viene prima accodato (una riga JSON)
+a un log append-only con un fsync per ciclo; il file HDF5 riceve poi i
+campioni a blocchi. Quando tutti i buffer sono scritti e il file HDF5 è
+su disco, il journal viene troncato.
+
+All'avvio, un journal non vuoto indica una chiusura non pulita: i campioni
+più recenti dell'ultimo timestamp presente nel file vengono riapplicati.
+
+Formato (una riga per record):
+  {"f": "<file h5>"}                                   cambio file di destinazione
+  {"e": "<entity_id>", "v": "<raw>", "t": <us>}        campione di stato
+  ... "a": "<attributo>"                               campione di un attributo
+  ... "s": {attributi statici}                         solo quando cambiano
+"""
+
+import json
+import os
+from typing import Dict, List, Optional
+
+from .constants import WAL_PATH
+
+
+class WriteAheadLog:
+    def __init__(self, path: str = WAL_PATH):
+        self.path = path
+        self._fh = None
+        self._file_path: Optional[str] = None
+        # attributi statici già scritti nel journal corrente, per entità
+        self._static: Dict[str, dict] = {}
+
+    @property
+    def size(self) -> int:
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def pending(self) -> bool:
+        return self.size > 0
+
+    def _open(self):
+        if self._fh is None:
+            d = os.path.dirname(self.path)
+            if d:
+                os.makedirs(d, exist_ok=True)
+            self._fh = open(self.path, "a", encoding="utf-8")
+        return self._fh
+
+    def log(self, file_path: str, records: List[tuple]) -> None:
+        """
+        records: [(entity_id, attributo o None, raw, ts_us, attributi statici)].
+        Un solo write + fsync per chiamata.
+        """
+        if not records:
+            return
+        lines = []
+        if file_path != self._file_path:
+            lines.append(json.dumps({"f": file_path}))
+            self._file_path = file_path
+        for entity_id, attribute, raw, ts_us, static in records:
+            rec = {"e": entity_id, "v": raw, "t": int(ts_us)}
+            if attribute:
+                rec["a"] = attribute
+            elif static is not None and self._static.get(entity_id) != static:
+                rec["s"] = static
+                self._static[entity_id] = static
+            lines.append(json.dumps(rec, ensure_ascii=False, separators=(",", ":")))
+        fh = self._open()
+        fh.write("\n".join(lines) + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+    def read(self) -> Dict[str, List[dict]]:
+        """
+        {file h5: [record]} dal journal su disco. Una riga finale troncata
+        (crash durante la scrittura) viene ignorata.
+        """
+        out: Dict[str, List[dict]] = {}
+        current = None
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "f" in rec:
+                        current = rec["f"]
+                        out.setdefault(current, [])
+                    elif current is not None and "e" in rec:
+                        out[current].append(rec)
+        except OSError:
+            pass
+        return out
+
+    def reset(self) -> None:
+        """
+        Tronca il journal (dopo che i campioni sono su disco nel file HDF5).
+        """
+        self.close()
+        try:
+            with open(self.path, "w", encoding="utf-8") as fh:
+                fh.flush()
+                os.fsync(fh.fileno())
+        except OSError as e:
+            print(f"[WARNING] Impossibile troncare il journal {self.path}: {e}")
+        self._file_path = None
+        self._static = {}
+
+    def close(self) -> None:
+        if self._fh is not None:
+            try:
+                self._fh.close()
+            except Exception:
+                pass
+            self._fh = None
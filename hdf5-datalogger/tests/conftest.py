@@ -0,0 +1,7 @@
+import os
+import sys
+
+# i moduli dell'add-on stanno in rootfs/usr/lib (in /usr/lib nel container)
+LIB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rootfs", "usr", "lib")
+if LIB not in sys.path:
+    sys.path.insert(0, LIB)
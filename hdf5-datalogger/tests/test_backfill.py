@@ -0,0 +1,319 @@
+"""
+Backfill dallo storico del recorder: server HTTP locale che imita
+/api/history/period e database SQLite generato con lo schema del recorder.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytest
+
+from hdf5_datalogger import backfill
+from hdf5_datalogger.filelock import FileLock
+from hdf5_datalogger.hdf5_writer import build_hdf5_path
+from hdf5_datalogger.query import read_range
+from hdf5_datalogger.rotation import Partitioner, label_window_us
+from hdf5_datalogger.timeutils import epoch_us_to_iso_z, iso_to_epoch_us, utc_now_us
+
+TZ = "utc"
+HOUR_US = 3600 * 1_000_000
+TODAY_US = label_window_us(Partitioner("daily", TZ).current())[0]
+START_US = TODAY_US - 3 * 24 * HOUR_US
+
+ATTRS = {
+    "sensor.t": {"unit_of_measurement": "°C", "friendly_name": "T"},
+    "switch.a": {"friendly_name": "A"},
+}
+
+
+def _history():
+    """
+    Tre giorni chiusi più qualche campione nella finestra corrente:
+    sensor.t ogni 10 minuti con valori ripetuti e un unavailable al giorno,
+    switch.a che commuta ogni ora.
+    """
+    hist = {"sensor.t": [], "switch.a": []}
+    for i in range(3 * 24 * 6 + 12):
+        ts = START_US + i * 600 * 1_000_000
+        value = "unavailable" if i % 144 == 70 else str(20 + (i // 2) % 5)
+        hist["sensor.t"].append((ts, value))
+    for i in range(3 * 24 + 2):
+        hist["switch.a"].append((START_US + i * HOUR_US, "on" if i % 2 else "off"))
+    return hist
+
+
+HISTORY = _history()
+ENTITY_IDS = sorted(HISTORY)
+
+
+def _expected(entity_id, start_us=START_US, end_us=TODAY_US):
+    out = []
+    for ts, value in HISTORY[entity_id]:
+        if start_us <= ts < end_us and (not out or out[-1][1] != value):
+            out.append((ts, value))
+    return out
+
+
+def _stored(prefix, entity_id):
+    res = read_range(entity_id, START_US, TODAY_US, output_path_prefix=prefix)[entity_id]
+    out = []
+    for ts, value, state in zip(res["timestamp"], res["value"], res["state"]):
+        if state:
+            raw = state.decode("utf-8")
+        elif isinstance(value, bytes):
+            raw = value.decode("utf-8")
+        else:
+            raw = str(int(value)) if float(value).is_integer() else repr(float(value))
+        out.append((int(ts), raw))
+    return out
+
+
+def _assert_complete(prefix):
+    for entity_id in ENTITY_IDS:
+        assert _stored(prefix, entity_id) == _expected(entity_id)
+
+
+def _iso(us):
+    return epoch_us_to_iso_z(us).replace("Z", "+00:00")
+
+
+class _HistoryHandler(BaseHTTPRequestHandler):
+    calls = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.headers.get("Authorization") != "Bearer test-token":
+            self.send_response(401)
+            self.end_headers()
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        if url.path == "/api/states":
+            body = [
+                {"entity_id": eid, "state": pts[-1][1], "attributes": ATTRS[eid]}
+                for eid, pts in HISTORY.items()
+            ]
+        else:
+            _HistoryHandler.calls.append(self.path)
+            start = iso_to_epoch_us(url.path.rsplit("/", 1)[1])
+            end = iso_to_epoch_us(query["end_time"][0])
+            body = []
+            for eid in query["filter_entity_id"][0].split(","):
+                pts = [(ts, v) for ts, v in HISTORY.get(eid, []) if start <= ts <= end]
+                if not pts:
+                    continue
+                # minimal_response: attributi solo sul primo stato
+                first_ts, first_value = pts[0]
+                states = [{
+                    "entity_id": eid,
+                    "state": first_value,
+                    "attributes": ATTRS[eid],
+                    "last_changed": _iso(first_ts),
+                    "last_updated": _iso(first_ts),
+                }]
+                states += [{"state": v, "last_changed": _iso(ts)} for ts, v in pts[1:]]
+                body.append(states)
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def history_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _HistoryHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    _HistoryHandler.calls = []
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/api"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _make_recorder_db(path, skip=None):
+    """
+    Database con lo schema del recorder (states_meta, HA >= 2023.4); per
+    ogni stato c'è anche un aggiornamento dei soli attributi, da ignorare.
+    skip(ts) esclude campioni (per simulare un buco nello storico).
+    """
+    con = sqlite3.connect(path)
+    con.executescript(
+        """
+        CREATE TABLE states_meta (metadata_id INTEGER PRIMARY KEY, entity_id TEXT);
+        CREATE TABLE state_attributes (attributes_id INTEGER PRIMARY KEY, shared_attrs TEXT);
+        CREATE TABLE states (
+            state_id INTEGER PRIMARY KEY, metadata_id INTEGER, state TEXT,
+            attributes_id INTEGER, last_updated_ts FLOAT, last_changed_ts FLOAT
+        );
+        """
+    )
+    for mid, (eid, pts) in enumerate(HISTORY.items(), 1):
+        con.execute("INSERT INTO states_meta VALUES (?, ?)", (mid, eid))
+        con.execute("INSERT INTO state_attributes VALUES (?, ?)", (mid, json.dumps(ATTRS[eid])))
+        for ts, value in pts:
+            if skip is not None and skip(ts):
+                continue
+            con.execute(
+                "INSERT INTO states (metadata_id, state, attributes_id, last_updated_ts, last_changed_ts)"
+                " VALUES (?, ?, ?, ?, NULL)",
+                (mid, value, mid, ts / 1e6),
+            )
+            con.execute(
+                "INSERT INTO states (metadata_id, state, attributes_id, last_updated_ts, last_changed_ts)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (mid, value, mid, ts / 1e6 + 5, ts / 1e6),
+            )
+    con.commit()
+    con.close()
+    return path
+
+
+@pytest.fixture
+def recorder_db(tmp_path):
+    return _make_recorder_db(str(tmp_path / "home-assistant_v2.db"))
+
+
+def _run(source, prefix, state_path, start_us=START_US, **kwargs):
+    kwargs.setdefault("partition_timezone", TZ)
+    return backfill.backfill_range(source, prefix, start_us, utc_now_us(), ENTITY_IDS, state_path=state_path, **kwargs)
+
+
+def test_plan_windows_excludes_current_window():
+    windows = backfill.plan_windows(START_US, utc_now_us(), "daily", TZ)
+    assert [w[1] for w in windows] == [START_US + d * 24 * HOUR_US for d in range(3)]
+    assert windows[-1][2] == TODAY_US
+
+
+def test_api_import_creates_window_files(tmp_path, history_api):
+    prefix = str(tmp_path / "h5") + "/"
+    os.makedirs(prefix)
+    api = backfill.ApiHistory("test-token", base_url=history_api, slice_hours=5)
+
+    done = _run(api, prefix, str(tmp_path / "state.json"))
+
+    assert sorted(done) == [datetime.fromtimestamp((START_US + d * 24 * HOUR_US) / 1e6, timezone.utc).strftime("%Y-%m-%dZ") for d in range(3)]
+    assert {e["mode"] for e in done.values()} == {"created"}
+    # 24 h in fette da 5 h: 5 richieste per finestra
+    assert len(_HistoryHandler.calls) == 15
+    assert not os.path.exists(build_hdf5_path(prefix, Partitioner("daily", TZ).current()))
+    _assert_complete(prefix)
+
+
+def test_checkpoint_resume_skips_completed_windows(tmp_path, history_api):
+    prefix = str(tmp_path / "h5") + "/"
+    os.makedirs(prefix)
+    state_path = str(tmp_path / "state.json")
+    api = backfill.ApiHistory("test-token", base_url=history_api)
+
+    first = _run(api, prefix, state_path)
+    calls = len(_HistoryHandler.calls)
+    assert _run(api, prefix, state_path) == {}
+    assert len(_HistoryHandler.calls) == calls
+
+    # checkpoint perso per una finestra: solo quella viene reimportata
+    state = backfill.load_state(state_path)
+    dropped = sorted(first)[1]
+    del state[api.key][dropped]
+    backfill.save_state(state_path, state)
+    assert list(_run(api, prefix, state_path)) == [dropped]
+    _assert_complete(prefix)
+
+
+def test_forced_rerun_is_idempotent(tmp_path, recorder_db):
+    prefix = str(tmp_path / "h5") + "/"
+    os.makedirs(prefix)
+    state_path = str(tmp_path / "state.json")
+    source = backfill.RecorderDatabase(recorder_db)
+
+    _run(source, prefix, state_path)
+    _assert_complete(prefix)
+    done = _run(source, prefix, state_path, force=True)
+
+    assert {e["mode"] for e in done.values()} == {"merged"}
+    _assert_complete(prefix)
+    ts = read_range("sensor.t", START_US, TODAY_US, output_path_prefix=prefix)["sensor.t"]["timestamp"]
+    assert len(ts) == len(np.unique(ts))
+
+
+def test_later_samples_are_appended(tmp_path, recorder_db):
+    prefix = str(tmp_path / "h5") + "/"
+    os.makedirs(prefix)
+    state_path = str(tmp_path / "state.json")
+    source = backfill.RecorderDatabase(recorder_db)
+    mid = START_US + 36 * HOUR_US + 5 * 60 * 1_000_000
+
+    backfill.backfill_range(source, prefix, START_US, mid, ENTITY_IDS, partition_timezone=TZ, state_path=state_path)
+    done = _run(source, prefix, state_path, start_us=mid)
+
+    modes = {label: e["mode"] for label, e in done.items()}
+    assert sorted(modes.values()) == ["appended", "created"]
+    _assert_complete(prefix)
+
+
+def test_gap_in_existing_file_is_merged(tmp_path):
+    prefix = str(tmp_path / "h5") + "/"
+    os.makedirs(prefix)
+    hole = (START_US + 30 * HOUR_US, START_US + 40 * HOUR_US)
+    partial = _make_recorder_db(str(tmp_path / "partial.db"), skip=lambda ts: hole[0] <= ts < hole[1])
+    full = _make_recorder_db(str(tmp_path / "full.db"))
+
+    _run(backfill.RecorderDatabase(partial), prefix, None)
+    done = _run(backfill.RecorderDatabase(full), prefix, None, workers=2)
+
+    assert {e["mode"] for e in done.values()} == {"merged"}
+    _assert_complete(prefix)
+
+
+def test_columnar_layout(tmp_path, recorder_db):
+    prefix = str(tmp_path / "h5") + "/"
+    os.makedirs(prefix)
+    source = backfill.RecorderDatabase(recorder_db)
+
+    _run(source, prefix, None, start_us=START_US + 12 * HOUR_US, layout="columnar")
+    done = _run(source, prefix, None, layout="columnar")
+
+    assert done[min(done)]["mode"] == "merged"
+    _assert_complete(prefix)
+
+
+def test_locked_window_is_skipped_and_retried(tmp_path, recorder_db):
+    """
+    Un file tenuto dal logger o dal compresser non viene toccato né
+    registrato nel checkpoint: la riesecuzione lo importa.
+    """
+    prefix = str(tmp_path / "h5") + "/"
+    os.makedirs(prefix)
+    state_path = str(tmp_path / "state.json")
+    source = backfill.RecorderDatabase(recorder_db)
+    busy_label = backfill.plan_windows(START_US, utc_now_us(), "daily", TZ)[1][0]
+    busy = build_hdf5_path(prefix, busy_label)
+
+    with FileLock(busy):
+        done = _run(source, prefix, state_path)
+    assert busy_label not in done and len(done) == 2
+    assert not os.path.exists(busy)
+    assert busy_label not in backfill.load_state(state_path)[source.key]
+
+    assert list(_run(source, prefix, state_path)) == [busy_label]
+    _assert_complete(prefix)
+
+
+def test_recorder_database_requires_states_meta(tmp_path):
+    path = str(tmp_path / "old.db")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE states (state_id INTEGER PRIMARY KEY, entity_id TEXT, state TEXT)")
+    con.close()
+    with pytest.raises(ValueError):
+        backfill.RecorderDatabase(path).read(ENTITY_IDS, START_US, TODAY_US)
@@ -0,0 +1,93 @@
+"""
+Codifica per dominio: unavailable/unknown passano dalla maschera
+availability e tornano identici in lettura, per ogni codifica e anche per
+un'entità nata non disponibile.
+"""
+
+import h5py
+import numpy as np
+import pytest
+
+from hdf5_datalogger.encoding import (
+    BOOL,
+    ENUM,
+    FLOAT,
+    STRING,
+    append_values,
+    is_encoded_group,
+    read_states,
+    read_values,
+)
+from hdf5_datalogger.migrate import _raw_values
+
+CASES = [
+    ("binary_sensor", {}, ["on", "unavailable", "off", "unknown", "on"], BOOL, "u1"),
+    ("climate", {}, ["heat", "unknown", "off", "unavailable", "heat"], ENUM, "u2"),
+    ("sensor", {"unit_of_measurement": "°C"}, ["21.5", "unavailable", "22", "unknown", "-3"], FLOAT, "f8"),
+    ("sensor", {}, ["eco", "unknown", "comfort", "unavailable", "eco"], STRING, "S256"),
+]
+
+
+def _write(tmp_path, domain, attrs, batches):
+    f = h5py.File(tmp_path / "e.h5", "w")
+    grp = f.create_group(f"/{domain}/{domain}.x")
+    for raw in batches:
+        append_values(grp, domain, attrs, raw, chunk_size=4)
+    return f, grp
+
+
+@pytest.mark.parametrize("domain,attrs,raw,encoding,dtype", CASES, ids=[c[3] for c in CASES])
+def test_availability_round_trip(tmp_path, domain, attrs, raw, encoding, dtype):
+    # due batch: la tabella stati e la maschera crescono tra un append e l'altro
+    f, grp = _write(tmp_path, domain, attrs, [raw[:2], raw[2:]])
+    with f:
+        assert is_encoded_group(grp)
+        assert grp["value"].attrs["encoding"] == encoding
+        assert grp["value"].dtype == np.dtype(dtype)
+        assert list(grp["availability"][()]) == [{"unavailable": 1, "unknown": 2}.get(v, 0) for v in raw]
+
+        values, states = read_values(grp), read_states(grp)
+        assert len(values) == len(states) == len(raw)
+        expected = [repr(float(v)) if _number(v) else v for v in raw]
+        assert _raw_values(values, states) == expected
+        if encoding == FLOAT:
+            assert np.isnan(values[[1, 3]]).all()
+            assert list(states) == [b"", b"unavailable", b"", b"unknown", b""]
+        else:
+            assert list(states) == [v.encode("utf-8") for v in raw]
+        # lettura di una fetta tutta non disponibile
+        i = raw.index("unavailable")
+        assert _raw_values(read_values(grp, slice(i, i + 1)), read_states(grp, slice(i, i + 1))) == ["unavailable"]
+
+
+def _number(raw):
+    try:
+        float(raw)
+        return True
+    except ValueError:
+        return False
+
+
+def test_entity_born_unavailable(tmp_path):
+    """
+    Solo unavailable/unknown e nessun indizio dagli attributi: value nasce
+    al primo valore valido, le righe precedenti restano mascherate.
+    """
+    f, grp = _write(tmp_path, "sensor", {}, [["unavailable", "unknown"]])
+    with f:
+        assert "value" not in grp
+        assert list(read_values(grp)) == [b"unavailable", b"unknown"]
+        assert list(read_states(grp)) == [b"unavailable", b"unknown"]
+
+        append_values(grp, "sensor", {}, ["12.5", "unavailable"], chunk_size=4)
+        assert grp["value"].attrs["encoding"] == FLOAT
+        values, states = read_values(grp), read_states(grp)
+        assert np.isnan(values[[0, 1, 3]]).all() and values[2] == 12.5
+        assert list(states) == [b"unavailable", b"unknown", b"", b"unavailable"]
+
+
+def test_numeric_unit_decides_float_before_first_value(tmp_path):
+    f, grp = _write(tmp_path, "sensor", {"unit_of_measurement": "W"}, [["unknown"], ["5"]])
+    with f:
+        assert grp["value"].attrs["encoding"] == FLOAT
+        assert _raw_values(read_values(grp), read_states(grp)) == ["unknown", "5.0"]
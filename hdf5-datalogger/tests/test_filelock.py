@@ -0,0 +1,92 @@
+"""
+Lock dei file dati tra logger e compresser: il file della finestra aperta
+non viene compresso (né sostituito) finché il writer non lo chiude.
+"""
+
+import os
+
+from hdf5_datalogger.compress_scheduler import compress_job, pending_files
+from hdf5_datalogger.compression import is_compressed
+from hdf5_datalogger.filelock import FileLock, lock_path_for, try_lock
+from hdf5_datalogger.hdf5_writer import HDF5Writer, build_hdf5_path
+from hdf5_datalogger.rotation import Partitioner, label_for_us, label_window_us
+from hdf5_datalogger.storage import _remove_data_file
+from hdf5_datalogger.swmr import open_read
+from hdf5_datalogger.timeutils import utc_now_us
+
+SETTINGS = {"codec": "gzip", "level": 4, "workers": 1}
+HOUR_US = 3600 * 1_000_000
+
+
+def _writer(tmp_path):
+    return HDF5Writer(
+        str(tmp_path) + "/",
+        last_values_path=str(tmp_path / "last_values.json"),
+        wal_path="",
+        rotation="hourly",
+        partition_timezone="utc",
+    )
+
+
+def _state(value):
+    return {"entity_id": "sensor.t", "state": value, "attributes": {"unit_of_measurement": "°C"}}
+
+
+def _compressed(path):
+    with open_read(path) as f:
+        return is_compressed(f)
+
+
+def test_writer_holds_the_window_until_it_closes(tmp_path):
+    w = _writer(tmp_path)
+    label = Partitioner("hourly", "utc").current()
+    path = build_hdf5_path(str(tmp_path) + "/", label)
+    w.append([_state("20.5")])
+    assert w.file_path == path
+
+    res = compress_job(path, SETTINGS, rollups=False)
+    assert res["busy"] and not res["ok"]
+    assert not _compressed(path)
+
+    # cambio di finestra senza campioni: il flush chiude comunque il file
+    next_label = label_for_us(label_window_us(label)[1], "hourly", "utc")
+    w.partitioner.current = lambda: next_label
+    w.append([])
+    assert w._file is None
+
+    res = compress_job(path, SETTINGS, rollups=False)
+    assert res["ok"] and not res["busy"]
+    assert _compressed(path)
+    w.close()
+
+
+def test_pending_files_defers_locked_files(tmp_path):
+    w = _writer(tmp_path)
+    ts = utc_now_us() - 3 * HOUR_US
+    w.append([_state("1")], ts_now=ts)
+    w.close()
+    path = build_hdf5_path(str(tmp_path) + "/", label_for_us(ts, "hourly", "utc"))
+
+    with FileLock(path):
+        queue, deferred = pending_files(str(tmp_path) + "/")
+        assert queue == [] and deferred == 1
+    queue, deferred = pending_files(str(tmp_path) + "/")
+    assert [p for _, p in queue] == [path] and deferred == 0
+
+
+def test_lock_survives_removal_of_the_lock_file(tmp_path):
+    path = str(tmp_path / "HDF5_datalogger_2026-01-01.h5")
+    open(path, "wb").close()
+    holder = FileLock(path)
+    assert holder.acquire(blocking=False)
+    with try_lock(path) as free:
+        assert not free
+
+    # chi tiene il lock cancella file dati e .lock: un nuovo lock parte
+    # dal file .lock ricreato, non da quello scollegato
+    _remove_data_file(path)
+    assert not os.path.exists(lock_path_for(path))
+    holder.release()
+    with try_lock(path) as free:
+        assert free
+        assert os.path.exists(lock_path_for(path))
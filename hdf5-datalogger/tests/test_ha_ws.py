@@ -0,0 +1,296 @@
+"""
+Ingestione via WebSocket contro un server locale che imita l'API
+websocket di Home Assistant (auth, subscribe_events, eventi state_changed).
+"""
+
+import asyncio
+import json
+
+import pytest
+import websockets
+
+from hdf5_datalogger import ha_ws
+from hdf5_datalogger.ha_ws import HAWebSocketError, LastUpdatedFilter, stream_state_changes
+
+TOKEN = "test-token"
+
+
+def _state(entity_id, value, second, updated=None, attributes=None):
+    return {
+        "entity_id": entity_id,
+        "state": value,
+        "attributes": attributes or {},
+        "last_changed": f"2026-01-01T00:00:{second:02d}+00:00",
+        "last_updated": f"2026-01-01T00:00:{second if updated is None else updated:02d}+00:00",
+    }
+
+
+def _event(st, event_type="state_changed"):
+    return {"type": "event", "event": {"event_type": event_type, "data": {"entity_id": st["entity_id"], "new_state": st}}}
+
+
+class FakeHA:
+    """
+    Server websocket: a ogni connessione autenticata e sottoscritta invia
+    i messaggi del copione successivo; subscribe_ok=False rifiuta la
+    subscribe. Dopo l'ultimo copione la connessione resta aperta.
+    """
+
+    def __init__(self, scripts, close_after_script=True, subscribe_ok=True):
+        self.scripts = list(scripts)
+        self.close_after_script = close_after_script
+        self.subscribe_ok = subscribe_ok
+        self.auth_attempts = 0
+        self.subscriptions = []
+        self.url = ""
+        self._server = None
+
+    async def _handler(self, ws, *_):
+        await ws.send(json.dumps({"type": "auth_required", "ha_version": "2026.1.0"}))
+        auth = json.loads(await ws.recv())
+        self.auth_attempts += 1
+        if auth.get("access_token") != TOKEN:
+            await ws.send(json.dumps({"type": "auth_invalid", "message": "Invalid access token"}))
+            await ws.close()
+            return
+        await ws.send(json.dumps({"type": "auth_ok", "ha_version": "2026.1.0"}))
+        sub = json.loads(await ws.recv())
+        self.subscriptions.append(sub)
+        if not self.subscribe_ok:
+            await ws.send(json.dumps({"id": sub["id"], "type": "result", "success": False,
+                                      "error": {"code": "unauthorized"}}))
+            return
+        await ws.send(json.dumps({"id": sub["id"], "type": "result", "success": True, "result": None}))
+        script = self.scripts.pop(0) if self.scripts else []
+        for msg in script:
+            await ws.send(json.dumps(msg))
+        if self.close_after_script and self.scripts:
+            await ws.close()
+            return
+        await ws.wait_closed()
+
+    async def __aenter__(self):
+        self._server = await websockets.serve(self._handler, "127.0.0.1", 0)
+        port = self._server.sockets[0].getsockname()[1]
+        self.url = f"ws://127.0.0.1:{port}/api/websocket"
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+async def _stream_until(fake, done, token=TOKEN, snapshots=None, timeout=10.0, **handlers):
+    """
+    Esegue stream_state_changes finché done() è vero (o scade timeout).
+    snapshots: stati restituiti dai fetch successivi (l'ultimo si ripete).
+    """
+    snapshots = list(snapshots or [[]])
+    fetched = []
+    stop = asyncio.Event()
+
+    async def fetch_snapshot():
+        fetched.append(1)
+        return snapshots.pop(0) if len(snapshots) > 1 else snapshots[0]
+
+    task = asyncio.create_task(stream_state_changes(
+        token,
+        fetch_snapshot,
+        handlers.get("on_snapshot", lambda states: None),
+        handlers.get("on_state", lambda st: None),
+        stop,
+        url=fake.url,
+        max_backoff=1.0,
+    ))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not done() and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    stop.set()
+    await asyncio.wait_for(task, timeout=5.0)
+    return len(fetched)
+
+
+def test_auth_failure_raises():
+    async def main():
+        async with FakeHA([]) as fake:
+            async with websockets.connect(fake.url) as ws:
+                with pytest.raises(HAWebSocketError, match="Invalid access token"):
+                    await ha_ws._authenticate(ws, "wrong-token")
+
+    asyncio.run(main())
+
+
+def test_auth_failure_is_retried_without_snapshot():
+    async def main():
+        async with FakeHA([]) as fake:
+            fetched = await _stream_until(fake, lambda: fake.auth_attempts >= 2, token="wrong-token")
+            assert fake.auth_attempts >= 2
+            assert fetched == 0
+            assert fake.subscriptions == []
+
+    asyncio.run(main())
+
+
+def test_subscribe_failure_raises():
+    async def main():
+        async with FakeHA([], subscribe_ok=False) as fake:
+            async with websockets.connect(fake.url) as ws:
+                await ha_ws._authenticate(ws, TOKEN)
+                with pytest.raises(HAWebSocketError, match="subscribe_events"):
+                    await ha_ws._subscribe_state_changed(ws, msg_id=1)
+
+    asyncio.run(main())
+
+
+def test_subscribe_delivers_state_changed_events():
+    a1, a2, b1 = _state("sensor.a", "1", 1), _state("sensor.a", "2", 2), _state("sensor.b", "on", 1)
+    removed = _event(b1)
+    removed["event"]["data"]["new_state"] = None
+    script = [
+        _event(a1),
+        _event(b1, event_type="call_service"),
+        removed,
+        # più eventi nello stesso frame (coalescenza lato server)
+        [_event(a2), _event(b1)],
+    ]
+    received = []
+
+    async def main():
+        async with FakeHA([script], close_after_script=False) as fake:
+            await _stream_until(fake, lambda: len(received) >= 3, on_state=received.append)
+            assert fake.subscriptions == [{"id": 1, "type": "subscribe_events", "event_type": "state_changed"}]
+
+    asyncio.run(main())
+    assert received == [a1, a2, b1]
+
+
+def test_snapshot_is_fetched_after_every_reconnect():
+    first = [_state("sensor.a", "1", 1)]
+    second = [_state("sensor.a", "3", 3)]
+    snapshots, received = [], []
+
+    async def main():
+        async with FakeHA([[_event(_state("sensor.a", "2", 2))], [_event(_state("sensor.a", "4", 4))]]) as fake:
+            fetched = await _stream_until(
+                fake,
+                lambda: len(received) >= 2,
+                snapshots=[first, second],
+                on_snapshot=snapshots.append,
+                on_state=received.append,
+            )
+            assert fake.auth_attempts == 2
+            assert fetched == 2
+
+    asyncio.run(main())
+    assert snapshots == [first, second]
+    assert [st["state"] for st in received] == ["2", "4"]
+
+
+def test_out_of_order_events_are_dropped():
+    """
+    Stesso schema del logger: snapshot ed eventi passano da un unico
+    LastUpdatedFilter, quindi eventi già coperti dallo snapshot, duplicati
+    o arrivati in ritardo non vengono scritti.
+    """
+    order = LastUpdatedFilter()
+    written = []
+
+    def on_snapshot(states):
+        written.extend(("snapshot", st["entity_id"], st["state"]) for st in states if order.accept(st))
+
+    def on_state(st):
+        if order.accept(st):
+            written.append(("event", st["entity_id"], st["state"]))
+
+    script_1 = [
+        _event(_state("sensor.a", "1", 1)),   # più vecchio dello snapshot
+        _event(_state("sensor.a", "5", 5)),   # stesso last_updated dello snapshot
+        _event(_state("sensor.a", "6", 6)),
+        _event(_state("sensor.a", "6", 6, updated=7)),   # solo attributi: passa
+        _event(_state("sensor.a", "4", 4)),   # fuori ordine
+        _event(_state("sensor.b", "on", 2)),
+    ]
+    script_2 = [
+        _event(_state("sensor.a", "6", 6)),   # ripetuto dopo la riconnessione
+        _event(_state("sensor.a", "8", 8)),
+    ]
+    snapshot_1 = [_state("sensor.a", "5", 5)]
+    # dopo la riconnessione: sensor.a invariato, sensor.c nuovo
+    snapshot_2 = [_state("sensor.a", "6", 6), _state("sensor.b", "on", 2), _state("sensor.c", "x", 3)]
+
+    async def main():
+        async with FakeHA([script_1, script_2]) as fake:
+            await _stream_until(
+                fake,
+                lambda: ("event", "sensor.a", "8") in written,
+                snapshots=[snapshot_1, snapshot_2],
+                on_snapshot=on_snapshot,
+                on_state=on_state,
+            )
+
+    asyncio.run(main())
+    assert written == [
+        ("snapshot", "sensor.a", "5"),
+        ("event", "sensor.a", "6"),
+        ("event", "sensor.a", "6"),
+        ("event", "sensor.b", "on"),
+        ("snapshot", "sensor.c", "x"),
+        ("event", "sensor.a", "8"),
+    ]
+
+
+def test_attribute_only_updates_pass_the_filter():
+    """
+    Un cambio di soli attributi (setpoint, luminosità) ha lo stesso
+    last_changed e un last_updated più recente: non è un duplicato.
+    """
+    order = LastUpdatedFilter()
+    received = []
+
+    def on_state(st):
+        if order.accept(st):
+            received.append(st["attributes"]["temperature"])
+
+    script = [
+        _event(_state("climate.zone", "heat", 1, attributes={"temperature": 20})),
+        _event(_state("climate.zone", "heat", 1, updated=2, attributes={"temperature": 21})),
+        _event(_state("climate.zone", "heat", 1, updated=2, attributes={"temperature": 21})),   # ripetuto
+        _event(_state("climate.zone", "heat", 1, updated=3, attributes={"temperature": 22})),
+    ]
+
+    async def main():
+        async with FakeHA([script], close_after_script=False) as fake:
+            await _stream_until(fake, lambda: len(received) >= 3, on_state=on_state)
+
+    asyncio.run(main())
+    assert received == [20, 21, 22]
+
+
+def test_snapshot_write_is_awaited_and_errors_reconnect():
+    calls, received = [], []
+
+    async def on_snapshot(states):
+        await asyncio.sleep(0.1)
+        calls.append(len(received))
+        if len(calls) == 1:
+            raise OSError("disco pieno")
+
+    script = [_event(_state("sensor.a", "1", 1))]
+
+    async def main():
+        async with FakeHA([script, script], close_after_script=False) as fake:
+            fetched = await _stream_until(fake, lambda: received, on_snapshot=on_snapshot, on_state=received.append)
+            assert fetched == 2
+
+    asyncio.run(main())
+    # nessun evento consegnato prima che la scrittura dello snapshot finisca
+    assert calls == [0, 0]
+    assert len(received) == 1
+
+
+def test_last_updated_filter_passes_states_without_timestamp():
+    order = LastUpdatedFilter()
+    st = {"entity_id": "sensor.a", "state": "1"}
+    assert order.accept(st)
+    assert order.accept(dict(st, state="2"))
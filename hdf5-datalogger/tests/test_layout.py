@@ -0,0 +1,125 @@
+"""
+Layout colonnare: tabella ordinata anche con campioni in ritardo tra un
+flush e l'altro, e conversione per_entity -> columnar -> per_entity senza
+perdite di valori, stati e attributi statici.
+"""
+
+import h5py
+import numpy as np
+import pytest
+
+from hdf5_datalogger.hdf5_writer import HDF5Writer, build_hdf5_path
+from hdf5_datalogger.layout import COLUMNAR, columnar_append, file_layout, read_columnar_entity
+from hdf5_datalogger.migrate import _raw_values, convert_file, iter_entities
+from hdf5_datalogger.timestamps import read_timestamps_us
+
+SECOND_US = 1_000_000
+BASE_US = 1_767_225_600 * SECOND_US  # 2026-01-01T00:00Z
+
+
+def _append(f, rows, fmt="epoch_us"):
+    """
+    rows: [(entity_id, raw, secondi da BASE_US)] -> un flush colonnare.
+    """
+    by_entity = {}
+    for entity_id, raw, sec in rows:
+        _, values, timestamps = by_entity.setdefault(entity_id, ({}, [], []))
+        values.append(raw)
+        timestamps.append(BASE_US + sec * SECOND_US)
+    entries = [(eid, attrs, values, ts) for eid, (attrs, values, ts) in by_entity.items()]
+    columnar_append(f, "sensor", entries, 64, fmt)
+
+
+@pytest.mark.parametrize("fmt", ["epoch_us", "iso"])
+def test_late_rows_keep_the_table_sorted(tmp_path, fmt):
+    with h5py.File(tmp_path / "c.h5", "w") as f:
+        _append(f, [("sensor.a", "1", 10), ("sensor.a", "2", 20), ("sensor.a", "3", 30)], fmt)
+        _append(f, [("sensor.b", "x", 25), ("sensor.b", "4", 35)], fmt)
+        # flush successivo con campioni precedenti alle righe già scritte
+        _append(f, [("sensor.a", "5", 40), ("sensor.b", "6", 15), ("sensor.c", "7", 20)], fmt)
+        grp = f["sensor"]
+        ts = read_timestamps_us(grp["timestamp"])
+        assert (np.diff(ts) >= 0).all()
+        assert len(ts) == 8
+
+        b = read_columnar_entity(grp, "sensor.b", BASE_US + 12 * SECOND_US, BASE_US + 30 * SECOND_US)
+        assert [int(t) for t in b[0]] == [BASE_US + 15 * SECOND_US, BASE_US + 25 * SECOND_US]
+        assert _raw_values(b[1], b[2]) == ["6.0", "x"]
+        # a parità di timestamp la riga già scritta resta prima
+        at_20 = read_columnar_entity(grp, "sensor.c", BASE_US + 20 * SECOND_US, BASE_US + 21 * SECOND_US)
+        assert _raw_values(at_20[1], at_20[2]) == ["7.0"]
+        assert [r[0] for r in _rows(grp) if r[1] == BASE_US + 20 * SECOND_US] == [0, 2]
+
+
+def _rows(grp):
+    return list(zip(grp["entity_index"][()], read_timestamps_us(grp["timestamp"])))
+
+
+def test_late_rows_in_a_large_table(tmp_path):
+    # oltre la soglia di lettura completa: inserimento con ricerca binaria
+    with h5py.File(tmp_path / "c.h5", "w") as f:
+        _append(f, [("sensor.a", str(i), i) for i in range(0, 10_000, 2)])
+        _append(f, [("sensor.b", "1", 9_001), ("sensor.b", "2", 20_000)])
+        grp = f["sensor"]
+        ts = read_timestamps_us(grp["timestamp"])
+        assert (np.diff(ts) >= 0).all()
+        b = read_columnar_entity(grp, "sensor.b", BASE_US + 9_000 * SECOND_US, BASE_US + 9_002 * SECOND_US)
+        assert [int(t) for t in b[0]] == [BASE_US + 9_001 * SECOND_US]
+        a = read_columnar_entity(grp, "sensor.a", BASE_US + 9_000 * SECOND_US, BASE_US + 9_004 * SECOND_US)
+        assert _raw_values(a[1], a[2]) == ["9000.0", "9002.0"]
+
+
+STATES = {
+    "sensor.power": ({"unit_of_measurement": "W", "friendly_name": "Power"}, ["120.5", "unavailable", "130", "unknown", "99"]),
+    "binary_sensor.door": ({"device_class": "door"}, ["on", "off", "unavailable", "on", "off"]),
+    "climate.zone": ({"friendly_name": "Zone"}, ["heat", "off", "heat", "unknown", "cool"]),
+    "sensor.mode": ({"friendly_name": "Mode"}, ["eco", "comfort", "unavailable", "eco", "boost"]),
+}
+
+
+def _snapshot(path):
+    with h5py.File(path, "r") as f:
+        return {
+            entity_id: (attrs, ts.tolist(), _raw_values(values, states), values, states)
+            for entity_id, _, attrs, ts, values, states in iter_entities(f)
+        }
+
+
+def test_convert_round_trip(tmp_path):
+    prefix = str(tmp_path) + "/"
+    w = HDF5Writer(
+        prefix,
+        last_values_path=str(tmp_path / "last_values.json"),
+        wal_path="",
+        timestamp_format="epoch_us",
+        partition_timezone="utc",
+    )
+    for i in range(5):
+        w.append(
+            [{"entity_id": eid, "state": values[i], "attributes": attrs} for eid, (attrs, values) in STATES.items()],
+            ts_now=BASE_US + i * SECOND_US,
+        )
+    w.close()
+    src = build_hdf5_path(prefix, "2026-01-01Z")
+
+    columnar = str(tmp_path / "columnar.h5")
+    back = str(tmp_path / "per_entity.h5")
+    assert convert_file(src, columnar, "columnar") == len(STATES)
+    assert convert_file(columnar, back, "per_entity") == len(STATES)
+    with h5py.File(columnar, "r") as f:
+        assert file_layout(f) == COLUMNAR
+
+    original, col, final = _snapshot(src), _snapshot(columnar), _snapshot(back)
+    assert sorted(original) == sorted(col) == sorted(final) == sorted(STATES)
+    for entity_id, (attrs, ts, raw, values, states) in original.items():
+        assert ts == [BASE_US + i * SECOND_US for i in range(5)]
+        for other in (col, final):
+            assert other[entity_id][1] == ts
+            assert other[entity_id][2] == raw
+            for key in ("unit_of_measurement", "device_class", "friendly_name"):
+                assert other[entity_id][0].get(key) == attrs.get(key)
+        # ritorno al layout per entità: stessi array di valori e stati
+        np.testing.assert_array_equal(final[entity_id][3], values)
+        np.testing.assert_array_equal(final[entity_id][4], states)
+    assert original["sensor.power"][2] == ["120.5", "unavailable", "130.0", "unknown", "99.0"]
+    assert original["binary_sensor.door"][2][2] == "unavailable"
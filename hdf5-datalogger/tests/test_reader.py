@@ -0,0 +1,133 @@
+"""
+HistoryReader: serie unica dai file chiusi (anche compressi e sostituiti)
+e dal file corrente ancora aperto in SWMR dal logger, con la LRU di handle
+e blocchi.
+"""
+
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from hdf5_datalogger.compress_scheduler import compress_job
+from hdf5_datalogger.hdf5_writer import HDF5Writer, _EntityBuffer, _write_partition, build_hdf5_path
+from hdf5_datalogger.query import read_range
+from hdf5_datalogger.reader import HistoryReader
+from hdf5_datalogger.rotation import Partitioner, label_for_us, label_window_us
+from hdf5_datalogger.timeutils import utc_now_us
+
+HOUR_US = 3600 * 1_000_000
+MINUTE_US = 60 * 1_000_000
+DAY_US = 24 * HOUR_US
+
+
+def _state(value):
+    return {"entity_id": "sensor.p", "state": value, "attributes": {"unit_of_measurement": "W"}}
+
+
+@pytest.fixture
+def history(tmp_path):
+    """
+    Due giorni chiusi (il primo compresso) più il giorno corrente aperto in
+    SWMR dal writer; ritorna (prefix, writer, [(ts, valore)]).
+    """
+    prefix = str(tmp_path) + "/"
+    w = HDF5Writer(
+        prefix,
+        last_values_path=str(tmp_path / "last_values.json"),
+        wal_path="",
+        timestamp_format="epoch_us",
+        partition_timezone="utc",
+        swmr=True,
+    )
+    today = label_window_us(Partitioner("daily", "utc").current())[0]
+    live_start = max(today, utc_now_us() - 30 * MINUTE_US)
+    samples = [(today - 2 * DAY_US + i * HOUR_US, str(i)) for i in range(0, 48, 6)]
+    samples += [(live_start + i * MINUTE_US, str(100 + i)) for i in range(3)]
+    for ts, value in samples:
+        w.append([_state(value)], ts_now=ts)
+    closed = build_hdf5_path(prefix, label_for_us(today - 2 * DAY_US, "daily", "utc"))
+    assert compress_job(closed, {"codec": "gzip", "level": 4, "workers": 1}, rollups=False)["ok"]
+    yield prefix, w, samples
+    w.close()
+
+
+def _pairs(res):
+    return [(int(t), float(v)) for t, v in zip(res["timestamp"], res["value"])]
+
+
+def test_merges_closed_and_live_files(history):
+    prefix, w, samples = history
+    start, end = samples[0][0], utc_now_us() + MINUTE_US
+    expected = [(ts, float(v)) for ts, v in samples]
+    with HistoryReader(prefix) as reader:
+        res = reader.read("sensor.p", start, end)["sensor.p"]
+        assert _pairs(res) == expected
+        assert _pairs(read_range("sensor.p", start, end, output_path_prefix=prefix)["sensor.p"]) == expected
+
+        # stessa query: handle e blocchi dalla cache
+        opens, reads = reader.stats["handle_opens"], reader.stats["block_reads"]
+        assert _pairs(reader.read("sensor.p", start, end)["sensor.p"]) == expected
+        assert reader.stats["handle_opens"] == opens
+        assert reader.stats["block_reads"] == reads
+        assert reader.stats["block_hits"] > 0
+
+        # il logger accoda al file corrente: solo le righe nuove vengono lette
+        ts_new = samples[-1][0] + MINUTE_US
+        w.append([_state("200")], ts_now=ts_new)
+        res = reader.read("sensor.p", start, end)["sensor.p"]
+        assert _pairs(res) == expected + [(ts_new, 200.0)]
+        assert reader.stats["handle_opens"] == opens
+
+
+def test_replaced_file_is_reopened(history, tmp_path):
+    prefix, _, samples = history
+    day = samples[0][0]
+    path = build_hdf5_path(prefix, label_for_us(day, "daily", "utc"))
+    with HistoryReader(prefix) as reader:
+        before = _pairs(reader.read("sensor.p", day, day + DAY_US)["sensor.p"])
+        # file sostituito (nuovo inode, os.replace come la compressione) con
+        # un campione in più
+        tmp = str(tmp_path / "replacement.h5")
+        shutil.copyfile(path, tmp)
+        buf = _EntityBuffer("sensor", {"unit_of_measurement": "W"})
+        buf.values, buf.timestamps = ["7"], [day + 23 * HOUR_US]
+        _write_partition(tmp, {"sensor.p": buf}, 64, "epoch_us", "per_entity")
+        os.replace(tmp, path)
+        opens = reader.stats["handle_opens"]
+        after = _pairs(reader.read("sensor.p", day, day + DAY_US)["sensor.p"])
+        assert after == before + [(day + 23 * HOUR_US, 7.0)]
+        assert reader.stats["handle_opens"] == opens + 1
+
+
+def test_duplicates_across_overlapping_files_are_dropped(tmp_path):
+    """
+    Un giorno archiviato ma non ancora cancellato: lo stesso campione in
+    due file compare una volta sola.
+    """
+    prefix = str(tmp_path) + "/"
+    day = label_window_us("2026-01-05Z")[0]
+    for label in ("2026-01-05Z", "2026-01-05T10Z"):
+        buf = _EntityBuffer("sensor", {"unit_of_measurement": "W"})
+        buf.values, buf.timestamps = ["1", "2"], [day + 10 * HOUR_US, day + 10 * HOUR_US + MINUTE_US]
+        _write_partition(build_hdf5_path(prefix, label), {"sensor.p": buf}, 64, "epoch_us", "per_entity")
+    with HistoryReader(prefix) as reader:
+        res = reader.read("sensor.p", day, day + DAY_US)["sensor.p"]
+    assert _pairs(res) == [(day + 10 * HOUR_US, 1.0), (day + 10 * HOUR_US + MINUTE_US, 2.0)]
+
+
+def test_lru_limits(history):
+    prefix, _, samples = history
+    start, end = samples[0][0], utc_now_us() + MINUTE_US
+    with HistoryReader(prefix) as reader:
+        full = reader.read("sensor.p", start, end)["sensor.p"]
+        total = reader.cached_bytes
+    # metà dei blocchi della query: i più vecchi escono dalla cache
+    with HistoryReader(prefix, max_handles=1, cache_mb=total / 2 / 1024 / 1024) as reader:
+        res = reader.read("sensor.p", start, end)["sensor.p"]
+        assert _pairs(res) == _pairs(full)
+        assert len(reader._handles) == 1
+        assert reader.cached_bytes <= reader.cache_bytes
+        assert reader.stats["evictions"] > 0
+        assert np.all(np.diff(res["timestamp"]) > 0)
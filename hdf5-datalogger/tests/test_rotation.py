@@ -0,0 +1,162 @@
+"""
+Finestre dei file: etichette e confini attorno ai cambi d'ora (ora locale
+Europe/Rome) e a cavallo di ore, giorni e settimane ISO; instradamento e
+divisione dei buffer del writer al cambio di finestra.
+"""
+
+import time
+from datetime import datetime, timezone
+
+import h5py
+import pytest
+
+from hdf5_datalogger.hdf5_writer import HDF5Writer, build_hdf5_path
+from hdf5_datalogger.query import read_range
+from hdf5_datalogger.rotation import (
+    WINDOW_END_ATTR,
+    WINDOW_START_ATTR,
+    Partitioner,
+    label_for_us,
+    label_window_us,
+)
+
+HOUR_US = 3600 * 1_000_000
+MINUTE_US = 60 * 1_000_000
+
+
+def _us(*args):
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp()) * 1_000_000
+
+
+@pytest.fixture
+def rome(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Rome")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def _walk(rotation, tz, start_us, end_us, step_us=15 * MINUTE_US):
+    """
+    Etichette in ordine di ts da start_us a end_us, verificando che ogni
+    ts cada nella finestra della sua etichetta e che finestre successive
+    siano contigue.
+    """
+    labels = []
+    prev_end = None
+    for ts in range(start_us, end_us, step_us):
+        label = label_for_us(ts, rotation, tz)
+        w_start, w_end = label_window_us(label)
+        assert w_start <= ts < w_end, label
+        if not labels or labels[-1] != label:
+            if prev_end is not None:
+                assert w_start == prev_end, label
+            labels.append(label)
+            prev_end = w_end
+    return labels
+
+
+def test_local_days_across_dst_changes(rome):
+    # 2026-03-29: 23 ore; 2026-10-25: 25 ore
+    spring = label_window_us("2026-03-29")
+    autumn = label_window_us("2026-10-25")
+    assert spring[1] - spring[0] == 23 * HOUR_US
+    assert autumn[1] - autumn[0] == 25 * HOUR_US
+    assert _walk("daily", "local", _us(2026, 3, 27), _us(2026, 3, 30, 22)) == [
+        "2026-03-27", "2026-03-28", "2026-03-29", "2026-03-30",
+    ]
+    # mezzanotte locale = 22:00 UTC (ora legale)
+    assert label_for_us(_us(2026, 10, 24, 21, 59), "daily", "local") == "2026-10-24"
+    assert label_for_us(_us(2026, 10, 24, 22, 0), "daily", "local") == "2026-10-25"
+
+
+def test_local_hours_across_dst_changes(rome):
+    spring = _walk("hourly", "local", _us(2026, 3, 28, 23), _us(2026, 3, 29, 3))
+    # 02:00 locale non esiste: dopo T01 viene T03
+    assert spring == ["2026-03-29T00", "2026-03-29T01", "2026-03-29T03", "2026-03-29T04"]
+
+    autumn = _walk("hourly", "local", _us(2026, 10, 24, 23), _us(2026, 10, 25, 3))
+    # 02:00-03:00 locale avviene due volte: un solo file di due ore
+    assert autumn == ["2026-10-25T01", "2026-10-25T02", "2026-10-25T03"]
+    start, end = label_window_us("2026-10-25T02")
+    assert (start, end) == (_us(2026, 10, 25, 0), _us(2026, 10, 25, 2))
+
+
+def test_utc_windows_ignore_dst(rome):
+    labels = _walk("hourly", "utc", _us(2026, 10, 24, 23), _us(2026, 10, 25, 3))
+    assert labels == ["2026-10-24T23Z", "2026-10-25T00Z", "2026-10-25T01Z", "2026-10-25T02Z"]
+    assert _walk("daily", "utc", _us(2026, 10, 24), _us(2026, 10, 26)) == ["2026-10-24Z", "2026-10-25Z"]
+
+
+def test_iso_weeks_across_year_end():
+    # 2026 ha 53 settimane ISO: 2027-01-03 (domenica) è ancora 2026-W53
+    labels = _walk("weekly", "utc", _us(2026, 12, 21), _us(2027, 1, 12), step_us=6 * HOUR_US)
+    assert labels == ["2026-W52Z", "2026-W53Z", "2027-W01Z", "2027-W02Z"]
+    assert label_window_us("2027-W01Z")[0] == _us(2027, 1, 4)
+
+
+def test_partitioner_cache_at_window_edges():
+    p = Partitioner("hourly", "utc")
+    edge = _us(2026, 1, 1, 10)
+    assert p.label_for(edge - 1) == "2026-01-01T09Z"
+    assert p.label_for(edge) == "2026-01-01T10Z"
+    # la finestra in cache non copre ts precedenti
+    assert p.label_for(edge - 1) == "2026-01-01T09Z"
+    assert p.window_start(edge + HOUR_US - 1) == edge
+
+
+def test_writer_splits_buffers_at_the_window_boundary(tmp_path):
+    prefix = str(tmp_path) + "/"
+    w = HDF5Writer(
+        prefix,
+        last_values_path=str(tmp_path / "last_values.json"),
+        wal_path="",
+        buffer_max_samples=100,
+        timestamp_format="epoch_us",
+        rotation="hourly",
+        partition_timezone="utc",
+    )
+    edge = _us(2026, 1, 1, 10)
+    samples = [(edge - 2 * MINUTE_US, "1"), (edge - 1, "2"), (edge, "3"), (edge + MINUTE_US, "4")]
+    for ts, value in samples:
+        w.append([{"entity_id": "sensor.t", "state": value, "attributes": {"unit_of_measurement": "W"}}], ts_now=ts)
+    assert w.buffered_points == 4
+    w.close()
+
+    for label, expected in (("2026-01-01T09Z", samples[:2]), ("2026-01-01T10Z", samples[2:])):
+        path = build_hdf5_path(prefix, label)
+        with h5py.File(path, "r") as f:
+            assert (f.attrs[WINDOW_START_ATTR], f.attrs[WINDOW_END_ATTR]) == label_window_us(label)
+        res = read_range("sensor.t", *label_window_us(label), output_path_prefix=prefix)["sensor.t"]
+        assert [int(t) for t in res["timestamp"]] == [ts for ts, _ in expected]
+        assert [float(v) for v in res["value"]] == [float(v) for _, v in expected]
+
+
+def test_stale_last_changed_is_clamped_to_arrival(tmp_path):
+    """
+    Un last_changed precedente alla finestra dell'arrivo non riapre il file
+    chiuso: il campione prende l'ora di arrivo.
+    """
+    prefix = str(tmp_path) + "/"
+    w = HDF5Writer(
+        prefix,
+        last_values_path=str(tmp_path / "last_values.json"),
+        wal_path="",
+        timestamp_format="epoch_us",
+        rotation="hourly",
+        partition_timezone="utc",
+    )
+    arrival = _us(2026, 1, 1, 10, 5)
+    stale = {
+        "entity_id": "sensor.t",
+        "state": "7",
+        "attributes": {"unit_of_measurement": "W"},
+        "last_changed": "2026-01-01T09:30:00+00:00",
+    }
+    w.append([stale], timestamp_key="last_changed", ts_now=arrival)
+    w.close()
+
+    res = read_range("sensor.t", arrival - HOUR_US, arrival + 1, output_path_prefix=prefix)["sensor.t"]
+    assert [int(t) for t in res["timestamp"]] == [arrival]
+    assert not (tmp_path / "HDF5_datalogger_2026-01-01T09Z.h5").exists()
@@ -0,0 +1,82 @@
+"""
+Piano di selezione con fetch_mode=auto: l'alternanza tra dump completo e
+include-list non ricostruisce il piano; un rendering rifiutato dalla
+template API dice quale attributo lo ha causato.
+"""
+
+import requests
+
+from hdf5_datalogger.ha_client import StateFetcher
+from hdf5_datalogger.selection import SelectionPlan
+
+
+def _st(entity_id, uom="W"):
+    attrs = {"unit_of_measurement": uom} if uom else {}
+    return {"entity_id": entity_id, "state": "1", "attributes": attrs}
+
+
+FULL = [_st("sensor.a"), _st("sensor.b"), _st("light.x", None), _st("switch.y", None), _st("person.z", None)]
+
+
+def _ids(states):
+    return sorted(st["entity_id"] for st in states)
+
+
+def test_include_and_full_fetches_share_the_plan(capsys):
+    plan = SelectionPlan(include_domains_raw=["sensor"], include_entities=["switch.y"])
+    scope = (frozenset({"sensor"}), frozenset({"switch.y"}))
+    include = [st for st in FULL if st["entity_id"] not in ("light.x", "person.z")]
+
+    _, flat = plan.apply(FULL)
+    assert _ids(flat) == ["sensor.a", "sensor.b", "switch.y"]
+    for _ in range(3):
+        assert _ids(plan.apply(include, scope)[1]) == _ids(flat)
+        assert _ids(plan.apply(FULL)[1]) == _ids(flat)
+    assert plan.rebuilds == 1
+    assert capsys.readouterr().out.count("Piano di selezione compilato") == 1
+
+    # entità nuova o sparita nello scope: ricostruzione che conserva il resto
+    _, flat = plan.apply(include + [_st("sensor.c")], scope)
+    assert _ids(flat) == ["sensor.a", "sensor.b", "sensor.c", "switch.y"]
+    assert plan.apply(FULL + [_st("sensor.c")])[1] == flat
+    assert plan.rebuilds == 2
+    plan.apply(include[1:], scope)
+    assert plan.rebuilds == 3
+
+
+def _response(status, text):
+    r = requests.Response()
+    r.status_code = status
+    r._content = text.encode("utf-8")
+    r.url = "http://supervisor/core/api/template"
+    return r
+
+
+class _Session:
+    """
+    La prima template (stati) fallisce come con un datetime negli attributi,
+    la seconda (ricerca degli attributi) risponde; GET /api/states riuscito.
+    """
+
+    def __init__(self):
+        self.templates = []
+
+    def post(self, url, json=None, timeout=None):
+        self.templates.append(json["template"])
+        if len(self.templates) == 1:
+            return _response(400, "Error rendering template: TypeError: Type is not JSON serializable: datetime")
+        return _response(200, "sensor.a.last_reset;calendar.c.start_time;")
+
+    def get(self, url, timeout=None):
+        return _response(200, '[{"entity_id": "sensor.a", "state": "1", "attributes": {}}]')
+
+
+def test_render_error_names_the_attribute(capsys):
+    fetcher = StateFetcher(_Session(), mode="include", include_domains=["sensor", "calendar"])
+    states = fetcher.fetch()
+    assert [st["entity_id"] for st in states] == ["sensor.a"]
+    assert fetcher.scope is None
+    out = capsys.readouterr().out
+    assert "attributi non serializzabili in JSON: sensor.a.last_reset, calendar.c.start_time" in out
+    assert "not JSON serializable: datetime" in out
+    assert "fino al ricaricamento delle opzioni" in out
@@ -0,0 +1,115 @@
+"""
+Journal write-ahead e SWMR: un processo logger terminato senza chiudere
+nulla (os._exit) non perde né duplica campioni, e il file rimasto
+"aperto in scrittura" torna apribile.
+"""
+
+import os
+import subprocess
+import sys
+import textwrap
+
+import h5py
+import pytest
+
+from hdf5_datalogger.hdf5_writer import HDF5Writer, build_hdf5_path
+from hdf5_datalogger.query import read_range
+from hdf5_datalogger.rotation import Partitioner
+from hdf5_datalogger.swmr import clear_status_flags, open_write
+from hdf5_datalogger.timeutils import utc_now_us
+
+N = 10
+SECOND_US = 1_000_000
+
+
+def _crash_writer(tmp_path, base_us, buffer_max_samples, swmr):
+    """
+    Logger in un processo separato: accoda N campioni e termina con
+    os._exit, senza flush finale né chiusura di file e journal.
+    """
+    code = textwrap.dedent(
+        f"""
+        import os
+        from hdf5_datalogger.hdf5_writer import HDF5Writer
+        w = HDF5Writer(
+            {str(tmp_path) + "/"!r},
+            last_values_path={str(tmp_path / "last_values.json")!r},
+            wal_path={str(tmp_path / "wal.jsonl")!r},
+            buffer_max_samples={buffer_max_samples},
+            timestamp_format="epoch_us",
+            partition_timezone="utc",
+            swmr={swmr},
+        )
+        for i in range({N}):
+            w.append(
+                [{{"entity_id": "sensor.t", "state": str(20 + i), "attributes": {{"unit_of_measurement": "°C"}}}}],
+                ts_now={base_us} + i * {SECOND_US},
+            )
+        os._exit(0)
+        """
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+
+
+def _reopen(tmp_path):
+    return HDF5Writer(
+        str(tmp_path) + "/",
+        last_values_path=str(tmp_path / "last_values.json"),
+        wal_path=str(tmp_path / "wal.jsonl"),
+        timestamp_format="epoch_us",
+        partition_timezone="utc",
+    )
+
+
+def _values(tmp_path, base_us):
+    res = read_range("sensor.t", base_us, base_us + N * SECOND_US, output_path_prefix=str(tmp_path) + "/")
+    return [float(v) for v in res["sensor.t"]["value"]], [int(t) for t in res["sensor.t"]["timestamp"]]
+
+
+@pytest.mark.parametrize(
+    "buffer_max_samples,swmr",
+    [(1000, False), (4, True)],
+    ids=["all-buffered", "partly-flushed-swmr"],
+)
+def test_wal_replay_after_crash(tmp_path, buffer_max_samples, swmr):
+    # finestra del giorno UTC già iniziata: tutti i campioni nello stesso file
+    base_us = max(utc_now_us() - 60 * SECOND_US, Partitioner("daily", "utc").window_start(utc_now_us()))
+    _crash_writer(tmp_path, base_us, buffer_max_samples, swmr)
+    assert os.path.getsize(tmp_path / "wal.jsonl") > 0
+
+    w = _reopen(tmp_path)
+    assert os.path.getsize(tmp_path / "wal.jsonl") == 0
+    assert w.last_values["sensor.t"] == str(20 + N - 1)
+    w.close()
+
+    values, timestamps = _values(tmp_path, base_us)
+    assert values == [20.0 + i for i in range(N)]
+    assert timestamps == [base_us + i * SECOND_US for i in range(N)]
+
+    # una seconda riapertura non riapplica nulla
+    _reopen(tmp_path).close()
+    assert _values(tmp_path, base_us)[0] == values
+
+
+def test_open_write_clears_flags_left_by_a_crashed_writer(tmp_path):
+    path = build_hdf5_path(str(tmp_path) + "/", "2026-01-01")
+    code = textwrap.dedent(
+        f"""
+        import os
+        import h5py
+        f = h5py.File({path!r}, "a", libver="latest")
+        f.create_dataset("x", data=[1, 2, 3], maxshape=(None,))
+        f.swmr_mode = True
+        f.flush()
+        os._exit(0)
+        """
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
+    with pytest.raises(OSError):
+        h5py.File(path, "a", libver="latest")
+
+    with open_write(path) as f:
+        assert list(f["x"][()]) == [1, 2, 3]
+    # flag già azzerati: nessuna modifica
+    assert not clear_status_flags(path)